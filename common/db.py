@@ -1,11 +1,20 @@
+import contextlib
+import cPickle
 from datetime import datetime
 import functools
+import heapq
+import itertools
+import logging
+import operator
 import re
 import sqlalchemy as sa
 import sqlalchemy.engine as sa_engine
 import sqlalchemy.ext.declarative as sa_ext_declarative
 import sqlalchemy.orm as sa_orm
+import sqlalchemy.sql.expression as sa_expression
 import sys
+import threading
+import time
 
 
 def close_session(f):
@@ -17,6 +26,19 @@ def close_session(f):
 		return result
 	return decorated_function
 
+def query_budget(max_statements):
+	"""A decorator that declares the most statements that a call of the function
+	executes, regardless of the count of rows that it reads or writes, and of the
+	calendar backend and whether CalendarEntries are queued.
+
+	The budget does not change the function, but is asserted by the tests that
+	call it through DbTestCase._call_within_budget.
+	"""
+	def decorator(f):
+		f.max_statements = max_statements
+		return f
+	return decorator
+
 """Exception class raised by the database.
 """
 class DbException(Exception):
@@ -33,6 +55,103 @@ class DbException(Exception):
 		raise DbException(exception_value), None, traceback
 
 
+def _create_record_init(cls, fields, defaults):
+	"""Returns a constructor that sets each of the given fields of the record class
+	in order, where the dict of defaults maps the name of a trailing field to its
+	default value.
+	"""
+	params = ['self']
+	lines = []
+	namespace = {'_defaults': defaults}
+	for i, name in enumerate(fields):
+		if name in defaults:
+			params.append('%s=_defaults[%r]' % (name, name))
+		else:
+			params.append(name)
+		# Set each field through its slot, because __setattr__ raises.
+		slot = next(base.__dict__[name] for base in cls.__mro__ if name in base.__dict__)
+		namespace['_set_%s' % i] = slot.__set__
+		lines.append('\t_set_%s(self, %s)' % (i, name))
+	source = 'def __init__(%s):\n%s\n' % (', '.join(params), '\n'.join(lines) or '\tpass')
+	exec source in namespace
+	return namespace['__init__']
+
+"""The metaclass of DisplayedRecord, which finds the fields of each record class
+and generates its constructor.
+"""
+class _DisplayedRecordType(type):
+	def __init__(cls, name, bases, namespace):
+		type.__init__(cls, name, bases, namespace)
+		fields = ()
+		for base in reversed(cls.__mro__):
+			fields += base.__dict__.get('__slots__', ())
+		cls._fields = fields
+		if len(fields) > 1:
+			cls._get_values = staticmethod(operator.attrgetter(*fields))
+		else:
+			# An attrgetter for fewer names does not return a tuple.
+			cls._get_values = staticmethod(
+					lambda record: tuple(getattr(record, name) for name in fields))
+		cls.__init__ = _create_record_init(cls, fields, namespace.get('_defaults', {}))
+
+"""The base class for an immutable record of values displayed by a view.
+
+A subclass names its attributes in __slots__, and a subclass of another record
+names only its additional attributes, which follow those of the base. The
+constructor takes the values of the attributes in that order, and is generated
+so that it sets each attribute directly. A subclass can map the names of its
+trailing attributes to default values in _defaults.
+"""
+class DisplayedRecord(object):
+	__metaclass__ = _DisplayedRecordType
+	__slots__ = ()
+
+	@classmethod
+	def get_fields(cls):
+		"""Returns the names of the fields of this record, in order."""
+		return cls._fields
+
+	def get_values(self):
+		"""Returns the values of the fields of this record, in order."""
+		return self._get_values(self)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('%s is immutable' % type(self).__name__)
+
+	def __delattr__(self, name):
+		raise AttributeError('%s is immutable' % type(self).__name__)
+
+	def __eq__(self, other):
+		return (type(self) is type(other)) and (self.get_values() == other.get_values())
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return hash(self.get_values())
+
+	def __reduce__(self):
+		return (type(self), self.get_values())
+
+	def __repr__(self):
+		return '%s(%s)' % (type(self).__name__, ', '.join(
+				'%s=%r' % (name, value)
+				for name, value in itertools.izip(self.get_fields(), self.get_values())))
+
+
+def dumps_records(value):
+	"""Returns a compact string for the value, which can contain DisplayedRecord
+	objects.
+
+	Each record is written as its class and a tuple of its values.
+	"""
+	return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def loads_records(data):
+	"""Returns the value from a string returned by dumps_records."""
+	return cPickle.loads(data)
+
+
 _Base = sa_ext_declarative.declarative_base()
 
 """A user of the site.
@@ -84,6 +203,36 @@ class TwitchUser(_Base):
 				self.name)
 
 
+"""A change to an entity, which invalidates every cached copy of the entity.
+
+Each change is added in the transaction of the mutation, and a ChangeBus in each
+process reads the changes in the order of their versions. If entity_id is None,
+then the change is to the list of all entities of the type.
+"""
+class Change(_Base):
+	__tablename__ = 'Changes'
+	# Do not reuse the versions of pruned changes on SQLite.
+	__table_args__ = {'sqlite_autoincrement': True}
+
+	version = sa.Column(sa.Integer, primary_key=True)
+	entity_type = sa.Column(sa.String, nullable=False)
+	entity_id = sa.Column(sa.Integer)
+	added = sa.Column(sa.DateTime, nullable=False)
+
+	def __repr__(self):
+		return 'Change(version=%r, entity_type=%r, entity_id=%r, added=%r)' % (
+				self.version,
+				self.entity_type,
+				self.entity_id,
+				self.added)
+
+# An index for pruning the change log.
+sa.Index('ChangesByAdded', Change.added)
+
+# The entity type of changes to users.
+USER_CHANGE_TYPE = 'user'
+
+
 _USER_URL_SEPARATOR = ':'
 _USER_URL_STEAM_PREFIX = 'steam'
 _USER_URL_TWITCH_PREFIX = 'twitch'
@@ -202,6 +351,7 @@ def twitch_user_logged_in(user_class, users_table,
 	# Update the TwitchUser.
 	twitch_user.name = name
 	session.add(twitch_user)
+	add_changes(((USER_CHANGE_TYPE, user_id),), now)
 	session.commit()
 	return user_id, new_user
 
@@ -258,6 +408,7 @@ def steam_user_logged_in(user_class, users_table,
 	# Update the SteamUser.
 	steam_user.profile_url = profile_url
 	session.add(steam_user)
+	add_changes(((USER_CHANGE_TYPE, user_id),), now)
 	session.commit()
 	return user_id, new_user
 
@@ -277,11 +428,494 @@ def optional_one(query):
 	return None
 
 
+# The count of slowest statements that a QueryLog keeps.
+_QUERY_LOG_NUM_SLOWEST = 3
+# The most characters of a statement that are logged.
+_MAX_LOGGED_STATEMENT_LENGTH = 1000
+
+_slow_query_logger = logging.getLogger('common_db.slow_queries')
+# The QueryLog of the request being handled by each thread.
+_query_logs = threading.local()
+
+"""The count, total time, and slowest of the statements executed while the log is
+begun for the current thread.
+"""
+class QueryLog:
+	def __init__(self, num_slowest=_QUERY_LOG_NUM_SLOWEST):
+		self.num_statements = 0
+		self.total_seconds = 0.0
+		self.num_slowest = num_slowest
+		# A min-heap of (seconds, statement) pairs.
+		self._slowest = []
+
+	def add(self, statement, seconds):
+		self.num_statements += 1
+		self.total_seconds += seconds
+		if len(self._slowest) < self.num_slowest:
+			heapq.heappush(self._slowest, (seconds, statement))
+		elif seconds > self._slowest[0][0]:
+			heapq.heapreplace(self._slowest, (seconds, statement))
+
+	def get_slowest(self):
+		"""Returns the slowest (seconds, statement) pairs, slowest first."""
+		return sorted(self._slowest, reverse=True)
+
+	def to_dict(self):
+		return {
+			'statements': self.num_statements,
+			'db_millis': self.total_seconds * 1000.0,
+			'slowest': [
+				{'millis': seconds * 1000.0, 'statement': _get_logged_statement(statement)}
+				for seconds, statement in self.get_slowest()],
+		}
+
+def _get_logged_statement(statement):
+	return ' '.join(statement.split())[:_MAX_LOGGED_STATEMENT_LENGTH]
+
+def begin_query_log():
+	"""Begins a QueryLog of the statements executed by the current thread.
+
+	Statements are only logged if create_session was called with
+	instrument_queries set to True.
+	"""
+	_query_logs.current = QueryLog()
+
+def end_query_log():
+	"""Ends and returns the QueryLog begun for the current thread, or returns None
+	if none was begun.
+	"""
+	query_log = getattr(_query_logs, 'current', None)
+	_query_logs.current = None
+	return query_log
+
+def _instrument_engine(engine, slow_query_seconds):
+	"""Adds the time of each statement executed by the engine to the QueryLog of the
+	current thread, and logs each statement that takes at least slow_query_seconds.
+	"""
+	def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault('query_start_times', []).append(time.time())
+
+	def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+		seconds = time.time() - conn.info['query_start_times'].pop()
+		query_log = getattr(_query_logs, 'current', None)
+		if query_log is not None:
+			query_log.add(statement, seconds)
+		if slow_query_seconds is not None and seconds >= slow_query_seconds:
+			_slow_query_logger.warning('slow query: %.1fms: %s',
+					seconds * 1000.0, _get_logged_statement(statement))
+
+	sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+	sa.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+# The statement that returns the seconds that a PostgreSQL standby lags behind its
+# primary, or NULL if the database is not a standby. A standby that has replayed
+# all received changes does not lag, even if the primary has not committed since.
+_POSTGRESQL_LAG_STATEMENT = (
+		'SELECT CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() '
+		'THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+def _get_replica_lag(engine):
+	"""Returns the seconds that the replica lags behind the primary.
+
+	Replicas that are not PostgreSQL standbys, such as copies of a SQLite file, do
+	not lag.
+	"""
+	if engine.dialect.name != 'postgresql':
+		return 0.0
+	lag_seconds = engine.execute(_POSTGRESQL_LAG_STATEMENT).scalar()
+	return float(lag_seconds or 0.0)
+
+"""A read replica, and its lag when last checked."""
+class _Replica:
+	def __init__(self, name, engine):
+		self.name = name
+		self.engine = engine
+		# The lag in seconds, or None if the replica could not be checked.
+		self.lag_seconds = None
+		self.checked_time = None
+		self.num_reads = 0
+		self.num_fallbacks = 0
+
+"""The read replicas that read-only functions are routed to.
+
+The lag of each replica is checked at most every lag_check_interval seconds, and
+a replica is not read if it could lag by more than max_lag_seconds, or if it
+could lag behind the last write by the client. If no replica can be read, the
+primary is read instead.
+"""
+class ReplicaSet:
+	def __init__(self, engines, max_lag_seconds=5.0, lag_check_interval=1.0,
+			get_lag=_get_replica_lag):
+		self.max_lag_seconds = max_lag_seconds
+		self.lag_check_interval = lag_check_interval
+		self._get_lag = get_lag
+		self._replicas = [_Replica('replica%s' % i, engine)
+				for i, engine in enumerate(engines)]
+		self._next_index = 0
+		self._lock = threading.Lock()
+
+	def _check(self, replica, now):
+		if ((replica.checked_time is not None) and
+				(now - replica.checked_time < self.lag_check_interval)):
+			return
+		replica.checked_time = now
+		try:
+			replica.lag_seconds = self._get_lag(replica.engine)
+		except sa.exc.DBAPIError:
+			# Do not read the replica until it is checked again.
+			replica.lag_seconds = None
+
+	def choose(self, last_write_time=None, now=None):
+		"""Returns the engine of a replica that is current enough to read, or None if
+		the primary must be read.
+
+		If last_write_time is not None, then the replica must include the writes
+		committed by the client at that time.
+		"""
+		if now is None:
+			now = time.time()
+		with self._lock:
+			num_replicas = len(self._replicas)
+			for i in xrange(num_replicas):
+				replica = self._replicas[(self._next_index + i) % num_replicas]
+				self._check(replica, now)
+				if replica.lag_seconds is None:
+					continue
+				# The lag could have grown since it was checked.
+				max_lag_seconds = replica.lag_seconds + (now - replica.checked_time)
+				if max_lag_seconds > self.max_lag_seconds:
+					continue
+				if (last_write_time is not None) and (now - max_lag_seconds <= last_write_time):
+					continue
+				self._next_index = (self._next_index + i + 1) % num_replicas
+				replica.num_reads += 1
+				return replica.engine
+			for replica in self._replicas:
+				replica.num_fallbacks += 1
+			return None
+
+	def get_engines(self):
+		"""Returns the (name, engine) pairs of the replicas."""
+		return [(replica.name, replica.engine) for replica in self._replicas]
+
+	def get_stats(self):
+		"""Returns a dict from the name of each replica to its routing statistics."""
+		with self._lock:
+			return dict((replica.name, {
+					'lag_seconds': replica.lag_seconds,
+					'reads': replica.num_reads,
+					'fallbacks': replica.num_fallbacks,
+				}) for replica in self._replicas)
+
+
+# The ReplicaSet of the read replicas, or None if there are none.
+_replica_set = None
+# The routing state of the request being handled by each thread.
+_routing = threading.local()
+
+def begin_routing(last_write_time=None):
+	"""Called before each request, so that its reads are routed to a replica only if
+	the replica includes the writes by the client.
+
+	The last_write_time is the time of the last write by the client in an earlier
+	request, or None if unknown.
+	"""
+	_routing.last_write_time = last_write_time
+	_routing.has_written = False
+
+def has_written():
+	"""Returns whether the current request has written to the primary."""
+	return getattr(_routing, 'has_written', False)
+
+def read_replica(f):
+	"""A decorator that routes the reads of a read-only function to a replica.
+
+	Reads are routed to the primary instead if the request has written, or inside
+	on_primary.
+	"""
+	@functools.wraps(f)
+	def decorated_function(*pargs, **kwargs):
+		_routing.replica_depth = getattr(_routing, 'replica_depth', 0) + 1
+		try:
+			return f(*pargs, **kwargs)
+		finally:
+			_routing.replica_depth -= 1
+	return decorated_function
+
+@contextlib.contextmanager
+def on_primary():
+	"""Routes the reads in the block to the primary, even in a function decorated
+	by read_replica.
+
+	This is used to load caches that must be as current as the change log.
+	"""
+	_routing.primary_depth = getattr(_routing, 'primary_depth', 0) + 1
+	try:
+		yield
+	finally:
+		_routing.primary_depth -= 1
+
+"""A session that routes reads to a replica inside read_replica, and everything
+else to the primary.
+"""
+class _RoutingSession(sa_orm.Session):
+	def get_bind(self, mapper=None, clause=None):
+		if _replica_set is None:
+			return sa_orm.Session.get_bind(self, mapper, clause)
+		if self._flushing or isinstance(clause, sa_expression.UpdateBase):
+			# Read the writes of this request from the primary.
+			_routing.has_written = True
+			return _engine
+		if (getattr(_routing, 'replica_depth', 0) and
+				not getattr(_routing, 'primary_depth', 0) and
+				not getattr(_routing, 'has_written', False)):
+			engine = _replica_set.choose(getattr(_routing, 'last_write_time', None))
+			if engine is not None:
+				return engine
+		return _engine
+
+def set_read_replicas(replica_uris, max_lag_seconds=5.0, lag_check_interval=1.0):
+	"""Routes the reads of functions decorated by read_replica to the databases with
+	the given URIs. If replica_uris is empty, then all reads are of the primary.
+	"""
+	global _replica_set
+	if _replica_set is not None:
+		for name, engine in _replica_set.get_engines():
+			engine.dispose()
+	if replica_uris:
+		engines = [sa.create_engine(replica_uri, convert_unicode=True, echo=False)
+				for replica_uri in replica_uris]
+		_replica_set = ReplicaSet(engines, max_lag_seconds, lag_check_interval)
+	else:
+		_replica_set = None
+
+def _get_pool_stats(engine):
+	pool = engine.pool
+	stats = {'pool': type(pool).__name__}
+	# Only a QueuePool has a fixed size and overflow.
+	for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+		method = getattr(pool, name, None)
+		if callable(method):
+			stats[name] = method()
+	return stats
+
+def get_engine_stats():
+	"""Returns a dict from the name of each engine of this process to the statistics
+	of its connection pool, and for a replica, of its routing.
+	"""
+	stats = {'primary': _get_pool_stats(_engine)}
+	if _replica_set is not None:
+		replica_stats = _replica_set.get_stats()
+		for name, engine in _replica_set.get_engines():
+			stats[name] = _get_pool_stats(engine)
+			stats[name].update(replica_stats[name])
+	return stats
+
+
+# The dialects and drivers on which a StatementCache can prepare its statements.
+_PREPARE_DRIVERS = frozenset((('postgresql', 'psycopg2'),))
+# The executions of a statement by a process before it is prepared.
+_PREPARE_MIN_EXECUTIONS = 3
+_PYFORMAT_PARAMETER_REGEX = re.compile(r'%\(([^)]+)\)s')
+
+# The most statements of each StatementCache that are prepared on each connection,
+# or 0 if no statements are prepared.
+_max_prepared_statements = 0
+# The names of prepared statements, which are unique in the process.
+_prepared_statement_names = itertools.count()
+
+"""A statement of a StatementCache that PostgreSQL prepares with the given name
+on each connection that executes it, so that it is planned once per connection
+instead of for each execution.
+"""
+class _PreparedStatement:
+	def __init__(self, name, compiled):
+		self.name = name
+		self.compiled = compiled
+		# The names of the bind parameters, in the order of their placeholders.
+		self.bind_names = []
+		def replace_parameter(match):
+			bind_name = match.group(1)
+			if bind_name not in self.bind_names:
+				self.bind_names.append(bind_name)
+			return '$%d' % (self.bind_names.index(bind_name) + 1)
+		statement = _PYFORMAT_PARAMETER_REGEX.sub(replace_parameter, compiled.string)
+		# The PREPARE statement is executed without parameters, so unescape percents.
+		self.prepare_statement = 'PREPARE %s AS %s' % (name, statement.replace('%%', '%'))
+		# Each bind parameter of the EXECUTE statement has the type of the original,
+		# so that its value is processed the same way.
+		if self.bind_names:
+			self.execute_statement = sa.text('EXECUTE %s (%s)' % (name,
+						', '.join(':%s' % bind_name for bind_name in self.bind_names)),
+					bindparams=[sa.bindparam(bind_name, type_=compiled.binds[bind_name].type)
+						for bind_name in self.bind_names])
+		else:
+			self.execute_statement = sa.text('EXECUTE %s' % name)
+
+	def get_parameters(self, params):
+		"""Returns the values of the bind parameters for the EXECUTE statement."""
+		return self.compiled.construct_params(params)
+
+
+"""Statements that are built once per process with bind parameters instead of
+values, and executed with the parameters of each call.
+
+Each statement is also compiled once for each dialect, instead of for each
+execution, by the compiled_cache of the connection that executes it. A key must
+identify the shape of its statement, and not the values of its parameters.
+
+If create_session was called with max_prepared_statements, then on PostgreSQL
+the most executed statements are also prepared on each connection that executes
+them, after _PREPARE_MIN_EXECUTIONS executions. When a statement that is not
+prepared is executed more than the least executed prepared statement, it
+replaces that statement, which each connection deallocates when it next executes
+a statement of the cache. On other dialects, all statements are executed
+normally.
+"""
+class StatementCache:
+	def __init__(self):
+		self._statements = {}
+		# The compiled_cache of the connections, which maps each statement and
+		# dialect to its compiled form.
+		self._compiled = {}
+		# The _PreparedStatement of each prepared key.
+		self._prepared = {}
+		# The executions of each key.
+		self._key_executions = {}
+		# The names of the prepared statements that were replaced by hotter ones.
+		self._demoted_names = set()
+		self.num_executions = 0
+		# The executions that prepared their statement on the connection.
+		self.num_prepares = 0
+		# The executions that found their statement prepared on the connection.
+		self.num_prepared_hits = 0
+		# The executions that deallocated a replaced statement on the connection.
+		self.num_deallocates = 0
+
+	def get(self, key, build):
+		"""Returns the statement with the given key, calling build to create it if it
+		is not cached.
+		"""
+		statement = self._statements.get(key)
+		if statement is None:
+			# Concurrent threads may build the same statement, but all use the first.
+			statement = self._statements.setdefault(key, build())
+		return statement
+
+	def execute(self, key, build, params):
+		"""Executes the statement with the given key and bind parameters in the
+		session, and returns its ResultProxy.
+		"""
+		statement = self.get(key, build)
+		self.num_executions += 1
+		connection = session.connection(clause=statement)\
+				.execution_options(compiled_cache=self._compiled)
+		prepared = self._get_prepared(key, statement, connection.dialect)
+		# Deallocate the statements that hotter statements replaced, so that the
+		# connection keeps at most the most prepared statements.
+		prepared_names = connection.info.get('prepared_statements')
+		if prepared_names and self._demoted_names:
+			for name in prepared_names & self._demoted_names:
+				connection.execution_options(no_parameters=True)\
+						.execute('DEALLOCATE %s' % name)
+				prepared_names.discard(name)
+				self.num_deallocates += 1
+		if prepared is None:
+			return connection.execute(statement, params)
+
+		prepared_names = connection.info.setdefault('prepared_statements', set())
+		if prepared.name in prepared_names:
+			self.num_prepared_hits += 1
+		else:
+			# Execute PREPARE without parameters, so that psycopg2 does not interpolate
+			# its statement, which has placeholders such as $1.
+			connection.execution_options(no_parameters=True)\
+					.execute(prepared.prepare_statement)
+			prepared_names.add(prepared.name)
+			self.num_prepares += 1
+		return connection.execute(
+				prepared.execute_statement, prepared.get_parameters(params))
+
+	def _get_prepared(self, key, statement, dialect):
+		"""Returns the _PreparedStatement for the key, or None if the statement is not
+		prepared on the dialect.
+		"""
+		if (not _max_prepared_statements or
+				(dialect.name, dialect.driver) not in _PREPARE_DRIVERS):
+			return None
+		num_executions = self._key_executions.get(key, 0) + 1
+		self._key_executions[key] = num_executions
+		prepared = self._prepared.get(key)
+		if prepared is not None:
+			return prepared
+		if num_executions < _PREPARE_MIN_EXECUTIONS:
+			return None
+
+		if len(self._prepared) >= _max_prepared_statements:
+			# Replace the least executed prepared statement if this is executed more.
+			coldest_key = min(self._prepared.keys(),
+					key=lambda prepared_key: self._key_executions.get(prepared_key, 0))
+			if self._key_executions.get(coldest_key, 0) >= num_executions:
+				return None
+			coldest = self._prepared.pop(coldest_key, None)
+			if coldest is not None:
+				self._demoted_names.add(coldest.name)
+		name = 'prepared_%s' % next(_prepared_statement_names)
+		return self._prepared.setdefault(key,
+				_PreparedStatement(name, statement.compile(dialect=dialect)))
+
+	def get_stats(self):
+		return {
+			'statements': len(self._statements),
+			'compiled': len(self._compiled),
+			'executions': self.num_executions,
+			'prepared': len(self._prepared),
+			'prepares': self.num_prepares,
+			'prepared_hits': self.num_prepared_hits,
+			'deallocates': self.num_deallocates,
+		}
+
+	def clear(self):
+		"""Removes all statements and their compiled forms, and resets the counts of
+		executions.
+
+		Statements that connections already prepared are deallocated when each
+		connection next executes a statement of the cache.
+		"""
+		self._statements.clear()
+		self._compiled.clear()
+		self._demoted_names.update(prepared.name for prepared in self._prepared.values())
+		self._prepared.clear()
+		self._key_executions.clear()
+		self.num_executions = 0
+		self.num_prepares = 0
+		self.num_prepared_hits = 0
+		self.num_deallocates = 0
+
+
 _engine = None
 session = None
-def create_session(database, database_uri):
+def create_session(database, database_uri,
+		instrument_queries=False, slow_query_seconds=None,
+		replica_uris=(), max_replica_lag_seconds=5.0, replica_lag_check_interval=1.0,
+		max_prepared_statements=0):
+	"""Creates the session.
+
+	If instrument_queries is True, then the statements executed by each thread
+	are added to its QueryLog, and statements that take at least
+	slow_query_seconds are logged. Otherwise, statements are not timed at all.
+
+	If replica_uris is not empty, then functions decorated by read_replica read
+	from those databases; see set_read_replicas.
+
+	If max_prepared_statements is greater than 0 and the database is PostgreSQL,
+	then up to that many hot statements of each StatementCache are prepared on
+	each connection; see StatementCache.
+	"""
 	global _engine
 	global session
+	global _max_prepared_statements
 
 	if database == 'sqlite':
 		# http://docs.sqlalchemy.org/en/rel_0_7/dialects/sqlite.html#foreign-key-support
@@ -291,17 +925,23 @@ def create_session(database, database_uri):
 			cursor.execute("PRAGMA foreign_keys=ON")
 			cursor.close()
 	_engine = sa.create_engine(database_uri, convert_unicode=True, echo=False)
+	_max_prepared_statements = max_prepared_statements
+	if instrument_queries:
+		_instrument_engine(_engine, slow_query_seconds)
 
 	# Use scoped_session with Flask: http://flask.pocoo.org/docs/patterns/sqlalchemy/
 	session = sa_orm.scoped_session(sa_orm.sessionmaker(
-			autocommit=False, autoflush=False, bind=_engine))
+			class_=_RoutingSession, autocommit=False, autoflush=False, bind=_engine))
+	set_read_replicas(replica_uris, max_replica_lag_seconds, replica_lag_check_interval)
 
 	global SteamUsers
 	global TwitchUsers
+	global Changes
 
 	# Create aliases for each table.
 	SteamUsers = SteamUser.__table__
 	TwitchUsers = TwitchUser.__table__
+	Changes = Change.__table__
 
 	return session
 
@@ -314,3 +954,230 @@ def drop_all_tables():
 	"""Drops all tables and indexes in the database."""
 	_Base.metadata.drop_all(_engine)
 
+
+# The PostgreSQL channel that is notified when a transaction adds changes.
+_CHANGES_CHANNEL = 'changes'
+
+def add_changes(changes, now=None):
+	"""Adds the given (entity_type, entity_id) pairs to the change log.
+
+	This must be called before the mutation commits, so that the changes commit in
+	the same transaction.
+	"""
+	now = _get_now(now)
+	session.execute(Changes.insert(), [
+			{'entity_type': entity_type, 'entity_id': entity_id, 'added': now}
+			for entity_type, entity_id in changes])
+	if session.bind.dialect.name == 'postgresql':
+		# Each listening ChangeBus is notified when the transaction commits.
+		session.execute('NOTIFY %s' % _CHANGES_CHANNEL)
+
+def prune_changes(before):
+	"""Deletes the changes added before the given time, and returns their count.
+
+	A ChangeBus started at a version that was pruned delivers None to its
+	listeners, so that they clear their caches.
+	"""
+	result = session.execute(Changes.delete().where(Change.added < before))
+	session.commit()
+	return result.rowcount
+
+
+"""A change delivered by a ChangeBus."""
+class ChangeEvent(DisplayedRecord):
+	__slots__ = ('version', 'entity_type', 'entity_id')
+
+
+"""Reads changes from the change log, and delivers them to each listener.
+
+Each process has its own ChangeBus. Calling poll reads all changes added since
+the last poll in batches of batch_size, but only if poll_interval seconds
+elapsed since the last poll or, on PostgreSQL, if a transaction that added
+changes committed since the last poll. The lag between a change committing and
+its delivery is therefore bounded by poll_interval, and is lower on PostgreSQL.
+
+If engine is None, then the changes are read through the session, and otherwise
+through connections of the given engine.
+
+On PostgreSQL, the version of a change is assigned before its transaction
+commits, so a change can commit after a change with a greater version was read.
+Each missing version is therefore read again by each poll for up to gap_timeout
+seconds, after which its transaction is assumed to have rolled back.
+"""
+class ChangeBus:
+	def __init__(self, engine=None, poll_interval=0.0, batch_size=1000,
+			gap_timeout=60.0, listen=True):
+		self._engine = engine
+		self.poll_interval = poll_interval
+		self.batch_size = batch_size
+		self.gap_timeout = gap_timeout
+		self._should_listen = listen and (self._get_engine().dialect.name == 'postgresql')
+		self._listeners = []
+		self._listen_connection = None
+		self.reset()
+
+	def reset(self):
+		"""Restarts the bus at the last change when it is next polled."""
+		self._version = None
+		# The time that each missing version was first found missing.
+		self._gap_times = {}
+		self._last_poll_time = None
+
+	def subscribe(self, listener):
+		"""Adds a function that is called with a tuple of ChangeEvent records.
+
+		If changes may have been missed, the function is called with None instead,
+		and it should clear the cache.
+		"""
+		self._listeners.append(listener)
+
+	def unsubscribe(self, listener):
+		"""Removes a function added by subscribe."""
+		self._listeners.remove(listener)
+
+	def expire(self):
+		"""Makes the next poll read the change log even if poll_interval seconds have
+		not elapsed, such as after this process added changes.
+		"""
+		self._last_poll_time = None
+
+	def _get_engine(self):
+		return self._engine if self._engine is not None else _engine
+
+	def _execute(self, statement):
+		"""Returns all rows returned by executing the given statement."""
+		if self._engine is None:
+			with on_primary():
+				return session.execute(statement).fetchall()
+		connection = self._engine.connect()
+		try:
+			return connection.execute(statement).fetchall()
+		finally:
+			connection.close()
+
+	def get_version(self):
+		"""Returns the greatest version of a delivered change, or None if not started."""
+		return self._version
+
+	def get_min_missing_version(self):
+		"""Returns the least version less than get_version that is missing, because
+		its transaction may not have committed yet, or None if no version is missing.
+		"""
+		return min(self._gap_times) if self._gap_times else None
+
+	def _deliver(self, changes):
+		for listener in self._listeners:
+			listener(changes)
+
+	def start(self, version=None):
+		"""Starts delivering the changes after the given version.
+
+		If version is None, then the bus starts after the last change. A listener
+		that caches outside of the process, and that therefore survives a restart,
+		can instead start at the last version it received.
+		"""
+		min_version, max_version = self._execute(
+				sa.select([sa.func.min(Change.version), sa.func.max(Change.version)]))[0]
+		max_version = max_version or 0
+		if version is None:
+			version = max_version
+		elif (min_version is not None) and (version < min_version - 1):
+			# The changes after the version were pruned.
+			self._deliver(None)
+			version = max_version
+		self._version = version
+		self._gap_times = {}
+		self._last_poll_time = None
+		if self._should_listen and (self._listen_connection is None):
+			self._listen()
+
+	def _listen(self):
+		"""Listens on a dedicated connection for notifications of added changes."""
+		connection = self._get_engine().raw_connection()
+		try:
+			# Notifications are only delivered outside of a transaction.
+			connection.connection.set_isolation_level(0)
+			cursor = connection.cursor()
+			cursor.execute('LISTEN %s' % _CHANGES_CHANNEL)
+			cursor.close()
+		except:
+			connection.invalidate()
+			raise
+		self._listen_connection = connection
+
+	def _has_notification(self):
+		"""Returns whether any transaction that added changes has committed since
+		the last call.
+		"""
+		if self._listen_connection is None:
+			return False
+		dbapi_connection = self._listen_connection.connection
+		try:
+			dbapi_connection.poll()
+		except self._get_engine().dialect.dbapi.Error:
+			# Poll now, and listen again on a new connection before the next poll.
+			self._listen_connection.invalidate()
+			self._listen_connection = None
+			return True
+		if dbapi_connection.notifies:
+			del dbapi_connection.notifies[:]
+			return True
+		return False
+
+	def poll(self, now=None):
+		"""Delivers the changes added since the last poll, and returns their count."""
+		if now is None:
+			now = time.time()
+		if self._version is None:
+			self.start()
+			self._last_poll_time = now
+			return 0
+		if self._should_listen and (self._listen_connection is None):
+			self._listen()
+		has_notification = self._has_notification()
+		if (not has_notification and (self._last_poll_time is not None) and
+				(now - self._last_poll_time < self.poll_interval)):
+			return 0
+		self._last_poll_time = now
+
+		num_changes = self._read_gaps(now)
+		while True:
+			rows = self._execute(sa.select(
+						[Change.version, Change.entity_type, Change.entity_id])
+					.where(Change.version > self._version)
+					.order_by(Change.version.asc())
+					.limit(self.batch_size))
+			if rows:
+				# Any version skipped by this batch may commit later.
+				expected_version = self._version + 1
+				for row in rows:
+					for missing_version in xrange(expected_version, row[0]):
+						self._gap_times[missing_version] = now
+					expected_version = row[0] + 1
+				self._version = rows[-1][0]
+				num_changes += len(rows)
+				self._deliver(tuple(ChangeEvent(*row) for row in rows))
+			if len(rows) < self.batch_size:
+				break
+		return num_changes
+
+	def _read_gaps(self, now):
+		"""Delivers any change with a missing version that has since committed."""
+		if not self._gap_times:
+			return 0
+		missing_versions = sorted(self._gap_times)
+		rows = []
+		for i in xrange(0, len(missing_versions), self.batch_size):
+			rows.extend(self._execute(sa.select(
+						[Change.version, Change.entity_type, Change.entity_id])
+					.where(Change.version.in_(missing_versions[i:i + self.batch_size]))
+					.order_by(Change.version.asc())))
+		for row in rows:
+			del self._gap_times[row[0]]
+		for missing_version, missing_time in self._gap_times.items():
+			if now - missing_time >= self.gap_timeout:
+				# The transaction that was assigned this version rolled back.
+				del self._gap_times[missing_version]
+		if rows:
+			self._deliver(tuple(ChangeEvent(*row) for row in rows))
+		return len(rows)
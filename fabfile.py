@@ -15,6 +15,10 @@ def prepare():
 	local('mkdir -p %s' % _DIST_FULL_DIR)
 	# Copy all files into it.
 	local('cp run_msg_server.py %s' % _DIST_FULL_DIR)
+	local('cp run_msg_calendar_worker.py %s' % _DIST_FULL_DIR)
+	local('cp run_msg_verify_counters.py %s' % _DIST_FULL_DIR)
+	local('cp run_msg_migrate_tables.py %s' % _DIST_FULL_DIR)
+	local('cp run_msg_import_feeds.py %s' % _DIST_FULL_DIR)
 	local('cp -r matchstreamguide %s' % _DIST_FULL_DIR)
 	with lcd(_DIST_FULL_DIR):
 		# Remove unnecessary files.
@@ -35,6 +39,18 @@ def deploy():
 		# Copy the archive file to the server.
 		put(_ARCHIVE_FILE, '/home/mgp')
 
+def migrate_tables():
+	# Add the enum values, columns, tables, and indexes that the deployed version
+	# needs to an existing database, before restarting the server.
+	with cd(os.path.join('/home/mgp', _DIST_DIR)):
+		run('python run_msg_migrate_tables.py')
+
+def repair_user_counters():
+	# Backfill Users.num_starred, which the hybrid calendar backend reads, after
+	# migrate_tables adds its column and before using that backend.
+	with cd(os.path.join('/home/mgp', _DIST_DIR)):
+		run('python run_msg_verify_counters.py --kind user --repair')
+
 def all():
 	prepare()
 	deploy()
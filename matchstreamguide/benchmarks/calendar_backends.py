@@ -0,0 +1,99 @@
+"""Compares the write and read costs of the calendar backends on a generated
+league.
+
+For each backend, every match is streamed once more, and then every user reads
+the first page of the calendar. By default this uses the database of
+MSG_ENVIRONMENT, and it drops and creates all tables in the database.
+"""
+
+from datetime import datetime
+from matchstreamguide import db
+from matchstreamguide.benchmarks import league as league_module
+from matchstreamguide.benchmarks import measurements as measurements_module
+import random
+
+# The count of stars by a user for a materialized calendar in the hybrid backend.
+_MIN_MATERIALIZED_STARS = 5
+
+def _benchmark(name, backend, league_config, seed, counter):
+	db.drop_all_tables()
+	db.create_all_tables()
+	db._calendar_backend = backend
+	rng = random.Random(seed)
+	league = league_module.create_league(rng, **league_config)
+
+	# Each match is streamed by a streaming user, which updates the calendars of users.
+	write_measurements = measurements_module.Measurements(
+			'%s_write' % name, counter)
+	for match_id in league.match_ids:
+		streamer_id = league.streamer_chooser.choose(rng)
+		if (streamer_id, match_id) in league.streamed_matches:
+			continue
+		write_measurements.measure(
+				db.add_stream_match, streamer_id, match_id, now=league.now)
+
+	# Each user reads the first page of the calendar.
+	read_measurements = measurements_module.Measurements(
+			'%s_read' % name, counter)
+	for user_id in league.user_ids:
+		read_measurements.measure(
+				db.get_displayed_viewer_calendar, user_id, now=league.now)
+
+	num_calendar_entries = db.session.query(db.CalendarEntry).count()
+	db.session.close()
+	return write_measurements, read_measurements, num_calendar_entries
+
+def run(league_config=None, seed=0, output_path=None,
+		min_materialized_stars=_MIN_MATERIALIZED_STARS):
+	"""Benchmarks each calendar backend.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	if league_config is None:
+		league_config = {}
+	counter = measurements_module.StatementCounter()
+	backends = (
+		('materialized', db.MaterializedCalendarBackend()),
+		('on_read', db.OnReadCalendarBackend()),
+		('hybrid', db.HybridCalendarBackend(min_materialized_stars)),
+	)
+	original_backend = db._calendar_backend
+	all_measurements = []
+	results = {
+		'benchmark': 'calendar_backends',
+		'created': datetime.utcnow().isoformat(),
+		'database': db.session.bind.dialect.name,
+		'league': dict(league_module.DEFAULT_CONFIG, **league_config),
+		'min_materialized_stars': min_materialized_stars,
+		'seed': seed,
+		'backends': {},
+	}
+	for name, backend in backends:
+		write_measurements, read_measurements, num_calendar_entries = _benchmark(
+				name, backend, league_config, seed, counter)
+		all_measurements.extend((write_measurements, read_measurements))
+		results['backends'][name] = {
+			'write': write_measurements.get_summary(),
+			'read': read_measurements.get_summary(),
+			'calendar_entries': num_calendar_entries,
+		}
+	db._calendar_backend = original_backend
+	db.drop_all_tables()
+
+	measurements_module.print_summaries(all_measurements)
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = league_module.get_argument_parser(__doc__.split('\n\n')[0])
+	parser.add_argument('--min-materialized-stars', type=int,
+			default=_MIN_MATERIALIZED_STARS,
+			help='the count of stars for a materialized calendar in the hybrid backend')
+	args = parser.parse_args(argv)
+	league_config = league_module.get_league_config(args)
+	run(league_config, args.seed, args.output_path, args.min_materialized_stars)
+
+
+if __name__ == '__main__':
+	main()
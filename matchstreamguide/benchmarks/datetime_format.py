@@ -0,0 +1,126 @@
+"""Measures the cost of formatting the match times of a calendar page, when each
+time is formatted by its row and when the times are formatted in one pass and
+memoized.
+
+This does not use the database or render templates.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import flask
+from matchstreamguide import app
+from matchstreamguide import datetime_format
+from matchstreamguide import db
+from matchstreamguide import views
+from matchstreamguide.benchmarks import measurements as measurements_module
+import pytz
+import time
+
+_NOW = datetime(2013, 1, 1, 12, 0, 0)
+_TIME_ZONE = 'America/Los_Angeles'
+_TIME_FORMAT = '12_hour'
+
+def _create_calendar(page_limit, matches_per_time):
+	"""Returns a DisplayedCalendar with the given count of matches, where the given
+	count of matches share each time.
+	"""
+	matches = []
+	for i in xrange(page_limit):
+		team1 = db.DisplayedTeam(2 * i, 'team_%s' % (2 * i), i, False)
+		team2 = db.DisplayedTeam(2 * i + 1, 'team_%s' % (2 * i + 1), i, False)
+		match_time = _NOW + timedelta(hours=i // matches_per_time)
+		matches.append(db.DisplayedMatch(i, team1, team2,
+				match_time, i, i, False, 'game', 'division'))
+	matches = tuple(matches)
+	return db.DisplayedCalendar(matches[0], matches)
+
+def _format_row(dt):
+	"""Formats the time of a row as the readable_datetime filter did before it was
+	memoized.
+	"""
+	if getattr(flask.g, 'time_neutral', False):
+		return pytz.utc.localize(dt).strftime(datetime_format.FORMAT_24_HOUR_UTC)
+	utc_datetime = pytz.utc.localize(dt)
+	time_zone = flask.g.time_zone
+	if time_zone:
+		localized_datetime = utc_datetime.astimezone(time_zone)
+		if flask.g.time_format == '12_hour':
+			return localized_datetime.strftime(datetime_format.FORMAT_12_HOUR_LOCALIZED)
+		return localized_datetime.strftime(datetime_format.FORMAT_24_HOUR_LOCALIZED)
+	else:
+		if flask.g.time_format == '12_hour':
+			return utc_datetime.strftime(datetime_format.FORMAT_12_HOUR_UTC)
+		return utc_datetime.strftime(datetime_format.FORMAT_24_HOUR_UTC)
+
+def _format_per_row(calendar):
+	"""Formats the time of each row of the page for a request, as before the times
+	were memoized.
+	"""
+	flask.g.time_zone = pytz.timezone(_TIME_ZONE)
+	return [_format_row(match.time)
+			for match in (calendar.next_match,) + calendar.matches]
+
+def _format_memoized(calendar):
+	"""Formats the times in one pass and reads each row from the memo, as the
+	readable_datetime filter does for each request now.
+	"""
+	flask.g.time_zone = datetime_format.get_time_zone(_TIME_ZONE)
+	flask.g.datetime_formatter = None
+	views._format_match_times(calendar)
+	return [views._render_readable_datetime(match.time)
+			for match in (calendar.next_match,) + calendar.matches]
+
+def _measure(f, calendar, num_pages):
+	"""Returns the microseconds taken to format each of the given count of pages."""
+	micros = []
+	for i in xrange(num_pages):
+		start_time = time.time()
+		f(calendar)
+		micros.append((time.time() - start_time) * 1000000.0)
+	return micros
+
+def run(num_pages, page_limit, matches_per_time, output_path=None):
+	"""Measures formatting the given count of pages for each approach.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	results = {
+		'benchmark': 'datetime_format',
+		'created': datetime.utcnow().isoformat(),
+		'pages': num_pages,
+		'page_limit': page_limit,
+		'matches_per_time': matches_per_time,
+	}
+	calendar = _create_calendar(page_limit, matches_per_time)
+	with app.test_request_context('/guide/viewer'):
+		flask.g.time_format = _TIME_FORMAT
+		flask.g.time_neutral = False
+		assert _format_per_row(calendar) == _format_memoized(calendar)
+		for name, f in (('per_row', _format_per_row), ('memoized', _format_memoized)):
+			micros = _measure(f, calendar, num_pages)
+			results['%s_p50_micros' % name] = measurements_module.get_percentile(micros, 50)
+			results['%s_p99_micros' % name] = measurements_module.get_percentile(micros, 99)
+			results['%s_total_seconds' % name] = sum(micros) / 1000000.0
+
+	for key in sorted(results):
+		print '%s: %s' % (key, results[key])
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--pages', type=int, default=10000, dest='num_pages',
+			help='the count of pages to format')
+	parser.add_argument('--page_limit', type=int, default=20,
+			help='the count of matches on each page')
+	parser.add_argument('--matches_per_time', type=int, default=4,
+			help='the count of matches on a page that share each time')
+	parser.add_argument('--output', dest='output_path',
+			help='the path of a file to write the results as JSON')
+	args = parser.parse_args(argv)
+	run(args.num_pages, args.page_limit, args.matches_per_time, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
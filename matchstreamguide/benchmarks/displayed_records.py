@@ -0,0 +1,167 @@
+"""Measures the memory, allocations, and serialized size of calendar pages built
+from Displayed* objects, and from equivalent objects that store their attributes
+in a __dict__ as the Displayed* classes did before they had slots.
+
+This does not use the database.
+"""
+
+import argparse
+import cPickle
+from datetime import datetime, timedelta
+import gc
+from matchstreamguide import db
+from matchstreamguide.benchmarks import measurements as measurements_module
+import sys
+import time
+import types
+
+_NOW = datetime(2013, 1, 1)
+# The count of matches in a page of the calendar.
+_PAGE_LIMIT = 20
+_MODES = ('dict', 'slots')
+
+
+"""A DisplayedTeam as it was before it had slots."""
+class _DictTeam:
+	def __init__(self, team_id, name, num_stars, is_starred, game=None, division=None):
+		self.team_id = team_id
+		self.name = name
+		self.num_stars = num_stars
+		self.is_starred = is_starred
+		self.game = game
+		self.division = division
+
+"""A DisplayedMatch as it was before it had slots."""
+class _DictMatch:
+	def __init__(self, match_id, team1, team2, time, num_stars, num_streams, is_starred,
+			game=None, division=None):
+		self.match_id = match_id
+		self.team1 = team1
+		self.team2 = team2
+		self.time = time
+		self.num_stars = num_stars
+		self.num_streams = num_streams
+		self.is_starred = is_starred
+		self.game = game
+		self.division = division
+
+"""A DisplayedCalendar as it was before it had slots."""
+class _DictCalendar:
+	def __init__(self, next_match, matches,
+			prev_time=None, prev_match_id=None, next_time=None, next_match_id=None):
+		self.next_match = next_match
+		self.matches = matches
+		self.prev_time = prev_time
+		self.prev_match_id = prev_match_id
+		self.next_time = next_time
+		self.next_match_id = next_match_id
+
+# The team, match, and calendar classes of each mode.
+_CLASSES = {
+	'dict': (_DictTeam, _DictMatch, _DictCalendar),
+	'slots': (db.DisplayedTeam, db.DisplayedMatch, db.DisplayedCalendar),
+}
+
+def _create_page(mode, page_index, page_limit):
+	"""Returns a calendar of the given mode for a page with the given count of
+	matches.
+	"""
+	team_class, match_class, calendar_class = _CLASSES[mode]
+	matches = []
+	for i in xrange(page_limit):
+		match_id = (page_index * page_limit) + i
+		team1 = team_class(2 * match_id, 'team_%s' % (2 * match_id), i, False)
+		team2 = team_class(2 * match_id + 1, 'team_%s' % (2 * match_id + 1), i, False)
+		matches.append(match_class(match_id, team1, team2,
+				_NOW + timedelta(hours=match_id), i, i, False, 'game', 'division'))
+	matches = tuple(matches)
+	last_match = matches[-1]
+	return calendar_class(matches[0], matches,
+			None, None, last_match.time, last_match.match_id)
+
+def _get_deep_size(root):
+	"""Returns the bytes of memory used by the object and the objects that it
+	references, excluding classes and modules.
+	"""
+	seen_ids = set()
+	size = 0
+	pending = [root]
+	while pending:
+		obj = pending.pop()
+		if (id(obj) in seen_ids or
+				isinstance(obj, (type, types.ClassType, types.ModuleType))):
+			continue
+		seen_ids.add(id(obj))
+		size += sys.getsizeof(obj)
+		pending.extend(gc.get_referents(obj))
+	return size
+
+def _measure(mode, num_pages, page_limit):
+	"""Builds, measures, and serializes the given count of calendar pages of the
+	given mode, and returns the measurements per page.
+	"""
+	gc.collect()
+	gc.disable()
+	try:
+		start_num_objects = len(gc.get_objects())
+		start_time = time.time()
+		pages = [_create_page(mode, page_index, page_limit)
+				for page_index in xrange(num_pages)]
+		create_seconds = time.time() - start_time
+		num_objects = len(gc.get_objects()) - start_num_objects
+	finally:
+		gc.enable()
+
+	start_time = time.time()
+	pickled_pages = [cPickle.dumps(page, cPickle.HIGHEST_PROTOCOL) for page in pages]
+	pickle_seconds = time.time() - start_time
+	start_time = time.time()
+	for pickled_page in pickled_pages:
+		cPickle.loads(pickled_page)
+	unpickle_seconds = time.time() - start_time
+
+	return {
+		'create_micros_per_page': create_seconds * 1000000.0 / num_pages,
+		'tracked_objects_per_page': num_objects / float(num_pages),
+		'bytes_per_page': _get_deep_size(pages[0]),
+		'pickled_bytes_per_page': sum(len(p) for p in pickled_pages) / float(num_pages),
+		'pickle_micros_per_page': pickle_seconds * 1000000.0 / num_pages,
+		'unpickle_micros_per_page': unpickle_seconds * 1000000.0 / num_pages,
+	}
+
+def run(num_pages, page_limit=_PAGE_LIMIT, output_path=None):
+	"""Builds, measures, and serializes the given count of calendar pages in each
+	mode.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	modes = dict((mode, _measure(mode, num_pages, page_limit)) for mode in _MODES)
+
+	print '%-26s %14s %14s' % (('measurement',) + _MODES)
+	for key in sorted(modes[_MODES[0]]):
+		print '%-26s %14.1f %14.1f' % ((key,) + tuple(modes[mode][key] for mode in _MODES))
+	results = {
+		'benchmark': 'displayed_records',
+		'created': datetime.utcnow().isoformat(),
+		'pages': num_pages,
+		'page_limit': page_limit,
+		'modes': modes,
+	}
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--pages', type=int, default=10000, dest='num_pages',
+			help='the count of calendar pages to build')
+	parser.add_argument('--page-limit', type=int, default=_PAGE_LIMIT,
+			help='the count of matches in each page')
+	parser.add_argument('--output', dest='output_path',
+			help='the path of a file to write the results as JSON')
+	args = parser.parse_args(argv)
+	run(args.num_pages, args.page_limit, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,112 @@
+"""Times each getter of the db module on a generated league, when its statements
+are built and compiled for each call and when they are read from the statement
+cache, reporting the p50 and p99 milliseconds per call and the overhead that the
+cache removes.
+
+By default this uses the database of MSG_ENVIRONMENT, such as an in-memory
+SQLite database for MSG_ENVIRONMENT=test or the local PostgreSQL database for
+MSG_ENVIRONMENT=dev. This drops and creates all tables in the database.
+"""
+
+from datetime import datetime
+from matchstreamguide import db
+from matchstreamguide.benchmarks import league as league_module
+from matchstreamguide.benchmarks import measurements as measurements_module
+import random
+
+# The default number of calls of each getter in each mode.
+_NUM_CALLS = 200
+_MODES = ('uncached', 'cached')
+
+def _get_getter_calls(league, rng):
+	"""Returns the name, function, and arguments of a call of each getter."""
+	user_id = rng.choice(league.user_ids)
+	now = league.now
+	return (
+		('get_displayed_viewer_calendar', db.get_displayed_viewer_calendar,
+			(user_id,), {'now': now}),
+		('get_starred_matches', db.get_starred_matches, (user_id,), {'now': now}),
+		('get_all_matches', db.get_all_matches, (user_id,), {'now': now}),
+		('get_starred_teams', db.get_starred_teams, (user_id,), {}),
+		('get_all_teams', db.get_all_teams, (user_id,), {}),
+		('get_starred_streamers', db.get_starred_streamers, (user_id,), {}),
+		('get_all_streamers', db.get_all_streamers, (user_id,), {}),
+		('get_displayed_match', db.get_displayed_match,
+			(user_id, league.match_chooser.choose(rng)), {}),
+		('get_displayed_team', db.get_displayed_team,
+			(user_id, league.team_chooser.choose(rng)), {'now': now}),
+		('get_displayed_streamer', db.get_displayed_streamer,
+			(user_id, league.streamer_chooser.choose(rng)), {'now': now}),
+	)
+
+def _benchmark_getters(league, rng, measurements, num_calls):
+	"""Calls each getter in each mode with the same arguments, after a call that is
+	not measured.
+
+	In the uncached mode the statement cache is cleared before each call, so that
+	the call builds and compiles its statements as it did before the cache.
+	"""
+	for i in xrange(num_calls):
+		for name, f, pargs, kwargs in _get_getter_calls(league, rng):
+			# Load the caches of the client's stars, so that no mode measures them.
+			f(*pargs, **kwargs)
+			for mode in _MODES:
+				if mode == 'uncached':
+					db._statements.clear()
+				measurements['%s_%s' % (name, mode)].measure(f, *pargs, **kwargs)
+
+def run(league_config=None, num_calls=_NUM_CALLS, seed=0, output_path=None):
+	"""Generates a league and times each getter on it in each mode.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	if league_config is None:
+		league_config = {}
+	rng = random.Random(seed)
+	db.drop_all_tables()
+	db.create_all_tables()
+	league = league_module.create_league(rng, **league_config)
+
+	counter = measurements_module.StatementCounter()
+	names = [name for name, f, pargs, kwargs in _get_getter_calls(league, rng)]
+	operations = ['%s_%s' % (name, mode) for name in names for mode in _MODES]
+	measurements = dict((operation, measurements_module.Measurements(operation, counter))
+			for operation in operations)
+	_benchmark_getters(league, rng, measurements, num_calls)
+	db.drop_all_tables()
+
+	measurements_module.print_summaries(
+			measurements[operation] for operation in operations)
+	summaries = dict((operation, measurements[operation].get_summary())
+			for operation in operations)
+	# The milliseconds of building and compiling statements that each call saves.
+	overhead_millis = {}
+	for name in names:
+		overhead_millis[name] = (summaries['%s_uncached' % name]['p50_millis'] -
+				summaries['%s_cached' % name]['p50_millis'])
+		print '%s: p50 overhead %.3fms' % (name, overhead_millis[name])
+	results = {
+		'benchmark': 'getters',
+		'created': datetime.utcnow().isoformat(),
+		'database': db.session.bind.dialect.name,
+		'league': league.config,
+		'num_calls': num_calls,
+		'seed': seed,
+		'operations': summaries,
+		'p50_overhead_millis': overhead_millis,
+	}
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = league_module.get_argument_parser(__doc__.split('\n\n')[0])
+	parser.add_argument('--calls', type=int, default=_NUM_CALLS, dest='num_calls',
+			help='the number of calls of each getter in each mode')
+	args = parser.parse_args(argv)
+	league_config = league_module.get_league_config(args)
+	run(league_config, args.num_calls, args.seed, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
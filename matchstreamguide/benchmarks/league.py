@@ -0,0 +1,245 @@
+"""Generates a synthetic league of teams, matches, users, stars, and streams
+through the public functions of the db module.
+
+The popularity of teams, matches, and streaming users, the count of stars by
+each user, and the count of streams for each match all follow power laws, so
+that a few popular matches have many stars and a few users star many things.
+"""
+
+import argparse
+import bisect
+from datetime import datetime, timedelta
+from matchstreamguide import db
+import sqlalchemy as sa
+
+# The default parameters of a generated league.
+DEFAULT_CONFIG = {
+	'num_teams': 40,
+	'num_seasons': 1,
+	'matches_per_season': 200,
+	'season_days': 90,
+	'num_streamers': 10,
+	'num_users': 500,
+	# Larger exponents mean fewer stars per user and fewer streams per match.
+	'star_exponent': 1.2,
+	'max_stars_per_user': 50,
+	'stream_exponent': 2.0,
+	'max_streams_per_match': 5,
+	# Larger exponents concentrate stars and streams on fewer popular targets.
+	'popularity_exponent': 1.0,
+}
+
+_GAME = 'game'
+_DIVISION = 'division'
+# The probabilities that a star is for a match or a team, and otherwise is for a
+# streaming user.
+_STAR_MATCH_PROBABILITY = 0.5
+_STAR_TEAM_PROBABILITY = 0.4
+
+_NOW = datetime(2013, 1, 1, 12, 0, 0)
+
+"""Chooses items with a probability that follows a power law of their rank.
+"""
+class PopularityChooser:
+	def __init__(self, items, exponent):
+		self.items = items
+		self.cumulative_weights = []
+		total_weight = 0.0
+		for rank in xrange(len(items)):
+			total_weight += 1.0 / ((rank + 1) ** exponent)
+			self.cumulative_weights.append(total_weight)
+	
+	def choose(self, rng):
+		"""Returns a random item, where the first items are the most popular."""
+		weight = rng.random() * self.cumulative_weights[-1]
+		return self.items[bisect.bisect_right(self.cumulative_weights, weight)]
+
+def get_power_law_count(rng, exponent, minimum, maximum):
+	"""Returns a random count between minimum and maximum inclusive that follows a
+	power law, so that small counts are most likely.
+	"""
+	count = minimum + int(rng.paretovariate(exponent)) - 1
+	return min(count, maximum)
+
+"""The identifiers in a generated league, and the stars and streams in it.
+"""
+class League:
+	def __init__(self, config, now):
+		self.config = config
+		self.now = now
+		self.team_ids = []
+		self.match_ids = []
+		self.streamer_ids = []
+		self.user_ids = []
+		# Pairs of user identifier and starred identifier.
+		self.starred_matches = set()
+		self.starred_teams = set()
+		self.starred_streamers = set()
+		# Pairs of streaming user identifier and match identifier.
+		self.streamed_matches = set()
+
+		# Choosers of popular matches, teams, and streaming users.
+		self.match_chooser = None
+		self.team_chooser = None
+		self.streamer_chooser = None
+
+	def _create_choosers(self):
+		exponent = self.config['popularity_exponent']
+		self.match_chooser = PopularityChooser(self.match_ids, exponent)
+		self.team_chooser = PopularityChooser(self.team_ids, exponent)
+		self.streamer_chooser = PopularityChooser(self.streamer_ids, exponent)
+
+	def get_chooser(self, star_type):
+		"""Returns the PopularityChooser for the given type of star."""
+		return {
+			'match': self.match_chooser,
+			'team': self.team_chooser,
+			'streamer': self.streamer_chooser,
+		}[star_type]
+
+	def get_starred(self, star_type):
+		"""Returns the set of stars of the given type."""
+		return {
+			'match': self.starred_matches,
+			'team': self.starred_teams,
+			'streamer': self.starred_streamers,
+		}[star_type]
+
+	def __repr__(self):
+		return 'League(teams=%r, matches=%r, streamers=%r, users=%r, starred_matches=%r, starred_teams=%r, starred_streamers=%r, streamed_matches=%r)' % (
+				len(self.team_ids),
+				len(self.match_ids),
+				len(self.streamer_ids),
+				len(self.user_ids),
+				len(self.starred_matches),
+				len(self.starred_teams),
+				len(self.starred_streamers),
+				len(self.streamed_matches))
+
+
+def _create_teams(league):
+	for i in xrange(league.config['num_teams']):
+		league.team_ids.append(db.add_team('Team %s' % i, 'team %s' % i,
+				_GAME, _DIVISION, 'team_fingerprint_%s' % i, now=league.now))
+
+def _create_matches(league, rng):
+	config = league.config
+	season_hours = config['season_days'] * 24
+	for season in xrange(config['num_seasons']):
+		season_start = league.now + timedelta(hours=season * season_hours)
+		for i in xrange(config['matches_per_season']):
+			team1_id, team2_id = rng.sample(league.team_ids, 2)
+			match_time = season_start + timedelta(hours=rng.randrange(1, season_hours))
+			fingerprint = 'match_fingerprint_%s_%s' % (season, i)
+			league.match_ids.append(db.add_match(team1_id, team2_id, match_time,
+					_GAME, _DIVISION, fingerprint, now=league.now))
+
+def _create_users(league):
+	config = league.config
+	for i in xrange(config['num_streamers']):
+		user_id, new_user = db.steam_user_logged_in(
+				i, 'streamer%s' % i, 'streamer%s' % i, None, None, None, now=league.now)
+		league.streamer_ids.append(user_id)
+	for i in xrange(config['num_users']):
+		steam_id = config['num_streamers'] + i
+		user_id, new_user = db.steam_user_logged_in(
+				steam_id, 'user%s' % i, 'user%s' % i, None, None, None, now=league.now)
+		league.user_ids.append(user_id)
+
+def choose_new_star(league, rng, user_id, star_type=None):
+	"""Returns the type and identifier of a random match, team, or streaming user
+	to star that the user has not already starred, or None if the chosen one is
+	already starred.
+
+	The type is 'match', 'team', or 'streamer'. If star_type is None, then a random
+	type is chosen.
+	"""
+	if star_type is None:
+		probability = rng.random()
+		if probability < _STAR_MATCH_PROBABILITY:
+			star_type = 'match'
+		elif probability < _STAR_MATCH_PROBABILITY + _STAR_TEAM_PROBABILITY:
+			star_type = 'team'
+		else:
+			star_type = 'streamer'
+	starred_id = league.get_chooser(star_type).choose(rng)
+	if (user_id, starred_id) in league.get_starred(star_type):
+		return None
+	return star_type, starred_id
+
+def get_star_functions(star_type):
+	"""Returns the db functions that add and remove a star of the given type."""
+	return (getattr(db, 'add_star_%s' % star_type),
+			getattr(db, 'remove_star_%s' % star_type))
+
+def _create_stars(league, rng):
+	config = league.config
+	for user_id in league.user_ids:
+		num_stars = get_power_law_count(
+				rng, config['star_exponent'], 1, config['max_stars_per_user'])
+		for i in xrange(num_stars):
+			star = choose_new_star(league, rng, user_id)
+			if star is None:
+				# Skip stars that the user has already added.
+				continue
+			star_type, starred_id = star
+			add_star, remove_star = get_star_functions(star_type)
+			add_star(user_id, starred_id, now=league.now)
+			league.get_starred(star_type).add((user_id, starred_id))
+
+def _create_streams(league, rng):
+	config = league.config
+	for match_id in league.match_ids:
+		num_streams = get_power_law_count(
+				rng, config['stream_exponent'], 0, config['max_streams_per_match'])
+		for i in xrange(num_streams):
+			streamer_id = league.streamer_chooser.choose(rng)
+			if (streamer_id, match_id) in league.streamed_matches:
+				continue
+			db.add_stream_match(streamer_id, match_id, now=league.now)
+			league.streamed_matches.add((streamer_id, match_id))
+
+def create_league(rng, now=_NOW, **config):
+	"""Creates and returns a League in the database.
+
+	Each keyword argument overrides the parameter in DEFAULT_CONFIG.
+	"""
+	league_config = dict(DEFAULT_CONFIG)
+	for name, value in config.iteritems():
+		if name not in league_config:
+			raise ValueError('Unknown league parameter: %s' % name)
+		league_config[name] = value
+
+	league = League(league_config, now)
+	_create_teams(league)
+	_create_matches(league, rng)
+	_create_users(league)
+	league._create_choosers()
+	_create_stars(league, rng)
+	_create_streams(league, rng)
+	return league
+
+def get_argument_parser(description):
+	"""Returns an ArgumentParser for the league and database arguments shared by
+	the benchmarks.
+	"""
+	parser = argparse.ArgumentParser(description=description)
+	parser.add_argument('--database-uri',
+			help='the database to use instead of the database of MSG_ENVIRONMENT')
+	parser.add_argument('--seed', type=int, default=0,
+			help='the seed for generating the league')
+	parser.add_argument('--output', dest='output_path',
+			help='the path of the JSON file to write the results to')
+	for name, value in sorted(DEFAULT_CONFIG.iteritems()):
+		parser.add_argument('--%s' % name.replace('_', '-'), type=type(value),
+				default=value, help='the league parameter %s' % name)
+	return parser
+
+def get_league_config(args):
+	"""Returns the league parameters from the arguments, and uses the given
+	database if needed.
+	"""
+	if args.database_uri is not None:
+		database = sa.engine.url.make_url(args.database_uri).drivername.split('+')[0]
+		db.create_session(database, args.database_uri)
+	return dict((name, getattr(args, name)) for name in DEFAULT_CONFIG)
@@ -0,0 +1,145 @@
+"""Times changing the time of a streamed match with many stars on a generated
+league, when edit_match_time updates each copy of the time with one statement
+for each table and when each star and calendar entry is loaded and updated.
+
+By default this uses the database of MSG_ENVIRONMENT, such as an in-memory
+SQLite database for MSG_ENVIRONMENT=test or the local PostgreSQL database for
+MSG_ENVIRONMENT=dev. This drops and creates all tables in the database.
+"""
+
+from datetime import datetime, timedelta
+from matchstreamguide import db
+from matchstreamguide.benchmarks import league as league_module
+from matchstreamguide.benchmarks import measurements as measurements_module
+import random
+import sqlalchemy as sa
+
+# The default count of stars of the edited match.
+_NUM_STARS = 100000
+# The default number of time changes in each mode.
+_NUM_CALLS = 20
+# The count of users and stars inserted by each statement.
+_INSERT_BATCH_SIZE = 5000
+_MODES = ('set_based', 'per_row')
+
+def _add_stars(league, match_id, num_stars):
+	"""Adds the given count of users that each star only the match, and the
+	CalendarEntry of each user for the streamed match.
+
+	The rows are inserted by executemany instead of through add_star_match, and
+	then the count of stars of the match is repaired.
+	"""
+	match_time = db.session.query(db.Match.time).filter(db.Match.id == match_id).scalar()
+	for start in xrange(0, num_stars, _INSERT_BATCH_SIZE):
+		end = min(start + _INSERT_BATCH_SIZE, num_stars)
+		db.session.execute(db.Users.insert(), [{
+				'display_name': 'star_user%s' % i,
+				'indexed_name': 'star_user%s' % i,
+				'created': league.now,
+				'url_by_id': 'star_user%s' % i,
+				'num_starred': 1,
+			} for i in xrange(start, end)])
+		user_ids = [row[0] for row in db.session.execute(
+				sa.select([db.User.id]).where(db.User.url_by_id.in_(
+					['star_user%s' % i for i in xrange(start, end)])))]
+		db.session.execute(db.StarredMatches.insert(), [{
+				'user_id': user_id,
+				'match_id': match_id,
+				'time': match_time,
+				'added': league.now,
+			} for user_id in user_ids])
+		db.session.execute(db.CalendarEntries.insert(), [{
+				'user_id': user_id,
+				'match_id': match_id,
+				'time': match_time,
+				'num_user_stars': 1,
+			} for user_id in user_ids])
+		db.session.commit()
+	db.session.close()
+	db.verify_match_counters(match_id, match_id + 1, repair=True)
+
+def _edit_per_row(editor_id, match_id, time):
+	"""Changes the time of the match by loading and updating each copy of its
+	time, as an implementation that updates the stars of each user would.
+	"""
+	try:
+		db.session.query(db.Match).filter(db.Match.id == match_id).one().time = time
+		for model in (db.MatchOpponent, db.StarredMatch, db.StreamedMatch,
+				db.CalendarEntry):
+			for row in db.session.query(model).filter(model.match_id == match_id):
+				row.time = time
+		db.session.add(db.MatchEdit(match_id=match_id, user_id=editor_id,
+				action='edit_time', data=time.isoformat()))
+		db.session.commit()
+	finally:
+		db.session.close()
+
+def _benchmark_edits(league, match_id, measurements, num_calls):
+	"""Moves the match later and then back in each mode, so that every call
+	changes its time.
+	"""
+	editor_id = league.user_ids[0]
+	match_time = db.session.query(db.Match.time).filter(db.Match.id == match_id).scalar()
+	db.session.close()
+	times = (match_time + timedelta(hours=1), match_time)
+	for mode in _MODES:
+		f = db.edit_match_time if mode == 'set_based' else _edit_per_row
+		for i in xrange(num_calls):
+			measurements[mode].measure(f, editor_id, match_id, times[i % 2])
+
+def run(league_config=None, num_stars=_NUM_STARS, num_calls=_NUM_CALLS, seed=0,
+		output_path=None):
+	"""Generates a league, adds the given count of stars to a streamed match, and
+	times changing the time of that match in each mode.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	if league_config is None:
+		league_config = {}
+	rng = random.Random(seed)
+	db.drop_all_tables()
+	db.create_all_tables()
+	league = league_module.create_league(rng, **league_config)
+	# The most popular match, which is streamed so that each star has a
+	# CalendarEntry.
+	match_id = league.match_ids[0]
+	streamer_id = league.streamer_ids[0]
+	if (streamer_id, match_id) not in league.streamed_matches:
+		db.add_stream_match(streamer_id, match_id, now=league.now)
+	_add_stars(league, match_id, num_stars)
+	num_match_stars = db.get_displayed_match(None, match_id).num_stars
+
+	counter = measurements_module.StatementCounter()
+	measurements = dict((mode, measurements_module.Measurements(mode, counter))
+			for mode in _MODES)
+	_benchmark_edits(league, match_id, measurements, num_calls)
+	db.drop_all_tables()
+
+	measurements_module.print_summaries(measurements[mode] for mode in _MODES)
+	results = {
+		'benchmark': 'match_time',
+		'created': datetime.utcnow().isoformat(),
+		'database': db.session.bind.dialect.name,
+		'league': league.config,
+		'match_stars': num_match_stars,
+		'num_calls': num_calls,
+		'seed': seed,
+		'operations': dict((mode, measurements[mode].get_summary()) for mode in _MODES),
+	}
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = league_module.get_argument_parser(__doc__.split('\n\n')[0])
+	parser.add_argument('--stars', type=int, default=_NUM_STARS, dest='num_stars',
+			help='the count of stars added to the edited match')
+	parser.add_argument('--calls', type=int, default=_NUM_CALLS, dest='num_calls',
+			help='the number of time changes in each mode')
+	args = parser.parse_args(argv)
+	league_config = league_module.get_league_config(args)
+	run(league_config, args.num_stars, args.num_calls, args.seed, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,89 @@
+"""Measures the seconds taken and SQL statements executed by database calls."""
+
+import json
+from matchstreamguide import common_db
+import sqlalchemy as sa
+import time
+
+"""Counts the statements executed by the database engine.
+
+If statements is not None, then each executed statement is appended to it.
+"""
+class StatementCounter:
+	def __init__(self):
+		self.num_statements = 0
+		self.statements = None
+		sa.event.listen(common_db._engine, 'before_cursor_execute',
+				self._before_cursor_execute)
+	
+	def _before_cursor_execute(self,
+			conn, cursor, statement, parameters, context, executemany):
+		self.num_statements += 1
+		if self.statements is not None:
+			self.statements.append(statement)
+
+
+def get_percentile(values, percentile):
+	"""Returns the given percentile of the values using the nearest rank, or None
+	if there are no values.
+	"""
+	if not values:
+		return None
+	values = sorted(values)
+	rank = int(round(percentile / 100.0 * (len(values) - 1)))
+	return values[rank]
+
+"""The seconds taken and statements executed by each call of an operation.
+"""
+class Measurements:
+	def __init__(self, name, counter):
+		self.name = name
+		self.counter = counter
+		self.seconds = []
+		self.num_statements = []
+
+	def measure(self, f, *pargs, **kwargs):
+		"""Calls the function with the given arguments, records its measurements,
+		and returns its result.
+		"""
+		start_num_statements = self.counter.num_statements
+		start_time = time.time()
+		result = f(*pargs, **kwargs)
+		self.seconds.append(time.time() - start_time)
+		self.num_statements.append(self.counter.num_statements - start_num_statements)
+		return result
+
+	def get_summary(self):
+		"""Returns a dict summarizing the measurements."""
+		def _get_millis(seconds):
+			return None if seconds is None else seconds * 1000.0
+		return {
+			'calls': len(self.seconds),
+			'total_seconds': sum(self.seconds),
+			'p50_millis': _get_millis(get_percentile(self.seconds, 50)),
+			'p99_millis': _get_millis(get_percentile(self.seconds, 99)),
+			'p50_statements': get_percentile(self.num_statements, 50),
+			'p99_statements': get_percentile(self.num_statements, 99),
+			'max_statements': max(self.num_statements) if self.num_statements else None,
+		}
+
+def print_summaries(measurements):
+	"""Prints a table summarizing each Measurements in the given sequence."""
+	print '%-20s %8s %12s %12s %10s %10s' % (
+			'operation', 'calls', 'p50_millis', 'p99_millis', 'p50_stmts', 'p99_stmts')
+	for measurement in measurements:
+		summary = measurement.get_summary()
+		if not summary['calls']:
+			continue
+		print '%-20s %8d %12.3f %12.3f %10d %10d' % (measurement.name,
+				summary['calls'],
+				summary['p50_millis'],
+				summary['p99_millis'],
+				summary['p50_statements'],
+				summary['p99_statements'])
+
+def write_results(path, results):
+	"""Writes the results as JSON to the file at the given path."""
+	with open(path, 'w') as f:
+		json.dump(results, f, indent=2, sort_keys=True)
+		f.write('\n')
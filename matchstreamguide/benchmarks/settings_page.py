@@ -0,0 +1,97 @@
+"""Times requests of the settings page, rendered by the settings view and its
+templates, when the time zone tables are computed for each request and when they
+are read from the hourly versioned asset.
+
+By default this uses the database of MSG_ENVIRONMENT, such as an in-memory
+SQLite database for MSG_ENVIRONMENT=test or the local PostgreSQL database for
+MSG_ENVIRONMENT=dev. This drops and creates all tables in the database.
+"""
+
+import argparse
+from datetime import datetime
+from matchstreamguide import app
+from matchstreamguide import db
+from matchstreamguide import views
+from matchstreamguide.benchmarks import measurements as measurements_module
+
+# The default number of requests in each mode.
+_NUM_REQUESTS = 1000
+_MODES = ('per_request', 'asset')
+
+def _create_client():
+	"""Returns a test client that is logged in as a new user."""
+	user_id, new_user = db.steam_user_logged_in(
+			1, 'settings_user', 'settings_user',
+			'http://steamcommunity.com/id/settings_user', None, None)
+	client = app.test_client()
+	with client.session_transaction() as session:
+		session['client'] = {
+			'id': user_id,
+			'name': 'settings_user',
+			'auth': 'steam',
+			'time_format': db.DEFAULT_SETTINGS_TIME_FORMAT,
+		}
+	return client
+
+def _get_settings(client, mode):
+	"""Requests the settings page and returns its size in bytes.
+
+	In the per_request mode the asset is discarded before the request, so that the
+	view computes and serializes the time zone tables as it did before they were
+	an asset.
+	"""
+	if mode == 'per_request':
+		views._time_zones_asset = None
+	response = client.get('/settings')
+	if response.status_code != 200:
+		raise RuntimeError('GET /settings returned %s' % response.status_code)
+	return len(response.data)
+
+def run(num_requests=_NUM_REQUESTS, output_path=None):
+	"""Times the given count of requests of the settings page in each mode.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	db.drop_all_tables()
+	db.create_all_tables()
+	client = _create_client()
+	# Compile the templates and build the assets before measuring.
+	page_bytes = _get_settings(client, 'asset')
+
+	counter = measurements_module.StatementCounter()
+	measurements = dict((mode, measurements_module.Measurements(mode, counter))
+			for mode in _MODES)
+	for i in xrange(num_requests):
+		for mode in _MODES:
+			measurements[mode].measure(_get_settings, client, mode)
+	asset = views._get_time_zones_asset()
+	db.drop_all_tables()
+
+	measurements_module.print_summaries(measurements[mode] for mode in _MODES)
+	results = {
+		'benchmark': 'settings_page',
+		'created': datetime.utcnow().isoformat(),
+		'database': db.session.bind.dialect.name,
+		'num_requests': num_requests,
+		'page_bytes': page_bytes,
+		# The bytes that each settings page no longer contains.
+		'asset_bytes': len(asset.data),
+		'asset_compressed_bytes': len(asset.compressed_data),
+		'operations': dict((mode, measurements[mode].get_summary()) for mode in _MODES),
+	}
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--requests', type=int, default=_NUM_REQUESTS,
+			dest='num_requests', help='the number of settings page requests in each mode')
+	parser.add_argument('--output', dest='output_path',
+			help='the path of a file to write the results as JSON')
+	args = parser.parse_args(argv)
+	run(args.num_requests, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
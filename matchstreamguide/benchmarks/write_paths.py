@@ -0,0 +1,105 @@
+"""Times each write path of the db module on a generated league, reporting the
+p50 and p99 milliseconds and SQL statements per call.
+
+By default this uses the database of MSG_ENVIRONMENT, such as an in-memory
+SQLite database for MSG_ENVIRONMENT=test or the local PostgreSQL database for
+MSG_ENVIRONMENT=dev. This drops and creates all tables in the database.
+"""
+
+from datetime import datetime
+from matchstreamguide import db
+from matchstreamguide.benchmarks import league as league_module
+from matchstreamguide.benchmarks import measurements as measurements_module
+import random
+
+_STAR_TYPES = ('match', 'team', 'streamer')
+_OPERATIONS = (
+	'add_star_match', 'remove_star_match',
+	'add_star_team', 'remove_star_team',
+	'add_star_streamer', 'remove_star_streamer',
+	'add_stream_match', 'remove_stream_match',
+)
+# The default number of calls of each operation.
+_NUM_CALLS = 200
+# The number of attempts to choose something that is not starred or streamed.
+_MAX_ATTEMPTS = 100
+
+def _benchmark_stars(league, rng, measurements, num_calls):
+	"""Adds and then removes stars by random users for popular targets."""
+	for star_type in _STAR_TYPES:
+		add_star, remove_star = league_module.get_star_functions(star_type)
+		add_measurements = measurements[add_star.__name__]
+		remove_measurements = measurements[remove_star.__name__]
+		for i in xrange(num_calls):
+			for attempt in xrange(_MAX_ATTEMPTS):
+				user_id = rng.choice(league.user_ids)
+				star = league_module.choose_new_star(league, rng, user_id, star_type)
+				if star is not None:
+					break
+			else:
+				continue
+			star_type, starred_id = star
+			add_measurements.measure(add_star, user_id, starred_id, now=league.now)
+			remove_measurements.measure(remove_star, user_id, starred_id, now=league.now)
+
+def _benchmark_streams(league, rng, measurements, num_calls):
+	"""Adds and then removes streams by random streaming users for popular matches."""
+	for i in xrange(num_calls):
+		for attempt in xrange(_MAX_ATTEMPTS):
+			streamer_id = league.streamer_chooser.choose(rng)
+			match_id = league.match_chooser.choose(rng)
+			if (streamer_id, match_id) not in league.streamed_matches:
+				break
+		else:
+			continue
+		measurements['add_stream_match'].measure(
+				db.add_stream_match, streamer_id, match_id, now=league.now)
+		measurements['remove_stream_match'].measure(
+				db.remove_stream_match, streamer_id, match_id, now=league.now)
+
+def run(league_config=None, num_calls=_NUM_CALLS, seed=0, output_path=None):
+	"""Generates a league and times each write path on it.
+
+	Returns the results, and if output_path is not None, writes them as JSON.
+	"""
+	if league_config is None:
+		league_config = {}
+	rng = random.Random(seed)
+	db.drop_all_tables()
+	db.create_all_tables()
+	league = league_module.create_league(rng, **league_config)
+
+	counter = measurements_module.StatementCounter()
+	measurements = dict((operation, measurements_module.Measurements(operation, counter))
+			for operation in _OPERATIONS)
+	_benchmark_stars(league, rng, measurements, num_calls)
+	_benchmark_streams(league, rng, measurements, num_calls)
+	db.drop_all_tables()
+
+	measurements_module.print_summaries(
+			measurements[operation] for operation in _OPERATIONS)
+	results = {
+		'benchmark': 'write_paths',
+		'created': datetime.utcnow().isoformat(),
+		'database': db.session.bind.dialect.name,
+		'league': league.config,
+		'num_calls': num_calls,
+		'seed': seed,
+		'operations': dict((operation, measurements[operation].get_summary())
+				for operation in _OPERATIONS),
+	}
+	if output_path is not None:
+		measurements_module.write_results(output_path, results)
+	return results
+
+def main(argv=None):
+	parser = league_module.get_argument_parser(__doc__.split('\n\n')[0])
+	parser.add_argument('--calls', type=int, default=_NUM_CALLS, dest='num_calls',
+			help='the number of calls of each operation')
+	args = parser.parse_args(argv)
+	league_config = league_module.get_league_config(args)
+	run(league_config, args.num_calls, args.seed, args.output_path)
+
+
+if __name__ == '__main__':
+	main()
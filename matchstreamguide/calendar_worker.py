@@ -0,0 +1,25 @@
+from matchstreamguide import db
+import time
+
+# The seconds to sleep after finding no pending CalendarJobs.
+_IDLE_SECONDS = 1.0
+# The seconds between prunings of the change log.
+_PRUNE_SECONDS = 3600.0
+
+def run(batch_size=None, idle_seconds=_IDLE_SECONDS, prune_seconds=_PRUNE_SECONDS):
+	"""Processes CalendarJobs and prunes the change log until interrupted.
+
+	Because each batch of CalendarJobs is processed in one transaction, the
+	worker can be stopped and restarted at any time. Only one worker should run
+	at a time, and it should run even if QUEUE_CALENDAR_ENTRIES is False.
+	"""
+	last_prune_time = None
+	while True:
+		now = time.time()
+		if (last_prune_time is None) or (now - last_prune_time >= prune_seconds):
+			db.prune_changes()
+			last_prune_time = now
+		num_jobs = db.process_calendar_jobs(batch_size)
+		if not num_jobs:
+			time.sleep(idle_seconds)
+
@@ -1,8 +1,14 @@
 from matchstreamguide import app
+import common_db
 import db
+import flask
 from flask.ext.assets import Environment, Bundle
+import logging
 import os
+import page_cache
+import query_stats
 import sqlalchemy as sa
+import time
 
 
 class Configuration:
@@ -10,6 +16,46 @@ class Configuration:
 
 	JINJA_TRIM_BLOCKS = True
 	COFFEE_NO_BARE = True
+	# If True, a separate worker updates CalendarEntries; see run_msg_calendar_worker.py.
+	# That worker also prunes the change log, so it runs even if this is False.
+	QUEUE_CALENDAR_ENTRIES = False
+	# Either 'materialized', 'on_read', or 'hybrid'; see the calendar backends in db.py.
+	CALENDAR_BACKEND = 'materialized'
+	# For the 'hybrid' backend, the count of stars by a user for a materialized calendar.
+	# Users.num_starred must be backfilled before using it; see repair_user_counters
+	# in fabfile.py.
+	CALENDAR_MIN_MATERIALIZED_STARS = 50
+	# The path of the SQLite file that caches client-neutral pages, shared by all
+	# worker processes. If None, then no pages are cached.
+	PAGE_CACHE_PATH = None
+	# The count of seconds that a page is cached, because pages display relative times.
+	PAGE_CACHE_MAX_AGE = 60
+	# If True, client-neutral pages display times in UTC that times.coffee localizes,
+	# and so pages are cached for all clients instead of for each time zone.
+	TIME_NEUTRAL_PAGES = False
+	# The most seconds between reads of the change log by each worker. On PostgreSQL,
+	# a worker also reads it after being notified of a change.
+	CHANGE_POLL_INTERVAL = 1.0
+	# If True, the count and time of the statements of each request are logged. If
+	# False, statements are not timed at all.
+	QUERY_INSTRUMENTATION = False
+	# The seconds after which a statement is logged as slow, or None to not log it.
+	SLOW_QUERY_SECONDS = 0.1
+	# The path of the SQLite file that aggregates the statements of requests for each
+	# route across all worker processes. If None, then no statements are aggregated.
+	QUERY_STATS_PATH = None
+	# The URIs of read replicas of DATABASE_URI, which the getters that only read are
+	# routed to. For local testing, these can be copies of a SQLite file or other
+	# local PostgreSQL databases.
+	DATABASE_REPLICA_URIS = ()
+	# The most seconds that a replica can lag behind the primary and still be read.
+	REPLICA_MAX_LAG_SECONDS = 5.0
+	# The most seconds between checks of the lag of each replica by each worker.
+	REPLICA_LAG_CHECK_INTERVAL = 1.0
+	# The most hot statements of the getters that PostgreSQL prepares on each
+	# connection, or 0 to prepare no statements. The most executed statements are
+	# prepared, and replace colder ones. Other databases prepare none.
+	MAX_PREPARED_STATEMENTS = 0
 
 class DevelopmentConfiguration(Configuration):
 	"""Configuration used in a local development environment."""
@@ -30,6 +76,7 @@ class TestingConfiguration(Configuration):
 	TESTING = True
 	DATABASE = 'sqlite'
 	DATABASE_URI = 'sqlite:///:memory:'
+	CHANGE_POLL_INTERVAL = 0.0
 	SECRET_KEY = 'secret_key'
 	SCSS_FILTERS = 'scss'
 	COFFEESCRIPT_FILTERS = 'coffeescript'
@@ -64,13 +111,75 @@ env.config['coffee_no_bare'] = app.config['COFFEE_NO_BARE']
 css = Bundle('style.scss', filters=app.config['SCSS_FILTERS'], output='gen/style.css')
 env.register('all_css', css)
 # Compile CoffeeScript.
-app_js = Bundle('app.coffee', filters='coffeescript', output='gen/app.js')
+app_js = Bundle('times.coffee', 'app.coffee', filters='coffeescript', output='gen/app.js')
 settings_js = Bundle(
 		'settings.coffee', filters=app.config['COFFEESCRIPT_FILTERS'], output='gen/settings.js')
 env.register('app_js', app_js)
 env.register('settings_js', settings_js)
 
-db.create_session(app.config['DATABASE'], app.config['DATABASE_URI'])
+def _get_calendar_backend(config):
+	backend = config['CALENDAR_BACKEND']
+	if backend == 'materialized':
+		return db.MaterializedCalendarBackend()
+	elif backend == 'on_read':
+		return db.OnReadCalendarBackend()
+	elif backend == 'hybrid':
+		return db.HybridCalendarBackend(config['CALENDAR_MIN_MATERIALIZED_STARS'])
+	raise ValueError('Unknown calendar backend: %s' % backend)
+
+db.create_session(app.config['DATABASE'], app.config['DATABASE_URI'],
+		queue_calendar_entries=app.config['QUEUE_CALENDAR_ENTRIES'],
+		calendar_backend=_get_calendar_backend(app.config),
+		change_poll_interval=app.config['CHANGE_POLL_INTERVAL'],
+		instrument_queries=app.config['QUERY_INSTRUMENTATION'],
+		slow_query_seconds=app.config['SLOW_QUERY_SECONDS'],
+		replica_uris=app.config['DATABASE_REPLICA_URIS'],
+		max_replica_lag_seconds=app.config['REPLICA_MAX_LAG_SECONDS'],
+		replica_lag_check_interval=app.config['REPLICA_LAG_CHECK_INTERVAL'],
+		max_prepared_statements=app.config['MAX_PREPARED_STATEMENTS'])
+
+if app.config['PAGE_CACHE_PATH']:
+	import views
+	views.set_page_cache(page_cache.PageCache(
+			app.config['PAGE_CACHE_PATH'], app.config['PAGE_CACHE_MAX_AGE']))
+
+if app.config['QUERY_INSTRUMENTATION']:
+	import views
+	# Write the request and slow query logs to the log of uwsgi.
+	query_log_handler = logging.StreamHandler()
+	for logger_name in ('matchstreamguide.queries', 'common_db.slow_queries'):
+		logger = logging.getLogger(logger_name)
+		logger.setLevel(logging.INFO)
+		logger.addHandler(query_log_handler)
+	if app.config['QUERY_STATS_PATH']:
+		views.set_query_stats(query_stats.QueryStats(app.config['QUERY_STATS_PATH']))
+
+	# Begin the log before begin_request, so that it counts polling the change log.
+	@app.before_request
+	def begin_query_log():
+		common_db.begin_query_log()
+
+	@app.after_request
+	def end_query_log(response):
+		query_log = common_db.end_query_log()
+		if query_log is not None:
+			views.log_request_queries(query_log, response)
+		return response
+
+# The key of the time of the client's last write in the Flask session.
+_LAST_WRITE_TIME_KEY = 'last_write_time'
+
+@app.before_request
+def begin_request():
+	# Read the primary until the replicas include the client's last write.
+	db.begin_request(flask.session.get(_LAST_WRITE_TIME_KEY))
+
+if app.config['DATABASE_REPLICA_URIS']:
+	@app.after_request
+	def record_last_write_time(response):
+		if common_db.has_written():
+			flask.session[_LAST_WRITE_TIME_KEY] = time.time()
+		return response
 
 if environment != 'test':
 	@app.teardown_request
@@ -0,0 +1,107 @@
+"""Formats the datetimes of pages in the time zone and time format of a client.
+
+Time zones are cached in a bounded LRU shared by all requests, and formatted
+datetimes are memoized for each request, because many rows of a page share the
+same match time.
+"""
+
+import collections
+import pytz
+import threading
+
+FORMAT_12_HOUR_LOCALIZED = '%a %b %d %I:%M%p'
+FORMAT_24_HOUR_LOCALIZED = '%a %b %d %H:%M'
+FORMAT_12_HOUR_UTC = '%a %b %d %I:%M%p %Z'
+FORMAT_24_HOUR_UTC = '%a %b %d %H:%M %Z'
+
+_TIME_ZONES_MAX_SIZE = 256
+
+_time_zones = collections.OrderedDict()
+_time_zones_lock = threading.Lock()
+
+def get_time_zone(name):
+	"""Returns the pytz time zone with the given name.
+
+	Raises pytz.UnknownTimeZoneError if no time zone has that name.
+	"""
+	with _time_zones_lock:
+		time_zone = _time_zones.pop(name, None)
+		if time_zone is not None:
+			# Insert the time zone again to make it the most recently used.
+			_time_zones[name] = time_zone
+			return time_zone
+	time_zone = pytz.timezone(name)
+	with _time_zones_lock:
+		_time_zones[name] = time_zone
+		while len(_time_zones) > _TIME_ZONES_MAX_SIZE:
+			_time_zones.popitem(last=False)
+	return time_zone
+
+def _get_format(time_zone, time_format):
+	if time_zone:
+		if time_format == '12_hour':
+			return FORMAT_12_HOUR_LOCALIZED
+		return FORMAT_24_HOUR_LOCALIZED
+	else:
+		if time_format == '12_hour':
+			return FORMAT_12_HOUR_UTC
+		return FORMAT_24_HOUR_UTC
+
+def format_datetime(dt, time_zone, time_format):
+	"""Returns the naive datetime in UTC as a string in the given time zone and
+	time format, or in UTC if time_zone is None.
+	"""
+	utc_datetime = pytz.utc.localize(dt)
+	if time_zone:
+		utc_datetime = utc_datetime.astimezone(time_zone)
+	return utc_datetime.strftime(_get_format(time_zone, time_format))
+
+
+"""Formats datetimes in a time zone and time format, memoizing each string by
+its datetime, time zone, and time format.
+
+An instance is created for each request, so that its memo is discarded with the
+request.
+"""
+class DatetimeFormatter:
+	def __init__(self):
+		self._memo = {}
+
+	def format(self, dt, time_zone, time_format):
+		"""Returns the datetime formatted by format_datetime."""
+		key = (dt, time_zone.zone if time_zone else None, time_format)
+		formatted = self._memo.get(key)
+		if formatted is None:
+			formatted = format_datetime(dt, time_zone, time_format)
+			self._memo[key] = formatted
+		return formatted
+
+	def format_all(self, datetimes, time_zone, time_format):
+		"""Formats each datetime of the given sequence that is not memoized in one
+		pass, so that a later call of format for any of them returns the memoized
+		string.
+		"""
+		zone = time_zone.zone if time_zone else None
+		datetime_format = _get_format(time_zone, time_format)
+		memo = self._memo
+		for dt in datetimes:
+			key = (dt, zone, time_format)
+			if key not in memo:
+				utc_datetime = pytz.utc.localize(dt)
+				if time_zone:
+					utc_datetime = utc_datetime.astimezone(time_zone)
+				memo[key] = utc_datetime.strftime(datetime_format)
+
+
+def get_match_times(displayed):
+	"""Yields the time of each match in a DisplayedCalendar, a Displayed*List, or a
+	Displayed*Details.
+	"""
+	next_match = getattr(displayed, 'next_match', None)
+	if next_match is not None:
+		yield next_match.time
+	match_time = getattr(displayed, 'time', None)
+	if match_time is not None:
+		yield match_time
+	for match in getattr(displayed, 'matches', None) or ():
+		yield match.time
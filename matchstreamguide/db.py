@@ -1,4 +1,11 @@
+import array
+import bisect
+import collections
+import contextlib
+import cStringIO
+import csv
 from datetime import datetime, timedelta
+import itertools
 import re
 import sqlalchemy as sa
 import sqlalchemy.engine as sa_engine
@@ -8,7 +15,7 @@ import sqlalchemy.schema as sa_schema
 import sys
 
 import common_db
-from common_db import _get_now, close_session
+from common_db import _get_now, close_session, on_primary, query_budget, read_replica
 
 """A user of the site.
 """
@@ -16,11 +23,13 @@ class User(common_db.UserMixin, common_db._Base):
 	__tablename__ = 'Users'
 
 	num_stars = sa.Column(sa.Integer, default=0, nullable=False)
+	# The count of matches, teams, and streaming users starred by this user.
+	num_starred = sa.Column(sa.Integer, default=0, nullable=False)
 	can_stream = sa.Column(sa.Boolean, default=False, nullable=False)
 	stream_description = sa.Column(sa.String)
 
 	def __repr__(self):
-		return 'User(id=%r, name=%r, image_url_small=%r, image_url_large=%r, created=%r, last_seen=%r, url_by_id=%r, url_by_name=%r, num_stars=%r, can_stream=%r, stream_description=%r, steam_user=%r, twitch_user=%r)' % (
+		return 'User(id=%r, name=%r, image_url_small=%r, image_url_large=%r, created=%r, last_seen=%r, url_by_id=%r, url_by_name=%r, num_stars=%r, num_starred=%r, can_stream=%r, stream_description=%r, steam_user=%r, twitch_user=%r)' % (
 				self.id,
 				self.name,
 				self.image_url_small,
@@ -30,6 +39,7 @@ class User(common_db.UserMixin, common_db._Base):
 				self.url_by_id,
 				self.url_by_name,
 				self.num_stars,
+				self.num_starred,
 				self.can_stream,
 				self.stream_description,
 				self.steam_user,
@@ -37,7 +47,7 @@ class User(common_db.UserMixin, common_db._Base):
 
 
 _SETTINGS_TIME_FORMATS = ('12_hour', '24_hour')
-_DEFAULT_SETTINGS_TIME_FORMAT = '24_hour'
+DEFAULT_SETTINGS_TIME_FORMAT = '24_hour'
 
 class Settings(common_db._Base):
 	__tablename__ = 'Settings'
@@ -45,7 +55,7 @@ class Settings(common_db._Base):
 	user_id = sa.Column(sa.Integer, sa.ForeignKey('Users.id'), primary_key=True)
 	time_format = sa.Column(
 			sa.Enum(*_SETTINGS_TIME_FORMATS, name='SettingsTimeFormat'),
-			nullable=False, default=_DEFAULT_SETTINGS_TIME_FORMAT)
+			nullable=False, default=DEFAULT_SETTINGS_TIME_FORMAT)
 	country = sa.Column(sa.String)
 	time_zone = sa.Column(sa.String)
 
@@ -97,9 +107,11 @@ class Match(common_db._Base):
 	num_streams = sa.Column(sa.Integer, default=0, nullable=False)
 	is_streamed = sa.Column(sa.Boolean, default=False, nullable=False)
 	fingerprint = sa.Column(sa.String, nullable=False)
+	# A cancelled match is not in any list of matches.
+	is_cancelled = sa.Column(sa.Boolean, default=False, nullable=False)
 
 	def __repr__(self):
-		return 'Match(id=%r, team1_id=%r, team2_id=%r, time=%r, game=%r, division=%r, num_stars=%r, num_streams=%r, is_streamed=%r, fingerprint=%r)' % (
+		return 'Match(id=%r, team1_id=%r, team2_id=%r, time=%r, game=%r, division=%r, num_stars=%r, num_streams=%r, is_streamed=%r, fingerprint=%r, is_cancelled=%r)' % (
 				self.id,
 				self.team1_id,
 				self.team2_id,
@@ -109,7 +121,8 @@ class Match(common_db._Base):
 				self.num_stars,
 				self.num_streams,
 				self.is_streamed,
-				self.fingerprint)
+				self.fingerprint,
+				self.is_cancelled)
 
 
 """The association between a team in a match and its opponent.
@@ -140,7 +153,8 @@ class MatchEdit(common_db._Base):
 	id = sa.Column(sa.Integer, primary_key=True)
 	match_id = sa.Column(sa.Integer, sa.ForeignKey('Matches.id'), nullable=False)
 	user_id = sa.Column(sa.Integer, sa.ForeignKey('Users.id'), nullable=False)
-	action = sa.Column(sa.Enum('edit_time', 'cancel', name='MatchEditAction'), nullable=False)
+	action = sa.Column(sa.Enum('edit_time', 'cancel', 'restore', name='MatchEditAction'),
+			nullable=False)
 	data = sa.Column(sa.String)
 	comment = sa.Column(sa.String)
 
@@ -246,9 +260,31 @@ class CalendarEntry(common_db._Base):
 				self.num_user_stars)
 
 
+"""A pending job that rebuilds the CalendarEntries of a user or a match.
+
+Exactly one of user_id and match_id is not None.
+"""
+class CalendarJob(common_db._Base):
+	__tablename__ = 'CalendarJobs'
+
+	id = sa.Column(sa.Integer, primary_key=True)
+	user_id = sa.Column(sa.Integer, sa.ForeignKey('Users.id'))
+	match_id = sa.Column(sa.Integer, sa.ForeignKey('Matches.id'))
+	added = sa.Column(sa.DateTime, nullable=False)
+
+	def __repr__(self):
+		return 'CalendarJob(id=%r, user_id=%r, match_id=%r, added=%r)' % (
+				self.id,
+				self.user_id,
+				self.match_id,
+				self.added)
+
+
 # Indexes for adding teams and matches.
 sa_schema.Index('MatchesByFingerprint', Match.fingerprint, unique=True)
 sa_schema.Index('TeamsByFingerprint', Team.fingerprint, unique=True)
+# An index for finding the edits of a match.
+sa_schema.Index('MatchEditsByMatchIdAndAction', MatchEdit.match_id, MatchEdit.action)
 # Indexes for building and displaying the calendar.
 sa_schema.Index('MatchOpponentsByTeamIdAndIsStreamed',
 		MatchOpponent.team_id, MatchOpponent.is_streamed)
@@ -258,7 +294,10 @@ sa_schema.Index('StarredStreamersByStreamerId', StarredStreamer.streamer_id)
 sa_schema.Index('CalendarEntriesByMatchId', CalendarEntry.match_id)
 sa_schema.Index('CalendarEntriesByUserIdAndTimeAndMatchId',
 		CalendarEntry.user_id, CalendarEntry.time, CalendarEntry.match_id)
-# Indexes for displaying matches.
+sa_schema.Index('CalendarJobsByUserId', CalendarJob.user_id)
+sa_schema.Index('CalendarJobsByMatchId', CalendarJob.match_id)
+# Indexes for displaying matches. Each list query also reads the counts, game,
+# and division of each match from Matches, so these indexes only order the rows.
 sa_schema.Index('StarredMatchesByUserIdAndTimeAndMatchId',
 		StarredMatch.user_id, StarredMatch.time, StarredMatch.match_id)
 sa_schema.Index('MatchesByTimeAndMatchId', Match.time, Match.id)
@@ -268,8 +307,11 @@ sa_schema.Index('StreamedMatchesByMatchIdAndAddedAndStreamerId',
 sa_schema.Index('StarredTeamsByUserIdAndIndexedNameAndTeamId',
 		StarredTeam.user_id, StarredTeam.indexed_name, StarredTeam.team_id)
 sa_schema.Index('TeamsByIndexedNameAndTeamId', Team.indexed_name, Team.id)
-sa_schema.Index('MatchOpponentsByTeamIdAndTimeAndMatchId',
-		MatchOpponent.team_id, MatchOpponent.time, MatchOpponent.match_id)
+# The opponent is read from this index instead of from MatchOpponents, but the
+# rest of each match is still read from Matches.
+sa_schema.Index('MatchOpponentsByTeamIdAndTimeAndMatchIdAndOpponentId',
+		MatchOpponent.team_id, MatchOpponent.time, MatchOpponent.match_id,
+		MatchOpponent.opponent_id)
 # Indexes for displaying streamers.
 sa_schema.Index('StarredStreamersByUserIdAndIndexedNameAndStreamerId',
 		StarredStreamer.user_id, StarredStreamer.indexed_name, StarredStreamer.streamer_id)
@@ -282,9 +324,47 @@ sa_schema.Index('UsersByUrlById', User.url_by_id, unique=True)
 sa_schema.Index('UsersByUrlByName', User.url_by_name, unique=True)
 
 
-def create_session(database, database_uri):
+def create_session(database, database_uri, queue_calendar_entries=False,
+		calendar_backend=None, change_poll_interval=0.0,
+		instrument_queries=False, slow_query_seconds=None,
+		replica_uris=(), max_replica_lag_seconds=5.0, replica_lag_check_interval=1.0,
+		max_prepared_statements=0):
+	"""Creates the session.
+
+	If queue_calendar_entries is True, then adding or removing stars and streams
+	adds a CalendarJob instead of updating CalendarEntries, and a separate worker
+	calls process_calendar_jobs to update them.
+
+	The calendar_backend decides which users have a materialized calendar. If None,
+	the calendar of every user is materialized.
+
+	The change log is polled at most every change_poll_interval seconds; see
+	begin_request.
+
+	If instrument_queries is True, then the statements of each request are added
+	to its common_db.QueryLog; see common_db.create_session.
+
+	If replica_uris is not empty, then the getters that only read are routed to
+	those read replicas, unless the client wrote within their lag; see
+	common_db.set_read_replicas.
+
+	If max_prepared_statements is greater than 0, then on PostgreSQL the hot
+	statements of the paginators and getters are prepared on each connection; see
+	common_db.StatementCache.
+	"""
 	global session
-	session = common_db.create_session(database, database_uri)
+	session = common_db.create_session(database, database_uri,
+			instrument_queries, slow_query_seconds,
+			replica_uris, max_replica_lag_seconds, replica_lag_check_interval,
+			max_prepared_statements)
+
+	global _queue_calendar_entries
+	_queue_calendar_entries = queue_calendar_entries
+
+	global _calendar_backend
+	if calendar_backend is None:
+		calendar_backend = MaterializedCalendarBackend()
+	_calendar_backend = calendar_backend
 
 	global Users
 	global SettingsTable
@@ -297,6 +377,7 @@ def create_session(database, database_uri):
 	global StarredStreamers
 	global StreamedMatches
 	global CalendarEntries
+	global CalendarJobs
 
 	# Create aliases for each table.
 	Users = User.__table__
@@ -310,17 +391,153 @@ def create_session(database, database_uri):
 	StarredStreamers = StarredStreamer.__table__
 	StreamedMatches = StreamedMatch.__table__
 	CalendarEntries = CalendarEntry.__table__
+	CalendarJobs = CalendarJob.__table__
+
+	global change_bus
+	change_bus = common_db.ChangeBus(poll_interval=change_poll_interval)
+	change_bus.subscribe(_update_directories)
+	change_bus.subscribe(_update_starred_ids)
 
 
 def create_all_tables():
 	"""Creates all tables and indexes in the database."""
 	common_db.create_all_tables()
+	_reset_directories()
 
 def drop_all_tables():
 	"""Drops all tables and indexes in the database."""
 	common_db.drop_all_tables()
+	_reset_directories()
+
+# The columns added to existing tables, and their definitions for ALTER TABLE.
+# Each existing user has 0 starred until verify_counters repairs the users.
+_ADDED_COLUMNS = (
+	(User, 'num_starred', 'INTEGER NOT NULL DEFAULT 0'),
+	(Match, 'is_cancelled', 'BOOLEAN NOT NULL DEFAULT false'),
+)
+# The values added to existing PostgreSQL enum types.
+_ADDED_ENUM_VALUES = (
+	('MatchEditAction', 'restore'),
+)
+# The indexes that were replaced by indexes with more columns.
+_REPLACED_INDEXES = ('MatchOpponentsByTeamIdAndTimeAndMatchId',)
+
+def migrate_tables():
+	"""Adds the tables, columns, indexes, and enum values that a database created
+	by an earlier version lacks, and drops the indexes that were replaced.
+
+	Each step is skipped if the database already has its change, so this can run
+	more than once.
+	"""
+	connection = common_db._engine.connect()
+	is_postgresql = connection.dialect.name == 'postgresql'
+	if is_postgresql:
+		# ALTER TYPE ... ADD VALUE cannot run inside a transaction.
+		connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+	try:
+		if is_postgresql:
+			for type_name, value in _ADDED_ENUM_VALUES:
+				row = connection.execute(sa.text(
+						'SELECT 1 FROM pg_enum JOIN pg_type ON pg_enum.enumtypid = pg_type.oid '
+						'WHERE pg_type.typname = :type_name AND pg_enum.enumlabel = :value'),
+						type_name=type_name, value=value).first()
+				if row is None:
+					connection.execute('ALTER TYPE "%s" ADD VALUE \'%s\'' % (type_name, value))
+
+		inspector = sa.inspect(connection)
+		for table, column_name, definition in _ADDED_COLUMNS:
+			column_names = set(column['name']
+					for column in inspector.get_columns(table.__tablename__))
+			if column_name not in column_names:
+				connection.execute('ALTER TABLE "%s" ADD COLUMN %s %s' % (
+						table.__tablename__, column_name, definition))
+
+		# Create the new tables with their indexes.
+		common_db._Base.metadata.create_all(connection, checkfirst=True)
+		inspector = sa.inspect(connection)
+		tables = common_db._Base.metadata.sorted_tables
+		index_names = set(index['name']
+				for table in tables for index in inspector.get_indexes(table.name))
+		for index_name in _REPLACED_INDEXES:
+			if index_name in index_names:
+				connection.execute('DROP INDEX "%s"' % index_name)
+		for table in tables:
+			for index in table.indexes:
+				if index.name not in index_names:
+					index.create(connection)
+	finally:
+		connection.close()
+
+
+# The entity types of changes in the change log. Changes to streaming users are
+# of type common_db.USER_CHANGE_TYPE.
+MATCH_CHANGE_TYPE = 'match'
+TEAM_CHANGE_TYPE = 'team'
+# A change to the matches, teams, or streaming users starred by the user.
+STARRED_CHANGE_TYPE = 'starred'
+
+# The tags of the lists of all matches, teams, and streaming users.
+MATCH_LIST_TAG = 'matches'
+TEAM_LIST_TAG = 'teams'
+STREAMER_LIST_TAG = 'streamers'
+
+def get_match_tag(match_id):
+	"""Returns the tag of the match with the given identifier."""
+	return 'match:%s' % match_id
+
+def get_team_tag(team_id):
+	"""Returns the tag of the team with the given identifier."""
+	return 'team:%s' % team_id
+
+def get_streamer_tag(streamer_id):
+	"""Returns the tag of the streaming user with the given identifier."""
+	return 'streamer:%s' % streamer_id
+
+_CHANGE_TAGS = {
+	MATCH_CHANGE_TYPE: (MATCH_LIST_TAG, get_match_tag),
+	TEAM_CHANGE_TYPE: (TEAM_LIST_TAG, get_team_tag),
+	common_db.USER_CHANGE_TYPE: (STREAMER_LIST_TAG, get_streamer_tag),
+}
+
+def get_change_tag(change):
+	"""Returns the tag of the entity, or list of entities, of the ChangeEvent, or
+	None if the change is not displayed by any shared page.
+	"""
+	change_tags = _CHANGE_TAGS.get(change.entity_type)
+	if change_tags is None:
+		return None
+	list_tag, get_tag = change_tags
+	return list_tag if change.entity_id is None else get_tag(change.entity_id)
+
+def _add_changes(*changes):
+	"""Adds the given (entity_type, entity_id) pairs to the change log in the
+	current transaction.
+	"""
+	common_db.add_changes(changes)
+	_changes_added()
+
+def _changes_added():
+	"""Called after this worker added changes, so that they are delivered to it
+	before its directories are next used, regardless of change_poll_interval.
+	"""
+	global _should_poll_changes
+	_should_poll_changes = True
+	change_bus.expire()
+
+# The age after which a change is pruned from the change log, which is much
+# longer than any worker goes between polls.
+_CHANGES_MAX_AGE = timedelta(days=1)
+
+@close_session
+def prune_changes(now=None):
+	"""Deletes the changes older than _CHANGES_MAX_AGE from the change log, and
+	returns their count.
+	"""
+	now = _get_now(now)
+	return common_db.prune_changes(now - _CHANGES_MAX_AGE)
 
 
+@query_budget(4)
 @close_session
 def add_match(team1_id, team2_id, time, game, division, fingerprint, now=None):
 	"""Adds a match between two teams at a given time."""
@@ -349,14 +566,18 @@ def add_match(team1_id, team2_id, time, game, division, fingerprint, now=None):
 				team_id=team2_id, match_id=match_id, time=time, opponent_id=team1_id)
 		session.add(match_opponent1)
 		session.add(match_opponent2)
+		_add_changes((MATCH_CHANGE_TYPE, None),
+				(TEAM_CHANGE_TYPE, team1_id),
+				(TEAM_CHANGE_TYPE, team2_id))
 		session.commit()
 
-		return match.id
+		return match_id
 	except sa.exc.IntegrityError:
 		# The commit failed because teams with the given identifiers are missing.
 		session.rollback()
 		raise common_db.DbException._chain()
 
+@query_budget(3)
 @close_session
 def add_team(display_name, indexed_name, game, division, fingerprint, now=None):
 	"""Adds a team in the given game and division."""
@@ -368,10 +589,612 @@ def add_team(display_name, indexed_name, game, division, fingerprint, now=None):
 		team = Team(display_name=display_name, indexed_name=indexed_name,
 				game=game, division=division, fingerprint=fingerprint)
 		session.add(team)
+		session.flush()
 
+	team_id = team.id
+	_add_changes((TEAM_CHANGE_TYPE, None), (TEAM_CHANGE_TYPE, team_id))
 	session.commit()
-	return team.id
+	return team_id
+
+
+# The default count of records that load_schedule reads and writes in each batch.
+_SCHEDULE_BATCH_SIZE = 5000
+# The most values in the IN clause of a statement, which keeps the count of its
+# bind parameters below the limit of SQLite.
+_MAX_IN_VALUES = 500
+# The fewest rows that are copied into a staging table on PostgreSQL. Fewer rows
+# are written by executemany, without creating and dropping the staging table.
+_MIN_STAGED_ROWS = 100
+
+"""A team to add or update with load_schedule.
+"""
+class ScheduleTeam:
+	def __init__(self, display_name, indexed_name, game, division, fingerprint):
+		self.display_name = display_name
+		self.indexed_name = indexed_name
+		self.game = game
+		self.division = division
+		self.fingerprint = fingerprint
+
+	def __repr__(self):
+		return 'ScheduleTeam(display_name=%r, indexed_name=%r, game=%r, division=%r, fingerprint=%r)' % (
+				self.display_name,
+				self.indexed_name,
+				self.game,
+				self.division,
+				self.fingerprint)
+
+"""A match to add or update with load_schedule, between the teams with the given
+fingerprints.
+"""
+class ScheduleMatch:
+	def __init__(self, team1_fingerprint, team2_fingerprint, time, game, division,
+			fingerprint):
+		self.team1_fingerprint = team1_fingerprint
+		self.team2_fingerprint = team2_fingerprint
+		self.time = time
+		self.game = game
+		self.division = division
+		self.fingerprint = fingerprint
+
+	def __repr__(self):
+		return 'ScheduleMatch(team1_fingerprint=%r, team2_fingerprint=%r, time=%r, game=%r, division=%r, fingerprint=%r)' % (
+				self.team1_fingerprint,
+				self.team2_fingerprint,
+				self.time,
+				self.game,
+				self.division,
+				self.fingerprint)
+
+"""A match to cancel with load_schedule, which is recorded as a MatchEdit.
+"""
+class ScheduleCancel:
+	def __init__(self, fingerprint):
+		self.fingerprint = fingerprint
+
+	def __repr__(self):
+		return 'ScheduleCancel(fingerprint=%r)' % self.fingerprint
+
+"""A cancelled match to restore with load_schedule, which is recorded as a
+MatchEdit.
+"""
+class ScheduleRestore:
+	def __init__(self, fingerprint):
+		self.fingerprint = fingerprint
+
+	def __repr__(self):
+		return 'ScheduleRestore(fingerprint=%r)' % self.fingerprint
+
+"""The counts of the teams and matches that load_schedule inserted, updated,
+cancelled, restored, or left unchanged.
+"""
+class ScheduleLoadCounts:
+	_FIELDS = ('teams_inserted', 'teams_updated', 'teams_unchanged',
+			'matches_inserted', 'matches_updated', 'matches_cancelled',
+			'matches_restored', 'matches_unchanged')
+
+	def __init__(self, teams_inserted=0, teams_updated=0, teams_unchanged=0,
+			matches_inserted=0, matches_updated=0, matches_cancelled=0,
+			matches_restored=0, matches_unchanged=0):
+		self.teams_inserted = teams_inserted
+		self.teams_updated = teams_updated
+		self.teams_unchanged = teams_unchanged
+		self.matches_inserted = matches_inserted
+		self.matches_updated = matches_updated
+		self.matches_cancelled = matches_cancelled
+		self.matches_restored = matches_restored
+		self.matches_unchanged = matches_unchanged
+
+	def add(self, other):
+		"""Adds the counts of the other ScheduleLoadCounts to these counts."""
+		for field in ScheduleLoadCounts._FIELDS:
+			setattr(self, field, getattr(self, field) + getattr(other, field))
+
+	def _get_values(self):
+		return tuple(getattr(self, field) for field in ScheduleLoadCounts._FIELDS)
+
+	def __eq__(self, other):
+		return (isinstance(other, ScheduleLoadCounts) and
+				self._get_values() == other._get_values())
+
+	def __ne__(self, other):
+		return not (self == other)
+
+	def __repr__(self):
+		return 'ScheduleLoadCounts(teams_inserted=%r, teams_updated=%r, teams_unchanged=%r, matches_inserted=%r, matches_updated=%r, matches_cancelled=%r, matches_restored=%r, matches_unchanged=%r)' % (
+				self._get_values())
+
+def _get_rows_by_fingerprint(fingerprint_column, columns, fingerprints):
+	"""Returns a dict from each of the given fingerprints that exists to the values
+	of the given columns of its row.
+	"""
+	fingerprints = list(fingerprints)
+	rows_by_fingerprint = {}
+	for i in xrange(0, len(fingerprints), _MAX_IN_VALUES):
+		rows = session.execute(sa.select([fingerprint_column] + columns)
+				.where(fingerprint_column.in_(fingerprints[i:i + _MAX_IN_VALUES])))
+		for row in rows:
+			rows_by_fingerprint[row[0]] = tuple(row[1:])
+	return rows_by_fingerprint
+
+def _add_match_edits(editor_id, action, edits, comment=None):
+	"""Adds a MatchEdit by the given user with the given action for each match
+	identifier and data in edits.
+
+	The edits of a load are few, so they are inserted by executemany on every
+	database.
+	"""
+	if not edits:
+		return
+	session.execute(MatchEdits.insert(), [{
+			'match_id': match_id,
+			'user_id': editor_id,
+			'action': action,
+			'data': data,
+			'comment': comment,
+		} for match_id, data in edits])
+
+def _should_stage(rows):
+	"""Returns whether to write the given rows through a staging table."""
+	return (session.bind.dialect.name == 'postgresql' and
+			len(rows) >= _MIN_STAGED_ROWS)
+
+def _get_copy_value(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+@contextlib.contextmanager
+def _staging_table(name, columns, rows):
+	"""Creates a temporary table with the given name and columns on PostgreSQL,
+	copies the rows into it with COPY, and drops it on exit.
+
+	Each row is a dict from the name of each column to its value, which must not be
+	None. If the transaction is rolled back, then so is creating the table.
+	"""
+	connection = session.connection()
+	staging = sa.Table(name, sa.MetaData(),
+			*[sa.Column(column.name, column.type) for column in columns],
+			prefixes=['TEMPORARY'])
+	staging.create(connection)
+
+	# Quote every value, so that no value is read as NULL.
+	data = cStringIO.StringIO()
+	writer = csv.writer(data, quoting=csv.QUOTE_ALL)
+	for row in rows:
+		writer.writerow([_get_copy_value(row[column.name]) for column in columns])
+	data.seek(0)
+	preparer = connection.dialect.identifier_preparer
+	cursor = connection.connection.cursor()
+	try:
+		cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (
+					preparer.format_table(staging),
+					', '.join(preparer.format_column(column) for column in staging.columns)),
+				data)
+	finally:
+		cursor.close()
+
+	yield staging
+	staging.drop(connection)
+
+def _bulk_insert(table, rows):
+	"""Inserts the rows into the table, where each row is a dict from the name of
+	each column without a default to its value.
+
+	On PostgreSQL many rows are copied into a staging table and inserted by one
+	statement, and otherwise they are inserted by executemany. Rows are also
+	inserted by executemany if a column that is not copied has a default that is not
+	a scalar, such as a function, which SQLAlchemy calls for each row.
+	"""
+	if not rows:
+		return
+	defaulted_columns = [column for column in table.columns
+			if (not column.primary_key and column.name not in rows[0] and
+				column.default is not None)]
+	if (not _should_stage(rows) or
+			not all(column.default.is_scalar for column in defaulted_columns)):
+		session.execute(table.insert(), rows)
+		return
+
+	columns = [table.c[name] for name in sorted(rows[0])]
+	with _staging_table('staging_%s' % table.name.lower(), columns, rows) as staging:
+		# Insert the default value of each column that is not copied.
+		selected = [staging.c[column.name] for column in columns]
+		selected.extend(sa.literal(column.default.arg, column.type)
+				for column in defaulted_columns)
+		session.execute(table.insert().from_select(
+				columns + defaulted_columns, sa.select(selected)))
+
+def _bulk_update(table, key_name, rows):
+	"""Updates the rows of the table where the column named key_name has the given
+	value, where each row is a dict from the name of that column and each updated
+	column to its value.
+
+	On PostgreSQL many rows are copied into a staging table and updated by one
+	statement, and otherwise they are updated by executemany.
+	"""
+	if not rows:
+		return
+	key_column = table.c[key_name]
+	updated_columns = [table.c[name] for name in sorted(rows[0]) if name != key_name]
+	if not _should_stage(rows):
+		# Name the bind parameters differently than the columns that they update.
+		session.execute(table.update()
+				.where(key_column == sa.bindparam('b_%s' % key_name))
+				.values(dict((column.name, sa.bindparam('b_%s' % column.name))
+					for column in updated_columns)),
+			[dict(('b_%s' % name, value) for name, value in row.iteritems())
+				for row in rows])
+		return
+
+	with _staging_table('staging_%s' % table.name.lower(),
+			[key_column] + updated_columns, rows) as staging:
+		session.execute(table.update()
+				.where(key_column == staging.c[key_name])
+				.values(dict((column.name, staging.c[column.name])
+					for column in updated_columns)))
+
+def _update_match_times(match_times):
+	"""Sets the time of each match in the given dict from match identifiers to
+	times, and the copies of its time in MatchOpponents, StarredMatches,
+	StreamedMatches, and CalendarEntries.
+
+	This executes a statement for each table, instead of reading or updating the
+	rows of each user.
+	"""
+	if not match_times:
+		return
+	tables = ((Matches, Match.id),
+			(MatchOpponents, MatchOpponent.match_id),
+			(StarredMatches, StarredMatch.match_id),
+			(StreamedMatches, StreamedMatch.match_id),
+			(CalendarEntries, CalendarEntry.match_id))
+	if not _should_stage(match_times):
+		params = [{'b_match_id': match_id, 'b_time': time}
+				for match_id, time in match_times.iteritems()]
+		for table, match_id_column in tables:
+			session.execute(table.update()
+					.where(match_id_column == sa.bindparam('b_match_id'))
+					.values(time=sa.bindparam('b_time')),
+				params)
+		return
+
+	# Copy the times once, and update each table from them.
+	rows = [{'match_id': match_id, 'time': time}
+			for match_id, time in match_times.iteritems()]
+	with _staging_table('staging_match_times',
+			[MatchOpponent.match_id, MatchOpponent.time], rows) as staging:
+		for table, match_id_column in tables:
+			session.execute(table.update()
+					.where(match_id_column == staging.c.match_id)
+					.values(time=staging.c.time))
+
+def _load_schedule_teams(teams, counts):
+	"""Inserts or updates the given ScheduleTeams, and returns the changes to add.
+
+	The display and indexed names of an existing team are updated, and so are the
+	copies of its indexed name in StarredTeams.
+	"""
+	teams = collections.OrderedDict((team.fingerprint, team) for team in teams)
+	existing_teams = _get_rows_by_fingerprint(Team.fingerprint,
+			[Team.id, Team.display_name, Team.indexed_name], teams.iterkeys())
+	inserted_teams = []
+	updated_teams = []
+	for fingerprint, team in teams.iteritems():
+		existing_team = existing_teams.get(fingerprint)
+		if existing_team is None:
+			inserted_teams.append({
+				'display_name': team.display_name,
+				'indexed_name': team.indexed_name,
+				'game': team.game,
+				'division': team.division,
+				'fingerprint': fingerprint,
+			})
+			continue
+		team_id, display_name, indexed_name = existing_team
+		if (display_name, indexed_name) == (team.display_name, team.indexed_name):
+			counts.teams_unchanged += 1
+		else:
+			updated_teams.append({
+				'id': team_id,
+				'display_name': team.display_name,
+				'indexed_name': team.indexed_name,
+			})
+
+	_bulk_insert(Teams, inserted_teams)
+	_bulk_update(Teams, 'id', updated_teams)
+	_bulk_update(StarredTeams, 'team_id',
+			[{'team_id': team['id'], 'indexed_name': team['indexed_name']}
+				for team in updated_teams])
+	counts.teams_inserted += len(inserted_teams)
+	counts.teams_updated += len(updated_teams)
+
+	changes = []
+	if inserted_teams or updated_teams:
+		changes.append((TEAM_CHANGE_TYPE, None))
+	changes.extend((TEAM_CHANGE_TYPE, team['id']) for team in updated_teams)
+	return changes
+
+def _load_schedule_matches(matches, counts, editor_id=None, edit_comment=None):
+	"""Inserts or updates the given ScheduleMatches, and returns the changes to add.
+
+	The time, game, and division of an existing match are updated, but not its
+	teams. If editor_id is not None, then each changed time is also recorded as a
+	MatchEdit by that user. Raises DbException if a match has a team that does not
+	exist.
+	"""
+	matches = collections.OrderedDict((match.fingerprint, match) for match in matches)
+	existing_matches = _get_rows_by_fingerprint(Match.fingerprint,
+			[Match.id, Match.team1_id, Match.team2_id, Match.time, Match.game,
+				Match.division],
+			matches.iterkeys())
+	team_fingerprints = set()
+	for fingerprint, match in matches.iteritems():
+		if fingerprint not in existing_matches:
+			team_fingerprints.add(match.team1_fingerprint)
+			team_fingerprints.add(match.team2_fingerprint)
+	team_ids = dict((fingerprint, row[0]) for fingerprint, row in
+			_get_rows_by_fingerprint(Team.fingerprint, [Team.id], team_fingerprints)
+				.iteritems())
+	missing_fingerprints = team_fingerprints.difference(team_ids)
+	if missing_fingerprints:
+		raise common_db.DbException(
+				'Teams do not exist: %s' % ', '.join(sorted(missing_fingerprints)))
+
+	inserted_matches = []
+	updated_matches = []
+	match_times = {}
+	changed_team_ids = set()
+	for fingerprint, match in matches.iteritems():
+		existing_match = existing_matches.get(fingerprint)
+		if existing_match is None:
+			team1_id = team_ids[match.team1_fingerprint]
+			team2_id = team_ids[match.team2_fingerprint]
+			inserted_matches.append({
+				'team1_id': team1_id,
+				'team2_id': team2_id,
+				'time': match.time,
+				'game': match.game,
+				'division': match.division,
+				'fingerprint': fingerprint,
+			})
+			changed_team_ids.update((team1_id, team2_id))
+			continue
+		match_id, team1_id, team2_id, time, game, division = existing_match
+		if (game, division) != (match.game, match.division):
+			updated_matches.append(
+					{'id': match_id, 'game': match.game, 'division': match.division})
+		if time != match.time:
+			match_times[match_id] = match.time
+			changed_team_ids.update((team1_id, team2_id))
+		elif (game, division) == (match.game, match.division):
+			counts.matches_unchanged += 1
+
+	_bulk_insert(Matches, inserted_matches)
+	# Add both opponents of each inserted match.
+	match_ids = _get_rows_by_fingerprint(Match.fingerprint, [Match.id],
+			(match['fingerprint'] for match in inserted_matches))
+	match_opponents = []
+	for match in inserted_matches:
+		match_id = match_ids[match['fingerprint']][0]
+		for team_id, opponent_id in ((match['team1_id'], match['team2_id']),
+				(match['team2_id'], match['team1_id'])):
+			match_opponents.append({
+				'match_id': match_id,
+				'team_id': team_id,
+				'time': match['time'],
+				'opponent_id': opponent_id,
+			})
+	_bulk_insert(MatchOpponents, match_opponents)
+	_bulk_update(Matches, 'id', updated_matches)
+	_update_match_times(match_times)
+	if editor_id is not None:
+		_add_match_edits(editor_id, 'edit_time',
+				[(match_id, time.isoformat())
+					for match_id, time in sorted(match_times.iteritems())],
+				edit_comment)
+
+	updated_match_ids = set(match['id'] for match in updated_matches)
+	updated_match_ids.update(match_times)
+	counts.matches_inserted += len(inserted_matches)
+	counts.matches_updated += len(updated_match_ids)
+
+	changes = []
+	if inserted_matches or updated_match_ids:
+		changes.append((MATCH_CHANGE_TYPE, None))
+	changes.extend((MATCH_CHANGE_TYPE, match_id) for match_id in sorted(updated_match_ids))
+	changes.extend((TEAM_CHANGE_TYPE, team_id) for team_id in sorted(changed_team_ids))
+	return changes
+
+def _load_schedule_cancels(records, is_cancelled, counts, editor_id,
+		edit_comment=None):
+	"""Cancels the matches of the given ScheduleCancels if is_cancelled is True, or
+	restores the matches of the given ScheduleRestores otherwise, and returns the
+	changes to add.
+
+	Each match that changes is recorded as a MatchEdit by the given user. Raises
+	DbException if a match does not exist.
+	"""
+	fingerprints = set(record.fingerprint for record in records)
+	if not fingerprints:
+		return []
+	if editor_id is None:
+		raise common_db.DbException('Cancelling or restoring matches requires an editor')
+	existing_matches = _get_rows_by_fingerprint(Match.fingerprint,
+			[Match.id, Match.team1_id, Match.team2_id, Match.is_cancelled], fingerprints)
+	missing_fingerprints = fingerprints.difference(existing_matches)
+	if missing_fingerprints:
+		raise common_db.DbException(
+				'Matches do not exist: %s' % ', '.join(sorted(missing_fingerprints)))
+
+	changed_matches = sorted(row[:3] for row in existing_matches.itervalues()
+			if row[3] != is_cancelled)
+	_bulk_update(Matches, 'id',
+			[{'id': match_id, 'is_cancelled': is_cancelled}
+				for match_id, team1_id, team2_id in changed_matches])
+	_add_match_edits(editor_id, 'cancel' if is_cancelled else 'restore',
+			[(match_id, None) for match_id, team1_id, team2_id in changed_matches],
+			edit_comment)
+	if is_cancelled:
+		counts.matches_cancelled += len(changed_matches)
+	else:
+		counts.matches_restored += len(changed_matches)
+	counts.matches_unchanged += len(existing_matches) - len(changed_matches)
+
+	if not changed_matches:
+		return []
+	# The matches are added to or removed from the lists of all matches and teams.
+	changes = [(MATCH_CHANGE_TYPE, None)]
+	changes.extend((MATCH_CHANGE_TYPE, match_id)
+			for match_id, team1_id, team2_id in changed_matches)
+	team_ids = set()
+	for match_id, team1_id, team2_id in changed_matches:
+		team_ids.update((team1_id, team2_id))
+	changes.extend((TEAM_CHANGE_TYPE, team_id) for team_id in sorted(team_ids))
+	return changes
+
+@close_session
+def load_schedule(records, batch_size=None, editor_id=None, edit_comment=None):
+	"""Inserts, updates, cancels, or restores the teams and matches of an iterable
+	of ScheduleTeam, ScheduleMatch, ScheduleCancel, and ScheduleRestore records, and
+	returns a ScheduleLoadCounts.
+
+	Teams and matches are found by their fingerprints. The records are read and
+	written in batches of batch_size, and each batch commits separately. A match
+	must follow the teams that it references, either in its batch or in an earlier
+	batch. If a match has a team that does not exist, then its batch is rolled back
+	and DbException is raised.
+
+	If editor_id is not None, then each changed match time is recorded as a
+	MatchEdit by that user with the given comment. Cancelling or restoring a match
+	is also recorded as a MatchEdit, and requires editor_id. A cancelled match keeps
+	its stars and streams, but is not in any list of matches until it is restored.
+	"""
+	if batch_size is None:
+		batch_size = _SCHEDULE_BATCH_SIZE
+	counts = ScheduleLoadCounts()
+	records = iter(records)
+	while True:
+		batch = list(itertools.islice(records, batch_size))
+		if not batch:
+			return counts
+		batch_counts = ScheduleLoadCounts()
+		try:
+			changes = _load_schedule_teams(
+					(record for record in batch if isinstance(record, ScheduleTeam)),
+					batch_counts)
+			changes.extend(_load_schedule_matches(
+					(record for record in batch if isinstance(record, ScheduleMatch)),
+					batch_counts, editor_id, edit_comment))
+			changes.extend(_load_schedule_cancels(
+					[record for record in batch if isinstance(record, ScheduleCancel)],
+					True, batch_counts, editor_id, edit_comment))
+			changes.extend(_load_schedule_cancels(
+					[record for record in batch if isinstance(record, ScheduleRestore)],
+					False, batch_counts, editor_id, edit_comment))
+			if changes:
+				_add_changes(*changes)
+			session.commit()
+		except common_db.DbException:
+			session.rollback()
+			raise
+		except sa.exc.IntegrityError:
+			session.rollback()
+			raise common_db.DbException._chain()
+		counts.add(batch_counts)
+
+def _edit_match_times(editor_id, match_times, comment):
+	"""Sets the times of the matches in the given dict from match identifiers to
+	times and commits, and returns the count of matches whose time changed.
+	"""
+	match_ids = sorted(match_times)
+	existing_matches = {}
+	try:
+		for i in xrange(0, len(match_ids), _MAX_IN_VALUES):
+			rows = session.execute(
+					sa.select([Match.id, Match.team1_id, Match.team2_id, Match.time])
+						.where(Match.id.in_(match_ids[i:i + _MAX_IN_VALUES])))
+			for row in rows:
+				existing_matches[row[0]] = tuple(row[1:])
+		missing_match_ids = set(match_ids).difference(existing_matches)
+		if missing_match_ids:
+			raise common_db.DbException('Matches do not exist: %s' %
+					', '.join(str(match_id) for match_id in sorted(missing_match_ids)))
+
+		changed_times = dict((match_id, time) for match_id, time in match_times.iteritems()
+				if existing_matches[match_id][2] != time)
+		if not changed_times:
+			return 0
+		_update_match_times(changed_times)
+		_add_match_edits(editor_id, 'edit_time',
+				[(match_id, time.isoformat())
+					for match_id, time in sorted(changed_times.iteritems())],
+				comment)
+
+		changes = [(MATCH_CHANGE_TYPE, None)]
+		changes.extend((MATCH_CHANGE_TYPE, match_id) for match_id in sorted(changed_times))
+		team_ids = set()
+		for match_id in changed_times:
+			team_ids.update(existing_matches[match_id][:2])
+		changes.extend((TEAM_CHANGE_TYPE, team_id) for team_id in sorted(team_ids))
+		_add_changes(*changes)
+		session.commit()
+		return len(changed_times)
+	except common_db.DbException:
+		session.rollback()
+		raise
+	except sa.exc.IntegrityError:
+		# The commit failed because the editor is missing.
+		session.rollback()
+		raise common_db.DbException._chain()
 
+@query_budget(8)
+@close_session
+def edit_match_time(editor_id, match_id, time, comment=None):
+	"""Sets the time of the match with the given identifier, and records it as a
+	MatchEdit by the given user.
+
+	The copies of the time in MatchOpponents, StarredMatches, StreamedMatches, and
+	CalendarEntries are updated by one statement for each table, regardless of the
+	count of stars of the match. Returns whether the time changed.
+	"""
+	return _edit_match_times(editor_id, {match_id: time}, comment) > 0
+
+@close_session
+def edit_match_times(editor_id, match_times, comment=None):
+	"""Sets the times of the matches in the given dict from match identifiers to
+	times in one transaction, and records a MatchEdit by the given user for each.
+
+	Returns the count of matches whose time changed. If a match does not exist,
+	then no time is changed and DbException is raised.
+	"""
+	return _edit_match_times(editor_id, dict(match_times), comment)
+
+@close_session
+def get_schedule_by_fingerprint(team_fingerprints, match_fingerprints):
+	"""Returns the current state of the teams and matches with the given
+	fingerprints that exist.
+
+	This returns a dict from each team fingerprint to the display name and indexed
+	name of its team, and a dict from each match fingerprint to the time, game,
+	division, and whether its match is cancelled.
+	"""
+	teams = _get_rows_by_fingerprint(Team.fingerprint,
+			[Team.display_name, Team.indexed_name], team_fingerprints)
+	matches = _get_rows_by_fingerprint(Match.fingerprint,
+			[Match.time, Match.game, Match.division, Match.is_cancelled],
+			match_fingerprints)
+	return teams, matches
+
+@close_session
+def get_match_ids_by_fingerprint(fingerprints):
+	"""Returns a dict from each of the given fingerprints of an existing match to
+	its identifier.
+	"""
+	match_ids = _get_rows_by_fingerprint(Match.fingerprint, [Match.id], fingerprints)
+	return dict((fingerprint, row[0]) for fingerprint, row in match_ids.iteritems())
+
+@query_budget(7)
 @close_session
 def add_star_match(client_id, match_id, now=None):
 	"""Adds a star by the client for the match with the given identifier."""
@@ -399,13 +1222,16 @@ def add_star_match(client_id, match_id, now=None):
 
 	# Increment the count of stars for the match.
 	match.num_stars += 1
+	_update_num_starred(client_id, 1)
 
 	# If needed, add a CalendarEntry for the streamed match.
-	if match.is_streamed:
-		_increment_num_user_stars(client_id, match, now)
+	_update_user_calendar(client_id, 1, match.is_streamed,
+			lambda: _increment_num_user_stars(client_id, match, now), now)
 
+	_add_changes((MATCH_CHANGE_TYPE, match_id), (STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(7)
 @close_session
 def remove_star_match(client_id, match_id, now=None):
 	"""Removes a star by the client for the match with the given identifier."""
@@ -423,17 +1249,20 @@ def remove_star_match(client_id, match_id, now=None):
 	session.execute(Matches.update()
 			.where(Match.id == match_id)
 			.values({Match.num_stars: Match.num_stars - 1}))
+	_update_num_starred(client_id, -1)
 
 	# If needed, remove a CalendarEntry for the streamed match.
 	is_streamed = session.query(Match.is_streamed)\
 			.filter(Match.id == match_id)\
 			.one()\
 			.is_streamed
-	if is_streamed:
-		_decrement_num_user_stars(client_id, match_id, now)
+	_update_user_calendar(client_id, -1, is_streamed,
+			lambda: _decrement_num_user_stars(client_id, match_id, now), now)
 
+	_add_changes((MATCH_CHANGE_TYPE, match_id), (STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(7)
 @close_session
 def add_star_team(client_id, team_id, now=None):
 	"""Adds a star by the client for the team with the given identifier."""
@@ -464,16 +1293,20 @@ def add_star_team(client_id, team_id, now=None):
 	session.execute(Teams.update()
 			.where(Team.id == team_id)
 			.values({Team.num_stars: Team.num_stars + 1}))
+	_update_num_starred(client_id, 1)
 
 	# If needed, add a CalendarEntry for each streamed match.
-	matches_cursor = session.query(MatchOpponent.match_id, Match)\
-			.join(Match, MatchOpponent.match_id == Match.id)\
-			.filter(MatchOpponent.team_id == team_id, MatchOpponent.is_streamed == True)
-	for match_id, match in matches_cursor:
-		_increment_num_user_stars(client_id, match, now)
-	
+	matches = sa.select([MatchOpponent.match_id, MatchOpponent.time])\
+			.where(sa.and_(
+				MatchOpponent.team_id == team_id,
+				MatchOpponent.is_streamed == True))
+	_update_user_calendar(client_id, 1, True,
+			lambda: _multi_increment_user_num_user_stars(client_id, matches, now), now)
+
+	_add_changes((TEAM_CHANGE_TYPE, team_id), (STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(6)
 @close_session
 def remove_star_team(client_id, team_id, now=None):
 	"""Removes a star by the client for the team with the given identifier."""
@@ -491,15 +1324,20 @@ def remove_star_team(client_id, team_id, now=None):
 	session.execute(Teams.update()
 			.where(Team.id == team_id)
 			.values({Team.num_stars: Team.num_stars - 1}))
+	_update_num_starred(client_id, -1)
 
 	# If needed, remove a CalendarEntry for each streamed match.
-	match_ids_cursor = session.query(MatchOpponent.match_id)\
-			.filter(MatchOpponent.team_id == team_id, MatchOpponent.is_streamed == True)
-	for row in match_ids_cursor:
-		_decrement_num_user_stars(client_id, row.match_id, now)
-
+	match_ids = sa.select([MatchOpponent.match_id])\
+			.where(sa.and_(
+				MatchOpponent.team_id == team_id,
+				MatchOpponent.is_streamed == True))
+	_update_user_calendar(client_id, -1, True,
+			lambda: _multi_decrement_user_num_user_stars(client_id, match_ids, now), now)
+
+	_add_changes((TEAM_CHANGE_TYPE, team_id), (STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(7)
 @close_session
 def add_star_streamer(client_id, streamer_id, now=None):
 	"""Adds a star by the client for the streaming user with the given identifier."""
@@ -530,16 +1368,18 @@ def add_star_streamer(client_id, streamer_id, now=None):
 	session.execute(Users.update()
 			.where(User.id == streamer_id)
 			.values({User.num_stars: User.num_stars + 1}))
+	_update_num_starred(client_id, 1)
 
 	# If needed, add a CalendarEntry for each streamed match.
-	matches_cursor = session.query(StreamedMatch.match_id, Match)\
-			.join(Match, StreamedMatch.match_id == Match.id)\
-			.filter(StreamedMatch.streamer_id == streamer_id)
-	for match_id, match in matches_cursor:
-		_increment_num_user_stars(client_id, match, now)
+	matches = sa.select([StreamedMatch.match_id, StreamedMatch.time])\
+			.where(StreamedMatch.streamer_id == streamer_id)
+	_update_user_calendar(client_id, 1, True,
+			lambda: _multi_increment_user_num_user_stars(client_id, matches, now), now)
 
+	_add_changes((common_db.USER_CHANGE_TYPE, streamer_id), (STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(6)
 @close_session
 def remove_star_streamer(client_id, streamer_id, now=None):
 	"""Removes a star by the client for the streaming user with the given identifier."""
@@ -557,13 +1397,16 @@ def remove_star_streamer(client_id, streamer_id, now=None):
 	session.execute(Users.update()
 			.where(User.id == streamer_id)
 			.values({User.num_stars: User.num_stars - 1}))
+	_update_num_starred(client_id, -1)
 
 	# If needed, remove a CalendarEntry for each streamed match.
-	match_ids_cursor = session.query(StreamedMatch.match_id)\
-			.filter(StreamedMatch.streamer_id == streamer_id)
-	for row in match_ids_cursor:
-		_decrement_num_user_stars(client_id, row.match_id, now)
+	match_ids = sa.select([StreamedMatch.match_id])\
+			.where(StreamedMatch.streamer_id == streamer_id)
+	_update_user_calendar(client_id, -1, True,
+			lambda: _multi_decrement_user_num_user_stars(client_id, match_ids, now), now)
 
+	_add_changes((common_db.USER_CHANGE_TYPE, streamer_id),
+			(STARRED_CHANGE_TYPE, client_id))
 	session.commit()
 
 
@@ -572,6 +1415,7 @@ def _set_match_opponent_streaming(match_id, is_streamed):
 				.where(MatchOpponent.match_id == match_id)
 				.values({MatchOpponent.is_streamed: is_streamed}))
 
+@query_budget(6)
 @close_session
 def add_stream_match(client_id, match_id, comment=None, now=None):
 	"""Adds a stream by the client for the match with the given identifier."""
@@ -594,17 +1438,22 @@ def add_stream_match(client_id, match_id, comment=None, now=None):
 	if match.num_streams > 0:
 		# This is not the first streaming user for the match.
 		match.num_streams += 1
-		_add_not_first_stream_calendar_entries(client_id, match, now)
+		_update_match_calendars(match_id,
+				lambda: _add_not_first_stream_calendar_entries(client_id, match, now), now)
 	else:
 		# This is the first streaming user for the match.
 		_set_match_opponent_streaming(match_id, True)
 
 		match.num_streams = 1
 		match.is_streamed = True
-		_add_first_stream_calendar_entries(client_id, match, now)
+		_update_match_calendars(match_id,
+				lambda: _add_first_stream_calendar_entries(client_id, match, now), now)
 
+	_add_changes((MATCH_CHANGE_TYPE, match_id),
+			(common_db.USER_CHANGE_TYPE, client_id))
 	session.commit()
 
+@query_budget(6)
 @close_session
 def remove_stream_match(client_id, match_id, now=None):
 	"""Removes a stream by the client for the match with the given identifier."""
@@ -627,7 +1476,8 @@ def remove_stream_match(client_id, match_id, now=None):
 		session.execute(Matches.update()
 				.where(Match.id == match_id)
 				.values({Match.num_streams: num_streams - 1}))
-		_remove_not_last_stream_calendar_entries(client_id, match_id, now)
+		_update_match_calendars(match_id,
+				lambda: _remove_not_last_stream_calendar_entries(client_id, match_id, now), now)
 	else:
 		# This was the last streaming user for the match.
 		_set_match_opponent_streaming(match_id, False)
@@ -635,107 +1485,258 @@ def remove_stream_match(client_id, match_id, now=None):
 		session.execute(Matches.update()
 				.where(Match.id == match_id)
 				.values({Match.num_streams: 0, Match.is_streamed: False}))
-		_remove_last_stream_calendar_entries(client_id, match_id, now)
+		_update_match_calendars(match_id,
+				lambda: _remove_last_stream_calendar_entries(client_id, match_id, now), now)
 	
+	_add_changes((MATCH_CHANGE_TYPE, match_id),
+			(common_db.USER_CHANGE_TYPE, client_id))
 	session.commit()
 
 
-def _get_calendar_entry(user_id, match):
-	"""Returns a CalendarEntry created with the given user identifier and match."""
-	return CalendarEntry(user_id=user_id,
-			match_id=match.id,
-			time=match.time,
-			num_user_stars=1)
+def _update_num_starred(client_id, delta):
+	"""Adds the given delta to the count of stars by the client."""
+	session.execute(Users.update()
+			.where(User.id == client_id)
+			.values({User.num_starred: User.num_starred + delta}))
+
+def _get_num_starred(client_id):
+	"""Returns the count of stars by the client, or None if the calendar backend
+	does not depend on it.
+	"""
+	if not _calendar_backend.uses_num_starred:
+		return None
+	return session.query(User.num_starred)\
+			.filter(User.id == client_id)\
+			.one()\
+			.num_starred
+
+def _update_user_calendar(client_id, num_starred_delta, changes_entries,
+		update_entries, now):
+	"""Updates the calendar of the client after the client added or removed a star.
+
+	The count of stars by the client must already include num_starred_delta. If the
+	calendar remains materialized and changes_entries is True, then update_entries
+	is called to update its CalendarEntries. If the calendar becomes materialized
+	or stops being materialized, then its CalendarEntries are rebuilt instead.
+	"""
+	num_starred = _get_num_starred(client_id)
+	is_materialized = _calendar_backend.is_materialized(num_starred)
+	if num_starred is None:
+		was_materialized = is_materialized
+	else:
+		was_materialized = _calendar_backend.is_materialized(
+				num_starred - num_starred_delta)
 
+	if is_materialized != was_materialized:
+		# Rebuilding either creates or deletes all CalendarEntries for the client.
+		if _queue_calendar_entries:
+			_add_user_calendar_job(client_id, now)
+		else:
+			_rebuild_calendar_entries((client_id,), ())
+	elif is_materialized and changes_entries:
+		if _queue_calendar_entries:
+			_add_user_calendar_job(client_id, now)
+		else:
+			update_entries()
+
+def _update_match_calendars(match_id, update_entries, now):
+	"""Updates the calendar of each user after a stream was added or removed for
+	the match with the given identifier.
+
+	If any calendar is materialized, then update_entries is called to update the
+	CalendarEntries for the match.
+	"""
+	if not _calendar_backend.has_materialized_calendars:
+		return
+	if _queue_calendar_entries:
+		_add_match_calendar_job(match_id, now)
+	else:
+		update_entries()
+
+def _filter_materialized_users(select, user_id_column):
+	"""Returns the given select filtered by users with a materialized calendar."""
+	materialized_filter = _calendar_backend.get_materialized_filter()
+	if materialized_filter is None:
+		return select
+	return select.where(materialized_filter(user_id_column))
 
-def _multi_increment_num_user_stars(user_ids, match, now):
-	for user_id in user_ids:
-		_increment_num_user_stars(user_id, match, now)
 
 def _increment_num_user_stars(user_id, match, now):
 	"""Updates or creates a CalendarEntry for the given user identifier and match."""
 	assert match.is_streamed
 
-	missing = session.query(CalendarEntry)\
-			.filter(
+	# Increment the count of stars for an existing CalendarEntry.
+	result = session.execute(CalendarEntries.update()
+			.where(sa.and_(
 				CalendarEntry.user_id == user_id,
-				CalendarEntry.match_id == match.id)\
-			.count() == 0
-	if missing:
+				CalendarEntry.match_id == match.id))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars + 1}))
+	if not result.rowcount:
 		# No existing CalendarEntry; create a new one.
-		entry = _get_calendar_entry(user_id, match)
-		session.add(entry)
-	else:
-		# Increment the count of stars for an existing CalendarEntry.
-		session.execute(CalendarEntries.update()
+		session.execute(CalendarEntries.insert().values({
+				CalendarEntry.user_id: user_id,
+				CalendarEntry.match_id: match.id,
+				CalendarEntry.time: match.time,
+				CalendarEntry.num_user_stars: 1}))
+
+def _decrement_num_user_stars(user_id, match_id, now):
+	"""Updates or deletes a CalendarEntry for the given user and match identifier."""
+	# Decrement the count of stars for the CalendarEntry.
+	session.execute(CalendarEntries.update()
+			.where(sa.and_(
+				CalendarEntry.user_id == user_id,
+				CalendarEntry.match_id == match_id))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars - 1}))
+	# Delete the CalendarEntry if the count of stars is now zero.
+	session.execute(CalendarEntries.delete().where(sa.and_(
+			CalendarEntry.user_id == user_id,
+			CalendarEntry.match_id == match_id,
+			CalendarEntry.num_user_stars <= 0)))
+
+
+def _multi_increment_match_num_user_stars(user_ids, match, now):
+	"""Updates or creates a CalendarEntry for the given match and each user in the
+	given select.
+
+	The select must have a user_id column containing each user at most once.
+	"""
+	assert match.is_streamed
+
+	# Increment the count of stars for each existing CalendarEntry.
+	session.execute(CalendarEntries.update()
+			.where(sa.and_(
+				CalendarEntry.match_id == match.id,
+				CalendarEntry.user_id.in_(user_ids)))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars + 1}))
+
+	# Create a CalendarEntry for each remaining user.
+	user_ids = user_ids.alias()
+	missing_entries = sa.select([
+				user_ids.c.user_id,
+				sa.literal(match.id, sa.Integer),
+				sa.literal(match.time, sa.DateTime),
+				sa.literal(1, sa.Integer)])\
+			.where(~sa.exists()
 				.where(sa.and_(
-					CalendarEntry.user_id == user_id,
-					CalendarEntry.match_id == match.id))
-				.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars + 1}))
+					CalendarEntry.match_id == match.id,
+					CalendarEntry.user_id == user_ids.c.user_id)))
+	_insert_calendar_entries(missing_entries)
 
+def _multi_decrement_match_num_user_stars(user_ids, match_id, now):
+	"""Updates or deletes a CalendarEntry for the given match identifier and each
+	user in the given select.
 
-def _multi_decrement_num_user_stars(user_ids, match_id, now):
-	for user_id in user_ids:
-		_decrement_num_user_stars(user_id, match_id, now)
+	The select must have a user_id column containing each user at most once.
+	"""
+	# Decrement the count of stars for each CalendarEntry.
+	session.execute(CalendarEntries.update()
+			.where(sa.and_(
+				CalendarEntry.match_id == match_id,
+				CalendarEntry.user_id.in_(user_ids)))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars - 1}))
+	# Delete each CalendarEntry where the count of stars is now zero.
+	session.execute(CalendarEntries.delete().where(sa.and_(
+			CalendarEntry.match_id == match_id,
+			CalendarEntry.user_id.in_(user_ids),
+			CalendarEntry.num_user_stars <= 0)))
+
+def _multi_increment_user_num_user_stars(user_id, matches, now):
+	"""Updates or creates a CalendarEntry for the given user identifier and each
+	streamed match in the given select.
+
+	The select must have match_id and time columns containing each match at most
+	once.
+	"""
+	matches = matches.alias()
 
-def _decrement_num_user_stars(user_id, match_id, now):
-	"""Updates or deletes a CalendarEntry for the given user and match identifier."""
-	num_user_stars = session.query(CalendarEntry.num_user_stars)\
-			.filter(
+	# Increment the count of stars for each existing CalendarEntry.
+	session.execute(CalendarEntries.update()
+			.where(sa.and_(
 				CalendarEntry.user_id == user_id,
-				CalendarEntry.match_id == match_id)\
-			.one()\
-			.num_user_stars
-	if num_user_stars > 1:
-		# Decrement the count of stars for the CalendarEntry to a positive integer.
-		session.execute(CalendarEntries.update()
+				CalendarEntry.match_id.in_(sa.select([matches.c.match_id]))))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars + 1}))
+
+	# Create a CalendarEntry for each remaining match.
+	missing_entries = sa.select([
+				sa.literal(user_id, sa.Integer),
+				matches.c.match_id,
+				matches.c.time,
+				sa.literal(1, sa.Integer)])\
+			.where(~sa.exists()
 				.where(sa.and_(
 					CalendarEntry.user_id == user_id,
-					CalendarEntry.match_id == match_id))
-				.values({CalendarEntry.num_user_stars: num_user_stars - 1}))
-	else:
-		# Delete the CalendarEntry becuase the count of stars is now zero.
-		session.execute(CalendarEntries.delete().where(sa.and_(
+					CalendarEntry.match_id == matches.c.match_id)))
+	_insert_calendar_entries(missing_entries)
+
+def _multi_decrement_user_num_user_stars(user_id, match_ids, now):
+	"""Updates or deletes a CalendarEntry for the given user identifier and each
+	match in the given select.
+
+	The select must have a match_id column containing each match at most once.
+	"""
+	# Decrement the count of stars for each CalendarEntry.
+	session.execute(CalendarEntries.update()
+			.where(sa.and_(
 				CalendarEntry.user_id == user_id,
-				CalendarEntry.match_id == match_id)))
+				CalendarEntry.match_id.in_(match_ids)))
+			.values({CalendarEntry.num_user_stars: CalendarEntry.num_user_stars - 1}))
+	# Delete each CalendarEntry where the count of stars is now zero.
+	session.execute(CalendarEntries.delete().where(sa.and_(
+			CalendarEntry.user_id == user_id,
+			CalendarEntry.match_id.in_(match_ids),
+			CalendarEntry.num_user_stars <= 0)))
+
+def _insert_calendar_entries(entries):
+	"""Inserts a CalendarEntry for each row in the given select.
+
+	Each row contains the user identifier, match identifier, time, and count of
+	stars, in that order.
+	"""
+	session.execute(CalendarEntries.insert().from_select(
+			(CalendarEntry.user_id,
+				CalendarEntry.match_id,
+				CalendarEntry.time,
+				CalendarEntry.num_user_stars),
+			entries))
 
 
 def _add_first_stream_calendar_entries(client_id, match, now):
-	"""Updates or creates CalendarEntries for users, given that the client was
-	added as the first streaming user.
-	"""
-	# Add a CalendarEntry for each user who starred the match.
-	user_ids_cursor = session.query(StarredMatch.user_id)\
-			.filter(StarredMatch.match_id == match.id)
-	for row in user_ids_cursor:
-		entry = _get_calendar_entry(row.user_id, match)
-		session.add(entry)
-	session.flush()
-
-	# Add a CalendarEntry for each user who starred either team.
-	user_ids_cursor = session.query(MatchOpponent.match_id, StarredTeam.user_id)\
-			.join(StarredTeam, MatchOpponent.team_id == StarredTeam.team_id)\
-			.filter(MatchOpponent.match_id == match.id)
-	user_ids_cursor = (row.user_id for row in user_ids_cursor)
-	_multi_increment_num_user_stars(user_ids_cursor, match, now)
-	session.flush()
-
-	# Add a CalendarEntry for each user who starred the streaming user.
-	user_ids_cursor = session.query(StarredStreamer.user_id)\
-			.filter(StarredStreamer.streamer_id == client_id)
-	user_ids_cursor = (row.user_id for row in user_ids_cursor)
-	_multi_increment_num_user_stars(user_ids_cursor, match, now)
-	session.flush()
+	"""Creates CalendarEntries for users, given that the client was added as the
+	first streaming user.
+	"""
+	# Select a row for each user who starred the match, either team, or the
+	# streaming user, once for every star.
+	user_stars = sa.union_all(
+			sa.select([StarredMatch.user_id])
+				.where(StarredMatch.match_id == match.id),
+			sa.select([StarredTeam.user_id])
+				.select_from(MatchOpponents.join(
+					StarredTeams, MatchOpponent.team_id == StarredTeam.team_id))
+				.where(MatchOpponent.match_id == match.id),
+			sa.select([StarredStreamer.user_id])
+				.where(StarredStreamer.streamer_id == client_id))\
+			.alias()
+
+	# No CalendarEntries exist for a match that is not streamed, so add one for
+	# each user with the sum of their stars.
+	entries = sa.select([
+				user_stars.c.user_id,
+				sa.literal(match.id, sa.Integer),
+				sa.literal(match.time, sa.DateTime),
+				sa.func.count()])\
+			.group_by(user_stars.c.user_id)
+	entries = _filter_materialized_users(entries, user_stars.c.user_id)
+	_insert_calendar_entries(entries)
 
 def _add_not_first_stream_calendar_entries(client_id, match, now):
 	"""Updates or creates CalendarEntries for users, given that the client was
 	added as a streamer, but not the first one.
 	"""
 	# If needed, add a CalendarEntry for each user who starred the streaming user.
-	user_ids_cursor = session.query(StarredStreamer.user_id)\
-			.filter(StarredStreamer.streamer_id == client_id)
-	user_ids_cursor = (row.user_id for row in user_ids_cursor)
-	_multi_increment_num_user_stars(user_ids_cursor, match, now)
+	user_ids = sa.select([StarredStreamer.user_id])\
+			.where(StarredStreamer.streamer_id == client_id)
+	user_ids = _filter_materialized_users(user_ids, StarredStreamer.user_id)
+	_multi_increment_match_num_user_stars(user_ids, match, now)
 
 
 def _remove_not_last_stream_calendar_entries(client_id, match_id, now):
@@ -743,10 +1744,10 @@ def _remove_not_last_stream_calendar_entries(client_id, match_id, now):
 	removed as a streamer, but not the last one.
 	"""
 	# If needed, remove a CalendarEntry for each user who starred the streaming user.
-	user_ids_cursor = session.query(StarredStreamer.user_id)\
-			.filter(StarredStreamer.streamer_id == client_id)
-	user_ids_cursor = (row.user_id for row in user_ids_cursor)
-	_multi_decrement_num_user_stars(user_ids_cursor, match_id, now)
+	user_ids = sa.select([StarredStreamer.user_id])\
+			.where(StarredStreamer.streamer_id == client_id)
+	user_ids = _filter_materialized_users(user_ids, StarredStreamer.user_id)
+	_multi_decrement_match_num_user_stars(user_ids, match_id, now)
 
 def _remove_last_stream_calendar_entries(client_id, match_id, now):	
 	"""Updates or deletes CalendarEntries for users, given that the client was
@@ -757,6 +1758,446 @@ def _remove_last_stream_calendar_entries(client_id, match_id, now):
 			CalendarEntries.delete().where(CalendarEntry.match_id == match_id))
 
 
+def _get_calendar_stars(user_filter=None, match_filter=None, time_filter=None):
+	"""Returns a select containing a row for each star that places a streamed
+	match in a user's calendar.
+
+	Each row contains the user identifier, match identifier, and match time. If
+	user_filter, match_filter, or time_filter is not None, it is called with the
+	user identifier, match identifier, or time column, respectively, and returns a
+	clause to filter the stars by.
+	"""
+	stars = (
+		# Stars for streamed matches.
+		(sa.select([StarredMatch.user_id, StarredMatch.match_id, StarredMatch.time])
+				.select_from(StarredMatches.join(Matches, StarredMatch.match_id == Match.id))
+				.where(Match.is_streamed == True),
+			StarredMatch.user_id, StarredMatch.match_id, StarredMatch.time),
+		# Stars for teams in streamed matches.
+		(sa.select([StarredTeam.user_id, MatchOpponent.match_id, MatchOpponent.time])
+				.select_from(StarredTeams.join(
+					MatchOpponents, StarredTeam.team_id == MatchOpponent.team_id))
+				.where(MatchOpponent.is_streamed == True),
+			StarredTeam.user_id, MatchOpponent.match_id, MatchOpponent.time),
+		# Stars for streaming users of matches.
+		(sa.select([StarredStreamer.user_id, StreamedMatch.match_id, StreamedMatch.time])
+				.select_from(StarredStreamers.join(
+					StreamedMatches, StarredStreamer.streamer_id == StreamedMatch.streamer_id)),
+			StarredStreamer.user_id, StreamedMatch.match_id, StreamedMatch.time),
+	)
+
+	selects = []
+	for select, user_id_column, match_id_column, time_column in stars:
+		if user_filter is not None:
+			select = select.where(user_filter(user_id_column))
+		if match_filter is not None:
+			select = select.where(match_filter(match_id_column))
+		if time_filter is not None:
+			select = select.where(time_filter(time_column))
+		selects.append(select)
+	return sa.union_all(*selects)
+
+def _get_calendar_entries(user_filter=None, match_filter=None,
+		materialized_only=False):
+	"""Returns a select containing a row for each CalendarEntry that should exist,
+	computed from the stars of each user.
+
+	Each row contains the user identifier, match identifier, time, and count of
+	stars, in that order. The filters are applied as in _get_calendar_stars. If
+	materialized_only is True, then only users with a materialized calendar have
+	rows.
+	"""
+	stars = _get_calendar_stars(user_filter, match_filter).alias()
+	entries = sa.select([stars.c.user_id, stars.c.match_id, stars.c.time,
+				sa.func.count().label('num_user_stars')])\
+			.group_by(stars.c.user_id, stars.c.match_id, stars.c.time)
+	if materialized_only:
+		entries = _filter_materialized_users(entries, stars.c.user_id)
+	return entries
+
+def _rebuild_calendar_entries(user_ids, match_ids):
+	"""Deletes and then recreates from their stars all CalendarEntries for the
+	given user identifiers and match identifiers.
+
+	This is idempotent, and does not depend on the existing CalendarEntries. Only
+	users with a materialized calendar have CalendarEntries recreated.
+	"""
+	has_materialized_calendars = _calendar_backend.has_materialized_calendars
+	if user_ids:
+		session.execute(CalendarEntries.delete()
+				.where(CalendarEntry.user_id.in_(user_ids)))
+		if has_materialized_calendars:
+			_insert_calendar_entries(_get_calendar_entries(
+					user_filter=lambda user_id: user_id.in_(user_ids),
+					materialized_only=True))
+	if match_ids:
+		# This deletes any CalendarEntry for the matches that was just recreated above.
+		session.execute(CalendarEntries.delete()
+				.where(CalendarEntry.match_id.in_(match_ids)))
+		if has_materialized_calendars:
+			_insert_calendar_entries(_get_calendar_entries(
+					match_filter=lambda match_id: match_id.in_(match_ids),
+					materialized_only=True))
+
+
+def _add_user_calendar_job(user_id, now):
+	"""Adds a CalendarJob that rebuilds the calendar of the given user."""
+	session.add(CalendarJob(user_id=user_id, added=now))
+
+def _add_match_calendar_job(match_id, now):
+	"""Adds a CalendarJob that rebuilds the calendar entries for the given match."""
+	session.add(CalendarJob(match_id=match_id, added=now))
+
+# The default number of CalendarJobs processed in one transaction.
+_CALENDAR_JOB_BATCH_SIZE = 100
+
+@close_session
+def process_calendar_jobs(batch_size=None):
+	"""Rebuilds the CalendarEntries for the oldest pending CalendarJobs, and then
+	deletes them.
+
+	Returns the number of CalendarJobs processed. This can be safely called again
+	after a failure, because the CalendarJobs are only deleted in the same
+	transaction that rebuilds their CalendarEntries.
+	"""
+	if batch_size is None:
+		batch_size = _CALENDAR_JOB_BATCH_SIZE
+	jobs = session.query(CalendarJob.id, CalendarJob.user_id, CalendarJob.match_id)\
+			.order_by(CalendarJob.id.asc())\
+			.limit(batch_size)\
+			.all()
+	if not jobs:
+		session.rollback()
+		return 0
+
+	# Rebuild each user and match only once for the batch.
+	user_ids = set(job.user_id for job in jobs if job.user_id is not None)
+	match_ids = set(job.match_id for job in jobs if job.match_id is not None)
+	_rebuild_calendar_entries(user_ids, match_ids)
+
+	job_ids = [job.id for job in jobs]
+	session.execute(CalendarJobs.delete().where(CalendarJob.id.in_(job_ids)))
+	session.commit()
+	return len(jobs)
+
+def _has_pending_calendar_job(client_id):
+	"""Returns whether a pending CalendarJob will change the client's calendar."""
+	stars = _get_calendar_stars(user_filter=lambda user_id: user_id == client_id).alias()
+	client_match_ids = sa.union(
+			# The matches that are in the client's calendar.
+			sa.select([CalendarEntry.match_id]).where(CalendarEntry.user_id == client_id),
+			# The matches that should be in the client's calendar.
+			sa.select([stars.c.match_id]))
+	query = session.query(CalendarJob.id)\
+			.filter(sa.or_(
+				CalendarJob.user_id == client_id,
+				CalendarJob.match_id.in_(client_match_ids)))
+	return common_db.optional_one(query) is not None
+
+
+"""A calendar backend where the calendar of every user is materialized as
+CalendarEntries.
+
+Reading a calendar is fast, but adding or removing a stream for a match must
+update the calendar of every user who starred it.
+"""
+class MaterializedCalendarBackend:
+	# Whether is_materialized depends on the count of stars by the user.
+	uses_num_starred = False
+	# Whether the calendar of any user is materialized.
+	has_materialized_calendars = True
+
+	def is_materialized(self, num_starred):
+		"""Returns whether the calendar of a user with the given count of stars is
+		materialized.
+		"""
+		return True
+
+	def get_materialized_filter(self):
+		"""Returns None if the calendar of every user is materialized, or else a
+		callable that is passed a user identifier column and returns a clause that
+		filters by users with a materialized calendar.
+		"""
+		return None
+
+"""A calendar backend where the calendar of every user is computed from the
+user's stars when read.
+
+Adding or removing a stream for a match writes no CalendarEntries, but reading a
+calendar joins every match, team, and streaming user starred by the user.
+"""
+class OnReadCalendarBackend:
+	uses_num_starred = False
+	has_materialized_calendars = False
+
+	def is_materialized(self, num_starred):
+		return False
+
+	def get_materialized_filter(self):
+		return lambda user_id: sa.literal(False)
+
+"""A calendar backend where the calendar of a user is materialized only if the
+user has starred at least min_materialized_stars matches, teams, and streaming
+users.
+
+Reading a calendar computed from few stars is cheap, so this avoids updating
+the CalendarEntries of most users when adding or removing a stream. The count
+of stars is read from User.num_starred, so on a database created before that
+column, verify_user_counters must repair every user before using this backend.
+"""
+class HybridCalendarBackend:
+	uses_num_starred = True
+	has_materialized_calendars = True
+
+	def __init__(self, min_materialized_stars):
+		self.min_materialized_stars = min_materialized_stars
+
+	def is_materialized(self, num_starred):
+		return num_starred >= self.min_materialized_stars
+
+	def get_materialized_filter(self):
+		return lambda user_id: sa.exists().where(sa.and_(
+				User.id == user_id,
+				User.num_starred >= self.min_materialized_stars))
+
+	def __repr__(self):
+		return 'HybridCalendarBackend(min_materialized_stars=%r)' % self.min_materialized_stars
+
+
+"""A denormalized value that differs from the value computed from the
+association tables.
+
+The row_id is the primary key of the row, or a tuple if the primary key has
+multiple columns. If the row is missing then actual is None, and if the row
+should not exist then expected is None.
+"""
+class CounterDifference:
+	def __init__(self, table_name, row_id, column_name, actual, expected):
+		self.table_name = table_name
+		self.row_id = row_id
+		self.column_name = column_name
+		self.actual = actual
+		self.expected = expected
+
+	def __eq__(self, other):
+		return (isinstance(other, CounterDifference) and
+				(self.table_name, self.row_id, self.column_name, self.actual, self.expected) ==
+				(other.table_name, other.row_id, other.column_name, other.actual, other.expected))
+
+	def __ne__(self, other):
+		return not (self == other)
+
+	def __repr__(self):
+		return 'CounterDifference(table_name=%r, row_id=%r, column_name=%r, actual=%r, expected=%r)' % (
+				self.table_name,
+				self.row_id,
+				self.column_name,
+				self.actual,
+				self.expected)
+
+# The entity type of the changes to rows of each table with counters.
+_COUNTER_CHANGE_TYPES = {
+	'Matches': MATCH_CHANGE_TYPE,
+	'MatchOpponents': MATCH_CHANGE_TYPE,
+	'Teams': TEAM_CHANGE_TYPE,
+	'Users': common_db.USER_CHANGE_TYPE,
+}
+
+def _add_counter_changes(differences):
+	"""Adds a change for each match, team, or user with a repaired counter."""
+	changes = set()
+	for difference in differences:
+		change_type = _COUNTER_CHANGE_TYPES.get(difference.table_name)
+		if change_type is None:
+			continue
+		row_id = difference.row_id
+		if isinstance(row_id, tuple):
+			# The first identifier of a MatchOpponent is its match.
+			row_id = row_id[0]
+		changes.add((change_type, row_id))
+	if changes:
+		_add_changes(*sorted(changes))
+
+def _count(column, value):
+	"""Returns a scalar select of the count of rows where the column has the value."""
+	return sa.select([sa.func.count()]).where(column == value).as_scalar()
+
+def _verify_counters(table, id_columns, id_filter, counters, repair):
+	"""Returns a CounterDifference for each counter in the rows of the table
+	selected by id_filter.
+
+	Each counter is a pair of a column and an expression computing its expected
+	value, which may be correlated with the table. If repair is True, then each
+	counter in a row with a difference is set to its expected value.
+	"""
+	columns = list(id_columns)
+	for column, expected in counters:
+		columns.extend((column, expected))
+	mismatch = sa.or_(*(column != expected for column, expected in counters))
+	rows = session.execute(sa.select(columns).where(sa.and_(id_filter, mismatch)))
+
+	differences = []
+	num_id_columns = len(id_columns)
+	for row in rows:
+		row_id = row[0] if num_id_columns == 1 else tuple(row[:num_id_columns])
+		for i, (column, expected) in enumerate(counters):
+			actual_value = row[num_id_columns + 2 * i]
+			expected_value = row[num_id_columns + 2 * i + 1]
+			if isinstance(actual_value, bool):
+				# SQLite returns integers for boolean expressions.
+				expected_value = bool(expected_value)
+			if actual_value != expected_value:
+				differences.append(CounterDifference(
+						table.name, row_id, column.name, actual_value, expected_value))
+
+	if repair and differences:
+		session.execute(table.update()
+				.where(sa.and_(id_filter, mismatch))
+				.values(dict(counters)))
+	return differences
+
+def _verify_calendar_entries(user_filter, repair):
+	"""Returns a CounterDifference for each CalendarEntry of the users selected by
+	user_filter that differs from its stars.
+
+	If repair is True, then the CalendarEntries of each user with a difference are
+	rebuilt.
+	"""
+	expected = _get_calendar_entries(user_filter=user_filter, materialized_only=True)\
+			.alias()
+	# Select each CalendarEntry that is missing or has a different count or time.
+	missing_or_different = sa.select([
+				expected.c.user_id,
+				expected.c.match_id,
+				CalendarEntry.num_user_stars,
+				expected.c.num_user_stars,
+				CalendarEntry.time,
+				expected.c.time])\
+			.select_from(expected.outerjoin(CalendarEntries, sa.and_(
+				CalendarEntry.user_id == expected.c.user_id,
+				CalendarEntry.match_id == expected.c.match_id)))\
+			.where(sa.or_(
+				CalendarEntry.user_id == None,
+				CalendarEntry.num_user_stars != expected.c.num_user_stars,
+				CalendarEntry.time != expected.c.time))
+	# Select each CalendarEntry that should not exist.
+	extra = sa.select([
+				CalendarEntry.user_id,
+				CalendarEntry.match_id,
+				CalendarEntry.num_user_stars,
+				sa.literal(None, sa.Integer),
+				CalendarEntry.time,
+				sa.literal(None, sa.DateTime)])\
+			.select_from(CalendarEntries.outerjoin(expected, sa.and_(
+				CalendarEntry.user_id == expected.c.user_id,
+				CalendarEntry.match_id == expected.c.match_id)))\
+			.where(sa.and_(
+				user_filter(CalendarEntry.user_id),
+				expected.c.user_id == None))
+
+	differences = []
+	for select in (missing_or_different, extra):
+		for row in session.execute(select):
+			user_id, match_id, actual_num_user_stars, expected_num_user_stars, \
+					actual_time, expected_time = row
+			row_id = (user_id, match_id)
+			if actual_num_user_stars != expected_num_user_stars:
+				differences.append(CounterDifference(CalendarEntries.name, row_id,
+						'num_user_stars', actual_num_user_stars, expected_num_user_stars))
+			if (actual_time is not None) and (expected_time is not None) and (
+					actual_time != expected_time):
+				differences.append(CounterDifference(CalendarEntries.name, row_id,
+						'time', actual_time, expected_time))
+
+	if repair and differences:
+		user_ids = set(difference.row_id[0] for difference in differences)
+		_rebuild_calendar_entries(user_ids, ())
+	return differences
+
+def _get_id_range_filter(id_column, min_id, max_id):
+	return sa.and_(id_column >= min_id, id_column < max_id)
+
+@close_session
+def verify_match_counters(min_match_id, max_match_id, repair=False):
+	"""Returns a CounterDifference for each counter of the matches with an
+	identifier in [min_match_id, max_match_id) that differs from the association
+	tables.
+
+	This verifies Match.num_stars, Match.num_streams, Match.is_streamed, and
+	MatchOpponent.is_streamed. If repair is True, then the differences are
+	repaired in the same transaction.
+	"""
+	differences = _verify_counters(Matches, (Match.id,),
+			_get_id_range_filter(Match.id, min_match_id, max_match_id),
+			((Match.num_stars, _count(StarredMatch.match_id, Match.id)),
+				(Match.num_streams, _count(StreamedMatch.match_id, Match.id)),
+				(Match.is_streamed,
+					sa.exists().where(StreamedMatch.match_id == Match.id))),
+			repair)
+	differences.extend(_verify_counters(MatchOpponents,
+			(MatchOpponent.match_id, MatchOpponent.team_id),
+			_get_id_range_filter(MatchOpponent.match_id, min_match_id, max_match_id),
+			((MatchOpponent.is_streamed,
+				sa.exists().where(StreamedMatch.match_id == MatchOpponent.match_id)),),
+			repair))
+	if repair:
+		_add_counter_changes(differences)
+	session.commit()
+	return differences
+
+@close_session
+def verify_team_counters(min_team_id, max_team_id, repair=False):
+	"""Returns a CounterDifference for each counter of the teams with an identifier
+	in [min_team_id, max_team_id) that differs from the association tables.
+
+	This verifies Team.num_stars. If repair is True, then the differences are
+	repaired in the same transaction.
+	"""
+	differences = _verify_counters(Teams, (Team.id,),
+			_get_id_range_filter(Team.id, min_team_id, max_team_id),
+			((Team.num_stars, _count(StarredTeam.team_id, Team.id)),),
+			repair)
+	if repair:
+		_add_counter_changes(differences)
+	session.commit()
+	return differences
+
+@close_session
+def verify_user_counters(min_user_id, max_user_id, repair=False):
+	"""Returns a CounterDifference for each counter and CalendarEntry of the users
+	with an identifier in [min_user_id, max_user_id) that differs from the
+	association tables.
+
+	This verifies User.num_stars, User.num_starred, and CalendarEntry.num_user_stars.
+	If repair is True, then the differences are repaired in the same transaction.
+	Because CalendarEntries depend on Match.is_streamed and MatchOpponent.is_streamed,
+	the match counters should be repaired first.
+	"""
+	num_starred = (_count(StarredMatch.user_id, User.id) +
+			_count(StarredTeam.user_id, User.id) +
+			_count(StarredStreamer.user_id, User.id))
+	differences = _verify_counters(Users, (User.id,),
+			_get_id_range_filter(User.id, min_user_id, max_user_id),
+			((User.num_stars, _count(StarredStreamer.streamer_id, User.id)),
+				(User.num_starred, num_starred)),
+			repair)
+	differences.extend(_verify_calendar_entries(
+			lambda user_id: _get_id_range_filter(user_id, min_user_id, max_user_id),
+			repair))
+	if repair:
+		_add_counter_changes(differences)
+	session.commit()
+	return differences
+
+@close_session
+def get_max_ids():
+	"""Returns the maximum identifier of any match, team, and user, or 0 if there
+	are none.
+	"""
+	return tuple(session.query(sa.func.coalesce(sa.func.max(column), 0)).scalar()
+			for column in (Match.id, Team.id, User.id))
+
+
 """Settings for a user."""
 class DisplayedSettings:
 	def __init__(self, time_format, country, time_zone):
@@ -770,6 +2211,8 @@ class DisplayedSettings:
 				self.country,
 				self.time_zone)
 
+@query_budget(1)
+@read_replica
 @close_session
 def get_settings(client_id):
 	"""Returns the DisplayedSettings for the given client.
@@ -785,8 +2228,9 @@ def get_settings(client_id):
 				settings.time_zone)
 	except sa_orm.exc.NoResultFound:
 		session.rollback()
-		return DisplayedSettings(_DEFAULT_SETTINGS_TIME_FORMAT, None, None)
+		return DisplayedSettings(DEFAULT_SETTINGS_TIME_FORMAT, None, None)
 
+@query_budget(2)
 @close_session
 def save_settings(client_id, time_format, country, time_zone):
 	"""Saves settings for the given client."""
@@ -799,31 +2243,10 @@ def save_settings(client_id, time_format, country, time_zone):
 
 
 """A view of a match."""
-class DisplayedMatch:
-	def __init__(self, match_id, team1, team2, time, num_stars, num_streams, is_starred,
-			game=None, division=None):
-		self.match_id = match_id
-		self.team1 = team1
-		self.team2 = team2
-		self.time = time
-		self.num_stars = num_stars
-		self.num_streams = num_streams
-		self.is_starred = is_starred
-		# Begin optional arguments.
-		self.game = game
-		self.division = division
-
-	def __repr__(self):
-		return 'DisplayedMatch(match_id=%r, team1=%r, team2=%r, time=%r, num_stars=%r, num_streams=%r, is_starred=%r, game=%r, division=%r)' % (
-				self.match_id,
-				self.team1,
-				self.team2,
-				self.time,
-				self.num_stars,
-				self.num_streams,
-				self.is_starred,
-				self.game,
-				self.division)
+class DisplayedMatch(common_db.DisplayedRecord):
+	__slots__ = ('match_id', 'team1', 'team2', 'time', 'num_stars', 'num_streams',
+			'is_starred', 'game', 'division')
+	_defaults = {'game': None, 'division': None}
 
 """A detailed view of a match.
 
@@ -831,114 +2254,29 @@ Includes whether the client has starred the match, and all of the match's
 streamers.
 """
 class DisplayedMatchDetails(DisplayedMatch):
-	def __init__(self, match_id, team1, team2, time, num_stars, num_streams, is_starred,
-			game, division, fingerprint, streamers,
-			prev_time, prev_streamer_id, next_time, next_streamer_id):
-		DisplayedMatch.__init__(self,
-				match_id, team1, team2, time, num_stars, num_streams, is_starred,
-				game, division)
-		self.fingerprint = fingerprint
-		self.streamers = streamers
-		self.prev_time = prev_time
-		self.prev_streamer_id = prev_streamer_id
-		self.next_time = next_time
-		self.next_streamer_id = next_streamer_id
-
-	def __repr__(self):
-		return 'DisplayedMatchDetails(match_id=%r, team1=%r, team2=%r, time=%r, num_stars=%r, num_streams=%r, is_starred=%r, game=%r, division=%r, fingerprint=%r, streamers=%r, prev_time=%r, prev_streamer_id=%r, next_time=%r, next_streamer_id=%r)' % (
-				self.match_id,
-				self.team1,
-				self.team2,
-				self.time,
-				self.num_stars,
-				self.num_streams,
-				self.is_starred,
-				self.game,
-				self.division,
-				self.fingerprint,
-				self.streamers,
-				self.prev_time,
-				self.prev_streamer_id,
-				self.next_time,
-				self.next_streamer_id)
+	__slots__ = ('fingerprint', 'streamers',
+			'prev_time', 'prev_streamer_id', 'next_time', 'next_streamer_id')
 
 
 """A view of a team."""
-class DisplayedTeam:
-	def __init__(self, team_id, name, num_stars, is_starred, game=None, division=None):
-		self.team_id = team_id
-		self.name = name
-		self.num_stars = num_stars
-		self.is_starred = is_starred
-		# Optional arguments.
-		self.game = game
-		self.division = division
-
-	def __repr__(self):
-		return 'DisplayedTeam(team_id=%r, name=%r, num_stars=%r, is_starred=%r, game=%r, division=%r)' % (
-				self.team_id,
-				self.name,
-				self.num_stars,
-				self.is_starred,
-				self.game,
-				self.division)
+class DisplayedTeam(common_db.DisplayedRecord):
+	__slots__ = ('team_id', 'name', 'num_stars', 'is_starred', 'game', 'division')
+	_defaults = {'game': None, 'division': None}
 
 """A detailed view of a team.
 
 Includes whether the client has starred the team, and all of the team's matches.
 """
 class DisplayedTeamDetails(DisplayedTeam):
-	def __init__(self, team_id, name, num_stars, is_starred, game, division,
-			fingerprint, matches,
-			prev_time, prev_match_id, next_time, next_match_id):
-		DisplayedTeam.__init__(self, team_id, name, num_stars, is_starred, game, division)
-		self.fingerprint = fingerprint
-		self.matches = matches
-		self.prev_time = prev_time
-		self.prev_match_id = prev_match_id
-		self.next_time = next_time
-		self.next_match_id = next_match_id
-
-	def __repr__(self):
-		return 'DisplayedTeamDetails(team_id=%r, name=%r, num_stars=%r, is_starred=%r, game=%r, division=%r, fingerprint=%r, matches=%r, prev_time=%r, prev_match_id=%r, next_time=%r, next_match_id=%r)' % (
-				self.team_id,
-				self.name,
-				self.num_stars,
-				self.is_starred,
-				self.game,
-				self.division,
-				self.fingerprint,
-				self.matches,
-				self.prev_time,
-				self.prev_match_id,
-				self.next_time,
-				self.next_match_id)
+	__slots__ = ('fingerprint', 'matches',
+			'prev_time', 'prev_match_id', 'next_time', 'next_match_id')
 
 
 """A view of a streaming user."""
-class DisplayedStreamer:
-	def __init__(self,
-			streamer_id, name, num_stars, is_starred, image_url_small, image_url_large,
-			url_by_id=None, url_by_name=None):
-		self.streamer_id = streamer_id
-		self.name = name
-		self.num_stars = num_stars
-		self.is_starred = is_starred
-		self.image_url_small = image_url_small
-		self.image_url_large = image_url_large
-		self.url_by_id = url_by_id
-		self.url_by_name = url_by_name
-
-	def __repr__(self):
-		return 'DisplayedStreamer(streamer_id=%r, name=%r, num_stars=%r, is_starred=%r, image_url_small=%r, image_url_large=%r, url_by_id=%r, url_by_name=%r)' % (
-				self.streamer_id,
-				self.name,
-				self.num_stars,
-				self.is_starred,
-				self.image_url_small,
-				self.image_url_large,
-				self.url_by_id,
-				self.url_by_name)
+class DisplayedStreamer(common_db.DisplayedRecord):
+	__slots__ = ('streamer_id', 'name', 'num_stars', 'is_starred',
+			'image_url_small', 'image_url_large', 'url_by_id', 'url_by_name')
+	_defaults = {'url_by_id': None, 'url_by_name': None}
 
 """A detailed view of a streaming user.
 
@@ -946,111 +2284,39 @@ Includes whether the client has starred the streaming user, and all of the
 matches the user is streaming.
 """
 class DisplayedStreamerDetails(DisplayedStreamer):
-	def __init__(self,
-			streamer_id, name, num_stars, is_starred, image_url_small, image_url_large,
-			url_by_id, url_by_name, matches,
-			prev_time, prev_match_id, next_time, next_match_id):
-		DisplayedStreamer.__init__(self,
-				streamer_id, name, num_stars, is_starred, image_url_small, image_url_large,
-				url_by_id, url_by_name)
-		self.matches = matches
-		self.prev_time = prev_time
-		self.prev_match_id = prev_match_id
-		self.next_time = next_time
-		self.next_match_id = next_match_id
-	
-	def __repr__(self):
-		return 'DisplayedStreamerDetails(streamer_id=%r, name=%r, num_stars=%r, is_starred=%r, image_url_small=%r, image_url_large=%r, url_by_id=%r, url_by_name=%r, matches=%r, prev_time=%r, prev_match_id=%r, next_time=%r, next_match_id=%r)' % (
-				self.streamer_id,
-				self.name,
-				self.num_stars,
-				self.is_starred,
-				self.image_url_small,
-				self.image_url_large,
-				self.url_by_id,
-				self.url_by_name,
-				self.matches,
-				self.prev_time,
-				self.prev_match_id,
-				self.next_time,
-				self.next_match_id)
+	__slots__ = ('matches', 'prev_time', 'prev_match_id', 'next_time', 'next_match_id')
 
 
 """A list of matches in the Calendar tab.
 """
-class DisplayedCalendar:
-	def __init__(self, next_match, matches,
-			prev_time=None, prev_match_id=None, next_time=None, next_match_id=None):
-		self.next_match = next_match
-		self.matches = matches
-		self.prev_time = prev_time
-		self.prev_match_id = prev_match_id
-		self.next_time = next_time
-		self.next_match_id = next_match_id
-	
-	def __repr__(self):
-		return 'DisplayedCalendar(next_match=%r, matches=%r, prev_time=%r, prev_match_id=%r, next_time=%r, next_match_id=%r)' % (
-				self.next_match,
-				self.matches,
-				self.prev_time,
-				self.prev_match_id,
-				self.next_time,
-				self.next_match_id)
+class DisplayedCalendar(common_db.DisplayedRecord):
+	__slots__ = ('next_match', 'matches',
+			'prev_time', 'prev_match_id', 'next_time', 'next_match_id', 'is_updating')
+	_defaults = {'prev_time': None, 'prev_match_id': None, 'next_time': None,
+			'next_match_id': None, 'is_updating': False}
 
 
 """A partial list of matches.
 """
-class DisplayedMatchList:
-	def __init__(self, matches, prev_time, prev_match_id, next_time, next_match_id):
-		self.matches = matches
-		self.prev_time = prev_time
-		self.prev_match_id = prev_match_id
-		self.next_time = next_time
-		self.next_match_id = next_match_id
-
-	def __repr__(self):
-		return 'DisplayedMatchList(matches=%r, prev_time=%r, prev_match_id=%r, next_time=%r, next_match_id=%r)' % (
-				self.matches,
-				self.prev_time,
-				self.prev_match_id,
-				self.next_time,
-				self.next_match_id)
+class DisplayedMatchList(common_db.DisplayedRecord):
+	__slots__ = ('matches', 'prev_time', 'prev_match_id', 'next_time', 'next_match_id')
 
 """A partial list of teams.
 """
-class DisplayedTeamList:
-	def __init__(self, teams, prev_name, prev_team_id, next_name, next_team_id):
-		self.teams = teams
-		self.prev_name = prev_name
-		self.prev_team_id = prev_team_id
-		self.next_name = next_name
-		self.next_team_id = next_team_id
-
-	def __repr__(self):
-		return 'DisplayedTeamList(teams=%r, prev_name=%r, prev_team_id=%r, next_name=%r, next_team_id=%r)' % (
-				self.teams,
-				self.prev_name,
-				self.prev_team_id,
-				self.next_name,
-				self.next_team_id)
+class DisplayedTeamList(common_db.DisplayedRecord):
+	__slots__ = ('teams', 'prev_name', 'prev_team_id', 'next_name', 'next_team_id')
 
 """A partial list of streaming users.
 """
-class DisplayedStreamerList:
-	def __init__(self, streamers, prev_name, prev_streamer_id, next_name, next_streamer_id):
-		self.streamers = streamers
-		self.prev_name = prev_name
-		self.prev_streamer_id = prev_streamer_id
-		self.next_name = next_name
-		self.next_streamer_id = next_streamer_id
+class DisplayedStreamerList(common_db.DisplayedRecord):
+	__slots__ = ('streamers',
+			'prev_name', 'prev_streamer_id', 'next_name', 'next_streamer_id')
 
-	def __repr__(self):
-		return 'DisplayedStreamerList(streamers=%r, prev_name=%r, prev_streamer_id=%r, next_name=%r, next_streamer_id=%r)' % (
-				self.streamers,
-				self.prev_name,
-				self.prev_streamer_id,
-				self.next_name,
-				self.next_streamer_id)
+"""The identifiers of the matches, teams, and streaming users starred by a user,
+each in ascending order.
+"""
+class DisplayedStarredIds(common_db.DisplayedRecord):
+	__slots__ = ('match_ids', 'team_ids', 'streamer_ids')
 
 
 _UPCOMING_MATCHES_CUTOFF = timedelta(minutes=-60)
@@ -1061,208 +2327,525 @@ def _get_upcoming_matches_cutoff(now):
 # The default number of entities per page.
 _PAGE_LIMIT = 20
 
-def _paginate(paginator, prev_col1, prev_col2, next_col1, next_col2, page_limit,
-		first_id=None):
-	if first_id is None:
-		first_id = paginator.get_first_id()
-	if first_id is not None:
-		query = paginator.get_partial_list_query()
-		last_id = paginator.get_last_id()
-
-		# Add pagination to the query.
-		col1, col2 = paginator.get_order_by_columns()
-		clicked_prev = prev_col1 and prev_col2
-		clicked_next = next_col1 and next_col2
-		if clicked_prev:
-			query = query\
-					.filter(sa.or_(
-						sa.and_(col1 == prev_col1, col2 < prev_col2), col1 < prev_col1))\
-					.order_by(col1.desc(), col2.desc())
-		elif clicked_next:
-			query = query\
-					.filter(sa.or_(
-						sa.and_(col1 == next_col1, col2 > next_col2), col1 > next_col1))\
-					.order_by(col1.asc(), col2.asc())
-		else:
-			# Show the first page.
-			query = query.order_by(col1.asc(), col2.asc())
-
-		if page_limit is None:
-			page_limit = _PAGE_LIMIT
-		query = query.limit(page_limit)
-
-		items = paginator.execute_query(query)
-		if clicked_prev:
-			# Reverse the partial list if clicked on Previous.
-			items = items[::-1]
-
-		prev_col1 = None
-		prev_col2 = None
-		next_col1 = None
-		next_col2 = None
+# The dialects whose planners satisfy a row value comparison with a range scan of
+# an index. MySQL may instead scan the whole index.
+_ROW_VALUE_DIALECTS = frozenset(('postgresql',))
+
+def _get_keyset_predicate(dialect_name, col1, col2, value1, value2, after):
+	"""Returns the predicate for rows following (value1, value2) if after is True,
+	or preceding (value1, value2) if after is False, when ordered by col1 and col2.
+	"""
+	if dialect_name in _ROW_VALUE_DIALECTS:
+		# Compare row values, which the planner satisfies with one index range scan.
+		row = sa.tuple_(col1, col2)
+		values = sa.tuple_(value1, value2)
+		return (row > values) if after else (row < values)
+
+	# Otherwise the leading bound on col1 allows a range scan of the index.
+	if after:
+		return sa.and_(col1 >= value1,
+				sa.or_(sa.and_(col1 == value1, col2 > value2), col1 > value1))
+	else:
+		return sa.and_(col1 <= value1,
+				sa.or_(sa.and_(col1 == value1, col2 < value2), col1 < value1))
+
+# The statements of the paginators and getters, which are built once per process.
+_statements = common_db.StatementCache()
+
+def get_statement_stats():
+	"""Returns the counts of statements built, compiled, executed, and prepared by
+	the paginators and getters of this process.
+	"""
+	return _statements.get_stats()
+
+# The directions of a page from the link that the client clicked.
+_FIRST_PAGE = 'first'
+_PREV_PAGE = 'prev'
+_NEXT_PAGE = 'next'
+
+def _get_page_query(paginator, direction, page_limit, dialect_name):
+	"""Returns the query for a page of items from the paginator, which includes an
+	extra item to find whether another page follows in the direction that the
+	client clicked.
+
+	Its bind parameters are those of the paginator, and page_col1 and page_col2 for
+	the values of the columns from the clicked link.
+	"""
+	query = paginator.get_partial_list_query()
+
+	# Add pagination to the query.
+	col1, col2 = paginator.get_order_by_columns()
+	page_col1 = sa.bindparam('page_col1', type_=col1.type)
+	page_col2 = sa.bindparam('page_col2', type_=col2.type)
+	if direction == _PREV_PAGE:
+		query = query\
+				.where(_get_keyset_predicate(
+					dialect_name, col1, col2, page_col1, page_col2, False))\
+				.order_by(col1.desc(), col2.desc())
+	elif direction == _NEXT_PAGE:
+		query = query\
+				.where(_get_keyset_predicate(
+					dialect_name, col1, col2, page_col1, page_col2, True))\
+				.order_by(col1.asc(), col2.asc())
+	else:
+		# Show the first page.
+		query = query.order_by(col1.asc(), col2.asc())
+
+	return query.limit(page_limit + 1)
+
+def _execute_page_query(paginator, direction, page_limit, page_col1, page_col2):
+	"""Executes the query for a page of items from the paginator, which is built
+	once for each type of paginator, shape of its query, direction, and limit.
+	"""
+	dialect_name = session.bind.dialect.name
+	key = (paginator.__class__, paginator.get_statement_key(),
+			direction, page_limit, dialect_name)
+	params = paginator.get_parameters()
+	if direction != _FIRST_PAGE:
+		params['page_col1'] = page_col1
+		params['page_col2'] = page_col2
+	return _statements.execute(key,
+			lambda: _get_page_query(paginator, direction, page_limit, dialect_name),
+			params)
+
+def _paginate(paginator, prev_col1, prev_col2, next_col1, next_col2, page_limit):
+	"""Returns a page of items from the paginator, and the values of the columns
+	for the Previous and Next links.
+
+	This executes one query, which fetches an extra item to find whether another
+	page follows in the direction that the client clicked.
+	"""
+	clicked_prev = prev_col1 and prev_col2
+	clicked_next = next_col1 and next_col2
+	if page_limit is None:
+		page_limit = _PAGE_LIMIT
+	if clicked_prev:
+		rows = _execute_page_query(
+				paginator, _PREV_PAGE, page_limit, prev_col1, prev_col2)
+	elif clicked_next:
+		rows = _execute_page_query(
+				paginator, _NEXT_PAGE, page_limit, next_col1, next_col2)
+	else:
+		rows = _execute_page_query(paginator, _FIRST_PAGE, page_limit, None, None)
+
+	items = paginator.get_items(rows)
+	# If the extra item exists, another page follows this one in its direction.
+	has_more_items = (len(items) > page_limit)
+	items = items[:page_limit]
+	if clicked_prev:
+		# Reverse the partial list if clicked on Previous.
+		items = items[::-1]
+
+	prev_col1 = None
+	prev_col2 = None
+	next_col1 = None
+	next_col2 = None
+	if items:
 		first_item = items[0]
 		last_item = items[-1]
 		if not clicked_prev and not clicked_next:
-			if (len(items) == page_limit) and not paginator.has_id(last_id, last_item):
+			if has_more_items:
 				next_col1, next_col2 = paginator.get_pagination_values(last_item)
 		elif clicked_prev:
-			if (len(items) == page_limit) and not paginator.has_id(first_id, first_item):
+			if has_more_items:
 				prev_col1, prev_col2 = paginator.get_pagination_values(first_item)
 			# Came from the following page, so display a Next link.
 			next_col1, next_col2 = paginator.get_pagination_values(last_item)
 		elif clicked_next:
-			if (len(items) == page_limit) and not paginator.has_id(last_id, last_item):
+			if has_more_items:
 				next_col1, next_col2 = paginator.get_pagination_values(last_item)
 			# Came from the previous page, so display a Previous link.
 			prev_col1, prev_col2 = paginator.get_pagination_values(first_item)
-	else:
-		items = ()
-		prev_col1 = None
-		prev_col2 = None
-		next_col1 = None
-		next_col2 = None
 
 	return (items, prev_col1, prev_col2, next_col1, next_col2)
 
 
-def _get_displayed_match_team(team):
-	return DisplayedTeam(team.id, team.display_name, team.num_stars, False)
+def _get_one_row(statement):
+	"""Like calling one() on a query, but executes the given Core statement and
+	returns its only row.
+	"""
+	rows = session.execute(statement).fetchall()
+	if not rows:
+		raise sa_orm.exc.NoResultFound('No row was found for one()')
+	elif len(rows) > 1:
+		raise sa_orm.exc.MultipleResultsFound('Multiple rows were found for one()')
+	return rows[0]
+
+def _get_one_cached_row(key, build, params):
+	"""Like _get_one_row, but executes the cached statement with the given key and
+	bind parameters.
+	"""
+	rows = _statements.execute(key, build, params).fetchall()
+	if not rows:
+		raise sa_orm.exc.NoResultFound('No row was found for one()')
+	elif len(rows) > 1:
+		raise sa_orm.exc.MultipleResultsFound('Multiple rows were found for one()')
+	return rows[0]
 
-def _get_displayed_match(match, team1, team2, is_starred):
-	"""Returns a DisplayedMatch from the given match and teams."""
-	displayed_team1 = _get_displayed_match_team(team1)
-	displayed_team2 = _get_displayed_match_team(team2)
-	return DisplayedMatch(match.id,
-			displayed_team1,
-			displayed_team2,
-			match.time,
-			match.num_stars,
-			match.num_streams,
+
+"""A directory of rows that each worker caches in memory, by identifier.
+
+The rows are loaded on first use, and a row is loaded again on its own after a
+change to its entity is read from the change log, or if it was missing.
+"""
+class _Directory:
+	def __init__(self, id_column, get_query, get_item, load_filter=None):
+		self.id_column = id_column
+		self.get_query = get_query
+		self.get_item = get_item
+		self.load_filter = load_filter
+		self.reset()
+
+	def reset(self):
+		self._items = None
+
+	def discard(self, item_id):
+		"""Discards the row with the given identifier, so that it is loaded again."""
+		if self._items is not None:
+			self._items.pop(item_id, None)
+
+	def _load(self):
+		query = self.get_query()
+		if self.load_filter is not None:
+			query = query.where(self.load_filter)
+		# Read the primary, because the rows are cached until they change.
+		with on_primary():
+			rows = session.execute(query)
+		self._items = dict((row[0], self.get_item(row)) for row in rows)
+
+	def get(self, item_id):
+		"""Returns the item with the given identifier."""
+		_poll_changes()
+		if self._items is None:
+			self._load()
+		item = self._items.get(item_id)
+		if item is None:
+			with on_primary():
+				row = _get_one_row(self.get_query().where(self.id_column == item_id))
+			item = self.get_item(row)
+			self._items[item_id] = item
+		return item
+
+# Whether the change log must be polled before the directories are next used.
+_should_poll_changes = True
+
+def begin_request(last_write_time=None):
+	"""Called before each request, so that the change log is polled at most once
+	per request, and at most every change_poll_interval seconds.
+
+	The last_write_time is the time of the client's last write in an earlier
+	request, or None if unknown; see common_db.begin_routing.
+	"""
+	global _should_poll_changes
+	common_db.begin_routing(last_write_time)
+	_should_poll_changes = True
+	_poll_changes()
+
+def _poll_changes():
+	global _should_poll_changes
+	if _should_poll_changes:
+		_should_poll_changes = False
+		change_bus.poll()
+
+def _update_directories(changes):
+	"""Discards each row of a directory that the ChangeEvents changed."""
+	if changes is None:
+		for directory in _directories:
+			directory.reset()
+		return
+	for change in changes:
+		directory = _change_directories.get(change.entity_type)
+		if (directory is not None) and (change.entity_id is not None):
+			directory.discard(change.entity_id)
+
+def _reset_directories():
+	"""Resets the directories and the change log after the tables are recreated."""
+	global _should_poll_changes
+	for directory in _directories:
+		directory.reset()
+	_starred_ids.reset()
+	change_bus.reset()
+	_should_poll_changes = True
+
+
+"""A cache of the sorted identifiers of the matches, teams, or streaming users
+starred by each user, which marks the starred items of pages shared by all users.
+
+The identifiers of a user are loaded on first use, and loaded again after a
+change of type STARRED_CHANGE_TYPE for the user is read from the change log. At
+most max_users users are cached, and the least recently used is discarded first.
+"""
+class _StarredIdsCache:
+	def __init__(self, max_users):
+		self.max_users = max_users
+		self.reset()
+
+	def reset(self):
+		self._starred_ids = collections.OrderedDict()
+
+	def discard(self, user_id):
+		"""Discards the starred identifiers of the user, so that they are loaded again."""
+		for kind in _STARRED_ID_QUERIES:
+			self._starred_ids.pop((kind, user_id), None)
+
+	def get(self, kind, user_id):
+		"""Returns a sorted array of the identifiers of the given kind starred by the
+		user.
+		"""
+		_poll_changes()
+		key = (kind, user_id)
+		starred_ids = self._starred_ids.pop(key, None)
+		if starred_ids is None:
+			query = _STARRED_ID_QUERIES[kind](user_id)
+			# Read the primary, because the identifiers are cached until they change.
+			with on_primary():
+				rows = session.execute(query)
+			starred_ids = array.array('l', sorted(row[0] for row in rows))
+			while len(self._starred_ids) >= self.max_users:
+				self._starred_ids.popitem(last=False)
+		# Insert the identifiers again to make them the most recently used.
+		self._starred_ids[key] = starred_ids
+		return starred_ids
+
+# Past matches are included, because their details can be displayed.
+_STARRED_ID_QUERIES = {
+	'matches': lambda user_id: sa.select([StarredMatch.match_id])
+			.where(StarredMatch.user_id == user_id),
+	'teams': lambda user_id: sa.select([StarredTeam.team_id])
+			.where(StarredTeam.user_id == user_id),
+	'streamers': lambda user_id: sa.select([StarredStreamer.streamer_id])
+			.where(StarredStreamer.user_id == user_id),
+}
+_STARRED_IDS_MAX_USERS = 10000
+_starred_ids = _StarredIdsCache(_STARRED_IDS_MAX_USERS)
+
+def _update_starred_ids(changes):
+	"""Discards the starred identifiers of each user that the ChangeEvents changed."""
+	if changes is None:
+		_starred_ids.reset()
+		return
+	for change in changes:
+		if change.entity_type == STARRED_CHANGE_TYPE:
+			_starred_ids.discard(change.entity_id)
+
+def _get_is_starred(kind, client_id):
+	"""Returns a function that returns whether the client starred the item of the
+	given kind with an identifier.
+	"""
+	if not client_id:
+		return lambda item_id: False
+	starred_ids = _starred_ids.get(kind, client_id)
+	num_starred_ids = len(starred_ids)
+	def is_starred(item_id):
+		index = bisect.bisect_left(starred_ids, item_id)
+		return (index < num_starred_ids) and (starred_ids[index] == item_id)
+	return is_starred
+
+
+@query_budget(3)
+@close_session
+def get_starred_ids(client_id):
+	"""Returns the DisplayedStarredIds of the client."""
+	return DisplayedStarredIds(
+			tuple(_starred_ids.get('matches', client_id)),
+			tuple(_starred_ids.get('teams', client_id)),
+			tuple(_starred_ids.get('streamers', client_id)))
+
+
+def _get_displayed_match_columns():
+	"""Returns the columns selected for _get_displayed_match."""
+	return [Match.id, Match.time, Match.num_stars, Match.num_streams,
+			Match.game, Match.division, Match.team1_id, Match.team2_id]
+
+def _get_displayed_match(row, is_starred):
+	"""Returns a DisplayedMatch from a row that begins with the columns returned by
+	_get_displayed_match_columns.
+	"""
+	(match_id, time, num_stars, num_streams, game, division,
+			team1_id, team2_id) = row[:8]
+	return DisplayedMatch(match_id,
+			_team_directory.get(team1_id),
+			_team_directory.get(team2_id),
+			time,
+			num_stars,
+			num_streams,
 			is_starred,
-			match.game,
-			match.division)
-
-def _get_calendar_entry_query(client_id, team_alias1, team_alias2, now):
-	cutoff_time = _get_upcoming_matches_cutoff(now)
-	return session\
-			.query(CalendarEntry.match_id, Match, team_alias1, team_alias2)\
-			.join(Match, CalendarEntry.match_id == Match.id)\
-			.join(team_alias1, Match.team1_id == team_alias1.id)\
-			.join(team_alias2, Match.team2_id == team_alias2.id)\
-			.filter(CalendarEntry.user_id == client_id)\
-			.filter(CalendarEntry.time > cutoff_time)
-
-def _get_next_viewer_match(client_id, team_alias1, team_alias2, now):
-	result = common_db.optional_one(
-			_get_calendar_entry_query(client_id, team_alias1, team_alias2, now)
-				.order_by(CalendarEntry.time.asc(), CalendarEntry.match_id.asc()))
-	if result is None:
-		return None
+			game,
+			division)
 
-	next_match_id, next_match, next_match_team1, next_match_team2 = result
-	return _get_displayed_match(
-			next_match, next_match_team1, next_match_team2, False)
+def _get_displayed_matches(rows, client_id):
+	"""Returns a DisplayedMatch for each of the given rows.
+
+	If client_id is not None, each row begins with a column that is not None if the
+	client has starred the match.
+	"""
+	if client_id:
+		return tuple(_get_displayed_match(row[1:], row[0] is not None)
+				for row in rows)
+	else:
+		return tuple(_get_displayed_match(row, False) for row in rows)
+
+def _get_materialized_viewer_calendar():
+	"""Returns an alias containing the match identifier and time of each match in
+	the calendar of the client_id parameter after the cutoff_time parameter, read
+	from its CalendarEntries.
+	"""
+	return sa.select([CalendarEntry.match_id, CalendarEntry.time])\
+			.where(sa.and_(
+				CalendarEntry.user_id == sa.bindparam('client_id'),
+				CalendarEntry.time > sa.bindparam('cutoff_time')))\
+			.alias()
+
+def _get_on_read_viewer_calendar():
+	"""Returns an alias containing the match identifier and time of each match in
+	the calendar of the client_id parameter after the cutoff_time parameter,
+	computed from the client's stars.
+	"""
+	stars = _get_calendar_stars(
+			user_filter=lambda user_id: user_id == sa.bindparam('client_id'),
+			time_filter=lambda time: time > sa.bindparam('cutoff_time')).alias()
+	return sa.select([stars.c.match_id, stars.c.time])\
+			.group_by(stars.c.match_id, stars.c.time)\
+			.alias()
+
+def _get_viewer_calendar(is_materialized):
+	"""Returns the cached alias containing the match identifier and time of each
+	upcoming match in the client's calendar, which is read from its CalendarEntries
+	if is_materialized is True.
+	"""
+	if is_materialized:
+		return _statements.get(('viewer_calendar', True),
+				_get_materialized_viewer_calendar)
+	return _statements.get(('viewer_calendar', False), _get_on_read_viewer_calendar)
+
+def _get_viewer_calendar_parameters(client_id, now):
+	return {
+		'client_id': client_id,
+		'cutoff_time': _get_upcoming_matches_cutoff(now),
+	}
+
+def _get_calendar_entry_query(calendar):
+	return sa.select(_get_displayed_match_columns())\
+			.select_from(sa.join(calendar, Match, calendar.c.match_id == Match.id))\
+			.where(Match.is_cancelled == False)
+
+def _get_next_viewer_match(client_id, now, is_materialized):
+	def _get_next_viewer_match_query():
+		calendar = _get_viewer_calendar(is_materialized)
+		return _get_calendar_entry_query(calendar)\
+				.order_by(calendar.c.time.asc(), calendar.c.match_id.asc())\
+				.limit(1)
+	row = _statements.execute(('next_viewer_match', is_materialized),
+			_get_next_viewer_match_query,
+			_get_viewer_calendar_parameters(client_id, now)).first()
+	if row is None:
+		return None
+	return _get_displayed_match(row, False)
 
 """A paginator for entries on the client's viewing calendar.
+
+The calendar is read from CalendarEntries if is_materialized is True; see
+_get_viewer_calendar.
 """
 class CalendarEntriesPaginator:
-	def __init__(self, client_id, team_alias1, team_alias2, now):
+	def __init__(self, client_id, now, is_materialized):
 		self.client_id = client_id
-		self.team_alias1 = team_alias1
-		self.team_alias2 = team_alias2
 		self.now = now
+		self.is_materialized = is_materialized
+		self.calendar = _get_viewer_calendar(is_materialized)
 	
-	def get_last_id(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		order_by_columns = (column.desc() for column in self.get_order_by_columns())
-		query = session.query(CalendarEntry.match_id)\
-				.filter(CalendarEntry.user_id == self.client_id)\
-				.filter(CalendarEntry.time > cutoff_time)\
-				.order_by(*order_by_columns)
-		calendar_entry = common_db.optional_one(query)
-		return calendar_entry.match_id
+	def get_statement_key(self):
+		return (self.is_materialized,)
 
 	def get_partial_list_query(self):
-		return _get_calendar_entry_query(
-				self.client_id, self.team_alias1, self.team_alias2, self.now)
+		return _get_calendar_entry_query(self.calendar)
 
 	def get_order_by_columns(self):
-		return (CalendarEntry.time, CalendarEntry.match_id)
-	
-	def execute_query(self, matches_query):
-		return tuple((match, team1, team2)
-				for match_id, match, team1, team2 in matches_query)
+		return (self.calendar.c.time, self.calendar.c.match_id)
+
+	def get_parameters(self):
+		return _get_viewer_calendar_parameters(self.client_id, self.now)
 	
-	def get_pagination_values(self, item):
-		match = item[0]
-		return (match.time, match.id)
+	def get_items(self, rows):
+		return _get_displayed_matches(rows, None)
 	
-	def has_id(self, queried_id, item):
-		match = item[0]
-		return (match.id == queried_id)
+	def get_pagination_values(self, match):
+		return (match.time, match.match_id)
 
+@query_budget(5)
+@read_replica
 @close_session
 def get_displayed_viewer_calendar(client_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
 		page_limit=None, now=None):
 	"""Returns a DisplayedCalendar containing calendar entries for streamed matches
 	where the client has starred the match, either team, or a streamer.
+
+	The calendar backend decides whether these are read from CalendarEntries or
+	computed from the client's stars.
+
+	If CalendarEntries are queued, its is_updating attribute is True if a pending
+	CalendarJob will change the calendar.
 	"""
 	now = _get_now(now)
+	is_updating = _queue_calendar_entries and _has_pending_calendar_job(client_id)
 
 	# Get the next match for viewing by the client.
-	team_alias1 = sa_orm.aliased(Team)
-	team_alias2 = sa_orm.aliased(Team)
-	first_match = _get_next_viewer_match(client_id, team_alias1, team_alias2, now)
+	is_materialized = _calendar_backend.is_materialized(_get_num_starred(client_id))
+	first_match = _get_next_viewer_match(client_id, now, is_materialized)
 	if first_match is None:
 		# No next match, so return an empty calendar.
-		return DisplayedCalendar(None, ())
+		return DisplayedCalendar(None, (), is_updating=is_updating)
 
 	# Get the partial list of matches.
-	paginator = CalendarEntriesPaginator(client_id, team_alias1, team_alias2, now)
+	paginator = CalendarEntriesPaginator(client_id, now, is_materialized)
 	matches, prev_time, prev_match_id, next_time, next_match_id = _paginate(
-			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit,
-			first_id=first_match.match_id)
+			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit)
 
 	# Return the calendar.
 	return DisplayedCalendar(first_match,
-			tuple(_get_displayed_match(match, team1, team2, False)
-					for match, team1, team2 in matches),
+			matches,
 			prev_time,
 			prev_match_id,
 			next_time,
-			next_match_id)
+			next_match_id,
+			is_updating)
 
 
-def _get_streamed_match_query(streamer_id, client_id, team_alias1, team_alias2, now):
-	if client_id:
-		query = session\
-				.query(StreamedMatch.match_id, Match, team_alias1, team_alias2, StarredMatch)\
-				.outerjoin(StarredMatch, sa.and_(
-					StarredMatch.user_id == client_id,
-					StarredMatch.match_id == StreamedMatch.match_id))
-	else:
-		query = session\
-				.query(StreamedMatch.match_id, Match, team_alias1, team_alias2)
-	cutoff_time = _get_upcoming_matches_cutoff(now)
-	return query\
-			.join(Match, StreamedMatch.match_id == Match.id)\
-			.join(team_alias1, Match.team1_id == team_alias1.id)\
-			.join(team_alias2, Match.team2_id == team_alias2.id)\
-			.filter(StreamedMatch.streamer_id == streamer_id)\
-			.filter(StreamedMatch.time > cutoff_time)
-
-def _get_next_streamer_match(client_id, team_alias1, team_alias2, now):
-	result = common_db.optional_one(
-			_get_streamed_match_query(client_id, None, team_alias1, team_alias2, now)
-				.order_by(StreamedMatch.time.asc(), StreamedMatch.match_id.asc()))
-	if result is None:
-		return None
+def _get_streamed_match_query(has_client):
+	"""Returns the query for matches streamed by the streamer_id parameter after the
+	cutoff_time parameter.
 
-	next_match_id, next_match, next_match_team1, next_match_team2 = result
-	return _get_displayed_match(
-			next_match, next_match_team1, next_match_team2, False)
+	If has_client is True, each row begins with a column that is not None if the
+	client_id parameter has starred the match.
+	"""
+	columns = _get_displayed_match_columns()
+	from_clause = sa.join(StreamedMatch, Match, StreamedMatch.match_id == Match.id)
+	if has_client:
+		columns.insert(0, StarredMatch.user_id)
+		from_clause = from_clause.outerjoin(StarredMatch, sa.and_(
+				StarredMatch.user_id == sa.bindparam('client_id'),
+				StarredMatch.match_id == StreamedMatch.match_id))
+	return sa.select(columns)\
+			.select_from(from_clause)\
+			.where(sa.and_(
+				StreamedMatch.streamer_id == sa.bindparam('streamer_id'),
+				StreamedMatch.time > sa.bindparam('cutoff_time'),
+				Match.is_cancelled == False))
+
+def _get_next_streamer_match(client_id, now):
+	row = _statements.execute(('next_streamer_match',),
+			lambda: _get_streamed_match_query(False)
+				.order_by(StreamedMatch.time.asc(), StreamedMatch.match_id.asc())
+				.limit(1),
+			{'streamer_id': client_id, 'cutoff_time': _get_upcoming_matches_cutoff(now)})\
+			.first()
+	if row is None:
+		return None
+	return _get_displayed_match(row, False)
 
+@query_budget(3)
+@read_replica
 @close_session
 def get_displayed_streamer_calendar(client_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
@@ -1273,260 +2856,180 @@ def get_displayed_streamer_calendar(client_id,
 	now = _get_now(now)
 
 	# Get the next match streamed by the client.
-	team_alias1 = sa_orm.aliased(Team)
-	team_alias2 = sa_orm.aliased(Team)
-	first_match = _get_next_streamer_match(client_id, team_alias1, team_alias2, now)
+	first_match = _get_next_streamer_match(client_id, now)
 	if first_match is None:
 		# No next match, so return an empty calendar.
 		return DisplayedCalendar(None, ())
 
 	# Get the partial list of matches.
-	paginator = StreamedMatchesPaginator(
-			client_id, None, now, team_alias1, team_alias2)
+	paginator = StreamedMatchesPaginator(client_id, None, now)
 	matches, prev_time, prev_match_id, next_time, next_match_id = _paginate(
-			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit,
-			first_id=first_match.match_id)
+			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit)
 
 	# Return the calendar.
 	return DisplayedCalendar(first_match,
-			tuple(_get_displayed_match(match, team1, team2, is_streamed)
-					for match, team1, team2, is_streamed in matches),
+			matches,
 			prev_time,
 			prev_match_id,
 			next_time,
 			next_match_id)
 
 
+"""The base class for a paginator used by _paginate.
+
+A subclass defines get_partial_list_query, get_order_by_columns, get_parameters,
+get_items, and get_pagination_values. The query is built once for each value of
+get_statement_key, and so its values are bind parameters returned by
+get_parameters.
+"""
 class _Paginator:
-	def get_first_id(self):
-		query = self._get_id_query()
-		order_by_columns = (column.asc() for column in self.get_order_by_columns())
-		query = query.order_by(*order_by_columns)
-		return self._get_id(query)
-	
-	def get_last_id(self):
-		query = self._get_id_query()
-		order_by_columns = (column.desc() for column in self.get_order_by_columns())
-		query = query.order_by(*order_by_columns)
-		return self._get_id(query)
+	def get_statement_key(self):
+		return ()
 
 
 class _MatchesPaginator(_Paginator):
 	def __init__(self, client_id, now):
-		self.team_alias1 = sa_orm.aliased(Team)
-		self.team_alias2 = sa_orm.aliased(Team)
 		self.client_id = client_id
 		self.now = now
 
-	def get_pagination_values(self, item):
-		match = item[0]
-		return (match.time, match.id)
+	def get_parameters(self):
+		return {'cutoff_time': _get_upcoming_matches_cutoff(self.now)}
 
-	def has_id(self, queried_id, item):
-		match = item[0]
-		return (match.id == queried_id)
+	def get_pagination_values(self, match):
+		return (match.time, match.match_id)
 	
 
 """A paginator for matches starred by the client.
 """
 class StarredMatchesPaginator(_MatchesPaginator):
-	def _get_id_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		query = session.query(StarredMatch.match_id)\
-				.filter(StarredMatch.user_id == self.client_id)\
-				.filter(StarredMatch.time > cutoff_time)
-		return query
-
-	def _get_id(self, query):
-		starred_match = common_db.optional_one(query)
-		return starred_match.match_id if starred_match else None
-
 	def get_partial_list_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		return session\
-				.query(StarredMatch.match_id, Match, self.team_alias1, self.team_alias2)\
-				.join(Match, StarredMatch.match_id == Match.id)\
-				.join(self.team_alias1, Match.team1_id == self.team_alias1.id)\
-				.join(self.team_alias2, Match.team2_id == self.team_alias2.id)\
-				.filter(StarredMatch.user_id == self.client_id)\
-				.filter(StarredMatch.time > cutoff_time)
+		return sa.select(_get_displayed_match_columns())\
+				.select_from(sa.join(StarredMatch, Match, StarredMatch.match_id == Match.id))\
+				.where(sa.and_(
+					StarredMatch.user_id == sa.bindparam('client_id'),
+					StarredMatch.time > sa.bindparam('cutoff_time'),
+					Match.is_cancelled == False))
 	
 	def get_order_by_columns(self):
 		return (StarredMatch.time, StarredMatch.match_id)
 
-	def execute_query(self, matches_query):
-		return tuple((match, team1, team2, True)
-				for match_id, match, team1, team2 in matches_query)
+	def get_parameters(self):
+		params = _MatchesPaginator.get_parameters(self)
+		params['client_id'] = self.client_id
+		return params
+
+	def get_items(self, rows):
+		return tuple(_get_displayed_match(row, True) for row in rows)
 
 """A paginator for all matches.
 """
 class AllMatchesPaginator(_MatchesPaginator):
-	def _get_id_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		return session.query(Match.id).filter(Match.time > cutoff_time)
-
-	def _get_id(self, query):
-		match = common_db.optional_one(query)
-		return match.id if match else None
-
 	def get_partial_list_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		if self.client_id:
-			query = session.query(Match, self.team_alias1, self.team_alias2, StarredMatch)\
-					.join(self.team_alias1, Match.team1_id == self.team_alias1.id)\
-					.join(self.team_alias2, Match.team2_id == self.team_alias2.id)\
-					.outerjoin(StarredMatch, sa.and_(
-						StarredMatch.user_id == self.client_id,
-						StarredMatch.match_id == Match.id))
-		else:
-			query = session.query(Match, self.team_alias1, self.team_alias2)\
-					.join(self.team_alias1, Match.team1_id == self.team_alias1.id)\
-					.join(self.team_alias2, Match.team2_id == self.team_alias2.id)
-		query = query.filter(Match.time > cutoff_time)
-		return query
+		return sa.select(_get_displayed_match_columns())\
+				.where(sa.and_(
+					Match.time > sa.bindparam('cutoff_time'),
+					Match.is_cancelled == False))
 
 	def get_order_by_columns(self):
 		return (Match.time, Match.id)
 
-	def execute_query(self, matches_query):
-		if self.client_id:
-			return tuple((match, team1, team2, bool(starred_match))
-					for match, team1, team2, starred_match in matches_query)
-		else:
-			return tuple((match, team1, team2, False)
-					for match, team1, team2 in matches_query)
+	def get_items(self, rows):
+		# The query does not depend on the client, and the client's stars are applied
+		# to its rows.
+		rows = rows.fetchall()
+		is_starred = _get_is_starred('matches', self.client_id)
+		return tuple(_get_displayed_match(row, is_starred(row[0])) for row in rows)
 
 
 class _TeamsPaginator(_Paginator):
 	def __init__(self, client_id):
 		self.client_id = client_id
+
+	def get_parameters(self):
+		return {'client_id': self.client_id}
 	
 	def get_pagination_values(self, item):
-		team = item[0]
-		return (team.indexed_name, team.id)
-
-	def has_id(self, queried_id, item):
-		team = item[0] 
-		return (team.id == queried_id)
+		indexed_name, team = item
+		return (indexed_name, team.team_id)
 
 """A paginator for teams starred by the client.
 """
 class StarredTeamsPaginator(_TeamsPaginator):
-	def _get_id_query(self):
-		query = session.query(StarredTeam.team_id)\
-				.filter(StarredTeam.user_id == self.client_id)
-		return query
-
-	def _get_id(self, query):
-		starred_team = common_db.optional_one(query)
-		return starred_team.team_id if starred_team else None
-
 	def get_partial_list_query(self):
-		return session.query(StarredTeam.team_id, Team)\
-				.join(Team, StarredTeam.team_id == Team.id)\
-				.filter(StarredTeam.user_id == self.client_id)
+		return sa.select([StarredTeam.indexed_name] + _get_displayed_team_columns())\
+				.select_from(sa.join(StarredTeam, Team, StarredTeam.team_id == Team.id))\
+				.where(StarredTeam.user_id == sa.bindparam('client_id'))
 
 	def get_order_by_columns(self):
 		return (StarredTeam.indexed_name, StarredTeam.team_id)
 
-	def execute_query(self, teams_query):
-		return tuple((team, True) for team_id, team in teams_query)
+	def get_items(self, rows):
+		return tuple((row[0], _get_displayed_team(row[1:], True)) for row in rows)
 
 """A paginator for all teams.
 """
 class AllTeamsPaginator(_TeamsPaginator):
-	def _get_id_query(self):
-		return session.query(Team.id)
-
-	def _get_id(self, query):
-		team = common_db.optional_one(query)
-		return team.id if team else None
-
 	def get_partial_list_query(self):
-		if self.client_id:
-			query = session.query(Team, StarredTeam)\
-					.outerjoin(StarredTeam, sa.and_(
-						StarredTeam.user_id == self.client_id,
-						StarredTeam.team_id == Team.id))
-		else:
-			query = session.query(Team)
-		return query
+		return sa.select([Team.indexed_name] + _get_displayed_team_columns())
 	
 	def get_order_by_columns(self):
 		return (Team.indexed_name, Team.id)
 
-	def execute_query(self, teams_query):
-		if self.client_id:
-			return tuple((team, bool(starred_team))
-					for team, starred_team in teams_query)
-		else:
-			return tuple((team, False) for team in teams_query)
+	def get_parameters(self):
+		return {}
+
+	def get_items(self, rows):
+		rows = rows.fetchall()
+		is_starred = _get_is_starred('teams', self.client_id)
+		return tuple((row[0], _get_displayed_team(row[1:], is_starred(row[1])))
+				for row in rows)
 
 
 class _StreamersPaginator(_Paginator):
 	def __init__(self, client_id):
 		self.client_id = client_id
+
+	def get_parameters(self):
+		return {'client_id': self.client_id}
 	
 	def get_pagination_values(self, item):
-		streamer = item[0]
-		return (streamer.indexed_name, streamer.id)
-	
-	def has_id(self, queried_id, item):
-		streamer = item[0]
-		return (streamer.id == queried_id)
+		indexed_name, streamer = item
+		return (indexed_name, streamer.streamer_id)
 
 """A paginator for streaming users starred by the client.
 """
 class StarredStreamersPaginator(_StreamersPaginator):
-	def _get_id_query(self):
-		query = session.query(StarredStreamer.streamer_id)\
-				.filter(StarredStreamer.user_id == self.client_id)
-		return query
-
-	def _get_id(self, query):
-		starred_streamer = common_db.optional_one(query)
-		return starred_streamer.streamer_id if starred_streamer else None
-
 	def get_partial_list_query(self):
-		return session.query(StarredStreamer.streamer_id, User)\
-				.join(User, StarredStreamer.streamer_id == User.id)\
-				.filter(StarredStreamer.user_id == self.client_id)
+		return sa.select(
+					[StarredStreamer.indexed_name] + _get_displayed_streamer_columns())\
+				.select_from(sa.join(
+					StarredStreamer, User, StarredStreamer.streamer_id == User.id))\
+				.where(StarredStreamer.user_id == sa.bindparam('client_id'))
 	
 	def get_order_by_columns(self):
 		return (StarredStreamer.indexed_name, StarredStreamer.streamer_id)
 
-	def execute_query(self, streamers_query):
-		return tuple((streamer, True) for streamer_id, streamer in streamers_query)
+	def get_items(self, rows):
+		return tuple((row[0], _get_displayed_streamer(row[1:], True)) for row in rows)
 
 """A paginator for all streaming users.
 """
 class AllStreamersPaginator(_StreamersPaginator):
-	def _get_id_query(self):
-		return session.query(User.id).filter(User.can_stream == True)
-
-	def _get_id(self, query):
-		streamer = common_db.optional_one(query)
-		return streamer.id if streamer else None
-
 	def get_partial_list_query(self):
-		if self.client_id:
-			query = session.query(User, StarredStreamer)\
-					.outerjoin(StarredStreamer, sa.and_(
-						StarredStreamer.user_id == self.client_id,
-						StarredStreamer.streamer_id == User.id))
-		else:
-			query = session.query(User)
-		return query.filter(User.can_stream == True)
+		return sa.select([User.indexed_name] + _get_displayed_streamer_columns())\
+				.where(User.can_stream == True)
 
 	def get_order_by_columns(self):
 		return (User.indexed_name, User.id)
+
+	def get_parameters(self):
+		return {}
 	
-	def execute_query(self, streamers_query):
-		if self.client_id:
-			return tuple((streamer, bool(starred_streamer))
-					for streamer, starred_streamer in streamers_query)
-		else:
-			return tuple((streamer, False) for streamer in streamers_query)
+	def get_items(self, rows):
+		rows = rows.fetchall()
+		is_starred = _get_is_starred('streamers', self.client_id)
+		return tuple((row[0], _get_displayed_streamer(row[1:], is_starred(row[1])))
+				for row in rows)
 
 
 def _get_match_list(
@@ -1534,14 +3037,14 @@ def _get_match_list(
 		paginator):
 	matches, prev_time, prev_match_id, next_time, next_match_id = _paginate(
 			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit)
-	return DisplayedMatchList(
-			tuple(_get_displayed_match(match, team1, team2, is_starred)
-				for match, team1, team2, is_starred in matches),
+	return DisplayedMatchList(matches,
 			prev_time,
 			prev_match_id,
 			next_time,
 			next_match_id)
 
+@query_budget(2)
+@read_replica
 @close_session
 def get_starred_matches(client_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
@@ -1552,6 +3055,8 @@ def get_starred_matches(client_id,
 	return _get_match_list(prev_time, prev_match_id, next_time, next_match_id, page_limit,
 			paginator)
 
+@query_budget(3)
+@read_replica
 @close_session
 def get_all_matches(client_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
@@ -1563,9 +3068,16 @@ def get_all_matches(client_id,
 			paginator)
 
 
-def _get_displayed_team(team, is_starred):
-	return DisplayedTeam(team.id, team.display_name, team.num_stars, is_starred,
-			team.game, team.division)
+def _get_displayed_team_columns():
+	"""Returns the columns selected for _get_displayed_team."""
+	return [Team.id, Team.display_name, Team.num_stars, Team.game, Team.division]
+
+def _get_displayed_team(row, is_starred):
+	"""Returns a DisplayedTeam from a row that begins with the columns returned by
+	_get_displayed_team_columns.
+	"""
+	team_id, name, num_stars, game, division = row[:5]
+	return DisplayedTeam(team_id, name, num_stars, is_starred, game, division)
 
 def _get_team_list(
 		prev_name, prev_team_id, next_name, next_team_id, page_limit,
@@ -1573,12 +3085,14 @@ def _get_team_list(
 	teams, prev_name, prev_team_id, next_name, next_team_id = _paginate(
 			paginator, prev_name, prev_team_id, next_name, next_team_id, page_limit)
 	return DisplayedTeamList(
-			tuple(_get_displayed_team(team, is_starred) for team, is_starred in teams),
+			tuple(team for indexed_name, team in teams),
 			prev_name,
 			prev_team_id,
 			next_name,
 			next_team_id)
 
+@query_budget(1)
+@read_replica
 @close_session
 def get_starred_teams(client_id,
 		prev_name=None, prev_team_id=None, next_name=None, next_team_id=None,
@@ -1588,6 +3102,8 @@ def get_starred_teams(client_id,
 	return _get_team_list(prev_name, prev_team_id, next_name, next_team_id, page_limit,
 			paginator)
 
+@query_budget(2)
+@read_replica
 @close_session
 def get_all_teams(client_id,
 		prev_name=None, prev_team_id=None, next_name=None, next_team_id=None,
@@ -1598,12 +3114,56 @@ def get_all_teams(client_id,
 			paginator)
 
 
-def _get_displayed_streamer(streamer, is_starred):
-	"""Returns a DisplayedStreamer for the given streamer."""
-	return DisplayedStreamer(streamer.id,
-			streamer.display_name,
-			streamer.num_stars,
+def _get_displayed_streamer_columns():
+	"""Returns the columns selected for _get_displayed_streamer."""
+	return [User.id, User.display_name, User.num_stars,
+			User.image_url_small, User.image_url_large,
+			User.url_by_id, User.url_by_name]
+
+def _get_displayed_streamer(row, is_starred):
+	"""Returns a DisplayedStreamer from a row that begins with the columns returned
+	by _get_displayed_streamer_columns.
+	"""
+	(streamer_id, name, num_stars, image_url_small, image_url_large,
+			url_by_id, url_by_name) = row[:7]
+	return DisplayedStreamer(streamer_id,
+			name,
+			num_stars,
 			is_starred,
+			image_url_small,
+			image_url_large,
+			url_by_id,
+			url_by_name)
+
+
+def _get_directory_team(row):
+	team_id, name, num_stars = row
+	return DisplayedTeam(team_id, name, num_stars, False)
+
+# The teams of displayed matches.
+_team_directory = _Directory(Team.id,
+		lambda: sa.select([Team.id, Team.display_name, Team.num_stars]),
+		_get_directory_team)
+# The users that can stream, who are displayed as streaming matches.
+_streamer_directory = _Directory(User.id,
+		lambda: sa.select(_get_displayed_streamer_columns()),
+		lambda row: _get_displayed_streamer(row, False),
+		User.can_stream == True)
+_directories = (_team_directory, _streamer_directory)
+_change_directories = {
+	TEAM_CHANGE_TYPE: _team_directory,
+	common_db.USER_CHANGE_TYPE: _streamer_directory,
+}
+
+def _get_directory_streamer(streamer_id, is_starred):
+	"""Returns the DisplayedStreamer with the given identifier from its directory."""
+	streamer = _streamer_directory.get(streamer_id)
+	if not is_starred:
+		return streamer
+	return DisplayedStreamer(streamer.streamer_id,
+			streamer.name,
+			streamer.num_stars,
+			True,
 			streamer.image_url_small,
 			streamer.image_url_large,
 			streamer.url_by_id,
@@ -1615,13 +3175,14 @@ def _get_streamer_list(
 	streamers, prev_name, prev_streamer_id, next_name, next_streamer_id = _paginate(
 			paginator, prev_name, prev_streamer_id, next_name, next_streamer_id, page_limit)
 	return DisplayedStreamerList(
-			tuple(_get_displayed_streamer(streamer, is_starred)
-					for streamer, is_starred in streamers),
+			tuple(streamer for indexed_name, streamer in streamers),
 			prev_name,
 			prev_streamer_id,
 			next_name,
 			next_streamer_id)
 
+@query_budget(1)
+@read_replica
 @close_session
 def get_starred_streamers(client_id,
 		prev_name=None, prev_streamer_id=None, next_name=None, next_streamer_id=None,
@@ -1631,6 +3192,8 @@ def get_starred_streamers(client_id,
 	return _get_streamer_list(
 			prev_name, prev_streamer_id, next_name, next_streamer_id, page_limit, paginator)
 
+@query_budget(2)
+@read_replica
 @close_session
 def get_all_streamers(client_id,
 		prev_name=None, prev_streamer_id=None, next_name=None, next_streamer_id=None,
@@ -1649,72 +3212,61 @@ class MatchStreamersPaginator(_Paginator):
 		self.match_id = match_id
 		self.client_id = client_id
 
-	def _get_id_query(self):
-		query = session.query(StreamedMatch.streamer_id)\
-				.filter(StreamedMatch.match_id == self.match_id)
-		return query
-
-	def _get_id(self, query):
-		streamed_match = common_db.optional_one(query)
-		return streamed_match.streamer_id if streamed_match else None
+	def get_statement_key(self):
+		return (bool(self.client_id),)
 
 	def get_partial_list_query(self):
+		columns = [StreamedMatch.added, StreamedMatch.streamer_id]
+		from_clause = StreamedMatch.__table__
 		if self.client_id:
-			query = session\
-					.query(StreamedMatch.streamer_id, StreamedMatch.added, User, StarredStreamer)\
-					.join(User, StreamedMatch.streamer_id == User.id)\
-					.outerjoin(StarredStreamer, sa.and_(
-						StarredStreamer.user_id == self.client_id,
-						StarredStreamer.streamer_id == User.id))
-		else:
-			query = session.query(StreamedMatch.streamer_id, StreamedMatch.added, User)\
-					.join(User, StreamedMatch.streamer_id == User.id)
-		return query\
-				.filter(StreamedMatch.match_id == self.match_id)
+			columns.insert(0, StarredStreamer.user_id)
+			from_clause = from_clause.outerjoin(StarredStreamer, sa.and_(
+					StarredStreamer.user_id == sa.bindparam('client_id'),
+					StarredStreamer.streamer_id == StreamedMatch.streamer_id))
+		return sa.select(columns)\
+				.select_from(from_clause)\
+				.where(StreamedMatch.match_id == sa.bindparam('match_id'))
 
 	def get_order_by_columns(self):
 		return (StreamedMatch.added, StreamedMatch.streamer_id)
 
-	def execute_query(self, streamers_query):
+	def get_parameters(self):
+		return {'client_id': self.client_id, 'match_id': self.match_id}
+
+	def get_items(self, rows):
 		if self.client_id:
-			return tuple((added, streamer, bool(starred_streamer))
-					for streamer_id, added, streamer, starred_streamer in streamers_query)
+			return tuple((row[1], _get_directory_streamer(row[2], row[0] is not None))
+					for row in rows)
 		else:
-			return tuple((added, streamer, False)
-					for streamer_id, added, streamer in streamers_query)
+			return tuple((row[0], _get_directory_streamer(row[1], False))
+					for row in rows)
 
 	def get_pagination_values(self, item):
-		added, streamer = item[0], item[1]
-		return (added, streamer.id)
-
-	def has_id(self, queried_id, item):
-		added, streamer = item[0], item[1]
-		return (streamer.id == queried_id)
+		added, streamer = item
+		return (added, streamer.streamer_id)
 
+@query_budget(4)
+@read_replica
 @close_session
 def get_displayed_match(client_id, match_id,
 		prev_time=None, prev_streamer_id=None, next_time=None, next_streamer_id=None,
 		page_limit=None):
 	"""Returns a DisplayedMatch containing streaming users."""
 	try:
-		# Get the match and teams.
-		team_alias1 = sa_orm.aliased(Team)
-		team_alias2 = sa_orm.aliased(Team)
-		match, team1, team2, starred_match = session\
-				.query(Match, team_alias1, team_alias2, StarredMatch)\
-				.join(team_alias1, Match.team1_id == team_alias1.id)\
-				.join(team_alias2, Match.team2_id == team_alias2.id)\
-				.outerjoin(StarredMatch, sa.and_(
-					StarredMatch.user_id == client_id,
-					StarredMatch.match_id == match_id))\
-				.filter(Match.id == match_id)\
-				.one()
-		displayed_team1 = _get_displayed_match_team(team1)
-		displayed_team2 = _get_displayed_match_team(team2)
+		# Get the match.
+		row = _get_one_cached_row(('displayed_match',),
+				lambda: sa.select([StarredMatch.user_id, Match.fingerprint] +
+						_get_displayed_match_columns())\
+					.select_from(sa.outerjoin(Match, StarredMatch, sa.and_(
+						StarredMatch.user_id == sa.bindparam('client_id'),
+						StarredMatch.match_id == Match.id)))\
+					.where(Match.id == sa.bindparam('match_id')),
+				{'client_id': client_id, 'match_id': match_id})
 	except sa_orm.exc.NoResultFound:
 		session.rollback()
 		raise common_db.DbException._chain()
-	is_starred = (starred_match is not None)
+	starred_user_id, fingerprint = row[:2]
+	match = _get_displayed_match(row[2:], starred_user_id is not None)
 	
 	# Get the partial list of streamers for this match.
 	if match.num_streams:
@@ -1730,38 +3282,40 @@ def get_displayed_match(client_id, match_id,
 
 	# Return the displayed match.
 	return DisplayedMatchDetails(match_id,
-			displayed_team1,
-			displayed_team2,
+			match.team1,
+			match.team2,
 			match.time,
 			match.num_stars,
 			match.num_streams,
-			is_starred,
+			match.is_starred,
 			match.game,
 			match.division,
-			match.fingerprint,
-			tuple(_get_displayed_streamer(streamer, is_starred)
-					for added, streamer, is_starred in streamers),
+			fingerprint,
+			tuple(streamer for added, streamer in streamers),
 			prev_time,
 			prev_streamer_id,
 			next_time,
 			next_streamer_id)
 
 
-def _get_displayed_team_match(match, team_id, opponent_team, is_starred):
-	opponent_team = DisplayedTeam(
-			opponent_team.id, opponent_team.display_name, opponent_team.num_stars, False)
-	if match.team1_id == team_id:
+def _get_displayed_team_match(row, team_id, is_starred):
+	"""Returns a DisplayedMatch of the team from a row returned by the query of
+	MatchOpponentsPaginator.
+	"""
+	match_id, time, num_stars, num_streams, team1_id, opponent_id = row[:6]
+	opponent_team = _team_directory.get(opponent_id)
+	if team1_id == team_id:
 		team1 = None
 		team2 = opponent_team
 	else:
 		team1 = opponent_team
 		team2 = None
-	return DisplayedMatch(match.id,
+	return DisplayedMatch(match_id,
 			team1,
 			team2,
-			match.time,
-			match.num_stars,
-			match.num_streams,
+			time,
+			num_stars,
+			num_streams,
 			is_starred)
 
 """A paginator for opponents of a team.
@@ -1772,55 +3326,50 @@ class MatchOpponentsPaginator(_Paginator):
 		self.client_id = client_id
 		self.now = now
 
-	def _get_id_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		query = session.query(MatchOpponent.match_id)\
-				.filter(MatchOpponent.team_id == self.team_id)\
-				.filter(MatchOpponent.time > cutoff_time)
-		return query
-
-	def _get_id(self, query):
-		first_match_opponent = common_db.optional_one(query)
-		return first_match_opponent.match_id if first_match_opponent else None
+	def get_statement_key(self):
+		return (bool(self.client_id),)
 
 	def get_partial_list_query(self):
+		columns = [Match.id, Match.time, Match.num_stars, Match.num_streams,
+				Match.team1_id, MatchOpponent.opponent_id]
+		from_clause = sa.join(MatchOpponent, Match, MatchOpponent.match_id == Match.id)
 		if self.client_id:
-			query = session\
-					.query(MatchOpponent.match_id, MatchOpponent.team_id, Match, Team, StarredMatch)\
-					.outerjoin(StarredMatch, sa.and_(
-						StarredMatch.user_id == self.client_id,
-						StarredMatch.match_id == MatchOpponent.match_id))
-		else:
-			query = session\
-					.query(MatchOpponent.match_id, MatchOpponent.team_id, Match, Team)
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		return query\
-				.join(Match, MatchOpponent.match_id == Match.id)\
-				.join(Team, MatchOpponent.opponent_id == Team.id)\
-				.filter(MatchOpponent.team_id == self.team_id)\
-				.filter(MatchOpponent.time > cutoff_time)
+			columns.insert(0, StarredMatch.user_id)
+			from_clause = from_clause.outerjoin(StarredMatch, sa.and_(
+					StarredMatch.user_id == sa.bindparam('client_id'),
+					StarredMatch.match_id == MatchOpponent.match_id))
+		return sa.select(columns)\
+				.select_from(from_clause)\
+				.where(sa.and_(
+					MatchOpponent.team_id == sa.bindparam('team_id'),
+					MatchOpponent.time > sa.bindparam('cutoff_time'),
+					Match.is_cancelled == False))
 
 	def get_order_by_columns(self):
 		return (MatchOpponent.time, MatchOpponent.match_id)
 
-	def execute_query(self, matches_query):
+	def get_parameters(self):
+		return {
+			'client_id': self.client_id,
+			'team_id': self.team_id,
+			'cutoff_time': _get_upcoming_matches_cutoff(self.now),
+		}
+
+	def get_items(self, rows):
 		if self.client_id:
 			# Convert any found StarredMatch to an is_starred value of True.
-			return tuple((match, opponent_team, bool(starred_match))
-					for match_id, team_id, match, opponent_team, starred_match
-						in matches_query)
+			return tuple(
+					_get_displayed_team_match(row[1:], self.team_id, row[0] is not None)
+					for row in rows)
 		else:
-			return tuple((match, opponent_team, False)
-					for match_id, team_id, match, opponent_team in matches_query)
-
-	def get_pagination_values(self, item):
-		match = item[0]
-		return (match.time, match.id)
+			return tuple(_get_displayed_team_match(row, self.team_id, False)
+					for row in rows)
 
-	def has_id(self, queried_id, item):
-		match = item[0]
-		return (match.id == queried_id)
+	def get_pagination_values(self, match):
+		return (match.time, match.match_id)
 
+@query_budget(3)
+@read_replica
 @close_session
 def get_displayed_team(client_id, team_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
@@ -1828,16 +3377,19 @@ def get_displayed_team(client_id, team_id,
 	"""Returns a DisplayedTeam containing scheduled matches."""
 	try:
 		# Get the team.
-		team, starred_team = session.query(Team, StarredTeam)\
-				.outerjoin(StarredTeam, sa.and_(
-					StarredTeam.user_id == client_id,
-					StarredTeam.team_id == team_id))\
-				.filter(Team.id == team_id)\
-				.one()
+		row = _get_one_cached_row(('displayed_team',),
+				lambda: sa.select([StarredTeam.user_id, Team.fingerprint] +
+						_get_displayed_team_columns())\
+					.select_from(sa.outerjoin(Team, StarredTeam, sa.and_(
+						StarredTeam.user_id == sa.bindparam('client_id'),
+						StarredTeam.team_id == Team.id)))\
+					.where(Team.id == sa.bindparam('team_id')),
+				{'client_id': client_id, 'team_id': team_id})
 	except sa_orm.exc.NoResultFound:
 		session.rollback()
 		raise common_db.DbException._chain()
-	is_starred = (starred_team is not None)
+	starred_user_id, fingerprint = row[:2]
+	team = _get_displayed_team(row[2:], starred_user_id is not None)
 
 	# Get the partial list of matches for this team.
 	now = _get_now(now)
@@ -1847,14 +3399,13 @@ def get_displayed_team(client_id, team_id,
 	
 	# Return the displayed team.
 	return DisplayedTeamDetails(team_id,
-			team.display_name,
+			team.name,
 			team.num_stars,
-			is_starred,
+			team.is_starred,
 			team.game,
 			team.division,
-			team.fingerprint,
-			tuple(_get_displayed_team_match(match, team_id, opponent_team, is_starred)
-					for match, opponent_team, is_starred in matches),
+			fingerprint,
+			matches,
 			prev_time,
 			prev_match_id,
 			next_time,
@@ -1864,90 +3415,75 @@ def get_displayed_team(client_id, team_id,
 """A paginator for matches streamed by a user.
 """
 class StreamedMatchesPaginator(_Paginator):
-	def __init__(self, streamer_id, client_id, now,
-			team_alias1=None, team_alias2=None):
+	def __init__(self, streamer_id, client_id, now):
 		self.streamer_id = streamer_id
 		self.client_id = client_id
-		self.team_alias1 = team_alias1 if team_alias1 else sa_orm.aliased(Team)
-		self.team_alias2 = team_alias2 if team_alias2 else sa_orm.aliased(Team)
 		self.now = now
 
-	def _get_id_query(self):
-		cutoff_time = _get_upcoming_matches_cutoff(self.now)
-		query = session.query(StreamedMatch.match_id)\
-				.filter(StreamedMatch.streamer_id == self.streamer_id)\
-				.filter(StreamedMatch.time > cutoff_time)
-		return query
-	
-	def _get_id(self, query):
-		first_streamed_match = common_db.optional_one(query)
-		return first_streamed_match.match_id if first_streamed_match else None
+	def get_statement_key(self):
+		return (bool(self.client_id),)
 
 	def get_partial_list_query(self):
-		return _get_streamed_match_query(self.streamer_id,
-				self.client_id,
-				self.team_alias1,
-				self.team_alias2,
-				self.now)
+		return _get_streamed_match_query(bool(self.client_id))
 
 	def get_order_by_columns(self):
 		return (StreamedMatch.time, StreamedMatch.match_id)
 
-	def execute_query(self, matches_query):
-		if self.client_id:
-			return tuple((match, team1, team2, bool(starred_match))
-					for match_id, match, team1, team2, starred_match in matches_query)
-		else:
-			return tuple((match, team1, team2, False)
-					for match_id, match, team1, team2 in matches_query)
+	def get_parameters(self):
+		return {
+			'client_id': self.client_id,
+			'streamer_id': self.streamer_id,
+			'cutoff_time': _get_upcoming_matches_cutoff(self.now),
+		}
 
-	def get_pagination_values(self, item):
-		match = item[0]
-		return (match.time, match.id)
+	def get_items(self, rows):
+		return _get_displayed_matches(rows, self.client_id)
 
-	def has_id(self, queried_id, item):
-		match = item[0]
-		return (match.id == queried_id)
+	def get_pagination_values(self, match):
+		return (match.time, match.match_id)
 
 
 @close_session
-def _get_displayed_streamer_by_filter(client_id, filter_adder,
+def _get_displayed_streamer_by_filter(client_id, filter_column, filter_value,
 		prev_time, prev_match_id, next_time, next_match_id, page_limit, now):
 	try:
-		# Get the streamer.
-		query = session.query(User, StarredStreamer)\
-				.outerjoin(StarredStreamer, sa.and_(
-					StarredStreamer.user_id == client_id,
-					StarredStreamer.streamer_id == User.id))
-		query = filter_adder(query)
-		streamer, starred_streamer = query.one()
+		# Get the streamer where the filter column equals the filter value.
+		row = _get_one_cached_row(('displayed_streamer', filter_column.key),
+				lambda: sa.select(
+						[StarredStreamer.user_id] + _get_displayed_streamer_columns())\
+					.select_from(sa.outerjoin(User, StarredStreamer, sa.and_(
+						StarredStreamer.user_id == sa.bindparam('client_id'),
+						StarredStreamer.streamer_id == User.id)))\
+					.where(filter_column == sa.bindparam('filter_value')),
+				{'client_id': client_id, 'filter_value': filter_value})
 	except sa_orm.exc.NoResultFound:
 		session.rollback()
 		raise common_db.DbException._chain()
-	is_starred = (starred_streamer is not None)
+	streamer = _get_displayed_streamer(row[1:], row[0] is not None)
 
 	# Get the partial list of matches streamed by this user.
 	now = _get_now(now)
-	paginator = StreamedMatchesPaginator(streamer.id, client_id, now)
+	paginator = StreamedMatchesPaginator(streamer.streamer_id, client_id, now)
 	matches, prev_time, prev_match_id, next_time, next_match_id = _paginate(
 			paginator, prev_time, prev_match_id, next_time, next_match_id, page_limit)
 	
 	# Return the displayed streaming user.
-	return DisplayedStreamerDetails(streamer.id,
-			streamer.display_name,
+	return DisplayedStreamerDetails(streamer.streamer_id,
+			streamer.name,
 			streamer.num_stars,
-			is_starred,
+			streamer.is_starred,
 			streamer.image_url_small,
 			streamer.image_url_large,
 			streamer.url_by_id,
 			streamer.url_by_name,
-			tuple(_get_displayed_match(match, team1, team2, is_starred)
-					for match, team1, team2, is_starred in matches),
+			matches,
 			prev_time,
 			prev_match_id,
 			next_time,
 			next_match_id)
 
+@query_budget(3)
+@read_replica
 def get_displayed_streamer(client_id, streamer_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
 		page_limit=None, now=None):
@@ -1955,11 +3491,11 @@ def get_displayed_streamer(client_id, streamer_id,
 	
 	The returned streaming user is found by its identifier.
 	"""
-	def _filter_adder(query):
-		return query.filter(User.id == streamer_id)
-	return _get_displayed_streamer_by_filter(client_id, _filter_adder,
+	return _get_displayed_streamer_by_filter(client_id, User.id, streamer_id,
 			prev_time, prev_match_id, next_time, next_match_id, page_limit, now)
 
+@query_budget(3)
+@read_replica
 def get_displayed_streamer_by_twitch_id(client_id, twitch_id,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
 		page_limit=None, now=None):
@@ -1968,11 +3504,11 @@ def get_displayed_streamer_by_twitch_id(client_id, twitch_id,
 	The returned streaming user is found by its Twitch identifier.
 	"""
 	url_by_id = common_db._get_twitch_url_by_id(twitch_id)
-	def _filter_adder(query):
-		return query.filter(User.url_by_id == url_by_id)
-	return _get_displayed_streamer_by_filter(client_id, _filter_adder,
+	return _get_displayed_streamer_by_filter(client_id, User.url_by_id, url_by_id,
 			prev_time, prev_match_id, next_time, next_match_id, page_limit, now)
 
+@query_budget(3)
+@read_replica
 def get_displayed_streamer_by_twitch_name(client_id, twitch_name,
 		prev_time=None, prev_match_id=None, next_time=None, next_match_id=None,
 		page_limit=None, now=None):
@@ -1981,9 +3517,7 @@ def get_displayed_streamer_by_twitch_name(client_id, twitch_name,
 	The returned streaming user is found by its Twitch username.
 	"""
 	url_by_name = common_db._get_twitch_url_by_name(twitch_name)
-	def _filter_adder(query):
-		return query.filter(User.url_by_name == url_by_name)
-	return _get_displayed_streamer_by_filter(client_id, _filter_adder,
+	return _get_displayed_streamer_by_filter(client_id, User.url_by_name, url_by_name,
 			prev_time, prev_match_id, next_time, next_match_id, page_limit, now)
 
 
@@ -1998,19 +3532,24 @@ def _toggle_can_stream_by_filter(filter_adder, can_stream):
 		raise common_db.DbException._chain()
 	
 	streamer.can_stream = True
+	_add_changes((common_db.USER_CHANGE_TYPE, None),
+			(common_db.USER_CHANGE_TYPE, streamer.id))
 	session.commit()
 
+@query_budget(2)
 def toggle_can_stream(streamer_id, can_stream):
 	def _filter_adder(query):
 		return query.filter(User.id == streamer_id)
 	_toggle_can_stream_by_filter(_filter_adder, can_stream)
 
+@query_budget(2)
 def toggle_can_stream_by_twitch_id(twitch_id, can_stream):
 	url_by_id = common_db._get_twitch_url_by_id(twitch_id)
 	def _filter_adder(query):
 		return query.filter(User.url_by_id == url_by_id)
 	_toggle_can_stream_by_filter(_filter_adder, can_stream)
 
+@query_budget(2)
 def toggle_can_stream_by_twitch_name(twitch_name, can_stream):
 	url_by_name = common_db._get_twitch_url_by_name(twitch_name)
 	def _filter_adder(query):
@@ -2018,16 +3557,22 @@ def toggle_can_stream_by_twitch_name(twitch_name, can_stream):
 	_toggle_can_stream_by_filter(_filter_adder, can_stream)
 
 
+@query_budget(5)
 def twitch_user_logged_in(twitch_id, name, display_name, indexed_name, logo,
 		now=None):
-	return common_db.twitch_user_logged_in(
+	result = common_db.twitch_user_logged_in(
 			User, Users, twitch_id, name, display_name, indexed_name, logo,
 			now=now)
+	_changes_added()
+	return result
 
+@query_budget(4)
 def steam_user_logged_in(
 		steam_id, personaname, indexed_name, profile_url, avatar, avatar_full,
 		now=None):
-	return common_db.steam_user_logged_in(
+	result = common_db.steam_user_logged_in(
 			User, Users, steam_id, personaname, indexed_name, profile_url, avatar, avatar_full,
 			now=now)
+	_changes_added()
+	return result
 
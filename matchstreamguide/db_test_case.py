@@ -1,8 +1,54 @@
 import configure
 from datetime import datetime, timedelta
+import common_db
 import db
+from benchmarks import measurements as measurements_module
+import sqlalchemy as sa
+import sqlalchemy.engine.result as sa_engine_result
+import sqlalchemy.orm as sa_orm
 import unittest
 
+# The counter of the statements executed by the database engine. SQLAlchemy 0.8
+# cannot remove an event listener, so the first test case creates the counter and
+# listens for loaded instances, and all test cases share them.
+_statement_counter = None
+# The _RowCounter installed by the running test case, or None.
+_row_counter = None
+
+# The original ResultProxy.process_rows, which _RowCounter.install replaces.
+_process_rows = sa_engine_result.ResultProxy.__dict__['process_rows']
+
+def _count_loaded_instance(target, context):
+	if _row_counter is not None:
+		_row_counter.num_loaded_instances += 1
+
+"""Counts the rows fetched from the results of statements, and the instances
+loaded by the ORM, while it is installed.
+"""
+class _RowCounter:
+	def __init__(self):
+		self.num_rows = 0
+		self.num_loaded_instances = 0
+
+	def install(self):
+		global _statement_counter, _row_counter
+		if _statement_counter is None:
+			_statement_counter = measurements_module.StatementCounter()
+			sa.event.listen(sa_orm.Mapper, 'load', _count_loaded_instance)
+		_row_counter = self
+
+		# SQLAlchemy has no event for fetching rows, but every fetch method of a
+		# result passes the fetched rows to process_rows.
+		def count_process_rows(result, rows):
+			self.num_rows += len(rows)
+			return _process_rows(result, rows)
+		sa_engine_result.ResultProxy.process_rows = count_process_rows
+
+	def remove(self):
+		global _row_counter
+		sa_engine_result.ResultProxy.process_rows = _process_rows
+		_row_counter = None
+
 """Base class for test cases that use the database.
 """
 class DbTestCase(unittest.TestCase):
@@ -13,11 +59,54 @@ class DbTestCase(unittest.TestCase):
 		self._next_twitch_id = 0
 		db.create_all_tables()
 		self.session = db.session
+		self._row_counter = _RowCounter()
+		self._row_counter.install()
 
 	def tearDown(self):
+		self._row_counter.remove()
 		db.drop_all_tables()
 		unittest.TestCase.tearDown(self)
 
+	def _get_num_statements(self, f, *pargs, **kwargs):
+		"""Utility method that returns the result of calling the function, and the
+		count of statements that it executed.
+		"""
+		start_num_statements = _statement_counter.num_statements
+		result = f(*pargs, **kwargs)
+		return result, _statement_counter.num_statements - start_num_statements
+
+	def _call_within_budget(self, f, *pargs, **kwargs):
+		"""Utility method that returns the result of calling the function, and the
+		count of rows that it fetched.
+
+		The test fails with the executed statements if the function executes more
+		statements than its budget declared by common_db.query_budget.
+		"""
+		max_statements = getattr(f, 'max_statements', None)
+		self.assertIsNotNone(max_statements,
+				'%s does not declare a query budget' % f.__name__)
+		statements = []
+		start_num_rows = self._row_counter.num_rows
+		_statement_counter.statements = statements
+		try:
+			result = f(*pargs, **kwargs)
+		finally:
+			_statement_counter.statements = None
+		if len(statements) > max_statements:
+			self.fail('%s executed %s statements, exceeding its budget of %s:\n%s' % (
+					f.__name__, len(statements), max_statements,
+					'\n'.join('%s. %s' % (i + 1, ' '.join(statement.split()))
+						for i, statement in enumerate(statements))))
+		return result, self._row_counter.num_rows - start_num_rows
+
+	def _get_num_loaded_instances(self, f, *pargs, **kwargs):
+		"""Utility method that returns the result of calling the function, and the
+		count of instances that the ORM loaded.
+		"""
+		start_num_loaded_instances = self._row_counter.num_loaded_instances
+		result = f(*pargs, **kwargs)
+		return result, self._row_counter.num_loaded_instances - start_num_loaded_instances
+
 	def _get_profile_url(self, display_name):
 		return 'http://steamcommunity.com/id/%s' % display_name
 
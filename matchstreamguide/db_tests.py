@@ -1,9 +1,23 @@
 from datetime import datetime, timedelta
+import contextlib
+import cStringIO
 import db
 from db_test_case import DbTestCase
 import functools
+import json
+import league_feeds
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sa_postgresql
 import sqlalchemy.orm as sa_orm
+import sys
+import tempfile
 import time
+import types
 import unittest
 
 import common_db
@@ -169,6 +183,391 @@ class AbstractFinderDbTestCase(DbTestCase):
 		self.assertEqual(next_time, displayed_streamer.next_time)
 		self.assertEqual(next_match_id, displayed_streamer.next_match_id)
 
+	def _get_num_user_stars(self, match_id):
+		"""Returns a map from each user identifier to the count of stars in its
+		CalendarEntry for the given match.
+		"""
+		return dict(self.session.query(
+					db.CalendarEntry.user_id, db.CalendarEntry.num_user_stars)
+				.filter(db.CalendarEntry.match_id == match_id))
+
+"""Tests for updating CalendarEntries through CalendarJobs.
+"""
+class CalendarJobDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		db._queue_calendar_entries = True
+
+		# Create the match.
+		self.team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		self.team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		self.match_id = db.add_match(self.team1_id, self.team2_id, self.time,
+				self.game, self.division, self.match_fingerprint, now=self.now)
+		# Create the streaming user.
+		self.streamer_steam_id, self.streamer_id, new_user = self._create_steam_user(
+				self.streamer_name, self.streamer_indexed_name)
+		# Create the clients.
+		self.client_steam_id1, self.client_id1, new_user = self._create_steam_user(
+				'client_name1', 'client_indexed_name1')
+		self.client_steam_id2, self.client_id2, new_user = self._create_steam_user(
+				'client_name2', 'client_indexed_name2')
+
+	def tearDown(self):
+		db._queue_calendar_entries = False
+		AbstractFinderDbTestCase.tearDown(self)
+
+	def _get_num_calendar_jobs(self):
+		return self.session.query(db.CalendarJob).count()
+
+	def _assert_calendar_is_updating(self, client_id, is_updating):
+		displayed_calendar = db.get_displayed_viewer_calendar(client_id, now=self.now)
+		self.assertEqual(is_updating, displayed_calendar.is_updating)
+
+	"""Test that CalendarEntries are only updated after processing CalendarJobs.
+	"""
+	def test_process_calendar_jobs(self):
+		# Add stars, and then stream the match.
+		db.add_star_match(self.client_id1, self.match_id, now=self.now)
+		db.add_star_team(self.client_id1, self.team1_id, now=self.now)
+		db.add_star_team(self.client_id2, self.team2_id, now=self.now)
+		db.add_stream_match(self.streamer_id, self.match_id, now=self.now)
+		# Assert that the counts are updated, but the calendars are not.
+		displayed_match = db.get_displayed_match(self.client_id1, self.match_id)
+		self._assert_displayed_match_details(displayed_match,
+				self.match_id, self.time, self.game, self.division, self.match_fingerprint,
+				num_stars=1, num_streams=1, is_starred=True)
+		self.assertEqual({}, self._get_num_user_stars(self.match_id))
+		self._assert_calendar_is_updating(self.client_id1, True)
+		self._assert_calendar_is_updating(self.client_id2, True)
+
+		# Process the jobs one at a time.
+		while db.process_calendar_jobs(batch_size=1):
+			pass
+		self.assertEqual(0, self._get_num_calendar_jobs())
+		self.assertEqual({self.client_id1: 2, self.client_id2: 1},
+				self._get_num_user_stars(self.match_id))
+		displayed_calendar = db.get_displayed_viewer_calendar(self.client_id1, now=self.now)
+		self._assert_displayed_calendar(displayed_calendar,
+				has_next_match=True, num_matches=1)
+		self.assertFalse(displayed_calendar.is_updating)
+
+		# Add a star for the streaming user, which only updates the client's calendar.
+		db.add_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self._assert_calendar_is_updating(self.client_id1, False)
+		self._assert_calendar_is_updating(self.client_id2, True)
+		self.assertEqual(1, db.process_calendar_jobs())
+		self.assertEqual({self.client_id1: 2, self.client_id2: 2},
+				self._get_num_user_stars(self.match_id))
+
+		# Remove the stream, which updates the calendars of both clients.
+		db.remove_stream_match(self.streamer_id, self.match_id, now=self.now)
+		self._assert_calendar_is_updating(self.client_id1, True)
+		self._assert_calendar_is_updating(self.client_id2, True)
+		self.assertEqual(1, db.process_calendar_jobs())
+		self.assertEqual({}, self._get_num_user_stars(self.match_id))
+		self._assert_calendar_is_updating(self.client_id1, False)
+		self._assert_calendar_is_updating(self.client_id2, False)
+
+	"""Test that processing the same CalendarJobs again has no effect.
+	"""
+	def test_process_calendar_jobs_idempotent(self):
+		db.add_stream_match(self.streamer_id, self.match_id, now=self.now)
+		db.add_star_team(self.client_id1, self.team1_id, now=self.now)
+		db.add_star_team(self.client_id1, self.team2_id, now=self.now)
+		db.add_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self.assertEqual(4, self._get_num_calendar_jobs())
+		self.assertEqual(4, db.process_calendar_jobs())
+		expected_num_user_stars = {self.client_id1: 2, self.client_id2: 1}
+		self.assertEqual(expected_num_user_stars, self._get_num_user_stars(self.match_id))
+
+		# Add the same jobs again, as if a worker failed before deleting them.
+		db._add_user_calendar_job(self.client_id1, self.now)
+		db._add_user_calendar_job(self.client_id2, self.now)
+		db._add_match_calendar_job(self.match_id, self.now)
+		self.session.commit()
+		self.assertEqual(3, db.process_calendar_jobs())
+		self.assertEqual(expected_num_user_stars, self._get_num_user_stars(self.match_id))
+		self.assertEqual(0, db.process_calendar_jobs())
+
+		# Remove the stars and assert that the calendars are empty.
+		db.remove_star_team(self.client_id1, self.team1_id, now=self.now)
+		db.remove_star_team(self.client_id1, self.team2_id, now=self.now)
+		db.remove_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self.assertEqual(3, db.process_calendar_jobs())
+		self.assertEqual({}, self._get_num_user_stars(self.match_id))
+
+	"""Test that the calendar worker prunes only the changes older than a day.
+	"""
+	def test_prune_changes(self):
+		num_changes = self.session.query(common_db.Change).count()
+		self.assertNotEqual(0, num_changes)
+		db.change_bus.start()
+		now = datetime.utcnow()
+		self.assertEqual(0, db.prune_changes(now=now))
+		self.assertEqual(num_changes,
+				db.prune_changes(now=now + db._CHANGES_MAX_AGE + timedelta(minutes=1)))
+		self.assertEqual(0, self.session.query(common_db.Change).count())
+
+		# Assert that the versions of the pruned changes are not reused, so that a
+		# started bus delivers the changes added after pruning.
+		db.add_team('team_name', 'team_indexed_name', 'game', 'division',
+				'team_fingerprint')
+		self.assertLess(num_changes,
+				self.session.query(sa.func.min(common_db.Change.version)).scalar())
+		self.assertNotEqual(0, db.change_bus.poll())
+
+
+"""Tests for the calendar backends that compute calendars from stars on read.
+"""
+class CalendarBackendDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+
+		# Create two matches between the same teams.
+		self.team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		self.team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		self.match_id1 = db.add_match(self.team1_id, self.team2_id, self.time,
+				self.game, self.division, 'match_fingerprint1', now=self.now)
+		self.match_id2 = db.add_match(self.team2_id, self.team1_id,
+				self.time + timedelta(days=1), self.game, self.division,
+				'match_fingerprint2', now=self.now)
+		# Create the streaming user.
+		self.streamer_steam_id, self.streamer_id, new_user = self._create_steam_user(
+				self.streamer_name, self.streamer_indexed_name)
+		# Create the clients.
+		self.client_steam_id1, self.client_id1, new_user = self._create_steam_user(
+				'client_name1', 'client_indexed_name1')
+		self.client_steam_id2, self.client_id2, new_user = self._create_steam_user(
+				'client_name2', 'client_indexed_name2')
+
+	def tearDown(self):
+		db._calendar_backend = db.MaterializedCalendarBackend()
+		AbstractFinderDbTestCase.tearDown(self)
+
+	def _get_calendar_match_ids(self, client_id):
+		displayed_calendar = db.get_displayed_viewer_calendar(client_id, now=self.now)
+		return [displayed_match.match_id for displayed_match in displayed_calendar.matches]
+
+	def _get_num_calendar_entries(self, client_id):
+		return self.session.query(db.CalendarEntry)\
+				.filter(db.CalendarEntry.user_id == client_id)\
+				.count()
+
+	def _get_num_starred(self, client_id):
+		return self.session.query(db.User.num_starred)\
+				.filter(db.User.id == client_id)\
+				.one()\
+				.num_starred
+
+	"""Test that the on-read backend returns calendars without CalendarEntries.
+	"""
+	def test_on_read_calendar(self):
+		db._calendar_backend = db.OnReadCalendarBackend()
+		db.add_star_match(self.client_id1, self.match_id2, now=self.now)
+		db.add_star_team(self.client_id1, self.team1_id, now=self.now)
+		db.add_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self.assertEqual([], self._get_calendar_match_ids(self.client_id1))
+
+		# Stream the second match, which is starred twice by the first client.
+		db.add_stream_match(self.streamer_id, self.match_id2, now=self.now)
+		self.assertEqual([self.match_id2], self._get_calendar_match_ids(self.client_id1))
+		self.assertEqual([self.match_id2], self._get_calendar_match_ids(self.client_id2))
+		# Stream the first match.
+		db.add_stream_match(self.streamer_id, self.match_id1, now=self.now)
+		expected_match_ids = [self.match_id1, self.match_id2]
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id1))
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id2))
+		self.assertEqual(0, self.session.query(db.CalendarEntry).count())
+
+		# Assert that the materialized backend returns the same calendars.
+		db._calendar_backend = db.MaterializedCalendarBackend()
+		db._rebuild_calendar_entries((self.client_id1, self.client_id2), ())
+		self.session.commit()
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id1))
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id2))
+
+		# Remove the stars, and assert that the calendars are empty.
+		db._calendar_backend = db.OnReadCalendarBackend()
+		db.remove_star_team(self.client_id1, self.team1_id, now=self.now)
+		self.assertEqual([self.match_id2], self._get_calendar_match_ids(self.client_id1))
+		db.remove_star_match(self.client_id1, self.match_id2, now=self.now)
+		db.remove_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self.assertEqual([], self._get_calendar_match_ids(self.client_id1))
+		self.assertEqual([], self._get_calendar_match_ids(self.client_id2))
+
+	"""Test that the hybrid backend materializes only calendars with enough stars.
+	"""
+	def test_hybrid_calendar(self):
+		db._calendar_backend = db.HybridCalendarBackend(2)
+		db.add_stream_match(self.streamer_id, self.match_id1, now=self.now)
+		db.add_star_team(self.client_id1, self.team1_id, now=self.now)
+		db.add_star_streamer(self.client_id2, self.streamer_id, now=self.now)
+		self.assertEqual(1, self._get_num_starred(self.client_id1))
+		self.assertEqual(0, self._get_num_calendar_entries(self.client_id1))
+		self.assertEqual([self.match_id1], self._get_calendar_match_ids(self.client_id1))
+
+		# Add a second star, which materializes the first client's calendar.
+		db.add_star_match(self.client_id1, self.match_id2, now=self.now)
+		self.assertEqual(2, self._get_num_starred(self.client_id1))
+		self.assertEqual({self.client_id1: 1}, self._get_num_user_stars(self.match_id1))
+		self.assertEqual([self.match_id1], self._get_calendar_match_ids(self.client_id1))
+
+		# Stream the second match, which only updates the materialized calendar.
+		db.add_stream_match(self.streamer_id, self.match_id2, now=self.now)
+		self.assertEqual({self.client_id1: 2}, self._get_num_user_stars(self.match_id2))
+		expected_match_ids = [self.match_id1, self.match_id2]
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id1))
+		self.assertEqual(expected_match_ids, self._get_calendar_match_ids(self.client_id2))
+		self.assertEqual(0, self._get_num_calendar_entries(self.client_id2))
+
+		# Remove a star, which deletes the first client's calendar.
+		db.remove_star_team(self.client_id1, self.team1_id, now=self.now)
+		self.assertEqual(1, self._get_num_starred(self.client_id1))
+		self.assertEqual(0, self._get_num_calendar_entries(self.client_id1))
+		self.assertEqual([self.match_id2], self._get_calendar_match_ids(self.client_id1))
+
+
+"""Tests for verifying and repairing denormalized counters.
+"""
+class VerifyCountersDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+
+		# Create the match.
+		self.team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		self.team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		self.match_id = db.add_match(self.team1_id, self.team2_id, self.time,
+				self.game, self.division, self.match_fingerprint, now=self.now)
+		# Create the streaming user and the client.
+		self.streamer_steam_id, self.streamer_id, new_user = self._create_steam_user(
+				self.streamer_name, self.streamer_indexed_name)
+		self.client_steam_id, self.client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+
+		# Add stars and a stream.
+		db.add_star_match(self.client_id, self.match_id, now=self.now)
+		db.add_star_team(self.client_id, self.team1_id, now=self.now)
+		db.add_star_streamer(self.client_id, self.streamer_id, now=self.now)
+		db.add_stream_match(self.streamer_id, self.match_id, now=self.now)
+
+	def _verify_all_counters(self, repair=False):
+		max_match_id, max_team_id, max_user_id = db.get_max_ids()
+		return (db.verify_match_counters(0, max_match_id + 1, repair) +
+				db.verify_team_counters(0, max_team_id + 1, repair) +
+				db.verify_user_counters(0, max_user_id + 1, repair))
+
+	"""Test that no differences are found after adding stars and streams.
+	"""
+	def test_verify_no_differences(self):
+		self.assertEqual([], self._verify_all_counters())
+		db.remove_stream_match(self.streamer_id, self.match_id, now=self.now)
+		db.remove_star_team(self.client_id, self.team1_id, now=self.now)
+		self.assertEqual([], self._verify_all_counters())
+
+	"""Test that differences are found and then repaired.
+	"""
+	def test_verify_and_repair(self):
+		# Corrupt the counters and a CalendarEntry.
+		self.session.execute(db.Matches.update()
+				.values({db.Match.num_stars: 5, db.Match.num_streams: 3}))
+		self.session.execute(db.MatchOpponents.update()
+				.where(db.MatchOpponent.team_id == self.team2_id)
+				.values({db.MatchOpponent.is_streamed: False}))
+		self.session.execute(db.Teams.update()
+				.where(db.Team.id == self.team1_id)
+				.values({db.Team.num_stars: 0}))
+		self.session.execute(db.Users.update()
+				.where(db.User.id == self.client_id)
+				.values({db.User.num_starred: 1}))
+		self.session.execute(db.CalendarEntries.update()
+				.values({db.CalendarEntry.num_user_stars: 1}))
+		self.session.commit()
+
+		expected_differences = [
+			db.CounterDifference('Matches', self.match_id, 'num_stars', 5, 1),
+			db.CounterDifference('Matches', self.match_id, 'num_streams', 3, 1),
+			db.CounterDifference('MatchOpponents', (self.match_id, self.team2_id),
+				'is_streamed', False, True),
+			db.CounterDifference('Teams', self.team1_id, 'num_stars', 0, 1),
+			db.CounterDifference('Users', self.client_id, 'num_starred', 1, 3),
+			db.CounterDifference('CalendarEntries', (self.client_id, self.match_id),
+				'num_user_stars', 1, 3),
+		]
+		self.assertEqual(expected_differences, self._verify_all_counters())
+		# Verifying without repairing does not change anything.
+		self.assertEqual(expected_differences, self._verify_all_counters())
+		self.assertEqual(expected_differences, self._verify_all_counters(repair=True))
+		self.assertEqual([], self._verify_all_counters())
+		self.assertEqual({self.client_id: 3}, self._get_num_user_stars(self.match_id))
+
+	"""Test that a missing CalendarEntry and an extra CalendarEntry are found.
+	"""
+	def test_verify_calendar_entries(self):
+		db.remove_stream_match(self.streamer_id, self.match_id, now=self.now)
+		# Add a CalendarEntry for the match that is no longer streamed.
+		self.session.add(db.CalendarEntry(user_id=self.client_id, match_id=self.match_id,
+				time=self.time, num_user_stars=2))
+		self.session.commit()
+		self.assertEqual(
+				[db.CounterDifference('CalendarEntries', (self.client_id, self.match_id),
+					'num_user_stars', 2, None)],
+				db.verify_user_counters(self.client_id, self.client_id + 1, repair=True))
+		self.assertEqual({}, self._get_num_user_stars(self.match_id))
+
+		# Add the stream and delete its CalendarEntry.
+		db.add_stream_match(self.streamer_id, self.match_id, now=self.now)
+		self.session.execute(db.CalendarEntries.delete())
+		self.session.commit()
+		self.assertEqual(
+				[db.CounterDifference('CalendarEntries', (self.client_id, self.match_id),
+					'num_user_stars', None, 3)],
+				db.verify_user_counters(self.client_id, self.client_id + 1, repair=True))
+		self.assertEqual({self.client_id: 3}, self._get_num_user_stars(self.match_id))
+		# The shard of the streaming user does not contain the client.
+		self.assertEqual([],
+				db.verify_user_counters(self.streamer_id, self.streamer_id + 1))
+
+
+"""Tests for migrating a database created by an earlier version.
+"""
+class MigrateTablesDbTestCase(DbTestCase):
+	def _get_index_names(self):
+		inspector = sa.inspect(db.session.connection())
+		return set(index['name']
+				for table in common_db._Base.metadata.sorted_tables
+				for index in inspector.get_indexes(table.name))
+
+	def test_migrate_tables(self):
+		# Restore the tables and indexes of the earlier version.
+		db.CalendarJob.__table__.drop(db.session.connection())
+		common_db.Change.__table__.drop(db.session.connection())
+		db.session.execute('DROP INDEX "MatchEditsByMatchIdAndAction"')
+		db.session.execute('CREATE INDEX "MatchOpponentsByTeamIdAndTimeAndMatchId" '
+				'ON "MatchOpponents" (team_id, time, match_id)')
+		db.session.commit()
+
+		db.migrate_tables()
+		index_names = self._get_index_names()
+		self.assertIn('CalendarJobsByUserId', index_names)
+		self.assertIn('ChangesByAdded', index_names)
+		self.assertIn('MatchEditsByMatchIdAndAction', index_names)
+		self.assertNotIn('MatchOpponentsByTeamIdAndTimeAndMatchId', index_names)
+		# Assert that migrating a migrated database changes nothing.
+		db.migrate_tables()
+		self.assertEqual(index_names, self._get_index_names())
+
 
 """Tests for pagination of streaming users.
 """
@@ -601,6 +1000,38 @@ class TeamPaginationTestCase(AbstractFinderDbTestCase):
 				displayed_teams, _get_next_page, _get_prev_page,
 				team_num_stars=1, is_starred=True)
 
+	"""Tests that each page of teams is fetched using only one statement, after the
+	teams starred by the client are loaded for the first page of all teams.
+	"""
+	def test_get_teams_pagination_num_statements(self):
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		for team_id in (self.team1_id, self.team2_id, self.team3_id):
+			db.add_star_team(client_id, team_id)
+		db.begin_request()
+
+		for get_teams, first_num_statements in (
+				(db.get_all_teams, 2), (db.get_starred_teams, 1)):
+			# Fetch the first page.
+			displayed_teams, num_statements = self._get_num_statements(
+					get_teams, client_id, page_limit=2)
+			self.assertEqual(first_num_statements, num_statements)
+			self.assertIsNotNone(displayed_teams.next_name)
+			# Fetch the next page.
+			displayed_teams, num_statements = self._get_num_statements(
+					get_teams, client_id, page_limit=2,
+					next_name=displayed_teams.next_name,
+					next_team_id=displayed_teams.next_team_id)
+			self.assertEqual(1, num_statements)
+			self.assertIsNotNone(displayed_teams.prev_name)
+			# Fetch the previous page.
+			displayed_teams, num_statements = self._get_num_statements(
+					get_teams, client_id, page_limit=2,
+					prev_name=displayed_teams.prev_name,
+					prev_team_id=displayed_teams.prev_team_id)
+			self.assertEqual(1, num_statements)
+			self.assertIsNone(displayed_teams.prev_name)
+
 
 """Tests for pagination of matches.
 """
@@ -1127,6 +1558,954 @@ class MatchPaginationTestCase(AbstractFinderDbTestCase):
 				match_num_stars=1, is_starred=True)
 
 
+	"""Tests that the read paths build displayed objects without loading ORM
+	instances.
+	"""
+	def test_get_displayed_loads_no_instances(self):
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		streamer_twitch_id, streamer_id, new_user = self._create_twitch_user(
+				self.streamer_name, self.streamer_indexed_name)
+		db.add_star_match(client_id, self.match_id1, now=self.now)
+		db.add_star_team(client_id, self.team2_id, now=self.now)
+		db.add_star_streamer(client_id, streamer_id, now=self.now)
+		db.add_stream_match(streamer_id, self.match_id2, now=self.now)
+
+		# Loading instances is counted.
+		matches, num_loaded_instances = self._get_num_loaded_instances(
+				self.session.query(db.Match).all)
+		self.assertEqual(7, num_loaded_instances)
+		self.session.remove()
+
+		for f, pargs, kwargs in (
+				(db.get_all_matches, (client_id,), {'now': self.now}),
+				(db.get_all_matches, (None,), {'now': self.now}),
+				(db.get_starred_matches, (client_id,), {'now': self.now}),
+				(db.get_all_teams, (client_id,), {}),
+				(db.get_starred_teams, (client_id,), {}),
+				(db.get_all_streamers, (client_id,), {}),
+				(db.get_starred_streamers, (client_id,), {}),
+				(db.get_displayed_viewer_calendar, (client_id,), {'now': self.now}),
+				(db.get_displayed_streamer_calendar, (streamer_id,), {'now': self.now}),
+				(db.get_displayed_match, (client_id, self.match_id2), {}),
+				(db.get_displayed_team, (client_id, self.team2_id), {'now': self.now}),
+				(db.get_displayed_streamer, (client_id, streamer_id), {'now': self.now})):
+			displayed, num_loaded_instances = self._get_num_loaded_instances(
+					f, *pargs, **kwargs)
+			self.assertEqual(0, num_loaded_instances, f.__name__)
+
+
+"""Tests for the keyset predicates used by the paginators.
+"""
+class KeysetPaginationDbTestCase(DbTestCase):
+	def _get_query_plan(self, query):
+		"""Utility method that returns the details of the SQLite query plan for the
+		query.
+		"""
+		connection = db.session.connection()
+		compiled = query.compile(dialect=connection.dialect)
+		params = [compiled.params[name] for name in compiled.positiontup]
+		cursor = connection.connection.cursor()
+		cursor.execute('EXPLAIN QUERY PLAN %s' % compiled, params)
+		return tuple(row[-1] for row in cursor.fetchall())
+
+	def _assert_range_scan(self, paginator, index_name, column_name):
+		"""Utility method that asserts the plan for each page of the paginator
+		scans a range of the given index.
+		"""
+		for direction, predicate in (
+				(db._NEXT_PAGE, '%s>?' % column_name),
+				(db._PREV_PAGE, '%s<?' % column_name)):
+			query = db._get_page_query(paginator, direction, 10, 'sqlite')
+			plan = self._get_query_plan(query)
+			self.assertTrue(any(detail.startswith('SEARCH') and
+						(index_name in detail) and (predicate in detail)
+					for detail in plan), plan)
+
+	"""Test that each paginator scans a range of its index on SQLite.
+	"""
+	def test_sqlite_range_scans(self):
+		client_id = 1
+		team_id = 2
+		streamer_id = 3
+		match_id = 4
+
+		self._assert_range_scan(db.AllMatchesPaginator(client_id, self.now),
+				'MatchesByTimeAndMatchId', 'time')
+		self._assert_range_scan(db.StarredMatchesPaginator(client_id, self.now),
+				'StarredMatchesByUserIdAndTimeAndMatchId', 'time')
+		self._assert_range_scan(db.AllTeamsPaginator(client_id),
+				'TeamsByIndexedNameAndTeamId', 'indexed_name')
+		self._assert_range_scan(db.StarredTeamsPaginator(client_id),
+				'StarredTeamsByUserIdAndIndexedNameAndTeamId', 'indexed_name')
+		self._assert_range_scan(db.AllStreamersPaginator(client_id),
+				'UsersByCanStreamAndIndexedNameAndUserId', 'indexed_name')
+		self._assert_range_scan(db.StarredStreamersPaginator(client_id),
+				'StarredStreamersByUserIdAndIndexedNameAndStreamerId', 'indexed_name')
+		self._assert_range_scan(db.MatchStreamersPaginator(match_id, client_id),
+				'StreamedMatchesByMatchIdAndAddedAndStreamerId', 'added')
+		self._assert_range_scan(
+				db.MatchOpponentsPaginator(team_id, client_id, self.now),
+				'MatchOpponentsByTeamIdAndTimeAndMatchIdAndOpponentId', 'time')
+		self._assert_range_scan(
+				db.StreamedMatchesPaginator(streamer_id, client_id, self.now),
+				'StreamedMatchesByStreamerIdAndTimeAndMatchId', 'time')
+		self._assert_range_scan(db.CalendarEntriesPaginator(client_id, self.now, True),
+				'CalendarEntriesByUserIdAndTimeAndMatchId', 'time')
+
+	"""Test that the keyset predicates compare row values on PostgreSQL.
+	"""
+	def test_postgresql_row_values(self):
+		dialect = sa_postgresql.dialect()
+		predicate = db._get_keyset_predicate(
+				'postgresql', db.Match.time, db.Match.id, self.now, 1, True)
+		self.assertEqual('("Matches".time, "Matches".id) > (%(param_1)s, %(param_2)s)',
+				str(predicate.compile(dialect=dialect)))
+		predicate = db._get_keyset_predicate(
+				'postgresql', db.Match.time, db.Match.id, self.now, 1, False)
+		self.assertEqual('("Matches".time, "Matches".id) < (%(param_1)s, %(param_2)s)',
+				str(predicate.compile(dialect=dialect)))
+
+
+"""A cursor of a _FakePostgresqlConnection, which records each statement and its
+parameters, and returns one row for each query.
+
+The data copied by copy_expert is recorded as the parameters of its statement.
+"""
+class _FakePostgresqlCursor:
+	# The row returned by each statement that the dialect executes on connecting.
+	_CONNECT_ROWS = (
+		('select version()', ('PostgreSQL 9.3.4 on x86_64-unknown-linux-gnu',)),
+		('select current_schema()', ('public',)),
+		('show transaction isolation level', ('read committed',)),
+		("SELECT CAST('test", ('test',)),
+	)
+	# The prefixes of the statements that return rows.
+	_QUERY_PREFIXES = ('select ', 'show ', 'execute ')
+
+	def __init__(self, statements):
+		self.statements = statements
+		self.description = None
+		self.rowcount = -1
+		self._rows = []
+
+	def execute(self, statement, parameters=None):
+		self.statements.append((statement, parameters))
+		if not statement.lower().startswith(self._QUERY_PREFIXES):
+			self.description = None
+			self._rows = []
+			return
+		row = (1,)
+		for prefix, connect_row in self._CONNECT_ROWS:
+			if statement.startswith(prefix):
+				row = connect_row
+		self.description = [('column', None, None, None, None, None, None)]
+		self.rowcount = 1
+		self._rows = [row]
+
+	def executemany(self, statement, parameters):
+		self.statements.append((statement, list(parameters)))
+		self.description = None
+
+	def copy_expert(self, statement, data):
+		self.statements.append((statement, data.read()))
+
+	def fetchone(self):
+		return self._rows.pop(0) if self._rows else None
+
+	def fetchall(self):
+		rows, self._rows = self._rows, []
+		return rows
+
+	def fetchmany(self, size=None):
+		return self.fetchall()
+
+	def close(self):
+		pass
+
+"""A psycopg2 connection that executes nothing."""
+class _FakePostgresqlConnection:
+	def __init__(self, statements):
+		self.statements = statements
+
+	def cursor(self, *args, **kwargs):
+		return _FakePostgresqlCursor(self.statements)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+	def close(self):
+		pass
+
+def _create_fake_psycopg2(statements):
+	"""Returns a psycopg2 module whose connections append each executed statement
+	and its parameters to the given list.
+	"""
+	psycopg2 = types.ModuleType('psycopg2')
+	psycopg2.__version__ = '2.5.2 (dt dec pq3 ext)'
+	psycopg2.paramstyle = 'pyformat'
+	psycopg2.Error = psycopg2.OperationalError = psycopg2.ProgrammingError = Exception
+	psycopg2.connect = lambda *args, **kwargs: _FakePostgresqlConnection(statements)
+	# The psycopg2 dialect imports these modules on connecting.
+	psycopg2.extras = types.ModuleType('psycopg2.extras')
+	psycopg2.extensions = types.ModuleType('psycopg2.extensions')
+	return psycopg2
+
+@contextlib.contextmanager
+def _fake_postgresql_session(statements):
+	"""Replaces the session with one whose instrumented engine has fake psycopg2
+	connections, which append each executed statement and its parameters to the
+	given list.
+	"""
+	saved_psycopg2 = sys.modules.get('psycopg2')
+	sys.modules['psycopg2'] = psycopg2 = _create_fake_psycopg2(statements)
+	engine = sa.create_engine('postgresql+psycopg2://', module=psycopg2,
+			use_native_unicode=False, use_native_hstore=False)
+	common_db._instrument_engine(engine, None)
+	session = common_db.session
+	common_db.session = db.session = sa_orm.scoped_session(
+			sa_orm.sessionmaker(bind=engine))
+	try:
+		# Connect before clearing the statements that the dialect executes.
+		common_db.session.connection()
+		del statements[:]
+		yield
+	finally:
+		common_db.session.remove()
+		common_db.session = db.session = session
+		if saved_psycopg2 is None:
+			del sys.modules['psycopg2']
+		else:
+			sys.modules['psycopg2'] = saved_psycopg2
+		engine.dispose()
+
+
+"""Tests for the statements that the paginators and getters build once.
+"""
+class StatementCacheDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		steam_id, self.client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		self.team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		self.team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		self.match_ids = [
+				db.add_match(self.team1_id, self.team2_id, self.time + timedelta(hours=i),
+					self.game, self.division, 'match%s' % i, now=self.now)
+				for i in xrange(4)]
+		db._statements.clear()
+
+	def _get_pages(self, match_id, team_id):
+		"""Utility method that returns the first and next pages of each getter."""
+		all_matches = db.get_all_matches(self.client_id, page_limit=2, now=self.now)
+		next_matches = db.get_all_matches(self.client_id,
+				next_time=all_matches.next_time, next_match_id=all_matches.next_match_id,
+				page_limit=2, now=self.now)
+		displayed_match = db.get_displayed_match(self.client_id, match_id)
+		displayed_team = db.get_displayed_team(
+				self.client_id, team_id, page_limit=2, now=self.now)
+		return all_matches, next_matches, displayed_match, displayed_team
+
+	"""Test that later calls reuse the statements built and compiled by the first,
+	and bind the values of their own parameters.
+	"""
+	def test_reuse_statements(self):
+		all_matches, next_matches, displayed_match, displayed_team = self._get_pages(
+				self.match_ids[0], self.team1_id)
+		stats = db._statements.get_stats()
+		self.assertLess(0, stats['statements'])
+		self.assertEqual(stats['statements'], stats['compiled'])
+
+		self.assertSequenceEqual(self.match_ids[:2],
+				[match.match_id for match in all_matches.matches])
+		self.assertSequenceEqual(self.match_ids[2:],
+				[match.match_id for match in next_matches.matches])
+		self.assertEqual(self.match_ids[0], displayed_match.match_id)
+		self.assertEqual(self.team1_name, displayed_team.name)
+
+		# Get the pages for another match and team.
+		all_matches, next_matches, displayed_match, displayed_team = self._get_pages(
+				self.match_ids[1], self.team2_id)
+		self.assertEqual(self.match_ids[1], displayed_match.match_id)
+		self.assertEqual(self.team2_name, displayed_team.name)
+		next_stats = db._statements.get_stats()
+		self.assertEqual(stats['statements'], next_stats['statements'])
+		self.assertEqual(stats['compiled'], next_stats['compiled'])
+		self.assertEqual(2 * stats['executions'], next_stats['executions'])
+
+	"""Test that the directions of a page and the client have distinct statements.
+	"""
+	def test_statement_keys(self):
+		db.get_all_matches(self.client_id, page_limit=2, now=self.now)
+		db.get_all_matches(self.client_id, next_time=self.time, next_match_id=1,
+				page_limit=2, now=self.now)
+		db.get_all_matches(self.client_id, prev_time=self.time, prev_match_id=1,
+				page_limit=2, now=self.now)
+		self.assertEqual(3, db._statements.get_stats()['statements'])
+
+		# A team with and without a client has distinct statements for its matches.
+		db.get_displayed_team(self.client_id, self.team1_id, now=self.now)
+		num_statements = db._statements.get_stats()['statements']
+		db.get_displayed_team(None, self.team1_id, now=self.now)
+		self.assertEqual(num_statements + 1, db._statements.get_stats()['statements'])
+
+
+	"""Test that statements are executed normally on dialects that cannot prepare
+	them.
+	"""
+	def test_prepare_fallback(self):
+		max_prepared_statements = common_db._max_prepared_statements
+		common_db._max_prepared_statements = 2
+		try:
+			for i in xrange(common_db._PREPARE_MIN_EXECUTIONS + 1):
+				all_matches, next_matches, displayed_match, displayed_team = \
+						self._get_pages(self.match_ids[0], self.team1_id)
+		finally:
+			common_db._max_prepared_statements = max_prepared_statements
+		self.assertSequenceEqual(self.match_ids[:2],
+				[match.match_id for match in all_matches.matches])
+		stats = db.get_statement_stats()
+		self.assertEqual(0, stats['prepared'])
+		self.assertEqual(0, stats['prepares'])
+		self.assertEqual(0, stats['prepared_hits'])
+
+	"""Test that the hot statements are prepared on PostgreSQL, up to the most
+	prepared statements, and that a hotter statement replaces a colder one.
+	"""
+	def test_prepare_postgresql(self):
+		dialect = sa_postgresql.dialect()
+		first_key = ('first',)
+		first_statement = db._get_page_query(
+				db.AllMatchesPaginator(self.client_id, self.now),
+				db._NEXT_PAGE, 10, 'postgresql')
+		second_key = ('second',)
+		second_statement = sa.select([db.Team.id])\
+				.where(db.Team.id == sa.bindparam('team_id'))
+		max_prepared_statements = common_db._max_prepared_statements
+		common_db._max_prepared_statements = 1
+		try:
+			for i in xrange(common_db._PREPARE_MIN_EXECUTIONS - 1):
+				self.assertIsNone(db._statements._get_prepared(
+						first_key, first_statement, dialect))
+			prepared = db._statements._get_prepared(first_key, first_statement, dialect)
+			self.assertIs(prepared,
+					db._statements._get_prepared(first_key, first_statement, dialect))
+			# No statement that is executed as much as the prepared one is prepared.
+			for i in xrange(common_db._PREPARE_MIN_EXECUTIONS + 1):
+				self.assertIsNone(db._statements._get_prepared(
+						second_key, second_statement, dialect))
+			# A statement that is executed more replaces the prepared one.
+			second_prepared = db._statements._get_prepared(
+					second_key, second_statement, dialect)
+			self.assertIsNotNone(second_prepared)
+			self.assertNotEqual(prepared.name, second_prepared.name)
+			self.assertItemsEqual([second_key], db._statements._prepared)
+			self.assertItemsEqual([prepared.name], db._statements._demoted_names)
+		finally:
+			common_db._max_prepared_statements = max_prepared_statements
+
+		# The parameters are numbered in the PREPARE statement.
+		self.assertTrue(prepared.prepare_statement.startswith(
+				'PREPARE %s AS SELECT ' % prepared.name), prepared.prepare_statement)
+		self.assertNotIn('%(', prepared.prepare_statement)
+		self.assertIn('("Matches".time, "Matches".id) > ($2, $3)',
+				prepared.prepare_statement)
+		self.assertSequenceEqual(['cutoff_time', 'page_col1', 'page_col2', 'param_1'],
+				prepared.bind_names)
+		self.assertEqual(
+				'EXECUTE %s (:cutoff_time, :page_col1, :page_col2, :param_1)' % prepared.name,
+				str(prepared.execute_statement))
+		cutoff_time = db._get_upcoming_matches_cutoff(self.now)
+		self.assertDictEqual(
+				{'cutoff_time': cutoff_time, 'page_col1': self.time, 'page_col2': 1,
+					'param_1': 11},
+				prepared.get_parameters(
+					{'cutoff_time': cutoff_time, 'page_col1': self.time, 'page_col2': 1}))
+
+	"""Test that a hot statement is prepared once on a psycopg2 connection and then
+	executed by name, and that both statements are added to the QueryLog.
+	"""
+	def test_prepare_execute(self):
+		statements = []
+		max_prepared_statements = common_db._max_prepared_statements
+		common_db._max_prepared_statements = 1
+		statement_cache = common_db.StatementCache()
+		build = lambda: sa.select([db.Team.id])\
+				.where(db.Team.id == sa.bindparam('team_id'))
+		try:
+			with _fake_postgresql_session(statements):
+				common_db.begin_query_log()
+				for i in xrange(common_db._PREPARE_MIN_EXECUTIONS + 1):
+					self.assertEqual(1, statement_cache.execute(
+							('team',), build, {'team_id': self.team1_id}).scalar())
+				query_log = common_db.end_query_log()
+		finally:
+			common_db._max_prepared_statements = max_prepared_statements
+
+		prepared = statement_cache._prepared[('team',)]
+		select_statement = (
+				'SELECT "Teams".id \nFROM "Teams" \nWHERE "Teams".id = %(team_id)s',
+				{'team_id': self.team1_id})
+		execute_statement = ('EXECUTE %s (%%(team_id)s)' % prepared.name,
+				{'team_id': self.team1_id})
+		self.assertSequenceEqual([
+				select_statement,
+				select_statement,
+				# PREPARE is executed without parameters, so psycopg2 does not format it.
+				('PREPARE %s AS SELECT "Teams".id \nFROM "Teams" \nWHERE "Teams".id = $1'
+					% prepared.name, None),
+				execute_statement,
+				execute_statement,
+			], statements)
+		self.assertEqual(len(statements), query_log.num_statements)
+		stats = statement_cache.get_stats()
+		self.assertEqual(1, stats['prepared'])
+		self.assertEqual(1, stats['prepares'])
+		self.assertEqual(1, stats['prepared_hits'])
+
+	"""Test that a connection deallocates a prepared statement that a hotter
+	statement replaced, before it prepares the hotter statement.
+	"""
+	def test_prepare_deallocate(self):
+		statements = []
+		max_prepared_statements = common_db._max_prepared_statements
+		common_db._max_prepared_statements = 1
+		statement_cache = common_db.StatementCache()
+		build_team = lambda: sa.select([db.Team.id])\
+				.where(db.Team.id == sa.bindparam('team_id'))
+		build_match = lambda: sa.select([db.Match.id])\
+				.where(db.Match.id == sa.bindparam('match_id'))
+		try:
+			with _fake_postgresql_session(statements):
+				for i in xrange(common_db._PREPARE_MIN_EXECUTIONS):
+					statement_cache.execute(('team',), build_team, {'team_id': self.team1_id})
+				team_prepared = statement_cache._prepared[('team',)]
+				for i in xrange(common_db._PREPARE_MIN_EXECUTIONS + 1):
+					self.assertEqual(self.match_ids[0], statement_cache.execute(
+							('match',), build_match, {'match_id': self.match_ids[0]}).scalar())
+				match_prepared = statement_cache._prepared[('match',)]
+				self.assertSequenceEqual([
+						('DEALLOCATE %s' % team_prepared.name, None),
+						('PREPARE %s AS SELECT "Matches".id \nFROM "Matches" \n'
+							'WHERE "Matches".id = $1' % match_prepared.name, None),
+						('EXECUTE %s (%%(match_id)s)' % match_prepared.name,
+							{'match_id': self.match_ids[0]}),
+					], statements[-3:])
+
+				# Assert that the replaced statement is deallocated only once.
+				del statements[:]
+				statement_cache.execute(('match',), build_match, {'match_id': self.match_ids[0]})
+				self.assertEqual(1, len(statements))
+		finally:
+			common_db._max_prepared_statements = max_prepared_statements
+
+		self.assertItemsEqual([('match',)], statement_cache._prepared)
+		stats = statement_cache.get_stats()
+		self.assertEqual(2, stats['prepares'])
+		self.assertEqual(1, stats['deallocates'])
+
+
+"""Tests for loading teams and matches in bulk.
+"""
+class LoadScheduleDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		self.team1 = db.ScheduleTeam(self.team1_name, self.team1_indexed_name,
+				self.game, self.division, self.team1_fingerprint)
+		self.team2 = db.ScheduleTeam(self.team2_name, self.team2_indexed_name,
+				self.game, self.division, self.team2_fingerprint)
+		self.match1 = db.ScheduleMatch(self.team1_fingerprint, self.team2_fingerprint,
+				self.time, self.game, self.division, 'match1')
+		self.match2 = db.ScheduleMatch(self.team2_fingerprint, self.team1_fingerprint,
+				self.time + timedelta(days=1), self.game, self.division, 'match2')
+
+	def _get_times(self, table, match_id_column, match_id):
+		"""Utility method that returns the times in the table for the match."""
+		return [row[0] for row in db.session.execute(
+				sa.select([table.c.time]).where(match_id_column == match_id))]
+
+	def _get_team_rows(self, num_rows):
+		"""Utility method that returns the rows of teams to insert."""
+		return [{
+				'display_name': 'team%s' % i,
+				'indexed_name': 'team%s' % i,
+				'game': self.game,
+				'division': self.division,
+				'fingerprint': 'team%s' % i,
+			} for i in xrange(num_rows)]
+
+	"""Test that many rows are inserted on PostgreSQL by copying them into a staging
+	table, and that a column that is not copied is inserted with its default.
+	"""
+	def test_stage_insert(self):
+		statements = []
+		rows = self._get_team_rows(db._MIN_STAGED_ROWS)
+		with _fake_postgresql_session(statements):
+			db._bulk_insert(db.Teams, rows)
+		self.assertEqual(4, len(statements))
+		self.assertTrue(statements[0][0].strip().startswith(
+				'CREATE TEMPORARY TABLE staging_teams ('), statements[0][0])
+		copy_statement, data = statements[1]
+		self.assertEqual('COPY staging_teams '
+					'(display_name, division, fingerprint, game, indexed_name) '
+					'FROM STDIN WITH CSV',
+				copy_statement)
+		lines = data.splitlines()
+		self.assertEqual(db._MIN_STAGED_ROWS, len(lines))
+		self.assertEqual('"team0","%s","team0","%s","team0"' % (self.division, self.game),
+				lines[0])
+		insert_statement, params = statements[2]
+		self.assertEqual('INSERT INTO "Teams" '
+					'(display_name, division, fingerprint, game, indexed_name, num_stars) '
+					'SELECT staging_teams.display_name, staging_teams.division, '
+					'staging_teams.fingerprint, staging_teams.game, '
+					'staging_teams.indexed_name, %(param_1)s AS anon_1 \nFROM staging_teams',
+				insert_statement)
+		self.assertEqual({'param_1': 0}, params)
+		self.assertEqual('\nDROP TABLE staging_teams', statements[3][0])
+
+		# Fewer rows are inserted by executemany.
+		del statements[:]
+		with _fake_postgresql_session(statements):
+			db._bulk_insert(db.Teams, rows[:db._MIN_STAGED_ROWS - 1])
+		self.assertEqual(1, len(statements))
+		self.assertTrue(statements[0][0].startswith('INSERT INTO "Teams" '))
+		self.assertEqual(db._MIN_STAGED_ROWS - 1, len(statements[0][1]))
+
+	"""Test that rows are inserted by executemany on PostgreSQL if a column that is
+	not copied has a default that is not a scalar.
+	"""
+	def test_stage_insert_default(self):
+		table = sa.Table('Defaults', sa.MetaData(),
+				sa.Column('id', sa.Integer, primary_key=True),
+				sa.Column('name', sa.String),
+				sa.Column('added', sa.DateTime, default=datetime.utcnow))
+		statements = []
+		with _fake_postgresql_session(statements):
+			db._bulk_insert(table, [{'name': 'name%s' % i}
+					for i in xrange(db._MIN_STAGED_ROWS)])
+		self.assertEqual(1, len(statements))
+		insert_statement, params = statements[0]
+		self.assertEqual(
+				'INSERT INTO "Defaults" (name, added) VALUES (%(name)s, %(added)s)',
+				insert_statement)
+		self.assertEqual(db._MIN_STAGED_ROWS, len(params))
+		self.assertIsInstance(params[0]['added'], datetime)
+
+	"""Test that many rows are updated on PostgreSQL from a staging table, and that
+	the times of many matches are copied once to update each table.
+	"""
+	def test_stage_update(self):
+		statements = []
+		rows = [{'id': i, 'display_name': 'team%s' % i}
+				for i in xrange(db._MIN_STAGED_ROWS)]
+		with _fake_postgresql_session(statements):
+			db._bulk_update(db.Teams, 'id', rows)
+		self.assertEqual(4, len(statements))
+		self.assertEqual('COPY staging_teams (id, display_name) FROM STDIN WITH CSV',
+				statements[1][0])
+		self.assertEqual('"0","team0"', statements[1][1].splitlines()[0])
+		self.assertEqual('UPDATE "Teams" SET display_name=staging_teams.display_name '
+					'FROM staging_teams WHERE "Teams".id = staging_teams.id',
+				statements[2][0])
+
+		del statements[:]
+		match_times = dict((i, self.time + timedelta(hours=i))
+				for i in xrange(db._MIN_STAGED_ROWS))
+		with _fake_postgresql_session(statements):
+			db._update_match_times(match_times)
+		# The times are copied once, and then each of the five tables is updated.
+		self.assertEqual(8, len(statements))
+		self.assertEqual('COPY staging_match_times (match_id, time) FROM STDIN WITH CSV',
+				statements[1][0])
+		self.assertEqual(db._MIN_STAGED_ROWS, len(statements[1][1].splitlines()))
+		self.assertEqual('UPDATE "CalendarEntries" SET time=staging_match_times.time '
+					'FROM staging_match_times '
+					'WHERE "CalendarEntries".match_id = staging_match_times.match_id',
+				statements[6][0])
+
+	"""Test that loads new teams and matches, and then loads them again unchanged.
+	"""
+	def test_insert(self):
+		records = (self.team1, self.team2, self.match1, self.match2)
+		counts = db.load_schedule(records)
+		self.assertEqual(db.ScheduleLoadCounts(teams_inserted=2, matches_inserted=2),
+				counts)
+
+		match_ids = db.get_match_ids_by_fingerprint(('match1', 'match2', 'missing'))
+		self.assertItemsEqual(('match1', 'match2'), match_ids)
+		displayed_match = db.get_displayed_match(None, match_ids['match1'])
+		self.assertEqual(self.team1_name, displayed_match.team1.name)
+		self.assertEqual(self.team2_name, displayed_match.team2.name)
+		self.assertEqual(self.time, displayed_match.time)
+		self.assertEqual(0, displayed_match.num_stars)
+		# Each team has both matches with the other team as its opponent.
+		team1_id = displayed_match.team1.team_id
+		displayed_team = db.get_displayed_team(None, team1_id, now=self.now)
+		self.assertSequenceEqual([match_ids['match1'], match_ids['match2']],
+				[match.match_id for match in displayed_team.matches])
+		self.assertEqual(self.team2_name, displayed_team.matches[0].team2.name)
+		self.assertEqual(self.team2_name, displayed_team.matches[1].team1.name)
+
+		# Loading the records again changes nothing.
+		counts = db.load_schedule(records)
+		self.assertEqual(db.ScheduleLoadCounts(teams_unchanged=2, matches_unchanged=2),
+				counts)
+		self.assertEqual(match_ids,
+				db.get_match_ids_by_fingerprint(('match1', 'match2')))
+
+	"""Test that updates a team name and a match time, and their copies.
+	"""
+	def test_update(self):
+		db.load_schedule((self.team1, self.team2, self.match1, self.match2))
+		match_id = db.get_match_ids_by_fingerprint(('match1',))['match1']
+		team1_id = db.get_displayed_match(None, match_id).team1.team_id
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		twitch_id, streamer_id, new_user = self._create_twitch_user(
+				self.streamer_name, self.streamer_indexed_name)
+		db.add_stream_match(streamer_id, match_id, now=self.now)
+		db.add_star_match(client_id, match_id, now=self.now)
+		db.add_star_team(client_id, team1_id, now=self.now)
+
+		new_time = self.time + timedelta(hours=2)
+		renamed_team1 = db.ScheduleTeam('renamed', 'renamed_indexed',
+				self.game, self.division, self.team1_fingerprint)
+		moved_match1 = db.ScheduleMatch(self.team1_fingerprint, self.team2_fingerprint,
+				new_time, self.game, self.division, 'match1')
+		counts = db.load_schedule((renamed_team1, self.team2, moved_match1, self.match2),
+				batch_size=2)
+		self.assertEqual(db.ScheduleLoadCounts(teams_updated=1, teams_unchanged=1,
+					matches_updated=1, matches_unchanged=1),
+				counts)
+
+		db._reset_directories()
+		displayed_match = db.get_displayed_match(client_id, match_id)
+		self.assertEqual('renamed', displayed_match.team1.name)
+		self.assertEqual(new_time, displayed_match.time)
+		self.assertEqual(1, displayed_match.num_stars)
+		starred_teams = db.get_starred_teams(client_id)
+		self.assertEqual('renamed', starred_teams.teams[0].name)
+		self.assertSequenceEqual(['renamed_indexed'],
+				[row[0] for row in db.session.execute(
+					sa.select([db.StarredTeam.indexed_name]))])
+		for table, match_id_column, num_rows in (
+				(db.MatchOpponents, db.MatchOpponent.match_id, 2),
+				(db.StarredMatches, db.StarredMatch.match_id, 1),
+				(db.StreamedMatches, db.StreamedMatch.match_id, 1),
+				(db.CalendarEntries, db.CalendarEntry.match_id, 1)):
+			self.assertSequenceEqual([new_time] * num_rows,
+					self._get_times(table, match_id_column, match_id))
+		db.session.close()
+		self.assertSequenceEqual([], db.verify_user_counters(0, streamer_id + 1))
+
+	"""Test that fails to load a match whose team does not exist, after committing
+	the earlier batches.
+	"""
+	def test_missing_team(self):
+		missing_match = db.ScheduleMatch(self.team1_fingerprint, 'missing',
+				self.time, self.game, self.division, 'missing_match')
+		with self.assertRaises(common_db.DbException):
+			db.load_schedule((self.team1, self.team2, self.match1, missing_match),
+					batch_size=3)
+		self.assertItemsEqual(('match1',),
+				db.get_match_ids_by_fingerprint(('match1', 'missing_match')))
+
+	"""Test that records a MatchEdit for each changed time and each cancelled match.
+	"""
+	def test_edits(self):
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		db.load_schedule((self.team1, self.team2, self.match1, self.match2))
+		match_ids = db.get_match_ids_by_fingerprint(('match1', 'match2'))
+
+		new_time = self.time + timedelta(hours=2)
+		moved_match1 = db.ScheduleMatch(self.team1_fingerprint, self.team2_fingerprint,
+				new_time, self.game, self.division, 'match1')
+		counts = db.load_schedule((moved_match1, db.ScheduleCancel('match2')),
+				editor_id=client_id, edit_comment='comment')
+		self.assertEqual(
+				db.ScheduleLoadCounts(matches_updated=1, matches_cancelled=1), counts)
+		self.assertItemsEqual([
+					(match_ids['match1'], client_id, 'edit_time', new_time.isoformat(),
+						'comment'),
+					(match_ids['match2'], client_id, 'cancel', None, 'comment')],
+				[tuple(row) for row in db.session.execute(sa.select([
+					db.MatchEdit.match_id, db.MatchEdit.user_id, db.MatchEdit.action,
+					db.MatchEdit.data, db.MatchEdit.comment]))])
+		teams, matches = db.get_schedule_by_fingerprint(
+				(self.team1_fingerprint, 'missing'), ('match1', 'match2', 'missing'))
+		self.assertEqual(
+				{self.team1_fingerprint: (self.team1_name, self.team1_indexed_name)},
+				teams)
+		self.assertEqual({
+					'match1': (new_time, self.game, self.division, False),
+					'match2': (self.time + timedelta(days=1), self.game, self.division, True),
+				},
+				matches)
+
+		# Cancelling a match again records no MatchEdit.
+		counts = db.load_schedule((db.ScheduleCancel('match2'),), editor_id=client_id)
+		self.assertEqual(db.ScheduleLoadCounts(matches_unchanged=1), counts)
+		self.assertEqual(2, db.session.query(db.MatchEdit).count())
+		db.session.close()
+		# Cancelling a match requires an editor.
+		with self.assertRaises(common_db.DbException):
+			db.load_schedule((db.ScheduleCancel('match1'),))
+
+
+class LeagueFeedsDbTestCase(AbstractFinderDbTestCase):
+	_CSV_HEADER = ('fingerprint,time,game,division,team1_name,team1_fingerprint,'
+			'team2_name,team2_fingerprint,status\n')
+
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		self.temp_dir = tempfile.mkdtemp()
+		client_steam_id, self.editor_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+		AbstractFinderDbTestCase.tearDown(self)
+
+	def _write_feed(self, filename, data):
+		"""Utility method that writes a feed and returns its path."""
+		path = os.path.join(self.temp_dir, filename)
+		with open(path, 'w') as f:
+			f.write(data)
+		return path
+
+	def _get_listed_match_ids(self):
+		"""Utility method that returns the identifiers of the matches in each list
+		that has the matches starred by the editor, asserting that they are equal.
+		"""
+		team1_id = db.session.query(db.Team.id)\
+				.filter(db.Team.fingerprint == 'team1')\
+				.scalar()
+		db.session.close()
+		match_lists = (
+			db.get_all_matches(self.editor_id, now=self.now).matches,
+			db.get_starred_matches(self.editor_id, now=self.now).matches,
+			db.get_displayed_team(self.editor_id, team1_id, now=self.now).matches,
+		)
+		match_ids = [[match.match_id for match in matches] for matches in match_lists]
+		for other_match_ids in match_ids[1:]:
+			self.assertSequenceEqual(match_ids[0], other_match_ids)
+		return match_ids[0]
+
+	def _get_csv_row(self, fingerprint, time, team1_name='Team One', status=''):
+		"""Utility method that returns a row of a CSV feed."""
+		return '%s,%s,%s,%s,%s,team1,Team Two,team2,%s\n' % (
+				fingerprint, time.strftime('%Y-%m-%dT%H:%M:%SZ'), self.game,
+				self.division, team1_name, status)
+
+	"""Test that imports a CSV feed, imports it again without changes, and then
+	imports a feed that renames a team, reschedules a match, and cancels a match.
+	"""
+	def test_import_csv_feed(self):
+		later_time = self.time + timedelta(days=1)
+		path = self._write_feed('feed.csv', self._CSV_HEADER +
+				self._get_csv_row('match1', self.time) +
+				self._get_csv_row('match2', later_time) +
+				self._get_csv_row('cancelled', later_time, status='cancelled'))
+		counts = league_feeds.import_feed(path, self.editor_id, batch_size=2)
+		self.assertEqual(db.ScheduleLoadCounts(teams_inserted=2, matches_inserted=2),
+				counts)
+		match_ids = db.get_match_ids_by_fingerprint(('match1', 'match2', 'cancelled'))
+		self.assertItemsEqual(('match1', 'match2'), match_ids)
+		displayed_match = db.get_displayed_match(None, match_ids['match1'])
+		self.assertEqual('Team One', displayed_match.team1.name)
+		self.assertEqual('team_one', db.session.query(db.Team.indexed_name)
+				.filter(db.Team.id == displayed_match.team1.team_id).scalar())
+
+		# Importing the feed again writes nothing.
+		counts = league_feeds.import_feed(path, self.editor_id, batch_size=2)
+		self.assertEqual(db.ScheduleLoadCounts(), counts)
+
+		new_time = self.time + timedelta(hours=2)
+		path = self._write_feed('changed.csv', self._CSV_HEADER +
+				self._get_csv_row('match1', new_time, team1_name='Team Uno') +
+				self._get_csv_row('match2', later_time, status='cancelled'))
+		counts = league_feeds.import_feed(path, self.editor_id)
+		self.assertEqual(db.ScheduleLoadCounts(teams_updated=1, matches_updated=1,
+					matches_cancelled=1),
+				counts)
+		db._reset_directories()
+		displayed_match = db.get_displayed_match(None, match_ids['match1'])
+		self.assertEqual('Team Uno', displayed_match.team1.name)
+		self.assertEqual(new_time, displayed_match.time)
+		self.assertItemsEqual([
+					(match_ids['match1'], 'edit_time', new_time.isoformat()),
+					(match_ids['match2'], 'cancel', None)],
+				[tuple(row) for row in db.session.execute(sa.select([
+					db.MatchEdit.match_id, db.MatchEdit.action, db.MatchEdit.data]))])
+		db.session.close()
+
+		# Importing the changed feed again writes nothing.
+		counts = league_feeds.import_feed(path, self.editor_id)
+		self.assertEqual(db.ScheduleLoadCounts(), counts)
+		self.assertEqual(2, db.session.query(db.MatchEdit).count())
+		db.session.close()
+
+		# The cancelled match is not in the lists of matches.
+		db.add_star_match(self.editor_id, match_ids['match1'], now=self.now)
+		db.add_star_match(self.editor_id, match_ids['match2'], now=self.now)
+		self.assertSequenceEqual([match_ids['match1']], self._get_listed_match_ids())
+
+		# Restore and reschedule the cancelled match.
+		restored_time = later_time + timedelta(hours=1)
+		path = self._write_feed('restored.csv', self._CSV_HEADER +
+				self._get_csv_row('match1', new_time, team1_name='Team Uno') +
+				self._get_csv_row('match2', restored_time, team1_name='Team Uno'))
+		counts = league_feeds.import_feed(path, self.editor_id)
+		self.assertEqual(db.ScheduleLoadCounts(matches_updated=1, matches_restored=1),
+				counts)
+		self.assertSequenceEqual([match_ids['match1'], match_ids['match2']],
+				self._get_listed_match_ids())
+		self.assertEqual(restored_time,
+				db.get_displayed_match(None, match_ids['match2']).time)
+		self.assertItemsEqual([
+					(match_ids['match2'], 'edit_time', restored_time.isoformat()),
+					(match_ids['match2'], 'restore', None)],
+				[tuple(row) for row in db.session.execute(sa.select([
+						db.MatchEdit.match_id, db.MatchEdit.action, db.MatchEdit.data])
+					.where(db.MatchEdit.id > 2))])
+		db.session.close()
+
+		# Cancel the match again.
+		path = self._write_feed('cancelled.csv', self._CSV_HEADER +
+				self._get_csv_row('match2', restored_time, status='cancelled'))
+		counts = league_feeds.import_feed(path, self.editor_id)
+		self.assertEqual(db.ScheduleLoadCounts(matches_cancelled=1), counts)
+		self.assertSequenceEqual([match_ids['match1']], self._get_listed_match_ids())
+
+	"""Test that imports several JSON feeds, and fails to import a feed with an
+	invalid record.
+	"""
+	def test_import_json_feeds(self):
+		paths = []
+		for i in xrange(2):
+			record = {
+				'fingerprint': 'match%s' % i,
+				'time': (self.time + timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%S'),
+				'game': self.game,
+				'division': self.division,
+				'team1_name': 'Team %s' % (2 * i),
+				'team1_fingerprint': 'team%s' % (2 * i),
+				'team2_name': 'Team %s' % (2 * i + 1),
+				'team2_fingerprint': 'team%s' % (2 * i + 1),
+			}
+			paths.append(self._write_feed('feed%s.json' % i, json.dumps(record) + '\n\n'))
+		# Capture the counts that are printed for each feed.
+		stdout = sys.stdout
+		sys.stdout = output = cStringIO.StringIO()
+		try:
+			counts = league_feeds.run(paths, self.editor_id)
+		finally:
+			sys.stdout = stdout
+		self.assertEqual(db.ScheduleLoadCounts(teams_inserted=4, matches_inserted=2),
+				counts)
+		self.assertEqual('total: %s' % counts, output.getvalue().splitlines()[-1])
+		self.assertItemsEqual(('match0', 'match1'),
+				db.get_match_ids_by_fingerprint(('match0', 'match1')))
+
+		path = self._write_feed('invalid.json', json.dumps({'fingerprint': 'match2'}))
+		with self.assertRaises(ValueError):
+			league_feeds.import_feed(path, self.editor_id)
+
+
+class EditMatchTimeDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		self.team1_id = db.add_team(self.team1_name, self.team1_indexed_name,
+				self.game, self.division, self.team1_fingerprint)
+		self.team2_id = db.add_team(self.team2_name, self.team2_indexed_name,
+				self.game, self.division, self.team2_fingerprint)
+		self.match_ids = [db.add_match(self.team1_id, self.team2_id,
+					self.time + timedelta(days=i), self.game, self.division, 'match%s' % i)
+				for i in xrange(2)]
+		client_steam_id, self.client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		twitch_id, self.streamer_id, new_user = self._create_twitch_user(
+				self.streamer_name, self.streamer_indexed_name)
+		for match_id in self.match_ids:
+			db.add_stream_match(self.streamer_id, match_id, now=self.now)
+			db.add_star_match(self.client_id, match_id, now=self.now)
+
+	def _get_times(self, match_id):
+		"""Utility method that returns the time of the match and each copy of it."""
+		times = [db.session.query(db.Match.time).filter(db.Match.id == match_id).scalar()]
+		for table, match_id_column in (
+				(db.MatchOpponents, db.MatchOpponent.match_id),
+				(db.StarredMatches, db.StarredMatch.match_id),
+				(db.StreamedMatches, db.StreamedMatch.match_id),
+				(db.CalendarEntries, db.CalendarEntry.match_id)):
+			times.extend(row[0] for row in db.session.execute(
+					sa.select([table.c.time]).where(match_id_column == match_id)))
+		db.session.close()
+		return times
+
+	def _get_match_edits(self):
+		"""Utility method that returns the match, action, and data of each MatchEdit."""
+		match_edits = [tuple(row) for row in db.session.execute(sa.select(
+				[db.MatchEdit.match_id, db.MatchEdit.action, db.MatchEdit.data]))]
+		db.session.close()
+		return match_edits
+
+	"""Test that changes the time of a match and each copy of its time.
+	"""
+	def test_edit_match_time(self):
+		match_id = self.match_ids[0]
+		new_time = self.time + timedelta(hours=2)
+		self.assertTrue(db.edit_match_time(self.client_id, match_id, new_time))
+		# The match, both opponents, the star, the stream, and the calendar entry.
+		self.assertSequenceEqual([new_time] * 6, self._get_times(match_id))
+		self.assertSequenceEqual([self.time + timedelta(days=1)] * 6,
+				self._get_times(self.match_ids[1]))
+		self.assertSequenceEqual([(match_id, 'edit_time', new_time.isoformat())],
+				self._get_match_edits())
+
+		db._reset_directories()
+		displayed_match = db.get_displayed_match(self.client_id, match_id)
+		self.assertEqual(new_time, displayed_match.time)
+		calendar = db.get_displayed_viewer_calendar(self.client_id, now=self.now)
+		self.assertEqual(new_time, calendar.matches[0].time)
+		self.assertSequenceEqual([], db.verify_user_counters(0, self.streamer_id + 1))
+
+		# Setting the same time again records no MatchEdit.
+		self.assertFalse(db.edit_match_time(self.client_id, match_id, new_time))
+		self.assertEqual(1, len(self._get_match_edits()))
+
+	"""Test that changes the times of many matches, and fails to change the times
+	if a match does not exist.
+	"""
+	def test_edit_match_times(self):
+		new_times = [self.time + timedelta(days=2 + i) for i in xrange(2)]
+		missing_match_id = self.match_ids[-1] + 1
+		with self.assertRaises(common_db.DbException):
+			db.edit_match_times(self.client_id,
+					{self.match_ids[0]: new_times[0], missing_match_id: new_times[1]})
+		self.assertSequenceEqual([self.time] * 6, self._get_times(self.match_ids[0]))
+		self.assertSequenceEqual([], self._get_match_edits())
+
+		num_edits = db.edit_match_times(self.client_id, zip(self.match_ids, new_times),
+				comment='comment')
+		self.assertEqual(2, num_edits)
+		for match_id, new_time in zip(self.match_ids, new_times):
+			self.assertSequenceEqual([new_time] * 6, self._get_times(match_id))
+		self.assertItemsEqual(
+				[(match_id, 'edit_time', new_time.isoformat())
+					for match_id, new_time in zip(self.match_ids, new_times)],
+				self._get_match_edits())
+
+
 class FinderDbTestCase(AbstractFinderDbTestCase):
 	"""Test that fails to create a match because one team identifier is unknown.
 	"""
@@ -1854,6 +3233,76 @@ class FinderDbTestCase(AbstractFinderDbTestCase):
 		displayed_calendar = db.get_displayed_viewer_calendar(client_id, now=self.now)
 		self._assert_displayed_calendar(displayed_calendar)
 
+	"""Test that stars from many users are summed into their CalendarEntries as
+	streamers and stars are added and removed.
+	"""
+	def test_multi_user_calendar_entries(self):
+		# Create the match.
+		team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		match_id = db.add_match(team1_id, team2_id, self.time, self.game, self.division,
+				self.match_fingerprint, now=self.now)
+		# Create the streaming users.
+		streamer_steam_id1, streamer_id1, new_user = self._create_steam_user(
+				self.streamer_name, self.streamer_indexed_name)
+		streamer_steam_id2, streamer_id2, new_user = self._create_steam_user(
+				'streamer_name2', 'streamer_indexed_name2')
+		# Create the clients.
+		client_ids = []
+		for i in range(5):
+			client_steam_id, client_id, new_user = self._create_steam_user(
+					'client_name%s' % i, 'client_indexed_name%s' % i)
+			client_ids.append(client_id)
+		client_id1, client_id2, client_id3, client_id4, client_id5 = client_ids
+
+		# Add stars before the match is streamed.
+		db.add_star_match(client_id1, match_id, now=self.now)
+		db.add_star_team(client_id1, team1_id, now=self.now)
+		db.add_star_team(client_id2, team1_id, now=self.now)
+		db.add_star_team(client_id2, team2_id, now=self.now)
+		db.add_star_streamer(client_id1, streamer_id1, now=self.now)
+		db.add_star_streamer(client_id3, streamer_id1, now=self.now)
+		db.add_star_streamer(client_id4, streamer_id2, now=self.now)
+		self.assertEqual({}, self._get_num_user_stars(match_id))
+
+		# The first streamer streams the match.
+		db.add_stream_match(streamer_id1, match_id)
+		self.assertEqual({client_id1: 3, client_id2: 2, client_id3: 1},
+				self._get_num_user_stars(match_id))
+		# The second streamer streams the match.
+		db.add_stream_match(streamer_id2, match_id)
+		self.assertEqual({client_id1: 3, client_id2: 2, client_id3: 1, client_id4: 1},
+				self._get_num_user_stars(match_id))
+
+		# Add stars after the match is streamed.
+		db.add_star_team(client_id3, team2_id, now=self.now)
+		db.add_star_streamer(client_id4, streamer_id1, now=self.now)
+		db.add_star_streamer(client_id5, streamer_id2, now=self.now)
+		self.assertEqual(
+				{client_id1: 3, client_id2: 2, client_id3: 2, client_id4: 2, client_id5: 1},
+				self._get_num_user_stars(match_id))
+
+		# Remove stars while the match is streamed.
+		db.remove_star_team(client_id2, team1_id, now=self.now)
+		db.remove_star_streamer(client_id3, streamer_id1, now=self.now)
+		db.remove_star_match(client_id1, match_id, now=self.now)
+		self.assertEqual(
+				{client_id1: 2, client_id2: 1, client_id3: 1, client_id4: 2, client_id5: 1},
+				self._get_num_user_stars(match_id))
+
+		# The first streamer is no longer streaming the match.
+		db.remove_stream_match(streamer_id1, match_id)
+		self.assertEqual({client_id1: 1, client_id2: 1, client_id3: 1, client_id4: 1,
+					client_id5: 1},
+				self._get_num_user_stars(match_id))
+		# The second streamer is no longer streaming the match.
+		db.remove_stream_match(streamer_id2, match_id)
+		self.assertEqual({}, self._get_num_user_stars(match_id))
+
 	# TODO: Test remove_stream_match.
 
 	"""Test that updates the name of an existing team.
@@ -2293,11 +3742,11 @@ class FinderDbTestCase(AbstractFinderDbTestCase):
 		client_steam_id2, client_id2, new_user = self._create_steam_user(
 				client_name2, client_indexed_name2)
 
-		self.assertEqual('24_hour', db._DEFAULT_SETTINGS_TIME_FORMAT)
+		self.assertEqual('24_hour', db.DEFAULT_SETTINGS_TIME_FORMAT)
 
 		# Assert the default settings.
 		settings = db.get_settings(client_id1)
-		self.assertEqual(db._DEFAULT_SETTINGS_TIME_FORMAT, settings.time_format)
+		self.assertEqual(db.DEFAULT_SETTINGS_TIME_FORMAT, settings.time_format)
 		self.assertIsNone(settings.country)
 		self.assertIsNone(settings.time_zone)
 
@@ -2362,3 +3811,680 @@ class FinderDbTestCase(AbstractFinderDbTestCase):
 		self.assertEqual(client_id, updated_client_id)
 		self.assertFalse(new_user)
 
+	"""Test that each mutation adds its changes to the change log.
+	"""
+	def test_changes(self):
+		changes = []
+		def listener(change_events):
+			changes.extend((change.entity_type, change.entity_id) for change in change_events)
+		db.change_bus.subscribe(listener)
+		try:
+			db.begin_request()
+			client_steam_id, client_id, new_user = self._create_steam_user(
+					self.client_name, self.client_indexed_name)
+			team1_id = db.add_team(
+					self.team1_name, self.team1_indexed_name, self.game, self.division,
+					self.team1_fingerprint)
+			team2_id = db.add_team(
+					self.team2_name, self.team2_indexed_name, self.game, self.division,
+					self.team2_fingerprint)
+			match_id = db.add_match(team1_id, team2_id, self.time, self.game, self.division,
+					self.match_fingerprint, now=self.now)
+			# Adding an existing match does not change it.
+			db.add_match(team1_id, team2_id, self.time, self.game, self.division,
+					self.match_fingerprint, now=self.now)
+			db.begin_request()
+			self.assertEqual([
+					(common_db.USER_CHANGE_TYPE, client_id),
+					(db.TEAM_CHANGE_TYPE, None),
+					(db.TEAM_CHANGE_TYPE, team1_id),
+					(db.TEAM_CHANGE_TYPE, None),
+					(db.TEAM_CHANGE_TYPE, team2_id),
+					(db.MATCH_CHANGE_TYPE, None),
+					(db.TEAM_CHANGE_TYPE, team1_id),
+					(db.TEAM_CHANGE_TYPE, team2_id)],
+				changes)
+			del changes[:]
+
+			db.add_star_match(client_id, match_id, now=self.now)
+			db.remove_star_match(client_id, match_id, now=self.now)
+			# Removing a missing star does not change the match.
+			db.remove_star_match(client_id, match_id, now=self.now)
+			db.add_star_team(client_id, team1_id, now=self.now)
+			db.remove_star_team(client_id, team1_id, now=self.now)
+			db.add_star_streamer(client_id, client_id, now=self.now)
+			db.remove_star_streamer(client_id, client_id, now=self.now)
+			db.add_stream_match(client_id, match_id, now=self.now)
+			db.remove_stream_match(client_id, match_id, now=self.now)
+			db.toggle_can_stream(client_id, True)
+			db.begin_request()
+			self.assertEqual([
+					(db.MATCH_CHANGE_TYPE, match_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(db.MATCH_CHANGE_TYPE, match_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(db.TEAM_CHANGE_TYPE, team1_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(db.TEAM_CHANGE_TYPE, team1_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(common_db.USER_CHANGE_TYPE, client_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(common_db.USER_CHANGE_TYPE, client_id),
+					(db.STARRED_CHANGE_TYPE, client_id),
+					(db.MATCH_CHANGE_TYPE, match_id),
+					(common_db.USER_CHANGE_TYPE, client_id),
+					(db.MATCH_CHANGE_TYPE, match_id),
+					(common_db.USER_CHANGE_TYPE, client_id),
+					(common_db.USER_CHANGE_TYPE, None),
+					(common_db.USER_CHANGE_TYPE, client_id)],
+				changes)
+			self.assertEqual(db.STREAMER_LIST_TAG,
+					db.get_change_tag(common_db.ChangeEvent(1, common_db.USER_CHANGE_TYPE, None)))
+			self.assertEqual(db.get_match_tag(match_id),
+					db.get_change_tag(common_db.ChangeEvent(1, db.MATCH_CHANGE_TYPE, match_id)))
+			self.assertIsNone(
+					db.get_change_tag(common_db.ChangeEvent(1, db.STARRED_CHANGE_TYPE, client_id)))
+		finally:
+			db.change_bus.unsubscribe(listener)
+
+	"""Test that the teams of matches are read from the directory of this worker,
+	which polls the change log at most once per request.
+	"""
+	def test_team_directory(self):
+		team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		match_id = db.add_match(team1_id, team2_id, self.time, self.game, self.division,
+				self.match_fingerprint, now=self.now)
+		def get_team1_name():
+			match_list = db.get_all_matches(None, now=self.now)
+			return match_list.matches[0].team1.name
+
+		db.begin_request()
+		self.assertEqual(self.team1_name, get_team1_name())
+		# Assert that the change log is not polled again in this request.
+		self.assertEqual((self.team1_name, 1), self._get_num_statements(get_team1_name))
+
+		# Rename the team as another worker would.
+		updated_name = 'updated_name'
+		db.session.execute(db.Teams.update()
+				.where(db.Team.id == team1_id)
+				.values({db.Team.display_name: updated_name}))
+		common_db.add_changes(((db.TEAM_CHANGE_TYPE, team1_id),))
+		db.session.commit()
+		self.assertEqual(self.team1_name, get_team1_name())
+		# Assert that the next request reads the change and loads only the renamed team.
+		self.assertEqual((None, 1), self._get_num_statements(db.begin_request))
+		self.assertEqual((updated_name, 2), self._get_num_statements(get_team1_name))
+
+		# Assert that renaming the team in this worker is read before the next use.
+		db.add_team(self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		self.assertEqual(self.team1_name, get_team1_name())
+		# Assert that the opponents of a team are read from the directory.
+		displayed_team = db.get_displayed_team(None, team2_id, now=self.now)
+		self.assertEqual(self.team1_name, displayed_team.matches[0].team1.name)
+
+	"""Test that the stars of the client are applied to the pages of all matches,
+	teams, and streaming users, and are loaded again after the client changes them.
+	"""
+	def test_starred_ids(self):
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		team1_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		match_id = db.add_match(team1_id, team2_id, self.time, self.game, self.division,
+				self.match_fingerprint, now=self.now)
+		def get_is_starred():
+			match = db.get_all_matches(client_id, now=self.now).matches[0]
+			teams = db.get_all_teams(client_id).teams
+			return (match.is_starred, tuple(team.is_starred for team in teams))
+
+		db.begin_request()
+		# The pages, the starred identifiers, and the team directory are loaded.
+		self.assertEqual(((False, (False, False)), 5),
+				self._get_num_statements(get_is_starred))
+		# Assert that the starred identifiers are not loaded again.
+		self.assertEqual(((False, (False, False)), 2),
+				self._get_num_statements(get_is_starred))
+		# Assert that the pages of a client that is not logged in are not starred.
+		self.assertFalse(db.get_all_matches(None, now=self.now).matches[0].is_starred)
+
+		# Assert that starring in this worker is read before the next use.
+		db.add_star_match(client_id, match_id, now=self.now)
+		db.add_star_team(client_id, team2_id, now=self.now)
+		self.assertEqual((True, (False, True)), get_is_starred())
+
+		# Remove a star as another worker would.
+		db.session.execute(db.StarredTeams.delete()
+				.where(db.StarredTeam.user_id == client_id))
+		common_db.add_changes(((db.STARRED_CHANGE_TYPE, client_id),))
+		db.session.commit()
+		self.assertEqual((True, (False, True)), get_is_starred())
+		db.begin_request()
+		self.assertEqual((True, (False, False)), get_is_starred())
+		self.assertEqual(db.DisplayedStarredIds((match_id,), (), ()),
+				db.get_starred_ids(client_id))
+
+	"""Test that starring in this worker is read by the next request, when the
+	change log is polled at most every second.
+	"""
+	def test_starred_ids_poll_interval(self):
+		poll_interval = db.change_bus.poll_interval
+		db.change_bus.poll_interval = 1.0
+		self.addCleanup(setattr, db.change_bus, 'poll_interval', poll_interval)
+		client_steam_id, client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		team_id = db.add_team(
+				self.team1_name, self.team1_indexed_name, self.game, self.division,
+				self.team1_fingerprint)
+		team2_id = db.add_team(
+				self.team2_name, self.team2_indexed_name, self.game, self.division,
+				self.team2_fingerprint)
+		match_id = db.add_match(team_id, team2_id, self.time, self.game, self.division,
+				self.match_fingerprint, now=self.now)
+		db.begin_request()
+		self.assertFalse(db.get_all_matches(client_id, now=self.now).matches[0].is_starred)
+		self.assertFalse(any(team.is_starred for team in db.get_all_teams(client_id).teams))
+
+		db.add_star_match(client_id, match_id, now=self.now)
+		db.add_star_team(client_id, team_id, now=self.now)
+		db.begin_request()
+		self.assertTrue(db.get_all_matches(client_id, now=self.now).matches[0].is_starred)
+		self.assertItemsEqual([(team_id, True), (team2_id, False)],
+				[(team.team_id, team.is_starred)
+					for team in db.get_all_teams(client_id).teams])
+
+		# Assert that the least recently used client is discarded from a full cache.
+		starred_ids = db._StarredIdsCache(1)
+		self.assertEqual([match_id], list(starred_ids.get('matches', client_id)))
+		self.assertEqual([], list(starred_ids.get('matches', client_id + 1)))
+		self.assertEqual([('matches', client_id + 1)], starred_ids._starred_ids.keys())
+
+
+
+"""Tests that each getter and mutation stays within its query budget, regardless
+of the page size and of the count of stars.
+"""
+class QueryBudgetDbTestCase(AbstractFinderDbTestCase):
+	def setUp(self):
+		AbstractFinderDbTestCase.setUp(self)
+		self.num_teams = 10
+		self.num_matches = 30
+		self.num_streamers = 3
+		self.called_names = set()
+
+		steam_id, self.client_id, new_user = self._create_steam_user(
+				self.client_name, self.client_indexed_name)
+		self.streamer_ids = []
+		for i in xrange(self.num_streamers):
+			twitch_id, streamer_id, new_user = self._create_twitch_user(
+					'%s%s' % (self.streamer_name, i), '%s%s' % (self.streamer_indexed_name, i))
+			self.streamer_ids.append(streamer_id)
+		self.team_ids = [
+				db.add_team('team%s' % i, 'team%s' % i, self.game, self.division, 'team%s' % i)
+				for i in xrange(self.num_teams)]
+		self.match_ids = [
+				db.add_match(self.team_ids[i % self.num_teams],
+					self.team_ids[(i + 1) % self.num_teams], self.time + timedelta(hours=i),
+					self.game, self.division, 'match%s' % i, now=self.now)
+				for i in xrange(self.num_matches)]
+
+	def _call(self, f, *pargs, **kwargs):
+		"""Calls the function with empty caches, as the first request of a worker
+		does, and fails if it exceeds its budget.
+		"""
+		self.called_names.add(f.__name__)
+		db._reset_directories()
+		db.begin_request()
+		return self._call_within_budget(f, *pargs, **kwargs)
+
+	def _call_getters(self, page_limit):
+		# Read the matches at the current time, so that each page is not empty.
+		for getter in (db.get_displayed_viewer_calendar, db.get_starred_matches,
+				db.get_all_matches):
+			self._call(getter, self.client_id, page_limit=page_limit, now=self.now)
+		for getter in (db.get_starred_teams, db.get_all_teams,
+				db.get_starred_streamers, db.get_all_streamers):
+			self._call(getter, self.client_id, page_limit=page_limit)
+		self._call(db.get_displayed_streamer_calendar, self.streamer_ids[0],
+				page_limit=page_limit, now=self.now)
+		self._call(db.get_displayed_match, self.client_id, self.match_ids[0],
+				page_limit=page_limit)
+		self._call(db.get_displayed_team, self.client_id, self.team_ids[0],
+				page_limit=page_limit, now=self.now)
+		self._call(db.get_displayed_streamer, self.client_id, self.streamer_ids[0],
+				page_limit=page_limit, now=self.now)
+		self._call(db.get_displayed_streamer_by_twitch_id, self.client_id, 0,
+				page_limit=page_limit, now=self.now)
+		self._call(db.get_displayed_streamer_by_twitch_name, self.client_id,
+				'%s0' % self.streamer_name, page_limit=page_limit, now=self.now)
+		self._call(db.get_starred_ids, self.client_id)
+
+	def _assert_budgets(self):
+		# Assert the budgets of the getters with no stars.
+		for page_limit in (1, self.num_matches):
+			self._call_getters(page_limit)
+
+		# Assert the budgets of the mutations as the stars and streams grow.
+		for match_id in self.match_ids:
+			self._call(db.add_star_match, self.client_id, match_id, now=self.now)
+		for team_id in self.team_ids:
+			self._call(db.add_star_team, self.client_id, team_id, now=self.now)
+		for streamer_id in self.streamer_ids:
+			self._call(db.add_star_streamer, self.client_id, streamer_id, now=self.now)
+			for match_id in self.match_ids:
+				self._call(db.add_stream_match, streamer_id, match_id, now=self.now)
+		# Assert the budgets of the getters with many stars, after any queued
+		# CalendarEntries are added.
+		db.process_calendar_jobs()
+		for page_limit in (1, self.num_matches):
+			self._call_getters(page_limit)
+		self._call(db.edit_match_time, self.client_id, self.match_ids[0],
+				self.time - timedelta(hours=1))
+		for streamer_id in self.streamer_ids:
+			for match_id in self.match_ids:
+				self._call(db.remove_stream_match, streamer_id, match_id, now=self.now)
+			self._call(db.remove_star_streamer, self.client_id, streamer_id, now=self.now)
+		for team_id in self.team_ids:
+			self._call(db.remove_star_team, self.client_id, team_id, now=self.now)
+		for match_id in self.match_ids:
+			self._call(db.remove_star_match, self.client_id, match_id, now=self.now)
+
+		self._call(db.add_team, 'added_team', 'added_team', self.game, self.division,
+				'added_team')
+		self._call(db.add_match, self.team_ids[0], self.team_ids[1], self.time,
+				self.game, self.division, 'added_match', now=self.now)
+		self._call(db.save_settings, self.client_id, '24_hour', 'US', 'America/Los_Angeles')
+		self._call(db.get_settings, self.client_id)
+		self._call(db.twitch_user_logged_in,
+				self.num_streamers, 'twitch_name', 'twitch_name', 'twitch_name', None)
+		self._call(db.steam_user_logged_in,
+				1, self.client_name, self.client_indexed_name, None, None, None)
+		self._call(db.toggle_can_stream, self.streamer_ids[0], True)
+		self._call(db.toggle_can_stream_by_twitch_id, 0, True)
+		self._call(db.toggle_can_stream_by_twitch_name, '%s0' % self.streamer_name, True)
+
+		# Assert that every function with a budget is tested.
+		budgeted_names = set(name for name, value in vars(db).iteritems()
+				if getattr(value, 'max_statements', None) is not None)
+		self.assertEqual(budgeted_names, self.called_names)
+
+	def test_budgets(self):
+		self._assert_budgets()
+
+	"""Test that the budgets hold when CalendarEntries are queued and only the
+	calendars of clients with many stars are materialized, which reads more.
+	"""
+	def test_budgets_queued_hybrid(self):
+		db._queue_calendar_entries = True
+		db._calendar_backend = db.HybridCalendarBackend(self.num_matches)
+		try:
+			self._assert_budgets()
+		finally:
+			db._queue_calendar_entries = False
+			db._calendar_backend = db.MaterializedCalendarBackend()
+
+	def test_exceed_budget(self):
+		@common_db.query_budget(2)
+		def get_team_names():
+			db.session.query(db.Team.display_name).filter(db.Team.id == self.team_ids[0]).all()
+			return db.session.query(db.Team.display_name).all()
+
+		# Assert that the count of fetched rows is returned.
+		team_names, num_rows = self._call_within_budget(get_team_names)
+		self.assertEqual(self.num_teams, len(team_names))
+		self.assertEqual(self.num_teams + 1, num_rows)
+		# Assert that exceeding the budget fails with the executed statements.
+		get_team_names.max_statements = 1
+		with self.assertRaises(self.failureException) as context:
+			self._call_within_budget(get_team_names)
+		message = str(context.exception)
+		self.assertIn('get_team_names executed 2 statements, exceeding its budget of 1',
+				message)
+		self.assertIn('2. SELECT "Teams".display_name', message)
+
+
+"""Tests for routing the getters that only read to a replica in a SQLite file.
+
+The replica does not replicate the primary, so that a read shows which database
+it was routed to.
+"""
+class ReadReplicaDbTestCase(DbTestCase):
+	def setUp(self):
+		DbTestCase.setUp(self)
+		self.temp_dir = tempfile.mkdtemp()
+		self.replica_uri = 'sqlite:///%s' % os.path.join(self.temp_dir, 'replica.db')
+		common_db.set_read_replicas([self.replica_uri], max_lag_seconds=5.0,
+				lag_check_interval=0.0)
+		(replica_name, self.replica_engine), = common_db._replica_set.get_engines()
+		common_db._Base.metadata.create_all(self.replica_engine)
+		self.lag_seconds = 0.0
+		common_db._replica_set._get_lag = lambda engine: self.lag_seconds
+		self.team_id = db.add_team('team_name', 'team_indexed_name', 'game', 'division',
+				'team_fingerprint')
+		db.begin_request()
+
+	def tearDown(self):
+		common_db.set_read_replicas(())
+		common_db.begin_routing()
+		shutil.rmtree(self.temp_dir)
+		DbTestCase.tearDown(self)
+
+	def _get_team_ids(self):
+		return [team.team_id for team in db.get_all_teams(None).teams]
+
+	def test_route_reads(self):
+		# Assert that the getter reads the replica, which does not have the team.
+		self.assertEqual([], self._get_team_ids())
+		# Assert that the team directory was loaded from the primary.
+		displayed_team = db._team_directory.get(self.team_id)
+		self.assertEqual('team_name', displayed_team.name)
+
+		# Assert that the team is read from the primary after this request writes.
+		steam_id, client_id, new_user = self._create_steam_user(
+				'client_name', 'client_indexed_name')
+		self.assertTrue(common_db.has_written())
+		self.assertEqual([self.team_id], self._get_team_ids())
+
+		# Assert that the next request reads the replica.
+		db.begin_request()
+		self.assertFalse(common_db.has_written())
+		self.assertEqual([], self._get_team_ids())
+		# Assert that a request after a write by the client within the lag of the
+		# replica reads the primary.
+		self.lag_seconds = 1.0
+		db.begin_request(time.time())
+		self.assertEqual([self.team_id], self._get_team_ids())
+		db.begin_request(time.time() - 60)
+		self.assertEqual([], self._get_team_ids())
+
+	def test_lag_fallback(self):
+		self.assertEqual([], self._get_team_ids())
+		# Assert that the primary is read while the replica lags too much.
+		self.lag_seconds = 10.0
+		self.assertEqual([self.team_id], self._get_team_ids())
+		# Assert that the primary is read if the replica cannot be checked.
+		def raise_error(engine):
+			raise sa.exc.OperationalError('SELECT', {}, Exception('unavailable'))
+		common_db._replica_set._get_lag = raise_error
+		self.assertEqual([self.team_id], self._get_team_ids())
+		# Assert that the replica is read again once it catches up.
+		self.lag_seconds = 1.0
+		common_db._replica_set._get_lag = lambda engine: self.lag_seconds
+		self.assertEqual([], self._get_team_ids())
+
+		stats = common_db.get_engine_stats()
+		self.assertItemsEqual(['primary', 'replica0'], stats.keys())
+		self.assertEqual(2, stats['replica0']['reads'])
+		self.assertEqual(2, stats['replica0']['fallbacks'])
+		self.assertEqual(1.0, stats['replica0']['lag_seconds'])
+		self.assertIn('pool', stats['primary'])
+
+	def test_choose(self):
+		replica_set = common_db.ReplicaSet(('engine1', 'engine2'), max_lag_seconds=5.0,
+				lag_check_interval=10.0, get_lag=lambda engine: 2.0)
+		now = 1000.0
+		# Assert that the replicas are read in turn.
+		self.assertEqual('engine1', replica_set.choose(now=now))
+		self.assertEqual('engine2', replica_set.choose(now=now))
+		self.assertEqual('engine1', replica_set.choose(now=now))
+		# Assert that a replica lagging behind the client's last write is not read.
+		self.assertIsNone(replica_set.choose(last_write_time=now - 1.0, now=now))
+		self.assertEqual('engine2', replica_set.choose(last_write_time=now - 3.0, now=now))
+		# Assert that the lag is assumed to grow until the replica is checked again.
+		self.assertIsNone(replica_set.choose(now=now + 4.0))
+		self.assertEqual('engine1', replica_set.choose(now=now + 10.0))
+
+
+"""A logging handler that appends each message to a list."""
+class _ListHandler(logging.Handler):
+	def __init__(self, messages):
+		logging.Handler.__init__(self)
+		self.messages = messages
+
+	def emit(self, record):
+		self.messages.append(record.getMessage())
+
+def _add_teams_in_process(database_uri, fingerprints):
+	"""Adds a team with each fingerprint to the database in a new process."""
+	db.create_session('sqlite', database_uri)
+	for fingerprint in fingerprints:
+		db.add_team(fingerprint, fingerprint, 'game', 'division', fingerprint)
+
+"""Tests for reading the change log that another process writes to a SQLite
+file.
+"""
+class ChangeBusDbTestCase(unittest.TestCase):
+	def setUp(self):
+		unittest.TestCase.setUp(self)
+		self.temp_dir = tempfile.mkdtemp()
+		self.database_uri = 'sqlite:///%s' % os.path.join(self.temp_dir, 'changes.db')
+		self.engine = sa.create_engine(self.database_uri)
+		common_db._Base.metadata.create_all(self.engine)
+		self.changes = []
+
+	def tearDown(self):
+		self.engine.dispose()
+		shutil.rmtree(self.temp_dir)
+		unittest.TestCase.tearDown(self)
+
+	def _add_teams(self, *fingerprints):
+		"""Adds teams to the database in another process, and returns their changes."""
+		process = multiprocessing.Process(target=_add_teams_in_process,
+				args=(self.database_uri, fingerprints))
+		process.start()
+		process.join()
+		self.assertEqual(0, process.exitcode)
+		team_ids = self.engine.execute(sa.select([db.Team.id])
+				.where(db.Team.fingerprint.in_(fingerprints))
+				.order_by(db.Team.id)).fetchall()
+		changes = []
+		for team_id, in team_ids:
+			changes.extend(((db.TEAM_CHANGE_TYPE, None), (db.TEAM_CHANGE_TYPE, team_id)))
+		return changes
+
+	def _listener(self, change_events):
+		if change_events is None:
+			self.changes.append(None)
+		else:
+			self.changes.append(tuple(
+					(change.entity_type, change.entity_id) for change in change_events))
+
+	def _create_bus(self, **kwargs):
+		bus = common_db.ChangeBus(self.engine, **kwargs)
+		bus.subscribe(self._listener)
+		return bus
+
+	"""Test that changes added by another process are read in batches.
+	"""
+	def test_poll_batches(self):
+		bus = self._create_bus(batch_size=4)
+		bus.start()
+		changes = self._add_teams('team1', 'team2', 'team3')
+		self.assertEqual(6, bus.poll())
+		self.assertEqual([tuple(changes[:4]), tuple(changes[4:])], self.changes)
+		self.assertEqual(0, bus.poll())
+		self.assertEqual(2, len(self.changes))
+
+	"""Test that the change log is read at most every poll interval.
+	"""
+	def test_poll_interval(self):
+		bus = self._create_bus(poll_interval=10)
+		bus.start()
+		self.assertEqual(0, bus.poll(now=100))
+		changes = self._add_teams('team1')
+		self.assertEqual(0, bus.poll(now=105))
+		self.assertEqual(2, bus.poll(now=110))
+		self.assertEqual([tuple(changes)], self.changes)
+
+	"""Test that a restarted process can read the changes added while it was stopped.
+	"""
+	def test_restart(self):
+		bus = self._create_bus()
+		bus.start()
+		self._add_teams('team1')
+		bus.poll()
+		version = bus.get_version()
+
+		# Add changes while no process is reading them.
+		changes = self._add_teams('team2')
+		restarted_bus = self._create_bus()
+		restarted_bus.start(version)
+		del self.changes[:]
+		self.assertEqual(2, restarted_bus.poll())
+		self.assertEqual([tuple(changes)], self.changes)
+
+		# Assert that starting at a pruned version clears the caches.
+		self.engine.execute(common_db.Changes.delete()
+				.where(common_db.Change.version <= version + 1))
+		del self.changes[:]
+		pruned_bus = self._create_bus()
+		pruned_bus.start(version)
+		self.assertEqual([None], self.changes)
+
+	"""Test that a change that commits after a change with a greater version is read.
+	"""
+	def test_gap(self):
+		bus = self._create_bus(gap_timeout=30)
+		bus.start()
+		def add_change(version, entity_id):
+			self.engine.execute(common_db.Changes.insert().values(version=version,
+					entity_type=db.TEAM_CHANGE_TYPE, entity_id=entity_id, added=datetime.utcnow()))
+		add_change(1, 1)
+		add_change(3, 3)
+		self.assertEqual(2, bus.poll(now=100))
+		self.assertEqual(2, bus.get_min_missing_version())
+		add_change(2, 2)
+		self.assertEqual(1, bus.poll(now=101))
+		self.assertIsNone(bus.get_min_missing_version())
+		self.assertEqual([
+				((db.TEAM_CHANGE_TYPE, 1), (db.TEAM_CHANGE_TYPE, 3)),
+				((db.TEAM_CHANGE_TYPE, 2),)],
+			self.changes)
+
+		# Assert that a missing version is no longer read after the gap timeout.
+		add_change(5, 5)
+		bus.poll(now=102)
+		self.assertEqual([4], bus._gap_times.keys())
+		bus.poll(now=132)
+		self.assertEqual([], bus._gap_times.keys())
+
+
+"""Tests for timing the statements of an instrumented engine.
+"""
+class QueryLogDbTestCase(unittest.TestCase):
+	def setUp(self):
+		unittest.TestCase.setUp(self)
+		self.engine = sa.create_engine('sqlite://')
+		common_db._instrument_engine(self.engine, 0.0)
+		self.slow_statements = []
+		self.handler = _ListHandler(self.slow_statements)
+		common_db._slow_query_logger.addHandler(self.handler)
+
+	def tearDown(self):
+		common_db._slow_query_logger.removeHandler(self.handler)
+		common_db.end_query_log()
+		self.engine.dispose()
+		unittest.TestCase.tearDown(self)
+
+	def test_query_log(self):
+		# Assert that statements are not logged unless a log is begun.
+		self.engine.execute('SELECT 1')
+		self.assertIsNone(common_db.end_query_log())
+
+		common_db.begin_query_log()
+		for i in xrange(5):
+			self.engine.execute('SELECT %s' % i)
+		query_log = common_db.end_query_log()
+		self.assertEqual(5, query_log.num_statements)
+		self.assertGreater(query_log.total_seconds, 0.0)
+		# Assert that only the slowest statements are kept, slowest first.
+		slowest = query_log.get_slowest()
+		self.assertEqual(common_db._QUERY_LOG_NUM_SLOWEST, len(slowest))
+		self.assertEqual(sorted(slowest, reverse=True), slowest)
+		self.assertEqual(common_db._QUERY_LOG_NUM_SLOWEST,
+				len(query_log.to_dict()['slowest']))
+		# Assert that each statement is slower than the threshold of zero.
+		self.assertEqual(6, len(self.slow_statements))
+		self.assertIn('SELECT 4', self.slow_statements[-1])
+
+		# Assert that ending the log stops adding statements to it.
+		self.engine.execute('SELECT 1')
+		self.assertEqual(5, query_log.num_statements)
+
+
+"""Tests for the records returned by the getters.
+"""
+class DisplayedRecordTestCase(unittest.TestCase):
+	def setUp(self):
+		unittest.TestCase.setUp(self)
+		self.time = datetime(2012, 10, 15, 12, 30, 45)
+
+	def _create_match_list(self):
+		team1 = db.DisplayedTeam(1, 'team1', 2, False)
+		team2 = db.DisplayedTeam(3, 'team2', 4, False)
+		match = db.DisplayedMatch(5, team1, team2, self.time, 6, 7, True, 'game', 'division')
+		return db.DisplayedMatchList((match,), None, None, self.time, 5)
+
+	"""Test that records are compared by their values.
+	"""
+	def test_equality(self):
+		match_list = self._create_match_list()
+		self.assertEqual(self._create_match_list(), match_list)
+		self.assertEqual(hash(self._create_match_list()), hash(match_list))
+		match = match_list.matches[0]
+		self.assertNotEqual(db.DisplayedMatch(match.match_id, match.team1, match.team2,
+				match.time, match.num_stars, match.num_streams, False), match)
+		# A subclass with equal values is not equal.
+		self.assertNotEqual(db.DisplayedTeamDetails(1, 'team1', 2, False, None, None,
+					None, (), None, None, None, None),
+				match.team1)
+
+	"""Test the generated constructors of records.
+	"""
+	def test_init(self):
+		self.assertEqual(db.DisplayedTeam(1, 'team1', 2, False, None, None),
+				db.DisplayedTeam(1, 'team1', 2, False))
+		self.assertEqual(('team1', 'game'), db.DisplayedTeam(
+				1, name='team1', num_stars=2, is_starred=False, game='game').get_values()[1::3])
+		# A subclass does not inherit the defaults of its base.
+		with self.assertRaises(TypeError):
+			db.DisplayedTeamDetails(1, 'team1', 2, False)
+		with self.assertRaises(TypeError):
+			db.DisplayedStarredIds((), ())
+		calendar = db.DisplayedCalendar(None, ())
+		self.assertFalse(calendar.is_updating)
+		self.assertEqual(('next_match', 'matches', 'prev_time', 'prev_match_id',
+					'next_time', 'next_match_id', 'is_updating'),
+				db.DisplayedCalendar.get_fields())
+
+	"""Test that records cannot be changed.
+	"""
+	def test_immutable(self):
+		match = self._create_match_list().matches[0]
+		with self.assertRaises(AttributeError):
+			match.is_starred = False
+		with self.assertRaises(AttributeError):
+			del match.is_starred
+		with self.assertRaises(AttributeError):
+			match.unknown = None
+		self.assertTrue(match.is_starred)
+
+	"""Test that records are serialized and deserialized.
+	"""
+	def test_serialize(self):
+		match_list = self._create_match_list()
+		data = common_db.dumps_records(match_list)
+		self.assertEqual(match_list, common_db.loads_records(data))
+		self.assertEqual(match_list, pickle.loads(pickle.dumps(match_list)))
+		self.assertEqual(
+				'DisplayedTeam(team_id=1, name=\'team1\', num_stars=2, is_starred=False, game=None, division=None)',
+				repr(match_list.matches[0].team1))
@@ -0,0 +1,241 @@
+"""Imports the schedules of league feeds, which are local files exported by ESEA
+and other leagues, into the teams and matches of the database.
+
+Each feed is read, normalized, and compared with the database in batches, so
+the memory used does not grow with the size of a feed. Only the differences are
+written: new teams, new matches, renamed teams, and rescheduled, cancelled, or
+restored matches, which are also recorded as MatchEdits. Importing a feed again without
+changes reads the database but writes no rows. Several feeds can be imported in
+parallel worker processes.
+
+A feed is a CSV file with a header row, or a JSON file with one object on each
+line, where each record is a match with the fields:
+
+	fingerprint: the fingerprint of the match
+	time: the time of the match in UTC, as YYYY-MM-DDTHH:MM:SS
+	game, division: the game and division of the match
+	team1_name, team1_fingerprint: the name and fingerprint of the first team
+	team2_name, team2_fingerprint: the name and fingerprint of the second team
+	status: optionally "scheduled" or "cancelled", by default "scheduled"
+"""
+
+import argparse
+import collections
+import csv
+from datetime import datetime
+import itertools
+import json
+from matchstreamguide import common_db
+from matchstreamguide import db
+from matchstreamguide import views
+import multiprocessing
+import os
+
+# The default count of records of a feed that are compared and written at once.
+_BATCH_SIZE = 1000
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+_SCHEDULED_STATUS = 'scheduled'
+_CANCELLED_STATUS = 'cancelled'
+_STATUSES = (_SCHEDULED_STATUS, _CANCELLED_STATUS)
+
+
+"""A match read from a feed, with the ScheduleTeam of each of its teams.
+"""
+class FeedMatch:
+	def __init__(self, fingerprint, time, game, division, team1, team2,
+			is_cancelled):
+		self.fingerprint = fingerprint
+		self.time = time
+		self.game = game
+		self.division = division
+		self.team1 = team1
+		self.team2 = team2
+		self.is_cancelled = is_cancelled
+
+	def __repr__(self):
+		return 'FeedMatch(fingerprint=%r, time=%r, game=%r, division=%r, team1=%r, team2=%r, is_cancelled=%r)' % (
+				self.fingerprint,
+				self.time,
+				self.game,
+				self.division,
+				self.team1,
+				self.team2,
+				self.is_cancelled)
+
+
+def _read_csv_feed(path):
+	"""Yields the line number and dict of each record of a CSV feed."""
+	with open(path, 'rb') as f:
+		reader = csv.DictReader(f)
+		for record in reader:
+			yield reader.line_num, dict((key, value.decode('utf-8'))
+					for key, value in record.iteritems() if value is not None)
+
+def _read_json_feed(path):
+	"""Yields the line number and dict of each record of a JSON feed, which has one
+	object on each line.
+	"""
+	with open(path, 'rb') as f:
+		for line_number, line in enumerate(f, 1):
+			if line.strip():
+				yield line_number, json.loads(line)
+
+def read_feed(path):
+	"""Yields the line number and dict of each record of the feed at the given path,
+	which is read as CSV if its extension is .csv and as JSON otherwise.
+	"""
+	if os.path.splitext(path)[1].lower() == '.csv':
+		return _read_csv_feed(path)
+	return _read_json_feed(path)
+
+def _get_field(path, line_number, record, name):
+	value = record.get(name)
+	if not value:
+		raise ValueError('%s:%s: Missing field %s' % (path, line_number, name))
+	return value
+
+def _normalize_team(path, line_number, record, prefix, game, division):
+	name = _get_field(path, line_number, record, '%s_name' % prefix).strip()
+	fingerprint = _get_field(path, line_number, record, '%s_fingerprint' % prefix)
+	return db.ScheduleTeam(
+			name, views._get_indexed_name(name), game, division, fingerprint)
+
+def normalize_feed(path, records):
+	"""Yields a FeedMatch for each line number and dict of a record read from the
+	feed at the given path.
+
+	Raises ValueError if a record is missing a field or has an invalid value.
+	"""
+	for line_number, record in records:
+		time = _get_field(path, line_number, record, 'time')
+		try:
+			time = datetime.strptime(time.rstrip('Z'), _TIME_FORMAT)
+		except ValueError:
+			raise ValueError('%s:%s: Invalid time %s' % (path, line_number, time))
+		status = record.get('status') or _SCHEDULED_STATUS
+		if status not in _STATUSES:
+			raise ValueError('%s:%s: Invalid status %s' % (path, line_number, status))
+		game = _get_field(path, line_number, record, 'game')
+		division = _get_field(path, line_number, record, 'division')
+		yield FeedMatch(
+				_get_field(path, line_number, record, 'fingerprint'),
+				time,
+				game,
+				division,
+				_normalize_team(path, line_number, record, 'team1', game, division),
+				_normalize_team(path, line_number, record, 'team2', game, division),
+				status == _CANCELLED_STATUS)
+
+def _get_batches(iterable, batch_size):
+	"""Yields lists of at most batch_size consecutive items of the iterable."""
+	iterator = iter(iterable)
+	while True:
+		batch = list(itertools.islice(iterator, batch_size))
+		if not batch:
+			return
+		yield batch
+
+def get_changes(feed_matches):
+	"""Yields the ScheduleTeam, ScheduleMatch, ScheduleCancel, and ScheduleRestore
+	records that differ from the database for a batch of FeedMatches.
+
+	A team or match that is unchanged yields nothing. A match that is cancelled
+	and does not exist is ignored. A cancelled match that the feed schedules again
+	is restored, and also rescheduled if its time, game, or division changed.
+	"""
+	teams = collections.OrderedDict()
+	matches = collections.OrderedDict()
+	for feed_match in feed_matches:
+		matches[feed_match.fingerprint] = feed_match
+		if not feed_match.is_cancelled:
+			for team in (feed_match.team1, feed_match.team2):
+				teams[team.fingerprint] = team
+	existing_teams, existing_matches = db.get_schedule_by_fingerprint(
+			teams.iterkeys(), matches.iterkeys())
+
+	# Yield the teams first, so that they exist before the matches between them.
+	for fingerprint, team in teams.iteritems():
+		if existing_teams.get(fingerprint) != (team.display_name, team.indexed_name):
+			yield team
+	for fingerprint, feed_match in matches.iteritems():
+		existing_match = existing_matches.get(fingerprint)
+		if existing_match is not None:
+			time, game, division, is_cancelled = existing_match
+			if feed_match.is_cancelled:
+				if not is_cancelled:
+					yield db.ScheduleCancel(fingerprint)
+				continue
+			if is_cancelled:
+				yield db.ScheduleRestore(fingerprint)
+			if (time, game, division) == (
+					feed_match.time, feed_match.game, feed_match.division):
+				continue
+		elif feed_match.is_cancelled:
+			continue
+		yield db.ScheduleMatch(feed_match.team1.fingerprint,
+				feed_match.team2.fingerprint, feed_match.time, feed_match.game,
+				feed_match.division, fingerprint)
+
+def import_feed(path, editor_id, batch_size=_BATCH_SIZE):
+	"""Imports the feed at the given path, recording each rescheduled, cancelled,
+	or restored match as a MatchEdit by the given user, and returns a ScheduleLoadCounts of the
+	changes written.
+
+	Each batch is compared and then written in its own transaction before the next
+	batch is read.
+	"""
+	counts = db.ScheduleLoadCounts()
+	comment = 'feed:%s' % os.path.basename(path)
+	feed_matches = normalize_feed(path, read_feed(path))
+	for batch in _get_batches(feed_matches, batch_size):
+		changes = list(get_changes(batch))
+		if changes:
+			counts.add(db.load_schedule(changes, len(changes), editor_id, comment))
+	return counts
+
+def _import_feed(args):
+	path, editor_id, batch_size = args
+	return path, import_feed(path, editor_id, batch_size)
+
+def run(paths, editor_id, batch_size=_BATCH_SIZE, num_processes=1):
+	"""Imports the feeds at the given paths, printing the counts of each.
+
+	Returns the ScheduleLoadCounts of all feeds. If num_processes is greater than
+	1, then the feeds are imported in parallel by that many worker processes, and
+	so two feeds should not share a team or match.
+	"""
+	if num_processes > 1:
+		# Close all connections so that the worker processes do not share them.
+		db.session.remove()
+		common_db._engine.dispose()
+		pool = multiprocessing.Pool(num_processes)
+		map_feeds = pool.imap_unordered
+	else:
+		pool = None
+		map_feeds = itertools.imap
+
+	counts = db.ScheduleLoadCounts()
+	for path, feed_counts in map_feeds(_import_feed,
+			[(path, editor_id, batch_size) for path in paths]):
+		print '%s: %s' % (path, feed_counts)
+		counts.add(feed_counts)
+	print 'total: %s' % counts
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	return counts
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('paths', nargs='+', metavar='path',
+			help='the path of a feed to import')
+	parser.add_argument('--editor-id', type=int, required=True,
+			help='the identifier of the user that records each MatchEdit')
+	parser.add_argument('--batch-size', type=int, default=_BATCH_SIZE,
+			help='the count of records of a feed to compare and write at once')
+	parser.add_argument('--processes', type=int, default=1,
+			help='the number of worker processes that import feeds in parallel')
+	args = parser.parse_args(argv)
+	run(args.paths, args.editor_id, args.batch_size, args.processes)
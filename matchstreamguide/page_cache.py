@@ -0,0 +1,275 @@
+"""A cache of rendered pages that is shared by all worker processes.
+
+The pages are stored gzip-compressed in a SQLite file. Each page has tags that
+identify the entities it displays, and invalidating a tag deletes each page
+that has that tag.
+"""
+
+import cStringIO
+import gzip
+from matchstreamguide import shared_sqlite
+import sqlite3
+import time
+
+# The gzip compression level of the cached pages.
+_COMPRESS_LEVEL = 6
+
+_CREATE_TABLES = (
+		'CREATE TABLE IF NOT EXISTS PageCacheEntries '
+			'(key TEXT PRIMARY KEY, data BLOB NOT NULL, created REAL NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS PageCacheEntriesByCreated '
+			'ON PageCacheEntries (created)',
+		'CREATE TABLE IF NOT EXISTS PageCacheTags '
+			'(tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))',
+		'CREATE INDEX IF NOT EXISTS PageCacheTagsByKey ON PageCacheTags (key)',
+		'CREATE TABLE IF NOT EXISTS PageCacheInvalidations '
+			'(tag TEXT PRIMARY KEY, sequence INTEGER NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS PageCacheCounters '
+			'(name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+)
+
+# The counter of invalidations, which orders each invalidation of a tag.
+_SEQUENCE_COUNTER = 'sequence'
+_HITS_COUNTER = 'hits'
+_MISSES_COUNTER = 'misses'
+_INVALIDATED_COUNTER = 'invalidated'
+# The greatest version of an invalidating change in the change log.
+_CHANGE_VERSION_COUNTER = 'change_version'
+# The tag of the invalidation recorded by clear, which invalidates every tag.
+_CLEAR_TAG = '*'
+
+
+def compress(body):
+	"""Returns the given string compressed by gzip."""
+	buf = cStringIO.StringIO()
+	gzip_file = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=_COMPRESS_LEVEL)
+	try:
+		gzip_file.write(body)
+	finally:
+		gzip_file.close()
+	return buf.getvalue()
+
+def decompress(data):
+	"""Returns the given string decompressed by gzip."""
+	gzip_file = gzip.GzipFile(mode='rb', fileobj=cStringIO.StringIO(data))
+	try:
+		return gzip_file.read()
+	finally:
+		gzip_file.close()
+
+
+"""Statistics of a PageCache, aggregated across all processes."""
+class PageCacheStats:
+	def __init__(self, hits, misses, invalidated, num_entries):
+		self.hits = hits
+		self.misses = misses
+		self.invalidated = invalidated
+		self.num_entries = num_entries
+
+	def get_hit_ratio(self):
+		"""Returns the fraction of lookups that were hits, or None if there were none."""
+		num_lookups = self.hits + self.misses
+		return float(self.hits) / num_lookups if num_lookups else None
+
+	def to_dict(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_ratio': self.get_hit_ratio(),
+			'invalidated': self.invalidated,
+			'entries': self.num_entries,
+		}
+
+	def __repr__(self):
+		return 'PageCacheStats(hits=%r, misses=%r, invalidated=%r, num_entries=%r)' % (
+				self.hits, self.misses, self.invalidated, self.num_entries)
+
+
+"""A cache of gzip-compressed pages in a SQLite file shared by all processes.
+
+A page is cached for at most max_age seconds, because pages display times
+relative to the current time. To not cache a page that was rendered from data
+that an invalidation raced with, get_sequence must be called before reading the
+data for the page, and its value passed to put.
+"""
+class PageCache(shared_sqlite.SharedSqliteFile):
+	def __init__(self, path, max_age, timeout=5.0):
+		shared_sqlite.SharedSqliteFile.__init__(self, path, _CREATE_TABLES, timeout,
+				text_factory=str)
+		self.max_age = max_age
+		self._hits = 0
+		self._misses = 0
+
+	def _reset_counts(self):
+		self._hits = 0
+		self._misses = 0
+
+	def _take_counts(self):
+		hits, misses = self._hits, self._misses
+		self._hits = 0
+		self._misses = 0
+		return (hits, misses) if (hits or misses) else None
+
+	def _restore_counts(self, counts):
+		hits, misses = counts
+		self._hits += hits
+		self._misses += misses
+
+	def _write_counts(self, connection, counts):
+		hits, misses = counts
+		self._add_counters(connection, ((_HITS_COUNTER, hits), (_MISSES_COUNTER, misses)))
+
+	def _count(self, is_hit):
+		with self._lock:
+			if is_hit:
+				self._hits += 1
+			else:
+				self._misses += 1
+			should_flush = self._count_unflushed()
+		if should_flush:
+			self.flush()
+
+	def get(self, key, now=None):
+		"""Returns the gzip-compressed page for the given key, or None if not cached."""
+		if now is None:
+			now = time.time()
+		row = self._get_connection().execute(
+				'SELECT data FROM PageCacheEntries WHERE key = ? AND created > ?',
+				(key, now - self.max_age)).fetchone()
+		self._count(row is not None)
+		return None if row is None else str(row[0])
+
+	def get_sequence(self):
+		"""Returns the sequence number of the last invalidation."""
+		row = self._get_connection().execute(
+				'SELECT value FROM PageCacheCounters WHERE name = ?',
+				(_SEQUENCE_COUNTER,)).fetchone()
+		return 0 if row is None else row[0]
+
+	def put(self, key, data, tags, sequence, now=None):
+		"""Caches the gzip-compressed page for the given key with the given tags.
+
+		If any tag was invalidated or the cache was cleared after get_sequence
+		returned sequence, the page is not cached and False is returned.
+		"""
+		if now is None:
+			now = time.time()
+		tags = frozenset(tags)
+		connection = self._get_connection()
+		with self._transaction(connection):
+			for tag in tags | frozenset((_CLEAR_TAG,)):
+				row = connection.execute(
+						'SELECT 1 FROM PageCacheInvalidations WHERE tag = ? AND sequence > ?',
+						(tag, sequence)).fetchone()
+				if row is not None:
+					# Nothing was written, so committing ends the transaction.
+					return False
+
+			# Remove expired pages before adding this page.
+			self._delete_entries(connection,
+					'SELECT key FROM PageCacheEntries WHERE created <= ?', (now - self.max_age,))
+			connection.execute('DELETE FROM PageCacheTags WHERE key = ?', (key,))
+			connection.execute(
+					'INSERT OR REPLACE INTO PageCacheEntries (key, data, created) VALUES (?, ?, ?)',
+					(key, sqlite3.Binary(data), now))
+			connection.executemany('INSERT INTO PageCacheTags (tag, key) VALUES (?, ?)',
+					((tag, key) for tag in tags))
+		return True
+
+	def _delete_entries(self, connection, key_select, params):
+		"""Deletes the pages and tags with keys returned by the given statement, and
+		returns the count of deleted pages.
+		"""
+		keys = connection.execute(key_select, params).fetchall()
+		if not keys:
+			return 0
+		connection.executemany('DELETE FROM PageCacheTags WHERE key = ?', keys)
+		connection.executemany('DELETE FROM PageCacheEntries WHERE key = ?', keys)
+		return len(keys)
+
+	def get_change_version(self):
+		"""Returns the greatest version passed to invalidate, or None if none was
+		passed.
+		"""
+		row = self._get_connection().execute(
+				'SELECT value FROM PageCacheCounters WHERE name = ?',
+				(_CHANGE_VERSION_COUNTER,)).fetchone()
+		return None if row is None else row[0]
+
+	def invalidate(self, tags, change_version=None):
+		"""Deletes each page with any of the given tags.
+
+		If the tags are of changes read from the change log, then change_version is
+		their greatest version, which is returned by get_change_version after a
+		restart.
+		"""
+		tags = frozenset(tags)
+		if not tags:
+			return
+		connection = self._get_connection()
+		with self._transaction(connection):
+			self._add_invalidations(connection, tags)
+
+			num_invalidated = 0
+			for tag in tags:
+				num_invalidated += self._delete_entries(connection,
+						'SELECT key FROM PageCacheTags WHERE tag = ?', (tag,))
+			self._add_counters(connection, ((_INVALIDATED_COUNTER, num_invalidated),))
+			if change_version is not None:
+				connection.execute(
+						'INSERT OR IGNORE INTO PageCacheCounters (name, value) VALUES (?, ?)',
+						(_CHANGE_VERSION_COUNTER, change_version))
+				connection.execute(
+						'UPDATE PageCacheCounters SET value = MAX(value, ?) WHERE name = ?',
+						(change_version, _CHANGE_VERSION_COUNTER))
+
+	def _add_invalidations(self, connection, tags):
+		"""Increments the sequence and records it as the last invalidation of each of
+		the given tags.
+		"""
+		connection.execute(
+				'INSERT OR IGNORE INTO PageCacheCounters (name, value) VALUES (?, 0)',
+				(_SEQUENCE_COUNTER,))
+		connection.execute(
+				'UPDATE PageCacheCounters SET value = value + 1 WHERE name = ?',
+				(_SEQUENCE_COUNTER,))
+		sequence = connection.execute(
+				'SELECT value FROM PageCacheCounters WHERE name = ?',
+				(_SEQUENCE_COUNTER,)).fetchone()[0]
+		connection.executemany(
+				'INSERT OR REPLACE INTO PageCacheInvalidations (tag, sequence) VALUES (?, ?)',
+				((tag, sequence) for tag in tags))
+
+	def _add_counters(self, connection, deltas):
+		for name, delta in deltas:
+			if not delta:
+				continue
+			connection.execute(
+					'INSERT OR IGNORE INTO PageCacheCounters (name, value) VALUES (?, 0)', (name,))
+			connection.execute(
+					'UPDATE PageCacheCounters SET value = value + ? WHERE name = ?', (delta, name))
+
+	def flush_stats(self):
+		"""Adds the hits and misses counted by this process to the shared counts."""
+		self.flush()
+
+	def get_stats(self):
+		"""Returns the PageCacheStats aggregated across all processes."""
+		self.flush()
+		connection = self._get_connection()
+		counters = dict(connection.execute('SELECT name, value FROM PageCacheCounters'))
+		num_entries = connection.execute('SELECT COUNT(*) FROM PageCacheEntries').fetchone()[0]
+		return PageCacheStats(counters.get(_HITS_COUNTER, 0), counters.get(_MISSES_COUNTER, 0),
+				counters.get(_INVALIDATED_COUNTER, 0), num_entries)
+
+	def clear(self):
+		"""Deletes all pages.
+
+		This keeps the sequence and records an invalidation of all tags, so that a
+		page rendered before clearing is not cached.
+		"""
+		connection = self._get_connection()
+		with self._transaction(connection):
+			self._add_invalidations(connection, (_CLEAR_TAG,))
+			connection.execute('DELETE FROM PageCacheTags')
+			connection.execute('DELETE FROM PageCacheEntries')
@@ -0,0 +1,180 @@
+"""Histograms of the statements and database time of requests for each route,
+shared by all worker processes.
+
+Each process counts its requests in memory, and adds them to the histograms in a
+SQLite file after every shared_sqlite.DEFAULT_FLUSH_INTERVAL requests.
+"""
+
+import bisect
+from matchstreamguide import shared_sqlite
+
+# The upper bounds of the buckets of each histogram. A last bucket counts the
+# requests greater than the last bound.
+_STATEMENTS_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64)
+_MILLIS_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+_HISTOGRAM_BOUNDS = {
+	'statements': _STATEMENTS_BOUNDS,
+	'db_millis': _MILLIS_BOUNDS,
+}
+
+_CREATE_TABLES = (
+		'CREATE TABLE IF NOT EXISTS QueryStatsRoutes '
+			'(route TEXT PRIMARY KEY, requests INTEGER NOT NULL, '
+			'statements INTEGER NOT NULL, db_millis REAL NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS QueryStatsBuckets '
+			'(route TEXT NOT NULL, histogram TEXT NOT NULL, bucket INTEGER NOT NULL, '
+			'requests INTEGER NOT NULL, PRIMARY KEY (route, histogram, bucket))',
+)
+
+
+def _get_empty_histograms():
+	"""Returns a dict from each histogram name to a count of zero for each bucket."""
+	return dict((histogram, [0] * (len(bounds) + 1))
+			for histogram, bounds in _HISTOGRAM_BOUNDS.iteritems())
+
+
+"""The counts of the requests for a route that a process has not yet flushed."""
+class _RouteCounts:
+	def __init__(self):
+		self.requests = 0
+		self.statements = 0
+		self.db_millis = 0.0
+		self.buckets = _get_empty_histograms()
+
+	def add(self, num_statements, db_millis):
+		self.requests += 1
+		self.statements += num_statements
+		self.db_millis += db_millis
+		for histogram, value in (('statements', num_statements), ('db_millis', db_millis)):
+			self.buckets[histogram][
+					bisect.bisect_left(_HISTOGRAM_BOUNDS[histogram], value)] += 1
+
+	def add_counts(self, other):
+		self.requests += other.requests
+		self.statements += other.statements
+		self.db_millis += other.db_millis
+		for histogram, buckets in other.buckets.iteritems():
+			for bucket, requests in enumerate(buckets):
+				self.buckets[histogram][bucket] += requests
+
+
+"""The statements and database time of the requests for a route, aggregated
+across all processes.
+"""
+class RouteQueryStats:
+	def __init__(self, route, requests, statements, db_millis, histograms):
+		self.route = route
+		self.requests = requests
+		self.statements = statements
+		self.db_millis = db_millis
+		# A dict from each histogram name to its count of requests in each bucket.
+		self.histograms = histograms
+
+	def to_dict(self):
+		histograms = {}
+		for histogram, bounds in _HISTOGRAM_BOUNDS.iteritems():
+			counts = self.histograms[histogram]
+			buckets = [{'le': bound, 'requests': count}
+					for bound, count in zip(bounds, counts)]
+			buckets.append({'le': None, 'requests': counts[len(bounds)]})
+			histograms[histogram] = buckets
+		return {
+			'requests': self.requests,
+			'statements': self.statements,
+			'db_millis': self.db_millis,
+			'mean_statements': float(self.statements) / self.requests,
+			'mean_db_millis': self.db_millis / self.requests,
+			'histograms': histograms,
+		}
+
+	def __repr__(self):
+		return 'RouteQueryStats(route=%r, requests=%r, statements=%r, db_millis=%r)' % (
+				self.route, self.requests, self.statements, self.db_millis)
+
+
+"""Histograms of the statements and database time of requests for each route, in
+a SQLite file shared by all processes.
+"""
+class QueryStats(shared_sqlite.SharedSqliteFile):
+	def __init__(self, path, timeout=5.0):
+		shared_sqlite.SharedSqliteFile.__init__(self, path, _CREATE_TABLES, timeout)
+		self._route_counts = {}
+
+	def _reset_counts(self):
+		self._route_counts = {}
+
+	def _take_counts(self):
+		route_counts = self._route_counts
+		self._route_counts = {}
+		return route_counts or None
+
+	def _restore_counts(self, route_counts):
+		for route, counts in route_counts.iteritems():
+			self._get_route_counts(route).add_counts(counts)
+
+	def _get_route_counts(self, route):
+		route_counts = self._route_counts.get(route)
+		if route_counts is None:
+			route_counts = _RouteCounts()
+			self._route_counts[route] = route_counts
+		return route_counts
+
+	def add(self, route, query_log):
+		"""Adds the given common_db.QueryLog of a request for the given route."""
+		with self._lock:
+			self._get_route_counts(route).add(
+					query_log.num_statements, query_log.total_seconds * 1000.0)
+			should_flush = self._count_unflushed()
+		if should_flush:
+			self.flush()
+
+	def _write_counts(self, connection, route_counts):
+		for route, counts in route_counts.iteritems():
+			connection.execute(
+					'INSERT OR IGNORE INTO QueryStatsRoutes '
+						'(route, requests, statements, db_millis) VALUES (?, 0, 0, 0.0)',
+					(route,))
+			connection.execute(
+					'UPDATE QueryStatsRoutes SET requests = requests + ?, '
+						'statements = statements + ?, db_millis = db_millis + ? WHERE route = ?',
+					(counts.requests, counts.statements, counts.db_millis, route))
+			for histogram, buckets in counts.buckets.iteritems():
+				for bucket, requests in enumerate(buckets):
+					if not requests:
+						continue
+					connection.execute(
+							'INSERT OR IGNORE INTO QueryStatsBuckets '
+								'(route, histogram, bucket, requests) VALUES (?, ?, ?, 0)',
+							(route, histogram, bucket))
+					connection.execute(
+							'UPDATE QueryStatsBuckets SET requests = requests + ? '
+								'WHERE route = ? AND histogram = ? AND bucket = ?',
+							(requests, route, histogram, bucket))
+
+	def get_stats(self):
+		"""Returns a dict from each route to its RouteQueryStats, aggregated across all
+		processes.
+		"""
+		self.flush()
+		connection = self._get_connection()
+		histograms = {}
+		for route, histogram, bucket, requests in connection.execute(
+				'SELECT route, histogram, bucket, requests FROM QueryStatsBuckets'):
+			bounds = _HISTOGRAM_BOUNDS.get(histogram)
+			if bounds is None or bucket > len(bounds):
+				continue
+			route_histograms = histograms.get(route)
+			if route_histograms is None:
+				route_histograms = _get_empty_histograms()
+				histograms[route] = route_histograms
+			route_histograms[histogram][bucket] = requests
+		stats = {}
+		for route, requests, statements, db_millis in connection.execute(
+				'SELECT route, requests, statements, db_millis FROM QueryStatsRoutes'):
+			stats[route] = RouteQueryStats(route, requests, statements, db_millis,
+					histograms.get(route) or _get_empty_histograms())
+		return stats
+
+	def clear(self):
+		"""Deletes all histograms."""
+		self._delete_all(('QueryStatsRoutes', 'QueryStatsBuckets'))
@@ -0,0 +1,123 @@
+"""A SQLite file shared by all worker processes, to which each process adds the
+counts that it keeps in memory.
+
+Each thread of each process has its own connection, and the file uses
+write-ahead logging so that readers do not block the writer.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+# The default count of events counted by a process before it adds their counts to
+# the counts shared by all processes.
+DEFAULT_FLUSH_INTERVAL = 100
+
+
+"""A SQLite file shared by all processes.
+
+A subclass counts each event in memory while holding _lock, and then calls
+_count_unflushed. After every flush_interval events, flush takes the counts by
+_take_counts and adds them to the file by _write_counts.
+"""
+class SharedSqliteFile:
+	def __init__(self, path, create_statements, timeout=5.0,
+			flush_interval=DEFAULT_FLUSH_INTERVAL, text_factory=None):
+		self.path = path
+		self.timeout = timeout
+		self.flush_interval = flush_interval
+		self._create_statements = create_statements
+		self._text_factory = text_factory
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._pid = os.getpid()
+		self._num_unflushed = 0
+
+	def _reset_counts(self):
+		"""Discards the counts of this process that are not flushed."""
+		raise NotImplementedError
+
+	def _take_counts(self):
+		"""Returns the counts of this process that are not flushed and resets them, or
+		None if there are none.
+		"""
+		raise NotImplementedError
+
+	def _write_counts(self, connection, counts):
+		"""Adds the counts returned by _take_counts to the file."""
+		raise NotImplementedError
+
+	def _restore_counts(self, counts):
+		"""Adds back the counts returned by _take_counts after writing them failed."""
+		raise NotImplementedError
+
+	def _get_connection(self):
+		"""Returns the connection to the SQLite file for this thread and process."""
+		pid = os.getpid()
+		if self._pid != pid:
+			# Do not share connections or unflushed counts with the parent process.
+			self._local = threading.local()
+			self._pid = pid
+			self._num_unflushed = 0
+			self._reset_counts()
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.path, timeout=self.timeout,
+					isolation_level=None)
+			if self._text_factory is not None:
+				connection.text_factory = self._text_factory
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.execute('PRAGMA synchronous=NORMAL')
+			for statement in self._create_statements:
+				connection.execute(statement)
+			self._local.connection = connection
+		return connection
+
+	@contextlib.contextmanager
+	def _transaction(self, connection):
+		"""Executes the block in a transaction that holds the write lock of the file,
+		and commits it unless the block raises an exception.
+		"""
+		connection.execute('BEGIN IMMEDIATE')
+		try:
+			yield
+		except:
+			connection.execute('ROLLBACK')
+			raise
+		connection.execute('COMMIT')
+
+	def _count_unflushed(self):
+		"""Counts an event that was counted in memory while holding _lock, and returns
+		whether flush should be called after releasing it.
+		"""
+		self._num_unflushed += 1
+		return self._num_unflushed >= self.flush_interval
+
+	def flush(self):
+		"""Adds the counts of this process to the counts shared by all processes."""
+		connection = self._get_connection()
+		with self._lock:
+			counts = self._take_counts()
+			self._num_unflushed = 0
+		if counts is None:
+			return
+		try:
+			with self._transaction(connection):
+				self._write_counts(connection, counts)
+		except:
+			with self._lock:
+				self._restore_counts(counts)
+			raise
+
+	def _delete_all(self, tables):
+		"""Discards the unflushed counts of this process, and deletes all rows of the
+		given tables.
+		"""
+		connection = self._get_connection()
+		with self._lock:
+			self._num_unflushed = 0
+			self._reset_counts()
+		with self._transaction(connection):
+			for table in tables:
+				connection.execute('DELETE FROM %s' % table)
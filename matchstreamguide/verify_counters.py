@@ -0,0 +1,87 @@
+"""Verifies and optionally repairs the denormalized counters and CalendarEntries
+by recomputing them from the association tables.
+
+The matches, teams, and users are verified in shards of consecutive identifiers,
+each in its own short transaction, so this never holds long locks and can run
+in parallel worker processes while the site is serving requests.
+"""
+
+import argparse
+import itertools
+from matchstreamguide import common_db
+from matchstreamguide import db
+import multiprocessing
+
+# The default count of identifiers in each shard.
+_SHARD_SIZE = 1000
+
+_VERIFIERS = {
+	'match': db.verify_match_counters,
+	'team': db.verify_team_counters,
+	'user': db.verify_user_counters,
+}
+_KINDS = ('match', 'team', 'user')
+
+def _get_shards(kind, shard_size, repair):
+	"""Returns each shard of the given kind to verify, as the kind, minimum
+	identifier, maximum identifier, and whether to repair it.
+	"""
+	max_id = dict(zip(_KINDS, db.get_max_ids()))[kind]
+	return [(kind, min_id, min_id + shard_size, repair)
+			for min_id in xrange(0, max_id + 1, shard_size)]
+
+def _verify_shard(shard):
+	kind, min_id, max_id, repair = shard
+	return kind, _VERIFIERS[kind](min_id, max_id, repair)
+
+def run(kinds=_KINDS, shard_size=_SHARD_SIZE, num_processes=1, repair=False):
+	"""Verifies the given kinds of counters, printing each difference.
+
+	Returns the number of differences found. If repair is True, then each
+	difference is also repaired.
+	"""
+	if num_processes > 1:
+		# Close all connections so that the worker processes do not share them.
+		db.session.remove()
+		common_db._engine.dispose()
+		pool = multiprocessing.Pool(num_processes)
+		map_shards = pool.imap_unordered
+	else:
+		pool = None
+		map_shards = itertools.imap
+
+	# CalendarEntries are computed using Match.is_streamed and
+	# MatchOpponent.is_streamed, so verify each kind in order.
+	num_differences = 0
+	for kind in _KINDS:
+		if kind not in kinds:
+			continue
+		num_kind_differences = 0
+		for shard_kind, differences in map_shards(
+				_verify_shard, _get_shards(kind, shard_size, repair)):
+			for difference in differences:
+				print '%s %s %s: actual=%s, expected=%s' % (difference.table_name,
+						difference.row_id, difference.column_name,
+						difference.actual, difference.expected)
+			num_kind_differences += len(differences)
+		print '%s: %s differences%s' % (
+				kind, num_kind_differences, ' repaired' if repair else '')
+		num_differences += num_kind_differences
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	return num_differences
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--kind', action='append', choices=_KINDS, dest='kinds',
+			help='the kind of counters to verify; defaults to all kinds')
+	parser.add_argument('--shard-size', type=int, default=_SHARD_SIZE,
+			help='the count of identifiers in each shard')
+	parser.add_argument('--processes', type=int, default=1,
+			help='the number of worker processes')
+	parser.add_argument('--repair', action='store_true',
+			help='repair each difference that is found')
+	args = parser.parse_args(argv)
+	run(args.kinds or _KINDS, args.shard_size, args.processes, args.repair)
@@ -3,15 +3,20 @@ from matchstreamguide import app
 from collections import defaultdict
 import common_db
 from datetime import datetime, timedelta
+import datetime_format
 import db
 import flask
 import functools
 from flask_openid import OpenID
+import hashlib
 from iso3166 import countries
 import json
+import logging
+import page_cache as page_cache_module
 import pytz
 import regex as re
 import requests
+import sqlite3
 import string
 import urllib
 
@@ -122,28 +127,39 @@ def _get_match_external_url(match):
 		return 'http://play.esea.net/index.php?s=stats&d=match&id=%s' % remainder
 
 
-_DATETIME_FORMAT_12_HOUR_LOCALIZED = '%a %b %d %I:%M%p'
-_DATETIME_FORMAT_24_HOUR_LOCALIZED = '%a %b %d %H:%M'
-_DATETIME_FORMAT_12_HOUR_UTC = '%a %b %d %I:%M%p %Z'
-_DATETIME_FORMAT_24_HOUR_UTC = '%a %b %d %H:%M %Z'
+def _get_datetime_formatter(g):
+	"""Returns the DatetimeFormatter that memoizes the formatted datetimes of the
+	current request.
+
+	The filters call this for every displayed time, and so pass the object behind
+	flask.g, whose attributes are much faster to read than through the proxy.
+	"""
+	formatter = getattr(g, 'datetime_formatter', None)
+	if formatter is None:
+		formatter = datetime_format.DatetimeFormatter()
+		g.datetime_formatter = formatter
+	return formatter
+
+def _get_time_settings(g):
+	"""Returns the time zone and time format that readable_datetime displays."""
+	if getattr(g, 'time_neutral', False):
+		# Clients without JavaScript see UTC in the 24-hour format.
+		return None, None
+	return g.time_zone, g.time_format
 
 def _get_readable_datetime(dt):
 	"""Returns the datetime as a string, using the user's timezone if logged in."""
-	utc_datetime = pytz.utc.localize(dt)
-	time_zone = flask.g.time_zone
-	if time_zone:
-		localized_datetime = utc_datetime.astimezone(time_zone)
-		if flask.g.time_format == '12_hour':
-			datetime_format = _DATETIME_FORMAT_12_HOUR_LOCALIZED
-		else:
-			datetime_format = _DATETIME_FORMAT_24_HOUR_LOCALIZED
-		return localized_datetime.strftime(datetime_format)
-	else:
-		if flask.g.time_format == '12_hour':
-			datetime_format = _DATETIME_FORMAT_12_HOUR_UTC
-		else:
-			datetime_format = _DATETIME_FORMAT_24_HOUR_UTC
-		return utc_datetime.strftime(datetime_format)
+	g = flask.g._get_current_object()
+	return _get_datetime_formatter(g).format(dt, g.time_zone, g.time_format)
+
+def _format_match_times(displayed):
+	"""Formats the times of all matches in the given displayed record in one pass,
+	so that readable_datetime returns them from the memo.
+	"""
+	g = flask.g._get_current_object()
+	time_zone, time_format = _get_time_settings(g)
+	_get_datetime_formatter(g).format_all(
+			datetime_format.get_match_times(displayed), time_zone, time_format)
 
 _SECONDS_PER_HOUR = 60 * 60
 _SECONDS_PER_MINUTE = 60
@@ -202,6 +218,49 @@ def _get_readable_timedelta(dt, now=None):
 	else:
 		return 'starting now'
 
+_TIME_ELEMENT_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def _is_time_neutral():
+	"""Returns whether the page being rendered displays times that times.coffee
+	localizes and updates, instead of times for the client.
+	"""
+	return getattr(flask.g, 'time_neutral', False)
+
+def _get_time_element(dt, css_class, text, capitalize):
+	return flask.Markup(
+			'<time class="%s" datetime="%s"%s>%s</time>' % (
+				css_class,
+				dt.strftime(_TIME_ELEMENT_DATETIME_FORMAT),
+				' data-capitalize="true"' if capitalize else '',
+				flask.escape(text)))
+
+def _render_readable_datetime(dt):
+	"""Renders the datetime for the readable_datetime filter.
+
+	If the page is time-neutral, then a time element in UTC is rendered, and its
+	text in UTC is displayed to clients without JavaScript.
+	"""
+	g = flask.g._get_current_object()
+	time_zone, time_format = _get_time_settings(g)
+	text = _get_datetime_formatter(g).format(dt, time_zone, time_format)
+	if not getattr(g, 'time_neutral', False):
+		return text
+	return _get_time_element(dt, 'readable-datetime', text, False)
+
+def _render_readable_timedelta(dt, capitalize=False, now=None):
+	"""Renders the time until or since the datetime for the readable_timedelta
+	filter.
+
+	If the page is time-neutral, then a time element is rendered, and its text
+	relative to the current time is displayed to clients without JavaScript.
+	"""
+	text = _get_readable_timedelta(dt, now)
+	if capitalize:
+		text = text.capitalize()
+	if not _is_time_neutral():
+		return text
+	return _get_time_element(dt, 'readable-timedelta', text, capitalize)
+
 _DATETIME_QUERY_PARAM_FORMAT = '%Y-%m-%dT%H:%M'
 
 def _get_datetime_query_param(datetime):
@@ -248,8 +307,8 @@ jinja_env.filters['match_url_part'] = _get_match_url_part
 jinja_env.filters['match_external_url'] = _get_match_external_url
 
 # Filters for rendering times.
-jinja_env.filters['readable_datetime'] = _get_readable_datetime
-jinja_env.filters['readable_timedelta'] = _get_readable_timedelta
+jinja_env.filters['readable_datetime'] = _render_readable_datetime
+jinja_env.filters['readable_timedelta'] = _render_readable_timedelta
 jinja_env.filters['datetime_query_param'] = _get_datetime_query_param
 
 # Filters for rendering leagues and divisions.
@@ -265,7 +324,7 @@ def _get_client_values(client):
 	flask.g.client_auth = client['auth']
 	flask.g.time_format = client['time_format']
 	time_zone = client.get('time_zone')
-	flask.g.time_zone = pytz.timezone(time_zone) if time_zone else None
+	flask.g.time_zone = datetime_format.get_time_zone(time_zone) if time_zone else None
 
 def login_required(f):
 	page_name = f.__name__
@@ -292,7 +351,7 @@ def login_optional(f):
 		else:
 			flask.g.logged_in = False
 			flask.g.client_id = None
-			flask.g.time_format = db._DEFAULT_SETTINGS_TIME_FORMAT
+			flask.g.time_format = db.DEFAULT_SETTINGS_TIME_FORMAT
 			flask.g.time_zone = None
 		flask.g.page_name = page_name
 		return f(*pargs, **kwargs)
@@ -327,6 +386,191 @@ def _get_datetime(args, key):
 	return datetime.strptime(value, _DATETIME_QUERY_PARAM_FORMAT)
 
 
+# The PageCache of pages rendered for clients that are not logged in, or None.
+_page_cache = None
+# Whether changes may have been missed because the PageCache could not be read or
+# written, so that its pages must be cleared once it can be written.
+_must_clear_pages = False
+
+def _invalidate_pages(changes):
+	"""Invalidates the cached pages of the ChangeEvents read from the change log."""
+	global _must_clear_pages
+	try:
+		if (changes is None) or _must_clear_pages:
+			# Changes may have been missed.
+			_page_cache.clear()
+			_must_clear_pages = False
+			return
+		max_version = max(change.version for change in changes)
+		change_version = _page_cache.get_change_version()
+		if (change_version is not None) and (change_version >= max_version):
+			# Every worker reads the same changes, and another worker invalidated them.
+			return
+		# Store a version through which every change was invalidated, so that a
+		# missing version is still invalidated by the worker that reads it later.
+		min_missing_version = db.change_bus.get_min_missing_version()
+		if min_missing_version is not None:
+			max_version = min(max_version, min_missing_version - 1)
+		tags = [db.get_change_tag(change) for change in changes]
+		_page_cache.invalidate([tag for tag in tags if tag is not None], max_version)
+	except sqlite3.Error:
+		# Do not fail the request, but clear the pages when the cache is next written.
+		_must_clear_pages = True
+
+def set_page_cache(page_cache):
+	"""Sets the PageCache of pages rendered for clients that are not logged in.
+
+	Changes read from the change log by db.change_bus invalidate its pages. If
+	page_cache is None, then no pages are cached.
+	"""
+	global _page_cache, _must_clear_pages
+	if _page_cache is not None:
+		db.change_bus.unsubscribe(_invalidate_pages)
+	_page_cache = page_cache
+	_must_clear_pages = False
+	if page_cache is not None:
+		db.change_bus.subscribe(_invalidate_pages)
+		try:
+			change_version = page_cache.get_change_version()
+		except sqlite3.Error:
+			# The bus starts at the last change, and the pages cached before it are
+			# cleared when the cache is next written.
+			change_version = None
+			_must_clear_pages = True
+		if change_version is not None:
+			# Invalidate the pages of changes added while no worker was running.
+			db.change_bus.start(change_version)
+
+def get_page_cache_stats():
+	"""Returns the PageCacheStats aggregated across all processes, or None if no
+	pages are cached.
+	"""
+	return None if _page_cache is None else _page_cache.get_stats()
+
+
+_query_logger = logging.getLogger('matchstreamguide.queries')
+_query_stats = None
+
+def set_query_stats(query_stats):
+	"""Sets the QueryStats that aggregates the statements of each request.
+
+	If query_stats is None, then statements are only logged.
+	"""
+	global _query_stats
+	_query_stats = query_stats
+
+def get_query_stats():
+	"""Returns the dict from each route to its RouteQueryStats, or None if there is
+	no QueryStats.
+	"""
+	return None if _query_stats is None else _query_stats.get_stats()
+
+def _get_route():
+	url_rule = flask.request.url_rule
+	return url_rule.rule if url_rule is not None else None
+
+def log_request_queries(query_log, response):
+	"""Logs the statements of the request from the given common_db.QueryLog, and
+	adds them to the QueryStats of the route.
+	"""
+	route = _get_route()
+	values = query_log.to_dict()
+	values.update(
+			route=route,
+			method=flask.request.method,
+			path=flask.request.path,
+			status=response.status_code)
+	_query_logger.info(json.dumps(values, sort_keys=True))
+	if _query_stats is not None and route is not None:
+		try:
+			_query_stats.add(route, query_log)
+		except sqlite3.Error:
+			pass
+
+def _get_page_key(params):
+	"""Returns the key of a cached page from the name of the page and the given
+	parameter names and values.
+
+	Parameters with a value of None are omitted, so that query parameters that are
+	unknown or missing do not change the key.
+	"""
+	normalized_params = []
+	for name, value in params:
+		if value is None:
+			continue
+		elif isinstance(value, datetime):
+			value = _get_datetime_query_param(value)
+		elif isinstance(value, unicode):
+			value = value.encode('utf-8')
+		normalized_params.append((name, value))
+	return '%s?%s' % (flask.g.page_name, urllib.urlencode(normalized_params))
+
+def _get_match_tags(matches):
+	"""Yields the tag of each match and of each team in the matches."""
+	for match in matches:
+		yield db.get_match_tag(match.match_id)
+		for team in (match.team1, match.team2):
+			if team is not None:
+				yield db.get_team_tag(team.team_id)
+
+def _get_compressed_response(data, mimetype='text/html'):
+	"""Returns the response for the given gzip-compressed page or asset."""
+	if flask.request.accept_encodings['gzip']:
+		response = flask.Response(data, mimetype=mimetype)
+		response.headers['Content-Encoding'] = 'gzip'
+	else:
+		response = flask.Response(page_cache_module.decompress(data), mimetype=mimetype)
+	response.vary.add('Accept-Encoding')
+	return response
+
+def _render_cached_page(params, render):
+	"""Returns the page rendered by the given function, or a cached copy of it.
+
+	The function returns the rendered page and the tags of the entities that it
+	displays. The page must be client-neutral, so that it is the same for all
+	clients with the same time settings, and app.coffee applies the client's name
+	and stars to it. If TIME_NEUTRAL_PAGES is True, then the page is rendered
+	time-neutral, and so is the same for all clients.
+	"""
+	flask.g.time_neutral = app.config['TIME_NEUTRAL_PAGES']
+	if _page_cache is None:
+		body, tags = render()
+		return body
+
+	if flask.g.time_neutral:
+		time_format = None
+		time_zone = None
+	else:
+		# Clients with the default time settings share the pages of clients that are
+		# not logged in.
+		time_format = flask.g.time_format
+		if time_format == db.DEFAULT_SETTINGS_TIME_FORMAT:
+			time_format = None
+		time_zone = flask.g.time_zone.zone if flask.g.time_zone else None
+	key = _get_page_key(
+			tuple(params) + (('time_format', time_format), ('time_zone', time_zone)))
+	try:
+		data = _page_cache.get(key)
+		if data is None:
+			sequence = _page_cache.get_sequence()
+	except sqlite3.Error:
+		# Render the page without the cache.
+		body, tags = render()
+		return body
+
+	if data is None:
+		# Read the primary, because a page rendered from a lagging replica would stay
+		# cached until its entities change again.
+		with common_db.on_primary():
+			body, tags = render()
+		data = page_cache_module.compress(body.encode('utf-8'))
+		try:
+			_page_cache.put(key, data, tags, sequence)
+		except sqlite3.Error:
+			pass
+	return _get_compressed_response(data)
+
+
 def _render_guide(db_getter, template_name):
 	args = flask.request.args
 	prev_time = _get_datetime(args, 'prev_time')
@@ -337,101 +581,173 @@ def _render_guide(db_getter, template_name):
 	calendar = db_getter(flask.g.client_id,
 			prev_time, prev_match_id, next_time, next_match_id)
 	assert calendar is not None
+	_format_match_times(calendar)
 	return flask.render_template(template_name, calendar=calendar)
 
 @app.route('/guide/viewer')
+@common_db.query_budget(5)
 @login_optional
 def viewer_guide():
 	return _render_guide(db.get_displayed_viewer_calendar, 'calendar_viewer.html')
 
 @app.route('/guide/streamer')
+@common_db.query_budget(3)
 @login_required
 def streamer_guide():
 	return _render_guide(db.get_displayed_streamer_calendar, 'calendar_streamer.html')
 
 
-def _render_matches_list(db_getter, template_name):
+def _render_matches_list(db_getter, template_name, list_tag=None):
+	"""Renders a list of matches.
+
+	If list_tag is not None, then the list is of all matches, and is rendered
+	client-neutral so that it can be cached.
+	"""
 	args = flask.request.args
 	prev_time = _get_datetime(args, 'prev_time')
 	prev_match_id = _get_int(args, 'prev_match_id')
 	next_time = _get_datetime(args, 'next_time')
 	next_match_id = _get_int(args, 'next_match_id')
+	client_neutral = list_tag is not None
+	client_id = None if client_neutral else flask.g.client_id
 
-	match_list = db_getter(flask.g.client_id,
-			prev_time, prev_match_id, next_time, next_match_id)
-	assert match_list is not None
-	return flask.render_template(template_name,
-			matches=match_list.matches,
-			prev_time=match_list.prev_time,
-			prev_match_id=match_list.prev_match_id,
-			next_time=match_list.next_time,
-			next_match_id=match_list.next_match_id)
-
-def _render_teams_list(db_getter, template_name):
+	def render():
+		match_list = db_getter(client_id,
+				prev_time, prev_match_id, next_time, next_match_id)
+		assert match_list is not None
+		_format_match_times(match_list)
+		body = flask.render_template(template_name,
+				client_neutral=client_neutral,
+				matches=match_list.matches,
+				prev_time=match_list.prev_time,
+				prev_match_id=match_list.prev_match_id,
+				next_time=match_list.next_time,
+				next_match_id=match_list.next_match_id)
+		tags = [list_tag]
+		tags.extend(_get_match_tags(match_list.matches))
+		return body, tags
+
+	if list_tag is None:
+		return render()[0]
+	return _render_cached_page((
+			('prev_time', prev_time),
+			('prev_match_id', prev_match_id),
+			('next_time', next_time),
+			('next_match_id', next_match_id)), render)
+
+def _render_teams_list(db_getter, template_name, list_tag=None):
+	"""Renders a list of teams.
+
+	If list_tag is not None, then the list is of all teams, and is rendered
+	client-neutral so that it can be cached.
+	"""
 	args = flask.request.args
 	prev_name = args.get('prev_name')
 	prev_team_id = _get_int(args, 'prev_team_id')
 	next_name = args.get('next_name')
 	next_team_id = _get_int(args, 'next_team_id')
-
-	team_list = db_getter(flask.g.client_id,
-			prev_name, prev_team_id, next_name, next_team_id)
-	assert team_list is not None
-	return flask.render_template(template_name,
-			teams=team_list.teams,
-			prev_name=team_list.prev_name,
-			prev_team_id=team_list.prev_team_id,
-			next_name=team_list.next_name,
-			next_team_id=team_list.next_team_id)
-
-def _render_streamers_list(db_getter, template_name):
+	client_neutral = list_tag is not None
+	client_id = None if client_neutral else flask.g.client_id
+
+	def render():
+		team_list = db_getter(client_id,
+				prev_name, prev_team_id, next_name, next_team_id)
+		assert team_list is not None
+		body = flask.render_template(template_name,
+				client_neutral=client_neutral,
+				teams=team_list.teams,
+				prev_name=team_list.prev_name,
+				prev_team_id=team_list.prev_team_id,
+				next_name=team_list.next_name,
+				next_team_id=team_list.next_team_id)
+		tags = [list_tag]
+		tags.extend(db.get_team_tag(team.team_id) for team in team_list.teams)
+		return body, tags
+
+	if list_tag is None:
+		return render()[0]
+	return _render_cached_page((
+			('prev_name', prev_name),
+			('prev_team_id', prev_team_id),
+			('next_name', next_name),
+			('next_team_id', next_team_id)), render)
+
+def _render_streamers_list(db_getter, template_name, list_tag=None):
+	"""Renders a list of streaming users.
+
+	If list_tag is not None, then the list is of all streaming users, and is
+	rendered client-neutral so that it can be cached.
+	"""
 	args = flask.request.args
 	prev_name = args.get('prev_name')
 	prev_streamer_id = _get_int(args, 'prev_streamer_id')
 	next_name = args.get('next_name')
 	next_streamer_id = _get_int(args, 'next_streamer_id')
-
-	streamer_list = db_getter(flask.g.client_id,
-			prev_name, prev_streamer_id, next_name, next_streamer_id)
-	assert streamer_list is not None
-	return flask.render_template(template_name,
-			streamers=streamer_list.streamers,
-			prev_name=streamer_list.prev_name,
-			prev_streamer_id=streamer_list.prev_streamer_id,
-			next_name=streamer_list.next_name,
-			next_streamer_id=streamer_list.next_streamer_id)
+	client_neutral = list_tag is not None
+	client_id = None if client_neutral else flask.g.client_id
+
+	def render():
+		streamer_list = db_getter(client_id,
+				prev_name, prev_streamer_id, next_name, next_streamer_id)
+		assert streamer_list is not None
+		body = flask.render_template(template_name,
+				client_neutral=client_neutral,
+				streamers=streamer_list.streamers,
+				prev_name=streamer_list.prev_name,
+				prev_streamer_id=streamer_list.prev_streamer_id,
+				next_name=streamer_list.next_name,
+				next_streamer_id=streamer_list.next_streamer_id)
+		tags = [list_tag]
+		tags.extend(db.get_streamer_tag(streamer.streamer_id)
+				for streamer in streamer_list.streamers)
+		return body, tags
+
+	if list_tag is None:
+		return render()[0]
+	return _render_cached_page((
+			('prev_name', prev_name),
+			('prev_streamer_id', prev_streamer_id),
+			('next_name', next_name),
+			('next_streamer_id', next_streamer_id)), render)
 
 
 @app.route('/starred/matches')
+@common_db.query_budget(2)
 @login_optional
 def starred_matches():
 	return _render_matches_list(db.get_starred_matches, 'matches_starred.html')
 
 @app.route('/starred/teams')
+@common_db.query_budget(1)
 @login_optional
 def starred_teams():
 	return _render_teams_list(db.get_starred_teams, 'teams_starred.html')
 
 @app.route('/starred/streamers')
+@common_db.query_budget(1)
 @login_optional
 def starred_streamers():
 	return _render_streamers_list(db.get_starred_streamers, 'streamers_starred.html')
 
 
 @app.route('/matches')
+@common_db.query_budget(3)
 @login_optional
 def all_matches():
-	return _render_matches_list(db.get_all_matches, 'matches_all.html')
+	return _render_matches_list(db.get_all_matches, 'matches_all.html', db.MATCH_LIST_TAG)
 
 @app.route('/teams')
+@common_db.query_budget(2)
 @login_optional
 def all_teams():
-	return _render_teams_list(db.get_all_teams, 'teams_all.html')
+	return _render_teams_list(db.get_all_teams, 'teams_all.html', db.TEAM_LIST_TAG)
 
 @app.route('/streamers')
+@common_db.query_budget(2)
 @login_optional
 def all_streamers():
-	return _render_streamers_list(db.get_all_streamers, 'streamers_all.html')
+	return _render_streamers_list(db.get_all_streamers, 'streamers_all.html',
+			db.STREAMER_LIST_TAG)
 
 
 def _get_id(url_part):
@@ -441,6 +757,7 @@ def _get_id(url_part):
 _MATCH_DETAILS_ROUTE = '/matches/<match_id>'
 
 @app.route(_MATCH_DETAILS_ROUTE)
+@common_db.query_budget(4)
 @login_optional
 def match_details(match_id):
 	try:
@@ -451,9 +768,22 @@ def match_details(match_id):
 		next_time = _get_datetime(args, 'next_time')
 		next_streamer_id = _get_int(args, 'next_streamer_id')
 
-		match = db.get_displayed_match(flask.g.client_id, match_id,
-				prev_time, prev_streamer_id, next_time, next_streamer_id)
-		return flask.render_template('match.html', match=match)
+		def render():
+			match = db.get_displayed_match(None, match_id,
+					prev_time, prev_streamer_id, next_time, next_streamer_id)
+			_format_match_times(match)
+			tags = list(_get_match_tags((match,)))
+			tags.extend(db.get_streamer_tag(streamer.streamer_id)
+					for streamer in match.streamers)
+			body = flask.render_template('match.html', client_neutral=True, match=match)
+			return body, tags
+
+		return _render_cached_page((
+				('match_id', match_id),
+				('prev_time', prev_time),
+				('prev_streamer_id', prev_streamer_id),
+				('next_time', next_time),
+				('next_streamer_id', next_streamer_id)), render)
 	except ValueError:
 		# Raised if any value is not the expected type.
 		flask.abort(requests.codes.not_found)
@@ -461,6 +791,7 @@ def match_details(match_id):
 		flask.abort(requests.codes.not_found)
 
 @app.route(_MATCH_DETAILS_ROUTE, methods=['POST'])
+@common_db.query_budget(7)
 @login_required
 def update_match_details(match_id):
 	match_id = _get_id(match_id)
@@ -476,6 +807,7 @@ def update_match_details(match_id):
 _TEAM_DETAILS_ROUTE = '/teams/<team_id>'
 
 @app.route(_TEAM_DETAILS_ROUTE)
+@common_db.query_budget(3)
 @login_optional
 def team_details(team_id):
 	try:
@@ -486,9 +818,21 @@ def team_details(team_id):
 		next_time = _get_datetime(args, 'next_time')
 		next_match_id = _get_int(args, 'next_match_id')
 
-		team = db.get_displayed_team(flask.g.client_id, team_id,
-				prev_time, prev_match_id, next_time, next_match_id)
-		return flask.render_template('team.html', team=team)
+		def render():
+			team = db.get_displayed_team(None, team_id,
+					prev_time, prev_match_id, next_time, next_match_id)
+			_format_match_times(team)
+			tags = [db.get_team_tag(team_id)]
+			tags.extend(_get_match_tags(team.matches))
+			body = flask.render_template('team.html', client_neutral=True, team=team)
+			return body, tags
+
+		return _render_cached_page((
+				('team_id', team_id),
+				('prev_time', prev_time),
+				('prev_match_id', prev_match_id),
+				('next_time', next_time),
+				('next_match_id', next_match_id)), render)
 	except ValueError:
 		# Raised if any value is not the expected type.
 		flask.abort(requests.codes.not_found)
@@ -496,6 +840,7 @@ def team_details(team_id):
 		flask.abort(requests.codes.not_found)
 
 @app.route(_TEAM_DETAILS_ROUTE, methods=['POST'])
+@common_db.query_budget(7)
 @login_required
 def update_team_details(team_id):
 	team_id = _get_id(team_id)
@@ -508,7 +853,33 @@ def update_team_details(team_id):
 		return flask.jsonify(starred=starred)
 	flask.abort(requests.codes.server_error)
 
+@app.route('/viewer')
+@common_db.query_budget(3)
+@login_optional
+def viewer():
+	"""Returns the client's name, starred identifiers, and time settings, which
+	app.coffee and times.coffee apply to client-neutral pages.
+	"""
+	if not flask.g.logged_in:
+		response = flask.jsonify(logged_in=False)
+	else:
+		starred_ids = db.get_starred_ids(flask.g.client_id)
+		response = flask.jsonify(
+				logged_in=True,
+				name=flask.g.client_name,
+				auth=flask.g.client_auth,
+				time_format=flask.g.time_format,
+				time_zone=flask.g.time_zone.zone if flask.g.time_zone else None,
+				starred={
+					'match': starred_ids.match_ids,
+					'team': starred_ids.team_ids,
+					'streamer': starred_ids.streamer_ids,
+				})
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response
+
 @app.route('/users/twitch/<name>')
+@common_db.query_budget(3)
 @login_optional
 def twitch_user_by_name(name):
 	try:
@@ -529,6 +900,7 @@ def twitch_user_by_name(name):
 		flask.abort(requests.codes.not_found)
 
 @app.route('/users/twitch_id/<twitch_id>')
+@common_db.query_budget(3)
 @login_optional
 def twitch_user_by_id(twitch_id):
 	try:
@@ -550,6 +922,7 @@ def twitch_user_by_id(twitch_id):
 		flask.abort(requests.codes.not_found)
 
 @app.route('/users/id/<streamer_id>', methods=['POST'])
+@common_db.query_budget(7)
 @login_required
 def update_streamer(streamer_id):
 	starred = flask.request.form.get('starred', None)
@@ -809,22 +1182,69 @@ def _get_displayed_offset(offset_minutes):
 		return 'UTC'
 	return '%s%02d:%02d' % (offset_prefix, offset_minutes / 60, offset_minutes % 60)
 
-def _get_displayed_offset_map(now, offset_minutes_set):
-	"""Given all UTC offsets, returns a map from each offset to a tuple containing
-	the displayed offset, the current time in 12-hour format after applying the
-	offset, and the current time in 24-hour format after applying the offset.
+def _get_time_zone_tables(now):
+	"""Returns the tables that settings.coffee uses to choose a time zone at the
+	given time.
+
+	The countries table maps each country code to the name, time zone, and UTC
+	offset in minutes of each of its time zones. The offsets table maps each UTC
+	offset in minutes to its displayed offset. The client computes its own current
+	time for each offset.
+	"""
+	country_offset_minutes_map, offset_minutes_set = _get_offset_minutes_map(now)
+	displayed_offset_map = dict((offset_minutes, _get_displayed_offset(offset_minutes))
+			for offset_minutes in offset_minutes_set)
+	return {
+		'countries': country_offset_minutes_map,
+		'offsets': displayed_offset_map,
+	}
+
+"""The time zone tables as a JSON asset, identified by a version that is the hash
+of its contents.
+"""
+class _TimeZonesAsset:
+	def __init__(self, hour, data):
+		self.hour = hour
+		self.data = data
+		self.compressed_data = page_cache_module.compress(data)
+		self.version = hashlib.sha1(data).hexdigest()[:_TIME_ZONES_VERSION_LENGTH]
+
+_TIME_ZONES_VERSION_LENGTH = 12
+_time_zones_asset = None
+
+def _get_time_zones_asset(now=None):
+	"""Returns the _TimeZonesAsset for the current hour.
+
+	Offsets change only at the daylight saving time transitions, so the tables are
+	computed at most once an hour by each worker. They are computed for the start
+	of the hour, and so all workers compute the same version, and it changes only
+	when an offset changes.
 	"""
+	global _time_zones_asset
+	if now is None:
+		now = datetime.utcnow()
+	hour = now.replace(minute=0, second=0, microsecond=0)
+	if (_time_zones_asset is None) or (_time_zones_asset.hour != hour):
+		data = json.dumps(_get_time_zone_tables(hour),
+				sort_keys=True, separators=(',', ':'))
+		if (_time_zones_asset is None) or (_time_zones_asset.data != data):
+			_time_zones_asset = _TimeZonesAsset(hour, data)
+		else:
+			_time_zones_asset.hour = hour
+	return _time_zones_asset
 
-	displayed_offset_map = {}
-	for offset_minutes in sorted(offset_minutes_set):
-		displayed_offset = _get_displayed_offset(offset_minutes)
-		now_offset = now + timedelta(minutes=offset_minutes)
+# The seconds that a client can cache a version of the time zone tables.
+_TIME_ZONES_MAX_AGE = 365 * 24 * 60 * 60
 
-		displayed_offset_map[offset_minutes] = (
-				displayed_offset, 
-				now_offset.strftime(_DATETIME_FORMAT_12_HOUR_LOCALIZED),
-				now_offset.strftime(_DATETIME_FORMAT_24_HOUR_LOCALIZED))
-	return displayed_offset_map
+@app.route('/time-zones/<version>.json')
+def time_zones(version):
+	asset = _get_time_zones_asset()
+	if version != asset.version:
+		# An offset changed since the settings page was rendered.
+		return flask.redirect(flask.url_for('time_zones', version=asset.version))
+	response = _get_compressed_response(asset.compressed_data, 'application/json')
+	response.headers['Cache-Control'] = 'public, max-age=%s' % _TIME_ZONES_MAX_AGE
+	return response
 
 
 _SETTINGS_ROUTE = '/settings'
@@ -833,10 +1253,9 @@ def _render_settings(
 		selected_time_format, selected_country_code, selected_time_zone,
 		errors={}, saved=None):
 	now = datetime.utcnow()
-	datetime_12_hour = now.strftime(_DATETIME_FORMAT_12_HOUR_UTC)
-	datetime_24_hour = now.strftime(_DATETIME_FORMAT_24_HOUR_UTC)
-	country_offset_minutes_map, offset_minutes_set = _get_offset_minutes_map(now)
-	displayed_offset_map = _get_displayed_offset_map(now, offset_minutes_set)
+	datetime_12_hour = now.strftime(datetime_format.FORMAT_12_HOUR_UTC)
+	datetime_24_hour = now.strftime(datetime_format.FORMAT_24_HOUR_UTC)
+	time_zones_version = _get_time_zones_asset(now).version
 
 	return flask.render_template('settings.html',
 			# The current user settings.
@@ -849,12 +1268,12 @@ def _render_settings(
 			# Data for changing the time zone.
 			server_time_12_hour=datetime_12_hour,
 			server_time_24_hour=datetime_24_hour,
-			country_offset_minutes_map=json.dumps(country_offset_minutes_map),
-			displayed_offset_map=json.dumps(displayed_offset_map),
+			time_zones_url=flask.url_for('time_zones', version=time_zones_version),
 			errors=errors,
 			saved=saved)
 
 @app.route(_SETTINGS_ROUTE)
+@common_db.query_budget(1)
 @login_required
 def get_settings():
 	settings = db.get_settings(flask.g.client_id)
@@ -866,6 +1285,7 @@ _COUNTRY_ERROR = 'country'
 _TIME_ZONE_ERROR = 'time_zone'
 
 @app.route(_SETTINGS_ROUTE, methods=['POST'])
+@common_db.query_budget(2)
 @login_required
 def save_settings():
 	errors = defaultdict(list)
@@ -919,21 +1339,58 @@ def save_settings():
 
 
 @app.route('/privacy')
+@common_db.query_budget(0)
 @login_optional
 def privacy():
 	return flask.render_template('privacy.html')
 
 @app.route('/terms')
+@common_db.query_budget(0)
 @login_optional
 def terms():
 	return flask.render_template('terms.html')
 
 @app.route('/about')
+@common_db.query_budget(0)
 @login_optional
 def about():
 	return flask.render_template('about.html')
 
 
+# The addresses of clients that can request internal statistics.
+_INTERNAL_ADDRS = frozenset(('127.0.0.1', '::1'))
+
+@app.route('/internal/page_cache')
+def page_cache_stats():
+	if flask.request.remote_addr not in _INTERNAL_ADDRS:
+		flask.abort(requests.codes.not_found)
+	stats = get_page_cache_stats()
+	if stats is None:
+		flask.abort(requests.codes.not_found)
+	return flask.jsonify(**stats.to_dict())
+
+@app.route('/internal/query_stats')
+def query_stats():
+	if flask.request.remote_addr not in _INTERNAL_ADDRS:
+		flask.abort(requests.codes.not_found)
+	stats = get_query_stats()
+	if stats is None:
+		flask.abort(requests.codes.not_found)
+	return flask.jsonify(routes=dict(
+			(route, route_stats.to_dict()) for route, route_stats in stats.iteritems()))
+
+@app.route('/internal/db_engines')
+def db_engine_stats():
+	"""Returns the statistics of the connection pool of each engine of this worker,
+	the routing of reads to each replica, and the statements of the getters that
+	are cached and prepared.
+	"""
+	if flask.request.remote_addr not in _INTERNAL_ADDRS:
+		flask.abort(requests.codes.not_found)
+	return flask.jsonify(engines=common_db.get_engine_stats(),
+			statements=db.get_statement_stats())
+
+
 @app.errorhandler(requests.codes.unauthorized)
 def unauthorized(e):
 	response = 'unauthorized'
@@ -954,6 +1411,28 @@ def internal_server_error(e):
 	return flask.render_template('error_500.html'), 500
 
 
+# The name of a cookie that is set while the client is logged in. Unlike the
+# session cookie, app.coffee can read it, and so only requests the viewer if set.
+_LOGGED_IN_COOKIE = 'logged_in'
+
+def _set_logged_in_cookie(response):
+	response.set_cookie(_LOGGED_IN_COOKIE, '1',
+			max_age=int(app.permanent_session_lifetime.total_seconds()))
+
+@app.after_request
+def update_logged_in_cookie(response):
+	"""Sets the logged_in cookie if the client is logged in but does not have it,
+	such as for a session created before the cookie existed, and deletes it if the
+	client is no longer logged in.
+	"""
+	logged_in = getattr(flask.g, 'logged_in', None)
+	has_cookie = _LOGGED_IN_COOKIE in flask.request.cookies
+	if logged_in and not has_cookie:
+		_set_logged_in_cookie(response)
+	elif (logged_in is False) and has_cookie:
+		response.delete_cookie(_LOGGED_IN_COOKIE)
+	return response
+
 def _finish_login(client_id, client_name, auth, new_user):
 	settings = db.get_settings(client_id)
 	client = {
@@ -970,13 +1449,15 @@ def _finish_login(client_id, client_name, auth, new_user):
 
 	# If a new user, redirect to the settings page.
 	if new_user:
-		return flask.redirect(flask.url_for('get_settings'))
-
-	# Redirect to the URL that the user came from.
-	next_url = flask.session.pop('next_url', None)
-	if next_url is None:
-		next_url = flask.url_for('home')
-	return flask.redirect(next_url)
+		response = flask.redirect(flask.url_for('get_settings'))
+	else:
+		# Redirect to the URL that the user came from.
+		next_url = flask.session.pop('next_url', None)
+		if next_url is None:
+			next_url = flask.url_for('home')
+		response = flask.redirect(next_url)
+	_set_logged_in_cookie(response)
+	return response
 
 
 _STEAM_OPEN_ID_URL = 'http://steamcommunity.com/openid'
@@ -1103,5 +1584,7 @@ def logout():
 	next_url = flask.request.args.get('next_url')
 	if next_url is None:
 		next_url = flask.url_for('home')
-	return flask.redirect(next_url)
+	response = flask.redirect(next_url)
+	response.delete_cookie(_LOGGED_IN_COOKIE)
+	return response
 
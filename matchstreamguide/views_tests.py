@@ -1,8 +1,18 @@
+import common_db
 from datetime import datetime, timedelta
+import datetime_format
 import db
+from db_test_case import DbTestCase
 import flask
+import json
+import os
+import page_cache as page_cache_module
 import pytz
+import query_stats as query_stats_module
 import regex as re
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import views
 
@@ -123,6 +133,98 @@ class ViewsTestCase(unittest.TestCase):
 			flask.g.time_format = '12_hour'
 			self.assertEqual('Sat Jan 05 10:30PM UTC', views._get_readable_datetime(self.now))
 
+	def test_format_match_times(self):
+		later = self.now + timedelta(hours=1)
+		next_match = self._get_displayed_match_details(time=self.now)
+		matches = [self._get_displayed_match_details(time=dt)
+				for dt in (self.now, later, later)]
+		calendar = db.DisplayedCalendar(next_match, matches)
+		with app.test_request_context('/'):
+			flask.g.time_zone = datetime_format.get_time_zone('America/Los_Angeles')
+			flask.g.time_format = '24_hour'
+			views._format_match_times(calendar)
+			# Assert that each distinct time was formatted once.
+			formatter = flask.g.datetime_formatter
+			self.assertEqual(2, len(formatter._memo))
+			self.assertEqual('Sat Jan 05 15:30', views._get_readable_datetime(later))
+			self.assertEqual(2, len(formatter._memo))
+			# Assert that a different time format is memoized separately.
+			flask.g.time_format = '12_hour'
+			self.assertEqual('Sat Jan 05 03:30PM', views._get_readable_datetime(later))
+			self.assertEqual(3, len(formatter._memo))
+
+		# Assert that the memo is discarded with the request.
+		with app.test_request_context('/'):
+			self.assertIsNone(getattr(flask.g, 'datetime_formatter', None))
+
+	def test_get_time_zone(self):
+		time_zone = datetime_format.get_time_zone('America/Los_Angeles')
+		self.assertEqual('America/Los_Angeles', time_zone.zone)
+		self.assertIs(time_zone, datetime_format.get_time_zone('America/Los_Angeles'))
+		self.assertRaises(pytz.UnknownTimeZoneError,
+				datetime_format.get_time_zone, 'America/Nowhere')
+		# Assert that the least recently used time zones are evicted.
+		names = pytz.common_timezones[:datetime_format._TIME_ZONES_MAX_SIZE + 1]
+		for name in names:
+			datetime_format.get_time_zone(name)
+		self.assertEqual(
+				datetime_format._TIME_ZONES_MAX_SIZE, len(datetime_format._time_zones))
+		self.assertNotIn(names[0], datetime_format._time_zones)
+		self.assertIn(names[-1], datetime_format._time_zones)
+
+	def test_render_time_neutral(self):
+		with app.test_request_context('/'):
+			flask.g.time_zone = pytz.timezone('America/Los_Angeles')
+			flask.g.time_format = '12_hour'
+			# Assert that a page that is not time-neutral displays times for the client.
+			self.assertEqual('Sat Jan 05 02:30PM', views._render_readable_datetime(self.now))
+			self.assertEqual('Starting in 1 minute', views._render_readable_timedelta(
+					self.now + timedelta(minutes=1), capitalize=True, now=self.now))
+
+			# Assert that a time-neutral page displays times in UTC.
+			flask.g.time_neutral = True
+			self.assertEqual(
+					'<time class="readable-datetime" datetime="2013-01-05T22:30:00Z">'
+						'Sat Jan 05 22:30 UTC</time>',
+					views._render_readable_datetime(self.now))
+			self.assertEqual(
+					'<time class="readable-timedelta" datetime="2013-01-05T22:31:00Z" '
+						'data-capitalize="true">Starting in 1 minute</time>',
+					views._render_readable_timedelta(
+						self.now + timedelta(minutes=1), capitalize=True, now=self.now))
+
+	def test_time_zones_asset(self):
+		views._time_zones_asset = None
+		now = datetime(2013, 1, 15, 10, 30)
+		asset = views._get_time_zones_asset(now)
+		tables = json.loads(asset.data)
+		los_angeles = [element for element in tables['countries']['US']
+				if element[1] == 'America/Los_Angeles']
+		self.assertEqual([[u'Pacific Time', u'America/Los_Angeles', -8 * 60]], los_angeles)
+		self.assertEqual('UTC-08:00', tables['offsets'][str(-8 * 60)])
+
+		# Assert that the asset is not computed again within the hour, and that its
+		# version does not change until an offset changes.
+		self.assertIs(asset, views._get_time_zones_asset(now + timedelta(minutes=29)))
+		self.assertEqual(asset.version,
+				views._get_time_zones_asset(now + timedelta(hours=1)).version)
+		# Daylight saving time begins at 2013-03-10 02:00 in Los Angeles.
+		before_dst = views._get_time_zones_asset(datetime(2013, 3, 10, 0, 30)).version
+		after_dst = views._get_time_zones_asset(datetime(2013, 3, 10, 3, 30)).version
+		self.assertNotEqual(before_dst, after_dst)
+
+		with app.test_request_context('/'):
+			views._time_zones_asset = None
+			version = views._get_time_zones_asset().version
+			response = views.time_zones(version)
+			self.assertEqual(200, response.status_code)
+			self.assertIn('max-age=', response.headers['Cache-Control'])
+			self.assertEqual(views._time_zones_asset.data, response.data)
+			# Assert that a stale version redirects to the current version.
+			response = views.time_zones('stale')
+			self.assertEqual(302, response.status_code)
+			self.assertTrue(response.headers['Location'].endswith('/%s.json' % version))
+
 	def _assert_time_between(self,
 			now, expected_days, expected_hours, expected_minutes):
 		td = timedelta(days=expected_days, hours=expected_hours, minutes=expected_minutes)
@@ -235,3 +337,549 @@ class ViewsTestCase(unittest.TestCase):
 		expected_indexed_name = 'a__b__c__d_e_f_012'
 		self.assertEqual(expected_indexed_name, views._get_indexed_name(displayed_name))
 
+
+
+class PageCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		unittest.TestCase.setUp(self)
+
+		self.temp_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.temp_dir, 'pages.db')
+		self.max_age = 60
+		self.page_cache = page_cache_module.PageCache(self.path, self.max_age)
+		self.now = 1000.0
+
+	def tearDown(self):
+		views.set_page_cache(None)
+		shutil.rmtree(self.temp_dir)
+		unittest.TestCase.tearDown(self)
+
+	def _put(self, key, body, tags, page_cache=None):
+		"""Caches the compressed page with the given tags at the current time."""
+		page_cache = page_cache or self.page_cache
+		sequence = page_cache.get_sequence()
+		return page_cache.put(key, page_cache_module.compress(body), tags, sequence,
+				now=self.now)
+
+	def _get(self, key, page_cache=None):
+		"""Returns the decompressed page, or None if not cached."""
+		page_cache = page_cache or self.page_cache
+		data = page_cache.get(key, now=self.now)
+		return None if data is None else page_cache_module.decompress(data)
+
+	def test_compress(self):
+		body = 'body ' * 100
+		data = page_cache_module.compress(body)
+		self.assertLess(len(data), len(body))
+		self.assertEqual(body, page_cache_module.decompress(data))
+
+	def test_get_put(self):
+		self.assertIsNone(self._get('key1'))
+		self.assertTrue(self._put('key1', 'body1', ('tag1',)))
+		self.assertEqual('body1', self._get('key1'))
+		self.assertIsNone(self._get('key2'))
+
+		# Assert that the hits and misses are counted.
+		stats = self.page_cache.get_stats()
+		self.assertEqual(1, stats.hits)
+		self.assertEqual(2, stats.misses)
+		self.assertEqual(1, stats.num_entries)
+
+	def test_max_age(self):
+		self._put('key1', 'body1', ('tag1',))
+		self.now += self.max_age - 1
+		self.assertEqual('body1', self._get('key1'))
+		self.now += 1
+		self.assertIsNone(self._get('key1'))
+
+		# Assert that putting another page removes the expired page.
+		self._put('key2', 'body2', ('tag1',))
+		self.assertEqual(1, self.page_cache.get_stats().num_entries)
+
+	def test_invalidate(self):
+		self._put('key1', 'body1', ('tag1', 'tag2'))
+		self._put('key2', 'body2', ('tag2', 'tag3'))
+		self._put('key3', 'body3', ('tag3',))
+
+		self.page_cache.invalidate(('tag1', 'tag4'))
+		self.assertIsNone(self._get('key1'))
+		self.assertEqual('body2', self._get('key2'))
+		self.assertEqual('body3', self._get('key3'))
+
+		self.page_cache.invalidate(('tag3',))
+		self.assertIsNone(self._get('key2'))
+		self.assertIsNone(self._get('key3'))
+		self.assertEqual(3, self.page_cache.get_stats().invalidated)
+
+	def test_invalidate_before_put(self):
+		# Assert that a page rendered before an invalidation of its tag is not cached.
+		sequence = self.page_cache.get_sequence()
+		self.page_cache.invalidate(('tag1',))
+		data = page_cache_module.compress('body1')
+		self.assertFalse(self.page_cache.put('key1', data, ('tag1',), sequence, now=self.now))
+		self.assertIsNone(self._get('key1'))
+
+		# Assert that an invalidation of another tag does not prevent caching.
+		self.assertTrue(self.page_cache.put('key1', data, ('tag2',), sequence, now=self.now))
+		self.assertEqual('body1', self._get('key1'))
+
+	def test_clear_before_put(self):
+		self._put('key1', 'body1', ('tag1',))
+		self.page_cache.invalidate(('tag1',))
+		sequence = self.page_cache.get_sequence()
+		self.page_cache.clear()
+		self.assertEqual(0, self.page_cache.get_stats().num_entries)
+		# Assert that clearing does not restart the sequence of invalidations.
+		self.assertGreater(self.page_cache.get_sequence(), sequence)
+
+		# Assert that a page rendered before clearing is not cached.
+		data = page_cache_module.compress('body2')
+		self.assertFalse(self.page_cache.put('key2', data, ('tag2',), sequence, now=self.now))
+		self.assertIsNone(self._get('key2'))
+		self.assertTrue(self._put('key2', 'body2', ('tag2',)))
+		self.assertEqual('body2', self._get('key2'))
+
+	def test_shared(self):
+		# Assert that pages and invalidations are shared by all caches of the file.
+		other_page_cache = page_cache_module.PageCache(self.path, self.max_age)
+		self._put('key1', 'body1', ('tag1',))
+		self.assertEqual('body1', self._get('key1', other_page_cache))
+		other_page_cache.invalidate(('tag1',))
+		self.assertIsNone(self._get('key1'))
+
+		# Assert that the statistics are aggregated across all caches after flushing.
+		self.page_cache.flush_stats()
+		stats = other_page_cache.get_stats()
+		self.assertEqual(1, stats.hits)
+		self.assertEqual(1, stats.misses)
+
+	def test_render_cached_page(self):
+		views.set_page_cache(self.page_cache)
+		num_renders = [0]
+		def render():
+			num_renders[0] += 1
+			return u'body\xe9', (db.get_match_tag(1),)
+
+		def render_cached_page(logged_in, match_id, accept_encoding=None, time_zone=None):
+			headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+			with app.test_request_context('/', headers=headers):
+				flask.g.logged_in = logged_in
+				flask.g.time_format = db.DEFAULT_SETTINGS_TIME_FORMAT
+				flask.g.time_zone = pytz.timezone(time_zone) if time_zone else None
+				flask.g.page_name = 'match_details'
+				return views._render_cached_page((('match_id', match_id),), render)
+
+		# Assert that clients with the default time settings share the cached page.
+		response = render_cached_page(True, 1)
+		self.assertEqual(u'body\xe9'.encode('utf-8'), response.data)
+		response = render_cached_page(False, 1)
+		self.assertEqual(u'body\xe9'.encode('utf-8'), response.data)
+		response = render_cached_page(False, 1, 'gzip, deflate')
+		self.assertEqual('gzip', response.headers['Content-Encoding'])
+		self.assertEqual(u'body\xe9'.encode('utf-8'),
+				page_cache_module.decompress(response.data))
+		self.assertEqual(1, num_renders[0])
+		# Assert that a page for a client with a time zone is cached separately.
+		render_cached_page(True, 1, time_zone='US/Pacific')
+		render_cached_page(True, 1, time_zone='US/Pacific')
+		self.assertEqual(2, num_renders[0])
+
+		# Assert that changing the match invalidates the page.
+		views._invalidate_pages((common_db.ChangeEvent(1, db.MATCH_CHANGE_TYPE, 1),))
+		render_cached_page(False, 1)
+		self.assertEqual(3, num_renders[0])
+		# Assert that a page with other parameters is cached separately.
+		render_cached_page(False, 2)
+		self.assertEqual(4, num_renders[0])
+		# Assert that the greatest version of the invalidating changes is stored.
+		self.assertEqual(1, self.page_cache.get_change_version())
+		views._invalidate_pages((common_db.ChangeEvent(3, db.MATCH_CHANGE_TYPE, 1),
+				common_db.ChangeEvent(2, db.TEAM_CHANGE_TYPE, 1)))
+		self.assertEqual(3, self.page_cache.get_change_version())
+		# Assert that changes already invalidated by another worker are skipped.
+		render_cached_page(False, 1)
+		views._invalidate_pages((common_db.ChangeEvent(3, db.MATCH_CHANGE_TYPE, 1),))
+		render_cached_page(False, 1)
+		self.assertEqual(5, num_renders[0])
+		# Assert that the stored version precedes a missing version, so that the
+		# change with the missing version is invalidated when it is read.
+		db.change_bus._gap_times[5] = self.now
+		try:
+			views._invalidate_pages((common_db.ChangeEvent(6, db.TEAM_CHANGE_TYPE, 1),))
+		finally:
+			del db.change_bus._gap_times[5]
+		self.assertEqual(4, self.page_cache.get_change_version())
+		views._invalidate_pages((common_db.ChangeEvent(5, db.MATCH_CHANGE_TYPE, 1),))
+		render_cached_page(False, 1)
+		self.assertEqual(6, num_renders[0])
+		views._invalidate_pages(None)
+		self.assertEqual(0, self.page_cache.get_stats().num_entries)
+
+		# Assert that time-neutral pages are shared by clients in all time zones.
+		app.config['TIME_NEUTRAL_PAGES'] = True
+		try:
+			render_cached_page(True, 1, time_zone='US/Pacific')
+			render_cached_page(False, 1)
+			self.assertEqual(7, num_renders[0])
+		finally:
+			app.config['TIME_NEUTRAL_PAGES'] = False
+
+
+	def test_unavailable(self):
+		# Assert that a cache whose file cannot be opened does not fail setting it.
+		unavailable_cache = page_cache_module.PageCache(
+				os.path.join(self.temp_dir, 'missing', 'pages.db'), self.max_age)
+		views.set_page_cache(unavailable_cache)
+		self.assertTrue(views._must_clear_pages)
+		# Assert that invalidating its pages does not fail.
+		views._invalidate_pages((common_db.ChangeEvent(1, db.MATCH_CHANGE_TYPE, 1),))
+		self.assertTrue(views._must_clear_pages)
+
+		# Assert that the pages are cleared when the cache can be written again.
+		self._put('key1', 'body1', ('tag1',))
+		views.set_page_cache(self.page_cache)
+		views._must_clear_pages = True
+		views._invalidate_pages((common_db.ChangeEvent(2, db.MATCH_CHANGE_TYPE, 1),))
+		self.assertFalse(views._must_clear_pages)
+		self.assertEqual(0, self.page_cache.get_stats().num_entries)
+
+
+"""Tests for caching pages while the getters read a replica in a SQLite file.
+
+The replica does not replicate the primary, so that a page shows which database
+it was rendered from.
+"""
+class ReplicaPageCacheTestCase(DbTestCase):
+	def setUp(self):
+		DbTestCase.setUp(self)
+		self.temp_dir = tempfile.mkdtemp()
+		self.page_cache = page_cache_module.PageCache(
+				os.path.join(self.temp_dir, 'pages.db'), 60)
+		common_db.set_read_replicas(
+				['sqlite:///%s' % os.path.join(self.temp_dir, 'replica.db')],
+				max_lag_seconds=5.0, lag_check_interval=0.0)
+		(replica_name, replica_engine), = common_db._replica_set.get_engines()
+		common_db._Base.metadata.create_all(replica_engine)
+		common_db._replica_set._get_lag = lambda engine: 0.0
+		self.team_id = db.add_team('team_name', 'team_indexed_name', 'game', 'division',
+				'team_fingerprint')
+
+	def tearDown(self):
+		views.set_page_cache(None)
+		common_db.set_read_replicas(())
+		common_db.begin_routing()
+		shutil.rmtree(self.temp_dir)
+		DbTestCase.tearDown(self)
+
+	def _render_cached_page(self):
+		def render():
+			team_ids = [team.team_id for team in db.get_all_teams(None).teams]
+			return unicode(team_ids), (db.TEAM_LIST_TAG,)
+
+		with app.test_request_context('/teams'):
+			flask.g.logged_in = False
+			flask.g.time_format = None
+			flask.g.time_zone = None
+			flask.g.page_name = 'teams'
+			db.begin_request()
+			return views._render_cached_page((), render).data
+
+	def test_render_from_primary(self):
+		# Assert that the getter reads the replica, which does not have the team.
+		db.begin_request()
+		self.assertSequenceEqual((), db.get_all_teams(None).teams)
+
+		# Assert that a page that is cached is rendered from the primary.
+		views.set_page_cache(self.page_cache)
+		self.assertEqual(str([self.team_id]), self._render_cached_page())
+		self.assertEqual(str([self.team_id]), self._render_cached_page())
+		self.assertEqual(1, self.page_cache.get_stats().hits)
+
+
+"""Tests for the statements of requests aggregated for each route.
+"""
+class QueryStatsTestCase(unittest.TestCase):
+	def setUp(self):
+		unittest.TestCase.setUp(self)
+
+		self.temp_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.temp_dir, 'query_stats.db')
+		self.query_stats = query_stats_module.QueryStats(self.path)
+
+	def tearDown(self):
+		views.set_query_stats(None)
+		shutil.rmtree(self.temp_dir)
+		unittest.TestCase.tearDown(self)
+
+	def _get_query_log(self, num_statements, millis):
+		query_log = common_db.QueryLog()
+		for i in xrange(num_statements):
+			query_log.add('SELECT %s' % i, millis / (1000.0 * num_statements))
+		return query_log
+
+	def test_histograms(self):
+		self.query_stats.add('/guide/viewer', self._get_query_log(3, 4.0))
+		self.query_stats.add('/guide/viewer', self._get_query_log(3, 30.0))
+		# Assert that the requests of another process are aggregated.
+		other_query_stats = query_stats_module.QueryStats(self.path)
+		other_query_stats.add('/guide/viewer', self._get_query_log(100, 2000.0))
+		other_query_stats.add('/teams', self._get_query_log(1, 1.0))
+		other_query_stats.flush()
+
+		stats = self.query_stats.get_stats()
+		self.assertItemsEqual(['/guide/viewer', '/teams'], stats.keys())
+		guide_stats = stats['/guide/viewer']
+		self.assertEqual(3, guide_stats.requests)
+		self.assertEqual(106, guide_stats.statements)
+		self.assertAlmostEqual(2034.0, guide_stats.db_millis)
+		# Two requests have at most 4 statements, and one has more than 64.
+		self.assertEqual([0, 0, 0, 2, 0, 0, 0, 0, 1], guide_stats.histograms['statements'])
+		# Assert that the requests are in the buckets of 5, 50, and over 1000 millis.
+		self.assertEqual([0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 1], guide_stats.histograms['db_millis'])
+		statements_buckets = guide_stats.to_dict()['histograms']['statements']
+		self.assertEqual({'le': 4, 'requests': 2}, statements_buckets[3])
+		self.assertEqual({'le': None, 'requests': 1}, statements_buckets[-1])
+
+		self.query_stats.clear()
+		self.assertEqual({}, self.query_stats.get_stats())
+
+	def test_flush_interval(self):
+		other_query_stats = query_stats_module.QueryStats(self.path)
+		other_query_stats.flush_interval = 2
+		other_query_stats.add('/teams', self._get_query_log(1, 1.0))
+		self.assertEqual({}, self.query_stats.get_stats())
+		# Assert that the requests are flushed after the interval.
+		other_query_stats.add('/teams', self._get_query_log(2, 1.0))
+		stats = self.query_stats.get_stats()
+		self.assertEqual(2, stats['/teams'].requests)
+		self.assertEqual(3, stats['/teams'].statements)
+
+	def test_flush_failure(self):
+		self.query_stats.add('/teams', self._get_query_log(1, 1.0))
+		# Assert that the counts are kept if they cannot be written.
+		def write_counts(connection, route_counts):
+			raise sqlite3.OperationalError('database is locked')
+		self.query_stats._write_counts = write_counts
+		self.assertRaises(sqlite3.OperationalError, self.query_stats.flush)
+		del self.query_stats._write_counts
+		self.query_stats.add('/teams', self._get_query_log(2, 1.0))
+		stats = self.query_stats.get_stats()
+		self.assertEqual(2, stats['/teams'].requests)
+		self.assertEqual(3, stats['/teams'].statements)
+
+	def test_log_request_queries(self):
+		views.set_query_stats(self.query_stats)
+		with app.test_request_context('/teams'):
+			views.log_request_queries(self._get_query_log(2, 1.0), flask.Response())
+
+		# Do not pretty-print, which reads a request attribute of an older Werkzeug.
+		app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+		try:
+			with app.test_request_context('/internal/query_stats',
+					environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+				response = views.query_stats()
+		finally:
+			app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+		routes = json.loads(response.data)['routes']
+		self.assertItemsEqual(['/teams'], routes.keys())
+		self.assertEqual(2, routes['/teams']['statements'])
+
+
+"""Tests for the viewer endpoint and the logged_in cookie that app.coffee reads
+before requesting it.
+"""
+class ViewerTestCase(DbTestCase):
+	def setUp(self):
+		DbTestCase.setUp(self)
+		steam_id, self.client_id, new_user = self._create_steam_user(
+				'client_name', 'client_indexed_name')
+		team1_id = db.add_team('team1', 'team1', 'game', 'division', 'team1')
+		team2_id = db.add_team('team2', 'team2', 'game', 'division', 'team2')
+		# The views list the matches after the current time.
+		self.match_id = db.add_match(team1_id, team2_id,
+				datetime.utcnow() + timedelta(days=1), 'game', 'division', 'match',
+				now=self.now)
+		db.add_star_match(self.client_id, self.match_id, now=self.now)
+		self.client = app.test_client()
+		# Do not pretty-print, which reads a request attribute of an older Werkzeug.
+		app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+		# Record the name of each rendered template instead of rendering it.
+		self.template_names = []
+		self._render_template = flask.render_template
+		flask.render_template = self._record_template
+
+	def tearDown(self):
+		flask.render_template = self._render_template
+		app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+		DbTestCase.tearDown(self)
+
+	def _record_template(self, template_name, **context):
+		self.template_names.append(template_name)
+		return ''
+
+	def _get_viewer(self):
+		"""Returns the viewer and the logged_in cookie set by the response, or None."""
+		response = self.client.get('/viewer')
+		self.assertEqual(200, response.status_code)
+		self.assertEqual('private, no-cache', response.headers['Cache-Control'])
+		cookies = [header for header in response.headers.getlist('Set-Cookie')
+				if header.startswith('logged_in=')]
+		return json.loads(response.data), (cookies[0] if cookies else None)
+
+	def test_viewer(self):
+		# Assert that a client that is not logged in gets no cookie.
+		viewer, cookie = self._get_viewer()
+		self.assertEqual({'logged_in': False}, viewer)
+		self.assertIsNone(cookie)
+
+		# Assert that a session created before the cookie existed gets the cookie.
+		with self.client.session_transaction() as session:
+			session['client'] = {
+				'id': self.client_id,
+				'name': 'client_name',
+				'auth': 'steam',
+				'time_format': db.DEFAULT_SETTINGS_TIME_FORMAT,
+			}
+		viewer, cookie = self._get_viewer()
+		self.assertTrue(viewer['logged_in'])
+		self.assertEqual('client_name', viewer['name'])
+		self.assertEqual('steam', viewer['auth'])
+		self.assertEqual(db.DEFAULT_SETTINGS_TIME_FORMAT, viewer['time_format'])
+		self.assertIsNone(viewer['time_zone'])
+		self.assertEqual({'match': [self.match_id], 'team': [], 'streamer': []},
+				viewer['starred'])
+		self.assertTrue(cookie.startswith('logged_in=1;'))
+		# Assert that the cookie is not set again.
+		viewer, cookie = self._get_viewer()
+		self.assertTrue(viewer['logged_in'])
+		self.assertIsNone(cookie)
+
+		# Assert that the cookie is deleted once the session is gone.
+		with self.client.session_transaction() as session:
+			session.pop('client')
+		viewer, cookie = self._get_viewer()
+		self.assertEqual({'logged_in': False}, viewer)
+		self.assertTrue(cookie.startswith('logged_in=;'))
+
+
+"""Tests that the views stay within their query budgets.
+
+The templates are not rendered, so that only the statements of each view are
+counted.
+"""
+class ViewsQueryBudgetTestCase(DbTestCase):
+	def setUp(self):
+		DbTestCase.setUp(self)
+		steam_id, self.client_id, new_user = self._create_steam_user(
+				'client_name', 'client_indexed_name')
+		self.twitch_id, self.streamer_id, new_user = self._create_twitch_user(
+				'streamer_name', 'streamer_indexed_name')
+		team1_id = db.add_team('team1', 'team1', 'game', 'division', 'team1')
+		team2_id = db.add_team('team2', 'team2', 'game', 'division', 'team2')
+		self.team_id = team1_id
+		# The views list the matches after the current time.
+		self.match_id = db.add_match(team1_id, team2_id,
+				datetime.utcnow() + timedelta(days=1), 'game', 'division', 'match',
+				now=self.now)
+		# Do not pretty-print, which reads a request attribute of an older Werkzeug.
+		app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+		# Record the name of each rendered template instead of rendering it.
+		self.template_names = []
+		self._render_template = flask.render_template
+		flask.render_template = self._record_template
+
+	def tearDown(self):
+		flask.render_template = self._render_template
+		app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+		DbTestCase.tearDown(self)
+
+	def _record_template(self, template_name, **context):
+		self.template_names.append(template_name)
+		return ''
+
+	def _call_view(self, path, view, *pargs, **kwargs):
+		"""Calls the view for the logged in client with empty caches, as the first
+		request of a worker does.
+		"""
+		method = 'POST' if 'data' in kwargs else 'GET'
+		with app.test_request_context(path, method=method, data=kwargs.pop('data', None)):
+			flask.session['client'] = {
+				'id': self.client_id,
+				'name': 'client_name',
+				'auth': 'steam',
+				'time_format': db.DEFAULT_SETTINGS_TIME_FORMAT,
+			}
+			db._reset_directories()
+			db.begin_request()
+			response, num_rows = self._call_within_budget(view, *pargs)
+		return response
+
+	def _call_json_view(self, path, view, *pargs, **kwargs):
+		"""Calls the view and returns its JSON response."""
+		response = self._call_view(path, view, *pargs, **kwargs)
+		self.assertEqual(200, response.status_code)
+		return json.loads(response.data)
+
+	def _call_page_view(self, path, view, *pargs, **kwargs):
+		"""Calls the view and returns the name of the template that it rendered."""
+		self.template_names = []
+		self._call_view(path, view, *pargs, **kwargs)
+		self.assertEqual(1, len(self.template_names))
+		return self.template_names[0]
+
+	def test_budgets(self):
+		for starred in ('true', 'false'):
+			self._call_json_view('/matches/%s' % self.match_id,
+					views.update_match_details, str(self.match_id), data={'starred': starred})
+			self._call_json_view('/teams/%s' % self.team_id,
+					views.update_team_details, str(self.team_id), data={'starred': starred})
+			self._call_json_view('/users/id/%s' % self.streamer_id,
+					views.update_streamer, self.streamer_id, data={'starred': starred})
+		db.add_star_match(self.client_id, self.match_id)
+		viewer = self._call_json_view('/viewer', views.viewer)
+		self.assertEqual([self.match_id], viewer['starred']['match'])
+
+	def test_budgets_queued_hybrid(self):
+		db._queue_calendar_entries = True
+		db._calendar_backend = db.HybridCalendarBackend(2)
+		try:
+			self.test_budgets()
+			# Remove the star that test_page_budgets adds again.
+			db.remove_star_match(self.client_id, self.match_id)
+			self.test_page_budgets()
+		finally:
+			db._queue_calendar_entries = False
+			db._calendar_backend = db.MaterializedCalendarBackend()
+
+	def test_page_budgets(self):
+		db.add_star_match(self.client_id, self.match_id)
+		db.add_star_team(self.client_id, self.team_id)
+		db.add_star_streamer(self.client_id, self.streamer_id)
+		db.add_stream_match(self.streamer_id, self.match_id)
+		# Add any queued CalendarEntries, so that the calendar is not empty.
+		db.process_calendar_jobs()
+		for path, view, pargs, template_name in (
+				('/guide/viewer', views.viewer_guide, (), 'calendar_viewer.html'),
+				('/guide/streamer', views.streamer_guide, (), 'calendar_streamer.html'),
+				('/starred/matches', views.starred_matches, (), 'matches_starred.html'),
+				('/starred/teams', views.starred_teams, (), 'teams_starred.html'),
+				('/starred/streamers', views.starred_streamers, (),
+					'streamers_starred.html'),
+				('/matches', views.all_matches, (), 'matches_all.html'),
+				('/teams', views.all_teams, (), 'teams_all.html'),
+				('/streamers', views.all_streamers, (), 'streamers_all.html'),
+				('/matches/%s' % self.match_id, views.match_details,
+					(str(self.match_id),), 'match.html'),
+				('/teams/%s' % self.team_id, views.team_details,
+					(str(self.team_id),), 'team.html'),
+				('/users/twitch/streamer_name', views.twitch_user_by_name,
+					('streamer_name',), 'streamer.html'),
+				('/users/twitch_id/%s' % self.twitch_id, views.twitch_user_by_id,
+					(str(self.twitch_id),), 'streamer.html'),
+				('/settings', views.get_settings, (), 'settings.html'),
+				('/privacy', views.privacy, (), 'privacy.html'),
+				('/terms', views.terms, (), 'terms.html'),
+				('/about', views.about, (), 'about.html')):
+			self.assertEqual(template_name, self._call_page_view(path, view, *pargs))
+		self.assertEqual('settings.html', self._call_page_view(
+				'/settings', views.save_settings, data={'time_format': '12_hour'}))
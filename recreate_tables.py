@@ -1,5 +1,6 @@
 import collections
 from datetime import datetime, timedelta
+import itertools
 from matchstreamguide import configure, db, views
 import pytz
 
@@ -33,15 +34,11 @@ _ESEA_TF2_INVITE_TEAMS = [
 	_VECTOR_GAMING,
 ]
 
-def _add_teams():
-	team_ids = {}
-	for invite_team in _ESEA_TF2_INVITE_TEAMS:
-		name, fingerprint = invite_team
+def _get_team_records():
+	for name, fingerprint in _ESEA_TF2_INVITE_TEAMS:
 		indexed_name = views._get_indexed_name(name)
-		team_id = db.add_team(
+		yield db.ScheduleTeam(
 				name, indexed_name, _TF2_GAME, _TF2_INVITE_DIVISION, fingerprint)
-		team_ids[fingerprint] = team_id
-	return team_ids
 
 
 _EseaMatch = collections.namedtuple(
@@ -52,15 +49,17 @@ _ESEA_TF2_INVITE_MATCHES = [
 	_EseaMatch(_CLASSIC_MIXUP, _DONT_TRIP, datetime(2013, 1, 18, 4, 0, 0), 'esea:3135189'),
 ]
 
-def _add_matches(team_ids):
-	match_ids = {}
+def _get_match_records():
 	for team1, team2, time, fingerprint in _ESEA_TF2_INVITE_MATCHES:
-		team1_id = team_ids[team1.fingerprint]
-		team2_id = team_ids[team2.fingerprint]
-		match_id = db.add_match(
-				team1_id, team2_id, time, _TF2_GAME, _TF2_INVITE_DIVISION, fingerprint)
-		match_ids[fingerprint] = match_id
-	return match_ids
+		yield db.ScheduleMatch(team1.fingerprint, team2.fingerprint,
+				time, _TF2_GAME, _TF2_INVITE_DIVISION, fingerprint)
+
+def _add_schedule():
+	counts = db.load_schedule(
+			itertools.chain(_get_team_records(), _get_match_records()))
+	match_ids = db.get_match_ids_by_fingerprint(
+			match.fingerprint for match in _ESEA_TF2_INVITE_MATCHES)
+	return counts, match_ids
 
 
 _TwitchStreamer = collections.namedtuple(
@@ -102,10 +101,8 @@ def _add_streamers(match_ids):
 def run():
 	_recreate_tables()
 
-	team_ids = _add_teams()
-	print 'Team IDs: %s' % team_ids
-
-	match_ids = _add_matches(team_ids)
+	counts, match_ids = _add_schedule()
+	print 'Schedule: %s' % counts
 	print 'Match IDs: %s' % match_ids
 
 	streamer_ids = _add_streamers(match_ids)
@@ -0,0 +1,3 @@
+from matchstreamguide import calendar_worker
+calendar_worker.run()
+
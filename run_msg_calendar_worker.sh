@@ -0,0 +1,3 @@
+export MSG_ENVIRONMENT=dev
+python ./run_msg_calendar_worker.py
+
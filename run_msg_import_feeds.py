@@ -0,0 +1,2 @@
+from matchstreamguide import league_feeds
+league_feeds.main()
@@ -0,0 +1,2 @@
+export MSG_ENVIRONMENT=dev
+python ./run_msg_import_feeds.py "$@"
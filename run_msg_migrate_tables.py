@@ -0,0 +1,2 @@
+from matchstreamguide import db
+db.migrate_tables()
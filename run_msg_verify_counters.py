@@ -0,0 +1,3 @@
+from matchstreamguide import verify_counters
+verify_counters.main()
+
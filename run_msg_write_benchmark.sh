@@ -0,0 +1,2 @@
+export MSG_ENVIRONMENT=test
+python -m matchstreamguide.benchmarks.write_paths "$@"
@@ -1,4 +1,6 @@
 from datetime import datetime
+import itertools
+import operator
 import re
 import sqlalchemy as sa
 import sqlalchemy.engine as sa_engine
@@ -24,6 +26,66 @@ class DbException(Exception):
 		raise DbException(exception_value), None, traceback
 
 
+def _create_record_init(cls, fields):
+	"""Returns a constructor that sets each of the given fields of the record class
+	in order.
+	"""
+	lines = []
+	namespace = {}
+	for i, name in enumerate(fields):
+		# Set each field through its slot, because __setattr__ raises.
+		namespace['_set_%s' % i] = cls.__dict__[name].__set__
+		lines.append('\t_set_%s(self, %s)' % (i, name))
+	source = 'def __init__(%s):\n%s\n' % (
+			', '.join(('self',) + fields), '\n'.join(lines) or '\tpass')
+	exec source in namespace
+	return namespace['__init__']
+
+"""The metaclass of DisplayedRecord, which generates the constructor of each
+record class.
+"""
+class _DisplayedRecordType(type):
+	def __init__(cls, name, bases, namespace):
+		type.__init__(cls, name, bases, namespace)
+		cls.__init__ = _create_record_init(cls, cls.__slots__)
+
+"""The base class for an immutable record of displayed values.
+
+A subclass names its attributes in __slots__. The constructor takes their values
+in that order, and is generated so that it sets each attribute directly.
+"""
+class DisplayedRecord(object):
+	__metaclass__ = _DisplayedRecordType
+	__slots__ = ()
+
+	def get_values(self):
+		"""Returns the values of the fields of this record, in order."""
+		return operator.attrgetter(*self.__slots__)(self)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('%s is immutable' % type(self).__name__)
+
+	def __delattr__(self, name):
+		raise AttributeError('%s is immutable' % type(self).__name__)
+
+	def __eq__(self, other):
+		return (type(self) is type(other)) and (self.get_values() == other.get_values())
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __hash__(self):
+		return hash(self.get_values())
+
+	def __reduce__(self):
+		return (type(self), self.get_values())
+
+	def __repr__(self):
+		return '%s(%s)' % (type(self).__name__, ', '.join(
+				'%s=%r' % (name, value)
+				for name, value in itertools.izip(self.__slots__, self.get_values())))
+
+
 def get_engine(testing=True):
 	if testing:
 		return sa.create_engine('sqlite:///:memory:', echo=False)
@@ -758,32 +820,9 @@ class DisplayedPlaylist:
 
 """Data for displaying a bookmark on a playlist page.
 """
-class DisplayedPlaylistBookmark:
-	def __init__(self, id, num_thumbs_up, num_thumbs_down, user_vote, video_title, comment, time_added, author_name, author_image_url_small, author_url):
-		self.id = id
-		self.num_thumbs_up = num_thumbs_up
-		self.num_thumbs_down = num_thumbs_down
-		self.user_vote = user_vote
-		self.video_title = video_title
-		self.comment = comment
-		self.time_added = time_added
-		# The author's info.
-		self.author_name = author_name
-		self.author_image_url_small = author_image_url_small
-		self.author_url = author_url
-	
-	def __repr__(self):
-		return 'DisplayedPlaylistBookmark(id=%r, num_thumbs_up=%r, num_thumbs_down=%r, user_vote=%r, video_title=%r, comment=%r, time_added=%r, author_name=%r, author_image_url_small=%r, author_url=%r)' % (
-				self.id,
-				self.num_thumbs_up,
-				self.num_thumbs_down,
-				self.user_vote,
-				self.video_title,
-				self.comment,
-				self.time_added,
-				self.author_name,
-				self.author_image_url_small,
-				self.author_url)
+class DisplayedPlaylistBookmark(DisplayedRecord):
+	__slots__ = ('id', 'num_thumbs_up', 'num_thumbs_down', 'user_vote', 'video_title',
+			'comment', 'time_added', 'author_name', 'author_image_url_small', 'author_url')
 
 
 """Returns the DisplayedPlaylist with the given identifier.
@@ -1101,35 +1140,10 @@ class DisplayedTwitchVideo(DisplayedVideo):
 
 """Data for displaying a bookmark on a video page.
 """
-class DisplayedVideoBookmark:
-	def __init__(self, id, num_thumbs_up, num_thumbs_down, user_vote, comment, time, time_created,
-			author_name, author_image_url_small, author_url):
-		self.id = id
-		self.num_thumbs_up = num_thumbs_up
-		self.num_thumbs_down = num_thumbs_down
-		self.user_vote = user_vote
-		self.comment = comment
-		# The bookmarked time.
-		self.time = time
-		# The time to bookmark was created.
-		self.time_created = time_created
-		# The author's info.
-		self.author_name = author_name
-		self.author_image_url_small = author_image_url_small
-		self.author_url = author_url
-
-	def __repr__(self):
-		return 'DisplayedBookmark(id=%r, num_thumbs_up=%r, num_thumbs_down=%r, user_vote=%r, comment=%r, time=%r, time_created=%r, author_name=%r, author_image_url_small=%r, author_url)' % (
-				self.id,
-				self.num_thumbs_up,
-				self.num_thumbs_down,
-				self.user_vote,
-				self.comment,
-				self.time,
-				self.time_created,
-				self.author_name,
-				self.author_image_url_small,
-				self.author_url)
+class DisplayedVideoBookmark(DisplayedRecord):
+	# The time is the bookmarked time, and time_created is when it was created.
+	__slots__ = ('id', 'num_thumbs_up', 'num_thumbs_down', 'user_vote', 'comment',
+			'time', 'time_created', 'author_name', 'author_image_url_small', 'author_url')
 
 
 """Returns the DisplayedVideo with the given identifier.
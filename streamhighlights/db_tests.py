@@ -1,5 +1,6 @@
 from datetime import timedelta
 import db
+import pickle
 from db_test_case import DbTestCase
 import sqlalchemy.orm as sa_orm
 import unittest
@@ -1828,6 +1829,17 @@ class TestBookmarksDb(DbTestCase):
 				author_url=self._get_steam_user_url(user_steam_id))
 
 
+	"""Test that displayed bookmarks are immutable records.
+	"""
+	def test_displayed_bookmark_record(self):
+		bookmark = db.DisplayedVideoBookmark(1, 2, 3, None, 'comment', 4, self.now,
+				'author_name', None, 'author_url')
+		self.assertEqual(bookmark, pickle.loads(pickle.dumps(bookmark)))
+		self.assertNotEqual(db.DisplayedVideoBookmark(1, 2, 3, None, 'comment', 5,
+				self.now, 'author_name', None, 'author_url'), bookmark)
+		with self.assertRaises(AttributeError):
+			bookmark.comment = 'updated_comment'
+
 if __name__ == '__main__':
 	unittest.main()
 